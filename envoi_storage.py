@@ -5,18 +5,68 @@
 
 import argparse
 # Used to parse command-line arguments.
+import asyncio
+# Async entry points of the library API (StorageDeployer.deploy_async).
 import base64
 # For encoding API tokens in Base64 for HTTP authentication.
+import collections
+# Ordered dictionaries and counters for caches and statistics.
+import concurrent.futures
+# Thread pools used to fan out filesystem and API work across many workers.
+import configparser
+# Reads the OCI CLI/SDK configuration file (~/.oci/config).
+import contextlib
+# Context managers for optional profiling and latency spans.
+import copy
+# Copies the cached argument defaults of the library API's deployment configurations.
+import cProfile
+# Deterministic profiling of a whole command run (--profile-output).
+import dataclasses
+# Typed configuration and result objects of the library API.
+import datetime
+# Expiry times of the cached assume-role credentials.
+import email.utils
+# Formats RFC 1123 dates for signed OCI requests.
+import getpass
+# Reads passwords at interactive prompts without echoing them.
+import glob
+# Expands shell-style file patterns given on the command line.
+import hashlib
+# Content hashes for request signing, part checksums and content-addressed keys.
 import http.client
 # A low-level client for making HTTP requests, used by the WekaApiClient.
+import http.server
+# The HTTP front end of the `serve` job service.
 import json
 # For handling JSON data, specifically parsing API responses and formatting request bodies.
 import logging
 # A standard library for logging messages and debugging.
 import os
 # Provides a way of using operating system dependent functionality, though not extensively used here.
+import pstats
+# Merges the cProfile data of every thread into one pstats file.
+import queue
+# The priority queue of the `serve` job service.
+import random
+# Seeded pseudo-random generators for deterministic synthetic datasets.
+import re
+# Regular expressions for parsing human-readable sizes.
+import secrets
+# Generates the job service's access token and compares tokens in constant time.
+import socket
+# TCP connects used to probe whether storage services are accepting connections.
+import socketserver
+# Threaded Unix socket server for `serve --socket`.
+import sqlite3
+# The deployment journal that lets interrupted rollouts resume.
+import subprocess
+# Runs external utilities such as `lfs` on Lustre clients.
 import sys
 # Provides access to system-specific parameters and functions, used for handling missing dependencies.
+import threading
+# Locks and events used to coordinate worker threads.
+import time
+# Monotonic clocks for rate limiting and progress reporting.
 import urllib.parse
 # For encoding URL query parameters.
 from types import SimpleNamespace
@@ -25,13 +75,39 @@ from types import SimpleNamespace
 try:
     # noinspection PyUnresolvedReferences
     import boto3
+    # noinspection PyUnresolvedReferences
+    import botocore.config
+    # noinspection PyUnresolvedReferences
+    import botocore.credentials
+    # noinspection PyUnresolvedReferences
+    import botocore.paginate
+    # noinspection PyUnresolvedReferences
+    import botocore.session
 # This is the AWS SDK for Python, essential for interacting with AWS services like CloudFormation.
+# botocore comes with boto3. It refreshes the credentials of assumed roles, turns off its own retries and encodes
+# the starting tokens of resumed paginations.
 except ImportError:
     if __name__ == '__main__':
         # Checks if the script is being run directly.
         print("Missing dependency boto3. Try running 'pip install boto3'")
         sys.exit(1)
     # The script exits with an error if the boto3 library is not installed.
+    botocore = None
+
+try:
+    # noinspection PyUnresolvedReferences
+    from cryptography.hazmat.primitives import hashes, serialization
+    # noinspection PyUnresolvedReferences
+    from cryptography.hazmat.primitives.asymmetric import padding
+# Used to sign OCI API requests with an API key. Only the OCI commands need it, so it is optional.
+except ImportError:
+    serialization = None
+
+try:
+    import fcntl
+# Locks the discovery cache file while its entries are merged. Windows has no fcntl; saves are then unlocked.
+except ImportError:
+    fcntl = None
 
 LOG = logging.getLogger(__name__)
 # Initializes a logger object for the current module.
@@ -46,6 +122,34 @@ def add_from_namespace_to_dict_if_not_none(source_obj, source_key, target_obj, t
             target_obj[target_key] = value
 
 
+SIZE_UNITS = {
+    '': 1, 'b': 1,
+    'k': 1000, 'kb': 1000, 'kib': 1024,
+    'm': 1000 ** 2, 'mb': 1000 ** 2, 'mib': 1024 ** 2,
+    'g': 1000 ** 3, 'gb': 1000 ** 3, 'gib': 1024 ** 3,
+    't': 1000 ** 4, 'tb': 1000 ** 4, 'tib': 1024 ** 4,
+}
+
+
+def parse_size(value):
+    # Converts a human-readable size such as "512KiB", "12MB" or "1.5GiB" into a number of bytes.
+    # Integers and floats are returned as whole bytes unchanged.
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([a-zA-Z]*)\s*', str(value))
+    if match is None or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size: {value!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def format_size(num_bytes):
+    # Formats a byte count using binary units for log and summary output.
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(num_bytes) < 1024 or unit == 'TiB':
+            return f"{num_bytes:,.1f}{unit}" if unit != 'B' else f"{int(num_bytes)}B"
+        num_bytes /= 1024
+
+
 class CustomFormatter(argparse.RawDescriptionHelpFormatter, argparse.ArgumentDefaultsHelpFormatter):
     # This class customizes the help output of the argument parser.
     # It allows newlines in the help text and shows default values for arguments.
@@ -55,6 +159,720 @@ class CustomFormatter(argparse.RawDescriptionHelpFormatter, argparse.ArgumentDef
         return text.splitlines()
 
 
+class TokenBucket:
+    # A thread-safe token bucket used to cap the rate of operations shared by many worker threads.
+    # A rate of 0 (or None) disables limiting entirely.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1.0))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        # Adds the tokens accrued since the last refill, never exceeding the bucket capacity.
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def acquire(self, tokens=1):
+        # Blocks until the requested number of tokens is available, then consumes them.
+        # Requests larger than the capacity are allowed to drive the bucket negative so they never deadlock.
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    return
+                wait = (min(tokens, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    # A token bucket whose rate adapts with AIMD: every success adds a little to the rate and every throttling
+    # response halves it, so callers converge on the highest rate the service sustains.
+
+    def __init__(self, rate, min_rate=0.5, max_rate=None, increase=0.1, decrease=0.5):
+        super().__init__(rate, capacity=1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or float('inf')
+        self.increase = increase
+        self.decrease = decrease
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = min(max(rate, self.min_rate), self.max_rate)
+            # A burst never exceeds about one second of calls at the current rate.
+            self.capacity = max(self.rate, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+        return self.rate
+
+    def on_success(self):
+        return self.set_rate(self.rate + self.increase)
+
+    def on_throttle(self):
+        return self.set_rate(self.rate * self.decrease)
+
+
+class ProgressReporter:
+    # Periodically writes a one-line progress summary to stderr from a background thread.
+    # Workers only increment counters, so reporting never slows down the hot path.
+
+    def __init__(self, label, interval=5.0, stream=None):
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, name, amount=1):
+        # Increments a named counter.
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def format_line(self):
+        # Builds the progress line, including a per-second rate for every counter.
+        elapsed = max(self.elapsed(), 1e-9)
+        with self.lock:
+            counters = dict(self.counters)
+        parts = [f"{name}={value:,} ({value / elapsed:,.0f}/s)" for name, value in counters.items()]
+        return f"{self.label}: {' '.join(parts) or 'starting'} elapsed={elapsed:.1f}s"
+
+    def _report_loop(self):
+        while not self.stop_event.wait(self.interval):
+            print(self.format_line(), file=self.stream, flush=True)
+
+    def start(self):
+        # Starts the background reporting thread. An interval of 0 disables periodic output.
+        self.started_at = time.monotonic()
+        if self.interval and self.interval > 0:
+            self.thread = threading.Thread(target=self._report_loop, name=f"{self.label}-progress", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class LatencyRecorder:
+    # Records a latency span for every API call (boto3 operations and Weka API requests) while enabled.
+    # Spans can be written out as JSON lines and summarised per operation with p50/p95/max latencies.
+    # Memory stays bounded however long the process runs: only the latest `max_spans` spans are kept for the JSON
+    # lines, and each operation keeps its count, errors and max plus the latest `max_samples` durations for the
+    # percentiles.
+
+    def __init__(self, enabled=False, max_spans=50000, max_samples=10000):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.spans = collections.deque(maxlen=max_spans)
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, started_at, duration, status='ok', **attributes):
+        if not self.enabled:
+            return
+        span = {'name': name, 'start': started_at, 'duration': duration, 'status': status,
+                'thread': threading.current_thread().name, **attributes}
+        with self.lock:
+            self.spans.append(span)
+            operation = self.operations.get(name)
+            if operation is None:
+                operation = self.operations[name] = {'count': 0, 'errors': 0, 'max': 0.0,
+                                                     'durations': collections.deque(maxlen=self.max_samples)}
+            operation['count'] += 1
+            operation['errors'] += status != 'ok'
+            operation['max'] = max(operation['max'], duration)
+            operation['durations'].append(duration)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            yield
+            return
+        started_at, start = time.time(), time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.record(name, started_at, time.perf_counter() - start, status, **attributes)
+
+    def instrument_boto_client(self, client):
+        # Times every operation of a boto3 client through botocore's before-call/after-call events. The span covers
+        # sending the request, botocore's own retries and parsing the response.
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return client
+
+        def before_call(model, context, **kwargs):
+            context['envoi_span'] = (f"{model.service_model.service_name}.{model.name}", time.time(),
+                                     time.perf_counter())
+
+        def after_call(http_response, context, **kwargs):
+            self.finish_boto_span(context, 'ok' if http_response.status_code < 300 else 'error',
+                                  http_status=http_response.status_code)
+
+        def after_call_error(exception, context, **kwargs):
+            self.finish_boto_span(context, 'error', error=type(exception).__name__)
+
+        events.register('before-call', before_call)
+        events.register('after-call', after_call)
+        events.register('after-call-error', after_call_error)
+        return client
+
+    def finish_boto_span(self, context, status, **attributes):
+        name, started_at, start = context.pop('envoi_span', (None, None, None))
+        if name is not None:
+            self.record(name, started_at, time.perf_counter() - start, status, **attributes)
+
+    def write_jsonl(self, path):
+        with self.lock:
+            spans = list(self.spans)
+        with open(path, 'w') as f:
+            for span in spans:
+                f.write(json.dumps(span) + '\n')
+        return len(spans)
+
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        # Nearest-rank percentile of an already sorted list.
+        return sorted_values[max(0, int(-(-len(sorted_values) * fraction // 1)) - 1)]
+
+    def summary(self):
+        # Returns a table with the call count and p50/p95/max latency (in milliseconds) of every operation. The
+        # percentiles are those of the operation's latest durations.
+        with self.lock:
+            operations = {name: (operation['count'], operation['errors'], operation['max'],
+                                 sorted(duration * 1000 for duration in operation['durations']))
+                          for name, operation in self.operations.items()}
+        width = max([len(name) for name in operations] + [len('operation')])
+        lines = [f"{'operation':<{width}} {'count':>7} {'errors':>7} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}"]
+        for name, (count, errors, longest, durations) in sorted(operations.items()):
+            lines.append(f"{name:<{width}} {count:>7,} {errors:>7,} "
+                         f"{self.percentile(durations, 0.5):>10.1f} {self.percentile(durations, 0.95):>10.1f} "
+                         f"{longest * 1000:>10.1f}")
+        return '\n'.join(lines)
+
+
+API_LATENCY = LatencyRecorder()
+# The recorder every AWS client and WekaApiClient reports to. It only keeps spans once enabled (--trace-output).
+
+
+class StackSampler:
+    # A sampling profiler: a background thread records the call stack of every other thread at a fixed interval.
+    # Stacks are written in the collapsed format ("thread;outer;inner count") read by flamegraph.pl and speedscope.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_label(frame))
+                frame = frame.f_back
+            self.counts[';'.join([names.get(ident, str(ident)), *reversed(stack)])] += 1
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._sample_loop, name='stack-sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class ThreadProfiler:
+    # Profiles the calling thread and every thread started while it runs with cProfile, and merges their stats.
+    # Before Python 3.12 a cProfile profiler only sees the thread that enabled it, so each new thread enables its own
+    # from a threading.setprofile hook. From 3.12 cProfile uses sys.monitoring, which already covers every thread.
+    # Threads that were running before start() are not profiled before 3.12.
+
+    per_thread = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.profilers = []
+        self.lock = threading.Lock()
+
+    def add_profiler(self):
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+        return profiler
+
+    def profile_thread(self, frame, event, arg):
+        # Runs on the first profiling event of a new thread and hands the thread over to its own profiler.
+        sys.setprofile(None)
+        self.add_profiler()
+
+    def start(self):
+        self.add_profiler()
+        if self.per_thread:
+            threading.setprofile(self.profile_thread)
+        return self
+
+    def stop(self):
+        if self.per_thread:
+            threading.setprofile(None)
+        self.profilers[0].disable()
+
+    def write(self, path):
+        with self.lock:
+            profilers = list(self.profilers)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+
+@contextlib.contextmanager
+def profile_command(output_path=None, mode='cprofile', sample_interval=0.005):
+    # Runs the body under cProfile in every thread (pstats output, e.g. for snakeviz) or the StackSampler (collapsed
+    # stacks for a flamegraph) and writes the result to output_path. Without an output path nothing is profiled.
+    if not output_path:
+        yield
+        return
+    if mode == 'sample':
+        profiler = StackSampler(interval=sample_interval).start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            profiler.write(output_path)
+    else:
+        profiler = ThreadProfiler().start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            profiler.write(output_path)
+    LOG.info(f"Wrote {mode} profile to {output_path}")
+
+
+class AssumeRoleCredentialCache:
+    # Assumes chains of IAM roles (each role assumed with the credentials of the one before it, starting from a
+    # profile) and caches the temporary credentials in memory and in credentials.json in the cache directory
+    # (readable by the owner only), so every thread and later runs share them. Credentials are assumed again
+    # `refresh_margin` seconds before they expire, and only one thread assumes a given chain at a time: a fleet
+    # operation over 20 accounts makes 20 STS calls, however many stacks and polls it runs. Entries are keyed by
+    # the access key ID the profile resolves to as well as its name, so a profile whose credentials now belong to
+    # someone else doesn't get the roles the previous identity assumed.
+
+    def __init__(self, path=None, duration_seconds=3600, refresh_margin=900, sts_client_factory=None,
+                 source_identity_factory=None):
+        self.path = path
+        self.duration_seconds = duration_seconds
+        # botocore refreshes credentials 15 minutes before they expire, so cached ones must last longer than that.
+        self.refresh_margin = refresh_margin
+        self.sts_client_factory = sts_client_factory or self.sts_client
+        self.source_identity_factory = source_identity_factory or self.profile_access_key_id
+        self.source_identities = {}
+        self.entries = None
+        self.lock = threading.Lock()
+        self.chain_locks = collections.defaultdict(threading.Lock)
+
+    @staticmethod
+    def make_key(profile, source_identity, role_arns, session_name):
+        return '|'.join([profile or 'default', source_identity, session_name, *role_arns])
+
+    @staticmethod
+    def profile_access_key_id(profile):
+        # Resolving the profile's credentials makes no STS call.
+        credentials = boto3.Session(profile_name=profile).get_credentials()
+        return credentials.access_key if credentials is not None else 'anonymous'
+
+    def source_identity(self, profile):
+        # Each profile is resolved once per process.
+        with self.lock:
+            identity = self.source_identities.get(profile)
+        if identity is None:
+            identity = self.source_identity_factory(profile)
+            with self.lock:
+                identity = self.source_identities.setdefault(profile, identity)
+        return identity
+
+    def file_path(self):
+        return self.path or os.path.join(envoi_cache_dir(), 'credentials.json')
+
+    def load(self):
+        try:
+            with open(self.file_path(), 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {key: entry for key, entry in entries.items() if entry['Expiration'] > time.time()}
+
+    def save(self, key):
+        # Re-reads the file under an exclusive lock and adds this process's new entry to it, so credentials other
+        # processes assumed in the meantime are kept. The file holds secrets, so it is created readable by the owner
+        # only.
+        path = self.file_path()
+        with open(f"{path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            entries = {**self.load(), key: self.entries[key]}
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, path)
+        self.entries = entries
+
+    def cached(self, key):
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            entry = self.entries.get(key)
+        if entry is not None and entry['Expiration'] - self.refresh_margin > time.time():
+            return entry
+        return None
+
+    @staticmethod
+    def sts_client(profile, credentials, region=None):
+        client_args = throttled_client_args({'region_name': region})
+        if credentials is not None:
+            return boto3.client('sts', aws_access_key_id=credentials['AccessKeyId'],
+                                aws_secret_access_key=credentials['SecretAccessKey'],
+                                aws_session_token=credentials['SessionToken'], **client_args)
+        return boto3.Session(profile_name=profile).client('sts', **client_args)
+
+    def credentials(self, profile, role_arns, region=None, session_name='envoi-storage'):
+        # Returns the credentials of the last role in the chain. Every link is cached, so chains that start with
+        # the same roles share those STS calls too.
+        key = self.make_key(profile, self.source_identity(profile), role_arns, session_name)
+        entry = self.cached(key)
+        if entry is not None:
+            return entry
+        with self.lock:
+            chain_lock = self.chain_locks[key]
+        with chain_lock:
+            # Another thread may have assumed the chain while this one waited.
+            entry = self.cached(key)
+            if entry is not None:
+                return entry
+            source = self.credentials(profile, role_arns[:-1], region, session_name) if len(role_arns) > 1 else None
+            # STS calls are rate limited and timed like those of every other client, under the caller's identity.
+            sts = AwsThrottledClient(self.sts_client_factory(profile, source, region), 'sts', region=region,
+                                     profile=role_arns[-2] if len(role_arns) > 1 else profile)
+            LOG.debug(f"Assuming role {role_arns[-1]}")
+            credentials = sts.assume_role(RoleArn=role_arns[-1], RoleSessionName=session_name,
+                                          DurationSeconds=self.duration_seconds)['Credentials']
+            entry = {'AccessKeyId': credentials['AccessKeyId'], 'SecretAccessKey': credentials['SecretAccessKey'],
+                     'SessionToken': credentials['SessionToken'],
+                     'Expiration': credentials['Expiration'].timestamp()}
+            with self.lock:
+                self.entries[key] = entry
+                self.save(key)
+            return entry
+
+    def session(self, profile, role_arns, region=None, session_name='envoi-storage'):
+        # Returns a boto3 session for the last role in the chain. Its credentials come from this cache and refresh
+        # themselves, so long-lived clients (the job service, pool maintenance) keep working past the expiry.
+        def refresh():
+            entry = self.credentials(profile, role_arns, region, session_name)
+            return {'access_key': entry['AccessKeyId'], 'secret_key': entry['SecretAccessKey'],
+                    'token': entry['SessionToken'],
+                    'expiry_time': datetime.datetime.fromtimestamp(entry['Expiration'],
+                                                                   datetime.timezone.utc).isoformat()}
+
+        botocore_session = botocore.session.get_session()
+        # noinspection PyProtectedMember
+        botocore_session._credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+            refresh(), refresh, 'assume-role')
+        return boto3.Session(botocore_session=botocore_session, region_name=region)
+
+
+AWS_ROLE_CREDENTIALS = AssumeRoleCredentialCache()
+# The role credentials shared by every AWS client the tool creates with --aws-role-arn.
+
+
+def aws_role_opts(opts):
+    # Returns the role chain, STS session name and the label used in place of a profile for the options, or
+    # (None, None, None) without --aws-role-arn.
+    role_arns = getattr(opts, 'aws_role_arn', None)
+    if not role_arns:
+        return None, None, None
+    return role_arns, getattr(opts, 'aws_role_session_name', None) or 'envoi-storage', role_arns[-1]
+
+
+def aws_session_from_opts(opts=None):
+    # Creates a boto3 session for the AWS profile in the command-line options (or the default session).
+    if opts is None:
+        opts = SimpleNamespace()
+    session_args = {}
+    add_from_namespace_to_dict_if_not_none(opts, 'aws_profile', session_args, 'profile_name')
+    add_from_namespace_to_dict_if_not_none(opts, 'aws_region', session_args, 'region_name')
+    role_arns, session_name, _ = aws_role_opts(opts)
+    if role_arns:
+        return AWS_ROLE_CREDENTIALS.session(session_args.get('profile_name'), role_arns,
+                                            region=session_args.get('region_name'), session_name=session_name)
+    return boto3.Session(**session_args)
+
+
+def aws_client_from_opts(service_name, client_args=None, opts=None):
+    # Creates a boto3 client for any AWS service.
+    # It handles optional AWS profile, region and endpoint settings from the command-line options.
+    # The endpoint override lets every command be pointed at a local AWS stand-in for testing.
+    if client_args is None:
+        client_args = {}
+
+    if opts is None:
+        opts = SimpleNamespace()
+
+    session_args = {}
+    # Populates session arguments for boto3.Session if an AWS profile is specified.
+    add_from_namespace_to_dict_if_not_none(opts, 'aws_profile', session_args, 'profile_name')
+    # Populates client arguments if an AWS region or endpoint is specified.
+    add_from_namespace_to_dict_if_not_none(opts, 'aws_region', client_args, 'region_name')
+    add_from_namespace_to_dict_if_not_none(opts, 'aws_endpoint_url', client_args, 'endpoint_url')
+
+    # With --aws-role-arn, clients use the cached credentials of the role chain, and each role gets its own rates.
+    role_arns, session_name, profile = aws_role_opts(opts)
+    if role_arns:
+        client_parent = AWS_ROLE_CREDENTIALS.session(session_args.get('profile_name'), role_arns,
+                                                     region=client_args.get('region_name'), session_name=session_name)
+    elif len(session_args) != 0:
+        client_parent = boto3.Session(**session_args)
+    else:
+        client_parent = boto3
+
+    client = client_parent.client(service_name, **throttled_client_args(client_args))
+    return AwsThrottledClient(client, service_name, profile=profile or session_args.get('profile_name'))
+
+
+def throttled_client_args(client_args):
+    # Clients wrapped in AwsThrottledClient make one attempt per call. Otherwise botocore would retry throttled
+    # calls itself, out of sight of the rate limiter, which then retries each failed call again on top.
+    if botocore is None:
+        return client_args
+    single_attempt = botocore.config.Config(retries={'total_max_attempts': 1, 'mode': 'standard'})
+    config = client_args.get('config')
+    return {**client_args, 'config': config.merge(single_attempt) if config is not None else single_attempt}
+
+
+def aws_error_code(error):
+    # Returns the AWS error code of a botocore ClientError (e.g. "404", "Throttling"), or None for other errors.
+    return (getattr(error, 'response', None) or {}).get('Error', {}).get('Code')
+
+
+class AwsRateLimiter:
+    # Shares an AdaptiveTokenBucket between every thread calling the same API in the same account and region,
+    # keyed by (profile, region, service, operation). Calls that are throttled slow that API down and are retried
+    # with full-jitter exponential backoff; other errors are raised straight away.
+
+    THROTTLING_ERROR_CODES = frozenset([
+        'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+        'TooManyRequestsException', 'RequestLimitExceeded', 'BandwidthLimitExceeded', 'SlowDown',
+        'ProvisionedThroughputExceededException', 'PriorRequestNotComplete', 'EC2ThrottledException',
+    ])
+    TRANSIENT_ERROR_CODES = frozenset(['InternalError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout'])
+
+    def __init__(self, initial_rate=10.0, min_rate=0.5, max_rate=100.0, max_attempts=8, backoff_base=0.5,
+                 backoff_cap=20.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = AdaptiveTokenBucket(self.initial_rate, min_rate=self.min_rate,
+                                                        max_rate=self.max_rate)
+            return self.buckets[key]
+
+    def rates(self):
+        # Returns the current rate of every API seen so far, e.g. for debug logging after a fleet operation.
+        with self.lock:
+            return {key: bucket.rate for key, bucket in self.buckets.items()}
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def call(self, key, func, *args, **kwargs):
+        bucket = self.bucket(key)
+        for attempt in range(self.max_attempts):
+            bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                code = aws_error_code(e)
+                if code in self.THROTTLING_ERROR_CODES:
+                    rate = bucket.on_throttle()
+                    LOG.debug(f"{'/'.join(str(part) for part in key)} throttled, rate now {rate:.2f}/s")
+                elif code not in self.TRANSIENT_ERROR_CODES:
+                    raise
+                if attempt == self.max_attempts - 1:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            bucket.on_success()
+            return result
+
+
+AWS_RATE_LIMITER = AwsRateLimiter()
+# The limiter shared by every AWS client the tool creates, so concurrent commands in one process share each API's rate.
+
+
+class AwsThrottledClient:
+    # Wraps a boto3 client so every API call goes through an AwsRateLimiter.
+    # Paginated calls take a token per page, feed back throttling and retry a failed page where they left off.
+
+    untracked_methods = frozenset(['can_paginate', 'close', 'generate_presigned_post', 'generate_presigned_url',
+                                   'get_waiter'])
+
+    def __init__(self, client, service_name, region=None, profile=None, limiter=None):
+        self.client = API_LATENCY.instrument_boto_client(client)
+        self.service_name = service_name
+        self.region = region or getattr(getattr(client, 'meta', None), 'region_name', None)
+        self.profile = profile or 'default'
+        self.limiter = limiter or AWS_RATE_LIMITER
+
+    def key(self, operation_name):
+        return self.profile, self.region or 'global', self.service_name, operation_name
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name == 'get_paginator':
+            return lambda operation_name: ThrottledPaginator(attr(operation_name), self.limiter,
+                                                             self.key(operation_name))
+        if not callable(attr) or name.startswith('_') or name in self.untracked_methods:
+            return attr
+        return lambda *args, **kwargs: self.limiter.call(self.key(name), attr, *args, **kwargs)
+
+
+class ThrottledPaginator:
+
+    def __init__(self, paginator, limiter, key):
+        self.paginator = paginator
+        self.limiter = limiter
+        self.key = key
+
+    def paginate(self, **kwargs):
+        # Retries a throttled or failed page like AwsRateLimiter.call retries a call. botocore's page iterators stop
+        # at the first error, so the listing is started again from the NextToken of the last page returned. APIs
+        # paged by markers instead of NextToken can only be retried before their first page.
+        bucket = self.limiter.bucket(self.key)
+        pages = iter(self.paginator.paginate(**kwargs))
+        next_token, started, attempt = None, False, 0
+        while True:
+            bucket.acquire()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception as e:
+                code = aws_error_code(e)
+                if code in self.limiter.THROTTLING_ERROR_CODES:
+                    bucket.on_throttle()
+                elif code not in self.limiter.TRANSIENT_ERROR_CODES:
+                    raise
+                if attempt == self.limiter.max_attempts - 1 or (started and next_token is None):
+                    raise
+                time.sleep(self.limiter.backoff(attempt))
+                attempt += 1
+                pages = iter(self.paginator.paginate(**self.resume_kwargs(kwargs, next_token)))
+                continue
+            bucket.on_success()
+            next_token, started, attempt = page.get('NextToken'), True, 0
+            yield page
+
+    @staticmethod
+    def resume_kwargs(kwargs, next_token):
+        # botocore takes the service's NextToken back as an encoded StartingToken.
+        if next_token is None:
+            return kwargs
+        if botocore is not None:
+            next_token = botocore.paginate.TokenEncoder().encode({'NextToken': next_token})
+        return {**kwargs, 'PaginationConfig': {**kwargs.get('PaginationConfig', {}), 'StartingToken': next_token}}
+
+
+def add_aws_arguments(parser):
+    # Adds the AWS connection arguments shared by the AWS commands.
+    parser.add_argument('--aws-region', type=str, required=False,
+                        default=argparse.SUPPRESS,
+                        help='AWS region. (defaults to the value from the AWS_DEFAULT_REGION environment variable)')
+    parser.add_argument('--aws-profile', type=str, required=False,
+                        default=argparse.SUPPRESS,
+                        help='AWS profile. (defaults to the value from the AWS_PROFILE environment variable)')
+    parser.add_argument('--aws-endpoint-url', type=str, required=False,
+                        default=argparse.SUPPRESS,
+                        help='Override the AWS API endpoint, e.g. to use a local AWS stand-in')
+    return add_aws_role_arguments(parser)
+
+
+def add_aws_role_arguments(parser):
+    # Adds the arguments for deploying into another account through a chain of assumed roles.
+    parser.add_argument('--aws-role-arn', type=str, action='append', required=False,
+                        default=argparse.SUPPRESS,
+                        help='Assume this IAM role (repeat for a chain, each role assumed from the one before). '
+                             'Credentials are cached until shortly before they expire')
+    parser.add_argument('--aws-role-session-name', type=str, required=False,
+                        default=argparse.SUPPRESS,
+                        help='STS session name used when assuming roles (default: envoi-storage)')
+    return parser
+
+
+def add_create_wait_arguments(parser):
+    # Adds the arguments of create commands that can wait for their stack.
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait until the stack is created, showing an ETA from earlier creates, and add its '
+                             'timings to the history')
+    parser.add_argument('--poll-interval', type=float, default=15,
+                        help='Seconds between stack status checks while waiting')
+    return parser
+
+
+class WaitStopped(Exception):
+    # Raised by a wait whose stop event was set, e.g. on Ctrl-C. Whatever was being waited for is left as it is.
+    pass
+
+
 class AwsCloudFormationHelper:
     # A utility class for interacting with the AWS CloudFormation service using boto3.
 
@@ -62,39 +880,29 @@ class AwsCloudFormationHelper:
     def client_from_opts(cls, cfn_client_args=None, opts=None):
         # A class method to create a CloudFormation client instance.
         # It handles optional AWS profile and region settings from the command-line options.
-        if cfn_client_args is None:
-            cfn_client_args = {}
-
-        if opts is None:
-            opts = SimpleNamespace()
-
-        session_args = {}
-        # Populates session arguments for boto3.Session if an AWS profile is specified.
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_profile', session_args, 'profile_name')
-        # Populates client arguments if an AWS region is specified.
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_region', cfn_client_args, 'region_name')
-
-        if len(session_args) != 0:
-            client_parent = boto3.Session(**session_args)
-        else:
-            client_parent = boto3
-
-        return client_parent.client('cloudformation', **cfn_client_args)
+        return aws_client_from_opts('cloudformation', client_args=cfn_client_args, opts=opts)
 
     @classmethod
-    def create_stack(cls, stack_name, template_url, cfn_role_arn=None, template_parameters=None, client=None,
-                     cfn_client_args=None):
+    def create_stack(cls, stack_name, template_url=None, cfn_role_arn=None, template_parameters=None, client=None,
+                     cfn_client_args=None, template_body=None, capabilities=None, tags=None):
         # A class method to create a CloudFormation stack.
-        # It takes the stack name, template URL, and optional parameters and role ARN.
+        # It takes the stack name, a template URL (or an inline template body), and optional parameters and role ARN.
         if client is None:
             if cfn_client_args is None:
                 cfn_client_args = {}
-            client = boto3.client('cloudformation', **cfn_client_args)
+            client = AwsThrottledClient(boto3.client('cloudformation', **throttled_client_args(cfn_client_args)),
+                                        'cloudformation')
 
-        cfn_create_stack_args = {
-            'StackName': stack_name,
-            'TemplateURL': template_url
-        }
+        cfn_create_stack_args = {'StackName': stack_name}
+        if template_url is not None:
+            cfn_create_stack_args['TemplateURL'] = template_url
+        elif template_body is not None:
+            cfn_create_stack_args['TemplateBody'] = template_body
+        else:
+            raise ValueError("A template URL or template body is required")
+
+        if capabilities:
+            cfn_create_stack_args['Capabilities'] = list(capabilities)
 
         # Adds optional parameters and role ARN to the stack creation arguments.
         if template_parameters is not None:
@@ -103,8 +911,148 @@ class AwsCloudFormationHelper:
         if cfn_role_arn is not None:
             cfn_create_stack_args['RoleARN'] = cfn_role_arn
 
+        if tags:
+            # Envoi stacks also record their template, which keys their create timings in the ETA history.
+            tags = [tag for tag in tags if tag['Key'] != cls.template_tag_key]
+            tags.append({'Key': cls.template_tag_key, 'Value': cls.template_digest(template_url, template_body)})
+            cfn_create_stack_args['Tags'] = tags
+
+        # The same request always carries the same token, so CloudFormation treats a retry as the original call.
+        cfn_create_stack_args['ClientRequestToken'] = cls.client_request_token(cfn_create_stack_args)
+
         # Calls the boto3 create_stack method with the prepared arguments.
-        return client.create_stack(**cfn_create_stack_args)
+        try:
+            return client.create_stack(**cfn_create_stack_args)
+        except Exception as e:
+            if aws_error_code(e) != 'AlreadyExistsException':
+                raise
+            # A retry after a timeout (or a re-run) attaches to the stack the first attempt created.
+            return cls.attach_to_existing_stack(client, stack_name, template_parameters or [])
+
+    # Statuses of an existing stack that a repeated create can attach to.
+    attachable_stack_statuses = ('CREATE_IN_PROGRESS', 'CREATE_COMPLETE', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE',
+                                 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+
+    # Stacks created by the create commands are tagged with their vendor, so `status` can find them.
+    vendor_tag_key = 'envoi:vendor'
+
+    # Holds a digest of the TemplateURL (staged templates have content-addressed keys) or of the template body.
+    template_tag_key = 'envoi:template'
+
+    @classmethod
+    def envoi_tags(cls, vendor):
+        return [{'Key': cls.vendor_tag_key, 'Value': vendor}]
+
+    @classmethod
+    def template_digest(cls, template_url=None, template_body=None):
+        return hashlib.sha256((template_url or template_body or '').encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def format_create_response(cls, response):
+        # Returns the stack ID line printed by the create commands.
+        if response.get('AlreadyExists'):
+            return f"Stack ID {response['StackId']} (already exists, {response['StackStatus']})"
+        return f"Stack ID {response['StackId']}"
+
+    @classmethod
+    def client_request_token(cls, cfn_create_stack_args):
+        # Derives a deterministic ClientRequestToken from the stack name, template and parameters.
+        digest = hashlib.sha256(json.dumps(cfn_create_stack_args, sort_keys=True, default=str).encode('utf-8'))
+        return f"envoi-{digest.hexdigest()[:48]}"
+
+    @classmethod
+    def attach_to_existing_stack(cls, client, stack_name, template_parameters):
+        # Returns the existing stack's ID when it is alive and was created with the same parameters; anything else
+        # is a different stack that happens to have the same name and raises ValueError.
+        stack = cls.describe_stack(client, stack_name)
+        status = stack['StackStatus']
+        if status not in cls.attachable_stack_statuses:
+            raise ValueError(f"Stack {stack_name} already exists in status {status}")
+        existing = {p['ParameterKey']: p.get('ParameterValue') for p in stack.get('Parameters', [])}
+        different = sorted(p['ParameterKey'] for p in template_parameters
+                           if existing.get(p['ParameterKey']) not in (p['ParameterValue'], '****'))
+        if different:
+            raise ValueError(f"Stack {stack_name} already exists with different parameters: {', '.join(different)}")
+        LOG.info(f"Stack {stack_name} already exists ({status}), attaching to {stack['StackId']}")
+        return {'StackId': stack['StackId'], 'StackStatus': status, 'AlreadyExists': True}
+
+    @classmethod
+    def describe_stack(cls, client, stack_name):
+        return client.describe_stacks(StackName=stack_name)['Stacks'][0]
+
+    @classmethod
+    def wait_for_stack(cls, client, stack_name, poll_interval=15, timeout=7200, predictor=None, stream=None,
+                       stop=None):
+        # Polls the stack until it reaches a *_COMPLETE status and returns its description.
+        # Failed, rolled back and deleted stacks raise ValueError with the status reason.
+        # With a StackEtaPredictor, every poll also reads the new stack events to show an ETA on `stream` and flag
+        # resources that are much slower than usual. Setting the `stop` event raises WaitStopped.
+        deadline = time.monotonic() + timeout
+        progress = {}
+        while True:
+            stack = cls.describe_stack(client, stack_name)
+            status = stack['StackStatus']
+            LOG.info(f"Stack {stack_name} is {status}")
+            if predictor is not None:
+                try:
+                    new_events = cls.new_stack_events(client, stack['StackId'], progress.get('last_event_id'))
+                except Exception as e:
+                    LOG.debug(f"Couldn't read the events of stack {stack_name}: {e}")
+                    new_events = []
+                if new_events:
+                    progress['last_event_id'] = new_events[-1]['EventId']
+                predictor.observe(stack, progress, new_events, stream)
+            if status.endswith('_FAILED') or 'ROLLBACK' in status or status.startswith('DELETE_'):
+                raise ValueError(f"Stack {stack_name} is {status}: {stack.get('StackStatusReason', '')}")
+            if status.endswith('_COMPLETE'):
+                return stack
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Timed out waiting for stack {stack_name} (last status {status})")
+            if stop is None:
+                time.sleep(poll_interval)
+            elif stop.wait(poll_interval):
+                raise WaitStopped(f"Stopped waiting for stack {stack_name}")
+
+    @classmethod
+    def wait_with_eta(cls, client, stack_name, poll_interval=15):
+        # Waits for the stack while printing an ETA to stderr, and adds a create it follows to the ETA history.
+        predictor = StackEtaPredictor()
+        try:
+            return cls.wait_for_stack(client, stack_name, poll_interval=poll_interval, predictor=predictor,
+                                      stream=sys.stderr)
+        finally:
+            predictor.close()
+
+    @classmethod
+    def new_stack_events(cls, client, stack_name, last_event_id=None):
+        # Returns the stack events after `last_event_id`, oldest first. Events are listed newest first, so only the
+        # pages down to the last event already seen are fetched.
+        events = []
+        for page in client.get_paginator('describe_stack_events').paginate(StackName=stack_name):
+            for event in page['StackEvents']:
+                if event['EventId'] == last_event_id:
+                    return events[::-1]
+                events.append(event)
+        return events[::-1]
+
+    @classmethod
+    def update_stack_tags(cls, client, stack_name, tags):
+        # Adds or changes tags of an existing stack (which CloudFormation propagates to its resources) with an
+        # update that keeps the template and every parameter value.
+        stack = cls.describe_stack(client, stack_name)
+        merged = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+        merged.update(tags)
+        update_args = {'StackName': stack_name, 'UsePreviousTemplate': True,
+                       'Parameters': [{'ParameterKey': parameter['ParameterKey'], 'UsePreviousValue': True}
+                                      for parameter in stack.get('Parameters', [])],
+                       'Tags': [{'Key': key, 'Value': value} for key, value in merged.items()]}
+        if stack.get('Capabilities'):
+            update_args['Capabilities'] = stack['Capabilities']
+        return client.update_stack(**update_args)
+
+    @classmethod
+    def stack_outputs(cls, stack):
+        return {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
 
     @classmethod
     def populate_template_parameters_from_opts(cls, template_parameters, opts, field_map):
@@ -121,6 +1069,70 @@ class AwsCloudFormationHelper:
         return template_parameters
 
 
+class CloudFormationTemplateStager:
+    # Uploads CloudFormation templates to S3 under content-addressed keys so they can be passed as a TemplateURL.
+    # The key is the SHA-256 of the template body, so an object that already exists is the same template: it is
+    # checked with a HEAD request and never uploaded twice, and repeat deploys of the same template skip the upload.
+
+    # CloudFormation rejects inline TemplateBody values larger than this; bigger templates must come from S3.
+    MAX_TEMPLATE_BODY_SIZE = 51200
+
+    def __init__(self, s3_client, bucket, prefix='cloudformation/templates/', region=None, endpoint_url=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.known_keys = set()
+
+    @classmethod
+    def from_opts(cls, opts, bucket, prefix='cloudformation/templates/'):
+        s3_client = aws_client_from_opts('s3', opts=opts)
+        return cls(s3_client, bucket, prefix=prefix, region=s3_client.meta.region_name,
+                   endpoint_url=getattr(opts, 'aws_endpoint_url', None))
+
+    @staticmethod
+    def serialize(template):
+        # Templates given as dicts are serialized compactly with sorted keys, so the same template always hashes
+        # (and stages) to the same key.
+        if isinstance(template, (dict, list)):
+            return json.dumps(template, sort_keys=True, separators=(',', ':'))
+        return template.decode('utf-8') if isinstance(template, bytes) else template
+
+    def template_key(self, body):
+        return f"{self.prefix}{hashlib.sha256(body.encode('utf-8')).hexdigest()}.json"
+
+    def template_url(self, key):
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        if self.region in (None, 'us-east-1'):
+            return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if aws_error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def stage(self, template):
+        # Returns the TemplateURL of the template, uploading it first only if its key is missing.
+        body = self.serialize(template)
+        key = self.template_key(body)
+        if key not in self.known_keys:
+            if self.exists(key):
+                LOG.info(f"Template already staged at s3://{self.bucket}/{key}")
+            else:
+                LOG.info(f"Staging {format_size(len(body))} template to s3://{self.bucket}/{key}")
+                self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body.encode('utf-8'),
+                                          ContentType='application/json')
+            self.known_keys.add(key)
+        return self.template_url(key)
+
+
 class EnvoiArgumentParser(argparse.ArgumentParser):
     # A custom ArgumentParser class.
 
@@ -138,20 +1150,28 @@ class WekaApiClient:
     DEFAULT_HOST_PORT = 443
     DEFAULT_BASE_PATH = "/dist/v1"
 
-    def __init__(self, token, host=DEFAULT_HOST, host_port=DEFAULT_HOST_PORT, base_path=DEFAULT_BASE_PATH):
+    def __init__(self, token, host=DEFAULT_HOST, host_port=DEFAULT_HOST_PORT, base_path=DEFAULT_BASE_PATH,
+                 secure=True, max_attempts=5, backoff_base=0.5, backoff_cap=20.0):
         # Initializes the API client with a token and optional host/port.
+        # `secure=False` talks plain HTTP, e.g. to the local WekaApiStandIn.
+        # Throttled and server error responses are retried up to `max_attempts` times in all.
         self.conn = None
         self.token = token
         self.host = host
         self.host_port = host_port
         self.base_path = base_path
+        self.secure = secure
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
         self.default_headers = {"Content-Type": "application/json"}
         self.init_auth_header()
         self.init_connection()
 
     def init_connection(self):
         # Initializes an HTTPS connection to the WekaIO API host.
-        self.conn = http.client.HTTPSConnection(self.host, self.host_port)
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        self.conn = connection_class(self.host, self.host_port)
 
     def init_auth_header(self):
         # Prepares the HTTP Authorization header using the provided token.
@@ -172,6 +1192,14 @@ class WekaApiClient:
     def handle_response(cls, response):
         # A static method to read and decode the response body from an HTTP request.
         # It handles different content types (JSON, text) and decodes them appropriately.
+        # Error statuses raise ValueError with the decoded body.
+        response_body = cls.decode_response(response)
+        if response.status >= 400:
+            raise ValueError(f"Weka API request failed with {response.status}: {response_body}")
+        return response_body
+
+    @classmethod
+    def decode_response(cls, response):
         response_body = response.read()
         content_type, header_attribs_raw = response.getheader("Content-Type").split(";")
         header_attribs = dict(map(lambda x: x.strip().split("="), header_attribs_raw.split(",")))
@@ -193,19 +1221,44 @@ class WekaApiClient:
         url = self.base_path + "/" + endpoint
         if query_params:
             url += "?" + urllib.parse.urlencode(query_params)
-        self.conn.request("GET", url, headers=self.prepare_headers(headers=headers, default_headers=default_headers))
-        response = self.conn.getresponse()
-        return self.__class__.handle_response(response)
+        with API_LATENCY.span(f"weka.GET {endpoint}"):
+            response = self.send("GET", url, headers=self.prepare_headers(headers=headers,
+                                                                          default_headers=default_headers))
+            return self.__class__.handle_response(response)
 
     def post(self, endpoint, data, query_params=None, headers=None, default_headers=None):
         # Sends a POST request with JSON data to a specified API endpoint.
         url = self.base_path + "/" + endpoint
         if query_params:
             url += "?" + urllib.parse.urlencode(query_params)
-        self.conn.request("POST", url, json.dumps(data), headers=self.prepare_headers(headers=headers,
-                                                                                      default_headers=default_headers))
-        response = self.conn.getresponse()
-        return self.__class__.handle_response(response)
+        with API_LATENCY.span(f"weka.POST {endpoint}"):
+            response = self.send("POST", url, json.dumps(data),
+                                 headers=self.prepare_headers(headers=headers, default_headers=default_headers))
+            return self.__class__.handle_response(response)
+
+    def send(self, method, url, body=None, headers=None):
+        # Sends a request on the kept-alive connection and returns the response. A connection the server has
+        # closed in the meantime is replaced and the request is sent once more, like OciObjectStorageClient does.
+        # 429 and 5xx responses are retried with full-jitter exponential backoff, like AwsRateLimiter retries.
+        attempt, reconnected = 0, False
+        while True:
+            try:
+                self.conn.request(method, url, body, headers=headers or {})
+                response = self.conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.conn.close()
+                self.init_connection()
+                if reconnected:
+                    raise
+                reconnected = True
+                continue
+            if (response.status != 429 and response.status < 500) or attempt >= self.max_attempts - 1:
+                return response
+            # The body is read so the connection can be reused for the retry.
+            response.read()
+            LOG.debug(f"Weka API {method} {url} failed with {response.status}, retrying")
+            time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+            attempt += 1
 
     def get_template_releases(self, page=1):
         # Retrieves a list of available WekaIO template releases.
@@ -263,6 +1316,302 @@ class WekaApiClient:
         return template_response
 
 
+class OciApiError(Exception):
+    # Raised when the OCI Object Storage API returns an error response.
+
+    def __init__(self, status, code=None, message=None, method=None, path=None):
+        self.status = status
+        self.code = code
+        self.message = message
+        super().__init__(f"OCI {method} {path} failed with {status} {code or ''}: {message or ''}".strip())
+
+
+class OciRequestSigner:
+    # Signs OCI API requests with an API signing key (OCI HTTP signature, rsa-sha256).
+    # Credentials come from the same ~/.oci/config file the OCI CLI uses, so the CLI itself isn't needed.
+
+    def __init__(self, tenancy, user, fingerprint, private_key):
+        self.key_id = f"{tenancy}/{user}/{fingerprint}"
+        self.private_key = private_key
+
+    @classmethod
+    def from_config(cls, config_file='~/.oci/config', profile='DEFAULT'):
+        if serialization is None:
+            raise ValueError("Missing dependency cryptography. Try running 'pip install cryptography'")
+        config = configparser.ConfigParser()
+        if not config.read(os.path.expanduser(config_file)):
+            raise ValueError(f"OCI config file {config_file} not found")
+        if profile not in config and profile != 'DEFAULT':
+            raise ValueError(f"Profile {profile} not found in {config_file}")
+        section = config[profile]
+        with open(os.path.expanduser(section['key_file']), 'rb') as f:
+            passphrase = section.get('pass_phrase')
+            private_key = serialization.load_pem_private_key(
+                f.read(), password=passphrase.encode('utf-8') if passphrase else None)
+        signer = cls(section['tenancy'], section['user'], section['fingerprint'], private_key)
+        signer.region = section.get('region')
+        signer.tenancy = section['tenancy']
+        return signer
+
+    def sign(self, method, path, headers, body=None):
+        # Adds the date and Authorization headers (and body digest headers for POST) to `headers` in place.
+        # Object data PUTs (PutObject, UploadPart) are signed without body headers, as Object Storage allows,
+        # so large parts never need to be hashed just for the signature.
+        headers['date'] = email.utils.formatdate(usegmt=True)
+        signed_headers = ['(request-target)', 'date', 'host']
+        if method == 'POST':
+            body = body or b''
+            headers['x-content-sha256'] = base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
+            headers.setdefault('content-type', 'application/json')
+            headers['content-length'] = str(len(body))
+            signed_headers += ['x-content-sha256', 'content-type', 'content-length']
+        lines = []
+        for name in signed_headers:
+            if name == '(request-target)':
+                lines.append(f"(request-target): {method.lower()} {path}")
+            else:
+                lines.append(f"{name}: {headers[name]}")
+        signature = self.private_key.sign('\n'.join(lines).encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+        headers['authorization'] = (
+            f'Signature version="1",keyId="{self.key_id}",algorithm="rsa-sha256",'
+            f'headers="{" ".join(signed_headers)}",signature="{base64.b64encode(signature).decode("ascii")}"')
+        return headers
+
+
+class OciObjectStorageClient:
+    # A minimal client for the OCI Object Storage REST API built on http.client, like the WekaApiClient.
+    # Each thread gets its own connection so uploads can run in parallel over keep-alive connections.
+    # Pointing `endpoint` at a local HTTP stand-in (with signer=None) allows testing without an OCI account.
+
+    DEFAULT_ENDPOINT = "https://objectstorage.{region}.oraclecloud.com"
+
+    def __init__(self, endpoint, signer=None, timeout=120):
+        parsed = urllib.parse.urlsplit(endpoint)
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self.signer = signer
+        self.local = threading.local()
+
+    def connection(self, reset=False):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or reset:
+            if conn is not None:
+                conn.close()
+            conn_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self.local.conn = conn_class(self.host, timeout=self.timeout)
+        return conn
+
+    @staticmethod
+    def quote(value):
+        return urllib.parse.quote(value, safe='')
+
+    def request(self, method, path, query_params=None, body=None, headers=None, json_body=None):
+        # Sends a request and returns (status, headers, parsed body). Non-2xx responses raise OciApiError.
+        if query_params:
+            path += "?" + urllib.parse.urlencode(query_params)
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+        headers = {'host': self.host, **(headers or {})}
+        if body is not None and 'content-length' not in headers:
+            headers['content-length'] = str(len(body))
+        if self.signer is not None:
+            self.signer.sign(method, path, headers, body)
+
+        for attempt in range(2):
+            conn = self.connection(reset=attempt > 0)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response_body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # A keep-alive connection closed by the server is retried once on a fresh connection.
+                if attempt:
+                    raise
+
+        content_type = response.getheader('Content-Type', '') or ''
+        parsed = response_body
+        if 'application/json' in content_type and response_body.strip():
+            parsed = json.loads(response_body.decode('utf-8'))
+        if response.status >= 300:
+            error = parsed if isinstance(parsed, dict) else {}
+            raise OciApiError(response.status, error.get('code'), error.get('message') or response_body[:200],
+                              method=method, path=path)
+        return response.status, {k.lower(): v for k, v in response.getheaders()}, parsed
+
+    def get_namespace(self):
+        return self.request('GET', '/n/')[2]
+
+    def create_bucket(self, namespace, name, compartment_id, storage_tier='Standard', public_access_type=None):
+        body = {'name': name, 'compartmentId': compartment_id, 'storageTier': storage_tier}
+        if public_access_type is not None:
+            body['publicAccessType'] = public_access_type
+        return self.request('POST', f"/n/{self.quote(namespace)}/b/", json_body=body)[2]
+
+    def object_path(self, namespace, bucket, object_name, kind='o'):
+        return f"/n/{self.quote(namespace)}/b/{self.quote(bucket)}/{kind}/{self.quote(object_name)}"
+
+    def put_object(self, namespace, bucket, object_name, data, content_md5=None):
+        headers = {'content-type': 'application/octet-stream'}
+        if content_md5 is not None:
+            headers['content-md5'] = content_md5
+        return self.request('PUT', self.object_path(namespace, bucket, object_name), body=data, headers=headers)[1]
+
+    def create_multipart_upload(self, namespace, bucket, object_name):
+        return self.request('POST', f"/n/{self.quote(namespace)}/b/{self.quote(bucket)}/u",
+                            json_body={'object': object_name})[2]
+
+    def list_multipart_uploads(self, namespace, bucket):
+        uploads = []
+        page = None
+        while True:
+            query_params = {'limit': 1000, **({'page': page} if page else {})}
+            _, headers, body = self.request('GET', f"/n/{self.quote(namespace)}/b/{self.quote(bucket)}/u",
+                                            query_params=query_params)
+            uploads.extend(body or [])
+            page = headers.get('opc-next-page')
+            if not page:
+                return uploads
+
+    def upload_part(self, namespace, bucket, object_name, upload_id, part_num, data, content_md5=None):
+        headers = {'content-type': 'application/octet-stream'}
+        if content_md5 is not None:
+            headers['content-md5'] = content_md5
+        _, response_headers, _ = self.request(
+            'PUT', self.object_path(namespace, bucket, object_name, kind='u'),
+            query_params={'uploadId': upload_id, 'uploadPartNum': part_num}, body=data, headers=headers)
+        return response_headers.get('etag')
+
+    def list_multipart_upload_parts(self, namespace, bucket, object_name, upload_id):
+        parts = []
+        page = None
+        while True:
+            query_params = {'uploadId': upload_id, 'limit': 1000, **({'page': page} if page else {})}
+            _, headers, body = self.request('GET', self.object_path(namespace, bucket, object_name, kind='u'),
+                                            query_params=query_params)
+            parts.extend(body or [])
+            page = headers.get('opc-next-page')
+            if not page:
+                return parts
+
+    def commit_multipart_upload(self, namespace, bucket, object_name, upload_id, parts):
+        body = {'partsToCommit': [{'partNum': part_num, 'etag': etag} for part_num, etag in sorted(parts.items())]}
+        return self.request('POST', self.object_path(namespace, bucket, object_name, kind='u'),
+                            query_params={'uploadId': upload_id}, json_body=body)[1]
+
+    def abort_multipart_upload(self, namespace, bucket, object_name, upload_id):
+        return self.request('DELETE', self.object_path(namespace, bucket, object_name, kind='u'),
+                            query_params={'uploadId': upload_id})
+
+
+class OciMultipartUploader:
+    # Uploads files to OCI Object Storage, using parallel multipart uploads for anything above the threshold.
+    # Part size adapts to the object size so big objects stay under the 10,000 part limit while smaller ones still
+    # split into enough parts to keep every worker busy. An interrupted upload is resumed from the service's list
+    # of committed parts: parts whose size and MD5 match the local data are not sent again.
+
+    MIN_PART_SIZE = 10 * 1024 ** 2
+    MAX_PART_SIZE = 50 * 1024 ** 3
+    MAX_PARTS = 10000
+
+    def __init__(self, client, namespace, bucket, executor, workers, part_size=None, multipart_threshold=None,
+                 progress=None, retries=3):
+        self.client = client
+        self.namespace = namespace
+        self.bucket = bucket
+        self.executor = executor
+        self.workers = workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold or 128 * 1024 ** 2
+        self.progress = progress or ProgressReporter('oci-upload', interval=0)
+        self.retries = retries
+        self.pending_uploads = None
+
+    @classmethod
+    def choose_part_size(cls, size, workers, part_size=None):
+        # A fixed part size is honoured unless it would need more than MAX_PARTS parts.
+        # Otherwise aim for about two parts per worker, clamped to 16MiB-128MiB, and rounded to whole MiB.
+        mib = 1024 ** 2
+        minimum = -(-size // cls.MAX_PARTS)
+        if part_size is None:
+            part_size = min(max(size // max(workers * 2, 1), 16 * mib), 128 * mib)
+        part_size = max(part_size, minimum, cls.MIN_PART_SIZE)
+        return min(-(-part_size // mib) * mib, cls.MAX_PART_SIZE)
+
+    @staticmethod
+    def read_range(path, offset, length):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def with_retries(self, func, *args):
+        for attempt in range(self.retries):
+            try:
+                return func(*args)
+            except (OciApiError, OSError, http.client.HTTPException) as e:
+                retryable = not isinstance(e, OciApiError) or e.status == 429 or e.status >= 500
+                if not retryable or attempt == self.retries - 1:
+                    raise
+                time.sleep(min(2 ** attempt + random.random(), 30))
+
+    def find_upload(self, object_name):
+        # Returns the most recent in-progress multipart upload for the object, if any.
+        if self.pending_uploads is None:
+            self.pending_uploads = self.client.list_multipart_uploads(self.namespace, self.bucket)
+        uploads = [u for u in self.pending_uploads if u.get('object') == object_name]
+        return max(uploads, key=lambda u: u.get('timeCreated', '')) if uploads else None
+
+    def put_small(self, path, object_name):
+        data = self.read_range(path, 0, os.path.getsize(path))
+        content_md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        self.with_retries(self.client.put_object, self.namespace, self.bucket, object_name, data, content_md5)
+        self.progress.add('bytes', len(data))
+        self.progress.add('objects')
+
+    def upload_part(self, path, object_name, upload_id, part_num, offset, length, committed):
+        data = self.read_range(path, offset, length)
+        content_md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        existing = committed.get(part_num)
+        if existing is not None and existing.get('size') == length and existing.get('md5') == content_md5:
+            self.progress.add('parts_skipped')
+            return part_num, existing['etag']
+        etag = self.with_retries(self.client.upload_part, self.namespace, self.bucket, object_name, upload_id,
+                                 part_num, data, content_md5)
+        self.progress.add('bytes', length)
+        self.progress.add('parts')
+        return part_num, etag
+
+    def upload_multipart(self, path, object_name, resume=True):
+        size = os.path.getsize(path)
+        part_size = self.choose_part_size(size, self.workers, self.part_size)
+        upload = self.find_upload(object_name) if resume else None
+        committed = {}
+        if upload is not None:
+            upload_id = upload['uploadId']
+            committed = {part['partNumber']: part for part in self.client.list_multipart_upload_parts(
+                self.namespace, self.bucket, object_name, upload_id)}
+            LOG.info(f"Resuming upload {upload_id} of {object_name} with {len(committed)} committed parts")
+        else:
+            upload_id = self.client.create_multipart_upload(self.namespace, self.bucket, object_name)['uploadId']
+
+        futures = [self.executor.submit(self.upload_part, path, object_name, upload_id, part_num, offset,
+                                        min(part_size, size - offset), committed)
+                   for part_num, offset in enumerate(range(0, size, part_size), start=1)]
+        # Parts of a resumed upload may have been written with another part size; only the new layout is committed.
+        parts = dict(future.result() for future in futures)
+        self.with_retries(self.client.commit_multipart_upload, self.namespace, self.bucket, object_name,
+                          upload_id, parts)
+        self.progress.add('objects')
+        return upload_id
+
+    def upload(self, path, object_name, resume=True):
+        if os.path.getsize(path) < self.multipart_threshold:
+            return self.executor.submit(self.put_small, path, object_name)
+        self.upload_multipart(path, object_name, resume=resume)
+        return None
+
+
 class EnvoiCommand:
     # A base class for all commands.
 
@@ -327,21 +1676,1333 @@ class EnvoiCommand:
         pass
 
 
-class EnvoiStorageHammerspaceAwsCreateClusterCommand(EnvoiCommand):
-    # A command class for creating a Hammerspace cluster on AWS.
+def prompt_choice(title, options, labels=None, count=1, stream=None):
+    # Shows a numbered menu and returns the selected option (or a list when `count` is more than 1).
+    # Options can be picked by number or by typing the value itself.
+    stream = stream or sys.stderr
+    if not options:
+        raise ValueError(f"Nothing to choose from for: {title}")
+    labels = labels or [str(option) for option in options]
+    print(f"\n{title}", file=stream)
+    for index, label in enumerate(labels, start=1):
+        print(f"{index}) {label}", file=stream)
+    hint = "Enter the number of your choice" if count == 1 else f"Enter {count} numbers separated by commas"
+    while True:
+        answer = input(f"{hint}: ").strip()
+        selected = []
+        for token in [t.strip() for t in answer.split(',') if t.strip()]:
+            if token.isdigit() and 1 <= int(token) <= len(options):
+                selected.append(options[int(token) - 1])
+            elif token in options:
+                selected.append(token)
+        if len(selected) == count:
+            return selected[0] if count == 1 else selected
+        print("Invalid choice.", file=stream)
 
-    cfn_param_names = {
-        # A dictionary mapping command-line argument names to CloudFormation parameter names.
-        "DeploymentType": "deployment_type",
-        "AnvilConfiguration": "anvil_configuration",
-        "AnvilInstanceType": "anvil_instance_type",
-        "DsxInstanceType": "dsx_instance_type",
-        "DsxInstanceCount": "dsx_instance_count",
-        "AnvilMetaDiskSize": "anvil_meta_disk_size",
-        "DsxDataDiskSize": "dsx_data_disk_size",
-        "DsxAddVols": "dsx_add_vols",
-        "VpcId": "vpc_id",
-        "AvailZone1": "avail_zone1",
+
+def prompt_value(prompt, secret=False, default=None):
+    # Reads a free-form value from the terminal, hiding the input for secrets.
+    suffix = f" [{default}]" if default is not None else ""
+    value = (getpass.getpass if secret else input)(f"{prompt}{suffix}: ").strip()
+    return value or default
+
+
+def prompt_confirm(prompt):
+    return input(f"{prompt} (y/n): ").strip().lower() in ('y', 'yes')
+
+
+def envoi_cache_dir():
+    # Returns (and creates) the directory holding the tool's local caches and state files.
+    # $ENVOI_STORAGE_CACHE_DIR overrides the default of $XDG_CACHE_HOME/envoi-storage (~/.cache/envoi-storage).
+    cache_dir = os.environ.get('ENVOI_STORAGE_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'envoi-storage')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+class DiscoveryCache:
+    # A small JSON-file cache of discovery results keyed by (profile, region, kind, arguments) with a TTL.
+    # Results are shared between runs, so repeated deployments into the same account make no discovery calls
+    # until the entries expire or are invalidated.
+
+    DEFAULT_TTL = 3600
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path or os.path.join(envoi_cache_dir(), 'discovery.json')
+        if ttl is None:
+            ttl = float(os.environ.get('ENVOI_STORAGE_DISCOVERY_TTL', self.DEFAULT_TTL))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self.load()
+        # Keys written or invalidated by this process since the last save, merged into what other processes wrote.
+        self.changed = set()
+        self.removed = set()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # Holds an exclusive lock on the cache file against other processes while it is read and rewritten.
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def save(self):
+        with self.file_lock():
+            self.merge_and_write()
+
+    def merge_and_write(self):
+        # Re-reads the file and applies only this process's changes to it, so entries other processes saved in the
+        # meantime are kept. Writes through a temporary file so a concurrent reader never sees a partial document.
+        # The caller holds file_lock().
+        entries = self.load()
+        for key in self.removed:
+            entries.pop(key, None)
+        for key in self.changed:
+            entries[key] = self.entries[key]
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.changed.clear()
+        self.removed.clear()
+
+    @staticmethod
+    def make_key(profile, region, kind, *args):
+        return '|'.join([profile or 'default', region or 'global', kind, *[str(arg) for arg in args]])
+
+    def get(self, profile, region, kind, *args):
+        # Returns the cached value, or None when it is missing or expired.
+        with self.lock:
+            entry = self.entries.get(self.make_key(profile, region, kind, *args))
+        if entry is None or entry['expires_at'] < time.time():
+            return None
+        return entry['value']
+
+    def put(self, profile, region, kind, value, *args, ttl=None):
+        key = self.make_key(profile, region, kind, *args)
+        with self.lock:
+            self.entries[key] = {
+                'expires_at': time.time() + (self.ttl if ttl is None else ttl),
+                'value': value,
+            }
+            self.removed.discard(key)
+            self.changed.add(key)
+            self.save()
+        return value
+
+    def get_or_load(self, profile, region, kind, loader, *args, ttl=None):
+        value = self.get(profile, region, kind, *args)
+        if value is None:
+            LOG.debug(f"Discovery cache miss for {self.make_key(profile, region, kind, *args)}")
+            value = self.put(profile, region, kind, loader(*args), *args, ttl=ttl)
+        return value
+
+    def invalidate(self, profile=None, region=None, kind=None):
+        # Drops every entry matching the given profile/region/kind (None matches anything) and returns the count.
+        # The file stays locked from the reload to the write, so entries other processes save meanwhile are neither
+        # missed by the match nor dropped.
+        with self.lock, self.file_lock():
+            self.entries = self.load()
+            matching = []
+            for key in self.entries:
+                key_profile, key_region, key_kind = key.split('|')[:3]
+                if ((profile is None or key_profile == profile) and (region is None or key_region == region)
+                        and (kind is None or key_kind == kind)):
+                    matching.append(key)
+            for key in matching:
+                del self.entries[key]
+                self.changed.discard(key)
+                self.removed.add(key)
+            self.merge_and_write()
+        return len(matching)
+
+
+class AwsNetworkDiscovery:
+    # Looks up the regions, Active Directory directories, VPCs and subnets needed to place a deployment.
+    # Per-region calls are fanned out concurrently from one process, so a scan of every FSx region costs about one
+    # API round trip instead of one CLI process per region. Results go through a DiscoveryCache keyed by
+    # (profile, region), so they back interactive pickers and argument validation without repeating the calls.
+
+    fsx_regions_parameter_path = '/aws/service/global-infrastructure/services/fsx/regions'
+
+    def __init__(self, session=None, endpoint_url=None, max_workers=16, cache=None, account=None):
+        self.session = session or boto3.Session()
+        self.endpoint_url = endpoint_url
+        # Sessions of assumed roles have no profile name; the role ARN keys their cache entries instead.
+        self.account = account
+        self.max_workers = max_workers
+        self.cache = cache if cache is not None else DiscoveryCache()
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    @classmethod
+    def from_opts(cls, opts=None):
+        discovery = cls(session=aws_session_from_opts(opts), endpoint_url=getattr(opts, 'aws_endpoint_url', None),
+                        account=aws_role_opts(opts)[2])
+        if getattr(opts, 'refresh_discovery', False):
+            discovery.invalidate()
+        return discovery
+
+    @property
+    def profile(self):
+        # The cache key for this account. Stand-in endpoints get their own key so fake data never leaks into real runs.
+        profile = self.account or self.session.profile_name or 'default'
+        return f"{profile}@{self.endpoint_url}" if self.endpoint_url else profile
+
+    def cached(self, kind, region, loader, *args):
+        # Extra arguments become part of the cache key and are passed to the loader.
+        return self.cache.get_or_load(self.profile, region, kind, loader, *args)
+
+    def invalidate(self, region=None, kind=None):
+        return self.cache.invalidate(profile=self.profile, region=region, kind=kind)
+
+    def client(self, service_name, region=None):
+        # Returns a cached client. boto3 sessions are not thread-safe when creating clients, so creation is locked;
+        # the clients themselves are safe to share between threads.
+        key = (service_name, region)
+        with self.clients_lock:
+            if key not in self.clients:
+                client_args = {}
+                if region is not None:
+                    client_args['region_name'] = region
+                if self.endpoint_url is not None:
+                    client_args['endpoint_url'] = self.endpoint_url
+                client = self.session.client(service_name, **throttled_client_args(client_args))
+                self.clients[key] = AwsThrottledClient(client, service_name, region=region or self.session.region_name,
+                                                       profile=self.profile)
+            return self.clients[key]
+
+    def fan_out(self, func, regions):
+        # Runs `func(region)` for every region concurrently and returns {region: result}.
+        # Regions that fail (opt-in regions, missing permissions) are logged and skipped.
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(regions)))) as pool:
+            futures = {pool.submit(func, region): region for region in regions}
+            for future in concurrent.futures.as_completed(futures):
+                region = futures[future]
+                try:
+                    results[region] = future.result()
+                except Exception as e:
+                    LOG.warning(f"Discovery in {region} failed: {e}")
+        return results
+
+    def fsx_regions(self):
+        # Lists the regions where Amazon FSx is available using the public SSM global-infrastructure parameters.
+        return self.cached('fsx-regions', None, self.load_fsx_regions)
+
+    def load_fsx_regions(self):
+        paginator = self.client('ssm').get_paginator('get_parameters_by_path')
+        regions = []
+        for page in paginator.paginate(Path=self.fsx_regions_parameter_path):
+            regions.extend(parameter['Value'] for parameter in page['Parameters'])
+        return sorted(regions)
+
+    def directories_in_region(self, region):
+        return self.cached('directories', region, lambda: self.load_directories(region))
+
+    def load_directories(self, region):
+        paginator = self.client('ds', region).get_paginator('describe_directories')
+        directories = []
+        for page in paginator.paginate():
+            for directory in page['DirectoryDescriptions']:
+                vpc_settings = directory.get('VpcSettings', {})
+                directories.append({
+                    'DirectoryId': directory['DirectoryId'],
+                    'Name': directory.get('Name'),
+                    'Type': directory.get('Type'),
+                    'Stage': directory.get('Stage'),
+                    'Region': region,
+                    'VpcId': vpc_settings.get('VpcId'),
+                    'SubnetIds': vpc_settings.get('SubnetIds', []),
+                    'DnsIpAddrs': directory.get('DnsIpAddrs', []),
+                })
+        return directories
+
+    def directories(self, regions):
+        # Lists the AWS Managed Microsoft AD directories in every given region concurrently.
+        by_region = self.fan_out(self.directories_in_region, list(regions))
+        return [directory for region in sorted(by_region) for directory in by_region[region]]
+
+    def vpcs(self, region):
+        return self.cached('vpcs', region, lambda: self.load_vpcs(region))
+
+    def load_vpcs(self, region):
+        paginator = self.client('ec2', region).get_paginator('describe_vpcs')
+        vpcs = []
+        for page in paginator.paginate():
+            for vpc in page['Vpcs']:
+                name = next((tag['Value'] for tag in vpc.get('Tags', []) if tag['Key'] == 'Name'), '')
+                vpcs.append({'VpcId': vpc['VpcId'], 'Name': name, 'CidrBlock': vpc.get('CidrBlock')})
+        return vpcs
+
+    def subnets(self, region, vpc_id=None):
+        # All subnets of a region are cached together and filtered locally, so any VPC is answered from one entry.
+        subnets = self.cached('subnets', region, lambda: self.load_subnets(region))
+        return [subnet for subnet in subnets if vpc_id is None or subnet['VpcId'] == vpc_id]
+
+    def load_subnets(self, region):
+        paginator = self.client('ec2', region).get_paginator('describe_subnets')
+        subnets = []
+        for page in paginator.paginate():
+            for subnet in page['Subnets']:
+                subnets.append({'SubnetId': subnet['SubnetId'], 'VpcId': subnet['VpcId'],
+                                'AvailabilityZone': subnet['AvailabilityZone'], 'CidrBlock': subnet.get('CidrBlock')})
+        return subnets
+
+    def network(self, region):
+        # Fetches the VPCs and all subnets of a region concurrently so picking a VPC doesn't cost another round trip.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            vpcs = pool.submit(self.vpcs, region)
+            subnets = pool.submit(self.subnets, region)
+            return vpcs.result(), subnets.result()
+
+    def validate_network(self, region, vpc_id=None, subnet_ids=()):
+        # Checks that the VPC and subnets exist (and that the subnets belong to the VPC) before anything is created.
+        # An unknown ID refreshes the cached lists once, since it may have been created after they were cached.
+        # Returns the subnet records so callers can read their availability zones.
+        subnet_ids = [subnet_id for subnet_id in subnet_ids if subnet_id]
+        for attempt in range(2):
+            vpcs, subnets = self.network(region)
+            known_vpcs = {vpc['VpcId'] for vpc in vpcs}
+            known_subnets = {subnet['SubnetId']: subnet for subnet in subnets}
+            missing = [vpc_id] if vpc_id and vpc_id not in known_vpcs else []
+            missing += [subnet_id for subnet_id in subnet_ids if subnet_id not in known_subnets]
+            if not missing:
+                break
+            if attempt == 0:
+                self.invalidate(region=region, kind='vpcs')
+                self.invalidate(region=region, kind='subnets')
+        else:
+            raise ValueError(f"Not found in {region}: {', '.join(missing)}")
+
+        for subnet_id in subnet_ids:
+            if vpc_id and known_subnets[subnet_id]['VpcId'] != vpc_id:
+                raise ValueError(f"Subnet {subnet_id} is in {known_subnets[subnet_id]['VpcId']}, not {vpc_id}")
+        return [known_subnets[subnet_id] for subnet_id in subnet_ids]
+
+    @classmethod
+    def validate_network_from_opts(cls, opts, vpc_id=None, subnet_ids=(), discovery=None):
+        # Argument validation for the create commands. Invalid IDs raise ValueError; if the lookup itself fails
+        # (e.g. no ec2:Describe* permission) the check is skipped with a warning rather than blocking the deploy.
+        # Long-lived callers pass a warm `discovery`; otherwise one is created from the options.
+        if getattr(opts, 'skip_network_validation', False):
+            return None
+        discovery = discovery or cls.from_opts(opts)
+        region = getattr(opts, 'aws_region', None) or discovery.session.region_name
+        try:
+            return discovery.validate_network(region, vpc_id=vpc_id, subnet_ids=subnet_ids)
+        except ValueError:
+            raise
+        except Exception as e:
+            LOG.warning(f"Skipping network validation: {e}")
+            return None
+
+
+class AwsCapacityPreflight:
+    # Checks that the instance types of a deployment are offered in its availability zone and that the account's
+    # On-Demand vCPU quotas leave room for them, before a stack is created. A stack that fails on
+    # InsufficientInstanceCapacity or a vCPU limit costs 20-40 minutes; these lookups take seconds.
+    # Offerings, instance type specs and quota values go through the discovery cache; current usage never does.
+
+    # Running On-Demand instance vCPU quotas, by instance family prefix. Families not listed here aren't checked.
+    quota_codes = {
+        'standard': 'L-1216C47A',
+        'g': 'L-DB2E81BA', 'vt': 'L-DB2E81BA',
+        'p': 'L-417A185B',
+        'f': 'L-74FC7D96',
+        'x': 'L-7295265B',
+        'inf': 'L-1945791B',
+        'dl': 'L-6E869C2A',
+        'trn': 'L-2C3B7624',
+    }
+    standard_families = set('acdhimrtz')
+    # Families with quotas of their own (dedicated hosts, HPC, high memory) that the preflight doesn't check.
+    unchecked_families = ('hpc', 'mac', 'u')
+
+    def __init__(self, discovery, max_workers=16):
+        self.discovery = discovery
+        self.max_workers = max_workers
+
+    @classmethod
+    def quota_code(cls, instance_type):
+        family = re.match(r'[a-z]+', instance_type).group(0)
+        for prefix in ('inf', 'trn', 'dl', 'vt'):
+            if family.startswith(prefix):
+                return cls.quota_codes[prefix]
+        if family.startswith(cls.unchecked_families):
+            return None
+        if family[0] in cls.standard_families:
+            return cls.quota_codes['standard']
+        return cls.quota_codes.get(family[0])
+
+    def offered_zones(self, region, instance_type):
+        return self.discovery.cached('instance-offerings', region, self.load_offered_zones, region, instance_type)
+
+    def load_offered_zones(self, region, instance_type):
+        paginator = self.discovery.client('ec2', region).get_paginator('describe_instance_type_offerings')
+        zones = []
+        for page in paginator.paginate(LocationType='availability-zone',
+                                       Filters=[{'Name': 'instance-type', 'Values': [instance_type]}]):
+            zones.extend(offering['Location'] for offering in page['InstanceTypeOfferings'])
+        return sorted(zones)
+
+    def vcpus(self, region, instance_type):
+        return self.discovery.cached('instance-types', region, self.load_vcpus, region, instance_type)
+
+    def load_vcpus(self, region, instance_type):
+        instance_types = self.discovery.client('ec2', region).describe_instance_types(
+            InstanceTypes=[instance_type])['InstanceTypes']
+        if not instance_types:
+            raise ValueError(f"Unknown instance type {instance_type}")
+        return instance_types[0]['VCpuInfo']['DefaultVCpus']
+
+    def quota(self, region, quota_code):
+        return self.discovery.cached('ec2-quotas', region, self.load_quota, region, quota_code)
+
+    def load_quota(self, region, quota_code):
+        client = self.discovery.client('service-quotas', region)
+        try:
+            return client.get_service_quota(ServiceCode='ec2', QuotaCode=quota_code)['Quota']['Value']
+        except Exception as e:
+            # Quotas that were never changed only exist as AWS defaults in some accounts.
+            if aws_error_code(e) != 'NoSuchResourceException':
+                raise
+            return client.get_aws_default_service_quota(ServiceCode='ec2', QuotaCode=quota_code)['Quota']['Value']
+
+    def running_instance_types(self, region):
+        # Counts the pending and running instances of the account by type.
+        paginator = self.discovery.client('ec2', region).get_paginator('describe_instances')
+        counts = collections.Counter()
+        for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]):
+            for reservation in page['Reservations']:
+                counts.update(instance['InstanceType'] for instance in reservation['Instances'])
+        return counts
+
+    def check(self, region, requirements, availability_zone=None):
+        # `requirements` maps instance types to instance counts. Returns a report with the zones offering every
+        # requested type and the vCPU needed/used/limit of every quota involved; report['problems'] lists what
+        # would make the stack fail.
+        instance_types = sorted(requirements)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            zones = {t: pool.submit(self.offered_zones, region, t) for t in instance_types}
+            vcpus = {t: pool.submit(self.vcpus, region, t) for t in instance_types}
+            codes = {t: self.quota_code(t) for t in instance_types}
+            quotas = {code: pool.submit(self.quota, region, code) for code in set(codes.values()) if code}
+            running = pool.submit(self.running_instance_types, region)
+            zones = {t: future.result() for t, future in zones.items()}
+            vcpus = {t: future.result() for t, future in vcpus.items()}
+            quotas = {code: future.result() for code, future in quotas.items()}
+            running = running.result()
+            running_vcpus = dict(zip(running, pool.map(lambda t: self.vcpus(region, t), running)))
+
+        problems = []
+        offered = sorted(set.intersection(*[set(z) for z in zones.values()])) if zones else []
+        for instance_type in instance_types:
+            if not zones[instance_type]:
+                problems.append(f"{instance_type} is not offered in {region}")
+            elif availability_zone and availability_zone not in zones[instance_type]:
+                problems.append(f"{instance_type} is not offered in {availability_zone} "
+                                f"(offered in {', '.join(zones[instance_type])})")
+
+        quota_report = {}
+        for code, limit in quotas.items():
+            needed = sum(vcpus[t] * requirements[t] for t in instance_types if codes[t] == code)
+            used = sum(running_vcpus[t] * count for t, count in running.items() if self.quota_code(t) == code)
+            quota_report[code] = {'needed': needed, 'used': used, 'limit': limit}
+            if used + needed > limit:
+                families = ', '.join(t for t in instance_types if codes[t] == code)
+                problems.append(f"{families} needs {needed} vCPUs but quota {code} allows {limit:g} "
+                                f"with {used} in use")
+        return {'region': region, 'zones': zones, 'offered_zones': offered, 'quotas': quota_report,
+                'problems': problems}
+
+    @classmethod
+    def subnet_for_zone(cls, subnets, zones, vpc_id=None):
+        # Picks the first subnet of the VPC whose zone is in `zones`, used to re-target a deployment.
+        for subnet in subnets:
+            if subnet['AvailabilityZone'] in zones and (vpc_id is None or subnet['VpcId'] == vpc_id):
+                return subnet
+        return None
+
+    @classmethod
+    def check_from_opts(cls, opts, requirements, subnet_id=None, vpc_id=None, retarget=False, discovery=None):
+        # Runs the preflight for a create command and returns the subnet ID to deploy into. When the subnet's zone
+        # lacks a type and `retarget` is set, another subnet of the VPC in a zone offering every type is returned.
+        # Capacity problems raise ValueError; a failed lookup (e.g. missing permissions) only logs a warning.
+        if getattr(opts, 'skip_preflight', False) or not requirements:
+            return subnet_id
+        discovery = discovery or AwsNetworkDiscovery.from_opts(opts)
+        region = getattr(opts, 'aws_region', None) or discovery.session.region_name
+        preflight = cls(discovery)
+        try:
+            subnets = discovery.subnets(region, vpc_id) if subnet_id else []
+            subnet = next((s for s in subnets if s['SubnetId'] == subnet_id), None)
+            zone = subnet['AvailabilityZone'] if subnet else None
+            report = preflight.check(region, requirements, availability_zone=zone)
+        except ValueError:
+            raise
+        except Exception as e:
+            LOG.warning(f"Skipping capacity preflight: {e}")
+            return subnet_id
+
+        problems = report['problems']
+        if zone and zone not in report['offered_zones'] and retarget:
+            alternative = cls.subnet_for_zone(subnets, report['offered_zones'], vpc_id)
+            if alternative is not None:
+                LOG.warning(f"Re-targeting from {subnet_id} ({zone}) to {alternative['SubnetId']} "
+                            f"({alternative['AvailabilityZone']})")
+                subnet_id = alternative['SubnetId']
+                problems = [p for p in problems if f"not offered in {zone}" not in p]
+        if problems:
+            raise ValueError("Capacity preflight failed: " + '; '.join(problems))
+        return subnet_id
+
+
+class AwsFsxHelper:
+    # A utility class for creating Amazon FSx file systems and waiting on their lifecycle using boto3.
+
+    lustre_deployment_types = ['SCRATCH_1', 'SCRATCH_2', 'PERSISTENT_1', 'PERSISTENT_2']
+    deployment_types = {
+        'WINDOWS': ['SINGLE_AZ_1', 'SINGLE_AZ_2', 'MULTI_AZ_1'],
+        'ONTAP': ['SINGLE_AZ_1', 'SINGLE_AZ_2', 'MULTI_AZ_1', 'MULTI_AZ_2'],
+    }
+    default_storage_capacity = {'LUSTRE': 1200, 'WINDOWS': 32, 'ONTAP': 1024}
+    default_throughput_capacity = {'WINDOWS': 32, 'ONTAP': 128}
+    # Each PERSISTENT generation only offers fixed per-unit storage throughputs (MB/s/TiB).
+    per_unit_storage_throughputs = {'PERSISTENT_1': [50, 100, 200], 'PERSISTENT_2': [125, 250, 500, 1000]}
+    default_per_unit_storage_throughput = {'PERSISTENT_1': 200, 'PERSISTENT_2': 250}
+    # The ImportPath file systems only take one of these fixed policies instead of a set of events.
+    legacy_auto_import_policies = {
+        frozenset(): 'NONE',
+        frozenset(['NEW']): 'NEW',
+        frozenset(['NEW', 'CHANGED']): 'NEW_CHANGED',
+        frozenset(['NEW', 'CHANGED', 'DELETED']): 'NEW_CHANGED_DELETED',
+    }
+
+    @classmethod
+    def build_windows_create_args(cls, subnet_ids, deployment_type, throughput_capacity=32, storage_capacity=32,
+                                  active_directory_id=None, self_managed_active_directory=None,
+                                  security_group_ids=None, name=None):
+        # Builds the create_file_system arguments for FSx for Windows File Server.
+        # Exactly one of an AWS Managed AD id or a self-managed AD configuration must be given.
+        windows_configuration = {
+            'DeploymentType': deployment_type,
+            'ThroughputCapacity': int(throughput_capacity),
+        }
+        if active_directory_id is not None:
+            windows_configuration['ActiveDirectoryId'] = active_directory_id
+        elif self_managed_active_directory is not None:
+            windows_configuration['SelfManagedActiveDirectoryConfiguration'] = self_managed_active_directory
+        else:
+            raise ValueError("FSx for Windows requires an Active Directory")
+        if deployment_type.startswith('MULTI_AZ'):
+            windows_configuration['PreferredSubnetId'] = subnet_ids[0]
+        return cls.build_create_args('WINDOWS', subnet_ids, storage_capacity, security_group_ids, name,
+                                     WindowsConfiguration=windows_configuration)
+
+    @classmethod
+    def build_ontap_create_args(cls, subnet_ids, deployment_type, throughput_capacity=128, storage_capacity=1024,
+                                fsx_admin_password=None, security_group_ids=None, name=None):
+        # Builds the create_file_system arguments for FSx for NetApp ONTAP.
+        ontap_configuration = {
+            'DeploymentType': deployment_type,
+            'ThroughputCapacity': int(throughput_capacity),
+        }
+        if deployment_type.startswith('MULTI_AZ'):
+            ontap_configuration['PreferredSubnetId'] = subnet_ids[0]
+        if fsx_admin_password:
+            ontap_configuration['FsxAdminPassword'] = fsx_admin_password
+        return cls.build_create_args('ONTAP', subnet_ids, storage_capacity, security_group_ids, name,
+                                     OntapConfiguration=ontap_configuration)
+
+    @classmethod
+    def build_create_args(cls, file_system_type, subnet_ids, storage_capacity, security_group_ids=None, name=None,
+                          **configuration):
+        create_args = {
+            'FileSystemType': file_system_type,
+            'StorageCapacity': int(storage_capacity),
+            'StorageType': 'SSD',
+            'SubnetIds': list(subnet_ids),
+            **configuration,
+        }
+        if security_group_ids:
+            create_args['SecurityGroupIds'] = list(security_group_ids)
+        if name:
+            create_args['Tags'] = [{'Key': 'Name', 'Value': name}]
+        return create_args
+
+    @classmethod
+    def legacy_auto_import_policy(cls, auto_import_events):
+        # Maps a set of S3 auto-import events to the AutoImportPolicy of a SCRATCH/PERSISTENT_1 file system.
+        events = frozenset(event.upper() for event in auto_import_events or [])
+        policy = cls.legacy_auto_import_policies.get(events)
+        if policy is None:
+            raise ValueError(f"Auto-import events {','.join(sorted(events))} have no ImportPath equivalent; "
+                             f"use NEW, NEW,CHANGED or NEW,CHANGED,DELETED")
+        return policy
+
+    @classmethod
+    def build_lustre_create_args(cls, subnet_ids, storage_capacity=1200, deployment_type='PERSISTENT_2',
+                                 per_unit_storage_throughput=None, security_group_ids=None, lustre_version='2.15',
+                                 data_compression_type='LZ4', import_path=None, export_path=None,
+                                 imported_file_chunk_size=None, auto_import_policy=None, name=None):
+        # Builds the create_file_system arguments for an FSx for Lustre file system.
+        # SCRATCH and PERSISTENT_1 file systems link S3 through ImportPath/ExportPath; PERSISTENT_2 uses a
+        # data repository association that is created once the file system is available.
+        lustre_configuration = {
+            'DeploymentType': deployment_type,
+            'DataCompressionType': data_compression_type,
+        }
+        if deployment_type in cls.per_unit_storage_throughputs:
+            allowed = cls.per_unit_storage_throughputs[deployment_type]
+            throughput = int(per_unit_storage_throughput or cls.default_per_unit_storage_throughput[deployment_type])
+            if throughput not in allowed:
+                raise ValueError(f"{deployment_type} supports a per-unit storage throughput of "
+                                 f"{', '.join(str(t) for t in allowed)} MB/s/TiB, not {throughput}")
+            lustre_configuration['PerUnitStorageThroughput'] = throughput
+        elif per_unit_storage_throughput:
+            raise ValueError(f"{deployment_type} file systems have no per-unit storage throughput")
+        if import_path is not None:
+            lustre_configuration['ImportPath'] = import_path
+            if export_path is not None:
+                lustre_configuration['ExportPath'] = export_path
+            if imported_file_chunk_size is not None:
+                lustre_configuration['ImportedFileChunkSize'] = int(imported_file_chunk_size)
+            if auto_import_policy is not None:
+                lustre_configuration['AutoImportPolicy'] = auto_import_policy
+
+        return cls.build_create_args('LUSTRE', subnet_ids, storage_capacity, security_group_ids, name,
+                                     FileSystemTypeVersion=lustre_version,
+                                     LustreConfiguration=lustre_configuration)
+
+    @classmethod
+    def build_data_repository_association_args(cls, file_system_id, data_repository_path, file_system_path='/',
+                                               batch_import_metadata=True, imported_file_chunk_size=None,
+                                               auto_import_events=None, auto_export_events=None):
+        # Builds the create_data_repository_association arguments linking an S3 prefix into the namespace.
+        dra_args = {
+            'FileSystemId': file_system_id,
+            'FileSystemPath': file_system_path,
+            'DataRepositoryPath': data_repository_path,
+            'BatchImportMetaDataOnCreate': batch_import_metadata,
+        }
+        if imported_file_chunk_size is not None:
+            dra_args['ImportedFileChunkSize'] = int(imported_file_chunk_size)
+        s3_config = {}
+        if auto_import_events:
+            s3_config['AutoImportPolicy'] = {'Events': list(auto_import_events)}
+        if auto_export_events:
+            s3_config['AutoExportPolicy'] = {'Events': list(auto_export_events)}
+        if s3_config:
+            dra_args['S3'] = s3_config
+        return dra_args
+
+    @classmethod
+    def wait_for_lifecycle(cls, describe, ready_states=('AVAILABLE',), failed_states=('FAILED', 'MISCONFIGURED'),
+                           poll_interval=30, timeout=3600):
+        # Polls `describe()` (which returns a resource dict with a Lifecycle key) until it reaches a ready state.
+        deadline = time.monotonic() + timeout
+        while True:
+            resource = describe()
+            lifecycle = resource.get('Lifecycle')
+            LOG.info(f"Lifecycle is {lifecycle}")
+            if lifecycle in ready_states:
+                return resource
+            if lifecycle in failed_states:
+                failure = resource.get('FailureDetails', {}).get('Message', '')
+                raise ValueError(f"Resource entered {lifecycle}: {failure}")
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Timed out waiting for resource (last lifecycle {lifecycle})")
+            time.sleep(poll_interval)
+
+    @classmethod
+    def wait_for_file_system(cls, client, file_system_id, **kwargs):
+        return cls.wait_for_lifecycle(
+            lambda: client.describe_file_systems(FileSystemIds=[file_system_id])['FileSystems'][0], **kwargs)
+
+    @classmethod
+    def wait_for_data_repository_association(cls, client, association_id, **kwargs):
+        return cls.wait_for_lifecycle(
+            lambda: client.describe_data_repository_associations(
+                AssociationIds=[association_id])['Associations'][0], **kwargs)
+
+
+class EnvoiStorageFsxAwsCreateFileSystemCommand(EnvoiCommand):
+    # Creates an Amazon FSx file system (Lustre, Windows File Server or NetApp ONTAP).
+    # FSx for Lustre is created with its S3 data repository linked, so the namespace is populated from S3 and the
+    # `preload` command can hydrate it before the first render.
+    # Anything not given on the command line (region, deployment type, Active Directory, VPC and subnets) is picked
+    # from menus built by AwsNetworkDiscovery when running on a terminal; with --no-input missing values are errors.
+
+    description = "Create an Amazon FSx file system"
+
+    file_system_types = ['LUSTRE', 'WINDOWS', 'ONTAP']
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        add_aws_arguments(parser)
+        parser.add_argument('--file-system-type', choices=cls.file_system_types, required=False,
+                            help='FSx file system type')
+        parser.add_argument('--name', type=str, required=False,
+                            help='Value of the Name tag')
+        parser.add_argument('--vpc-id', type=str, required=False,
+                            help='VPC used to narrow the subnet choices when --subnet-ids is not given')
+        parser.add_argument('--subnet-ids', type=str, required=False,
+                            help='Comma-separated subnet IDs (two for MULTI_AZ deployments, preferred subnet first)')
+        parser.add_argument('--security-group-ids', type=str, required=False,
+                            help='Comma-separated security group IDs')
+        parser.add_argument('--storage-capacity', type=int, required=False,
+                            help='Storage capacity in GiB (defaults to 1200 for Lustre, 32 for Windows, '
+                                 '1024 for ONTAP)')
+        parser.add_argument('--yes', action='store_true',
+                            help='Do not ask for confirmation before creating the file system')
+        parser.add_argument('--no-input', action='store_true',
+                            help='Never prompt; fail if a required value is missing')
+        parser.add_argument('--refresh-discovery', action='store_true',
+                            help='Ignore cached regions, directories, VPCs and subnets for this profile')
+        parser.add_argument('--wait', action='store_true',
+                            help='Wait until the file system is available')
+        parser.add_argument('--poll-interval', type=float, default=30,
+                            help='Seconds between status checks while waiting')
+
+        # FSx for Windows File Server and NetApp ONTAP
+        parser.add_argument('--deployment-type', choices=sorted(set(sum(AwsFsxHelper.deployment_types.values(), []))),
+                            required=False,
+                            help='Windows/ONTAP deployment type')
+        parser.add_argument('--throughput-capacity', type=int, required=False,
+                            help='Throughput capacity in MB/s (defaults to 32 for Windows, 128 for ONTAP)')
+        parser.add_argument('--active-directory-id', type=str, required=False,
+                            help='AWS Managed Microsoft AD directory ID (Windows)')
+        parser.add_argument('--ad-domain-name', type=str, required=False,
+                            help='Self-managed Active Directory domain name (Windows)')
+        parser.add_argument('--ad-dns-ips', type=str, required=False,
+                            help='Comma-separated DNS server IPs of the self-managed Active Directory')
+        parser.add_argument('--ad-username', type=str, required=False,
+                            help='Self-managed Active Directory service account user name')
+        parser.add_argument('--ad-password', type=str, required=False,
+                            default=os.environ.get('FSX_AD_PASSWORD'),
+                            help='Self-managed Active Directory password (defaults to $FSX_AD_PASSWORD)')
+        parser.add_argument('--fsx-admin-password', type=str, required=False,
+                            default=os.environ.get('FSX_ADMIN_PASSWORD'),
+                            help='ONTAP fsxadmin password (defaults to $FSX_ADMIN_PASSWORD)')
+
+        # FSx for Lustre
+        parser.add_argument('--lustre-deployment-type', choices=AwsFsxHelper.lustre_deployment_types,
+                            default='PERSISTENT_2',
+                            help='Lustre deployment type')
+        parser.add_argument('--lustre-version', type=str, default='2.15',
+                            help='Lustre version')
+        parser.add_argument('--per-unit-storage-throughput', type=int, required=False,
+                            help='Throughput per TiB of storage (MB/s/TiB) for PERSISTENT deployments; '
+                                 'defaults to 200 for PERSISTENT_1 and 250 for PERSISTENT_2')
+        parser.add_argument('--data-compression-type', choices=['LZ4', 'NONE'], default='LZ4',
+                            help='Lustre data compression')
+        parser.add_argument('--data-repository-path', type=str, required=False,
+                            help='S3 data repository to link, e.g. s3://bucket/prefix')
+        parser.add_argument('--file-system-path', type=str, default='/',
+                            help='Lustre path the data repository is linked to (PERSISTENT_2)')
+        parser.add_argument('--export-path', type=str, required=False,
+                            help='S3 export path (SCRATCH/PERSISTENT_1 only)')
+        parser.add_argument('--imported-file-chunk-size', type=int, required=False,
+                            help='Stripe size in MiB for files imported from S3')
+        parser.add_argument('--auto-import-events', type=str, default='NEW,CHANGED,DELETED',
+                            help='Comma-separated S3 events imported automatically (empty to disable)')
+        parser.add_argument('--auto-export-events', type=str, default='',
+                            help='Comma-separated Lustre events exported automatically (PERSISTENT_2)')
+        parser.add_argument('--no-batch-import-metadata', action='store_true',
+                            help='Do not import the S3 metadata when the association is created')
+        return parser
+
+    def __init__(self, opts=None, auto_exec=True):
+        self.discovery = None
+        self.interactive = False
+        super().__init__(opts=opts, auto_exec=auto_exec)
+
+    @staticmethod
+    def split_list(value):
+        return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+    def create_lustre(self, client, opts):
+        deployment_type = opts.lustre_deployment_type
+        uses_association = opts.data_repository_path is not None and deployment_type == 'PERSISTENT_2'
+        legacy_import_path = opts.data_repository_path if not uses_association else None
+        auto_import_events = self.split_list(opts.auto_import_events)
+        auto_import_policy = AwsFsxHelper.legacy_auto_import_policy(auto_import_events) if legacy_import_path else None
+        create_args = AwsFsxHelper.build_lustre_create_args(
+            subnet_ids=self.split_list(opts.subnet_ids),
+            security_group_ids=self.split_list(opts.security_group_ids),
+            storage_capacity=opts.storage_capacity or AwsFsxHelper.default_storage_capacity['LUSTRE'],
+            deployment_type=deployment_type,
+            per_unit_storage_throughput=opts.per_unit_storage_throughput,
+            lustre_version=opts.lustre_version,
+            data_compression_type=opts.data_compression_type,
+            import_path=legacy_import_path,
+            export_path=opts.export_path,
+            imported_file_chunk_size=opts.imported_file_chunk_size,
+            auto_import_policy=auto_import_policy,
+            name=opts.name)
+
+        file_system = client.create_file_system(**create_args)['FileSystem']
+        file_system_id = file_system['FileSystemId']
+        LOG.info(f"Created file system {file_system_id}")
+        result = {'FileSystemId': file_system_id, 'Lifecycle': file_system.get('Lifecycle')}
+
+        # Associations can only be created once the file system is available, so linking S3 implies waiting.
+        if opts.wait or uses_association:
+            file_system = AwsFsxHelper.wait_for_file_system(client, file_system_id, poll_interval=opts.poll_interval)
+            result['Lifecycle'] = file_system['Lifecycle']
+
+        if uses_association:
+            dra_args = AwsFsxHelper.build_data_repository_association_args(
+                file_system_id, opts.data_repository_path,
+                file_system_path=opts.file_system_path,
+                batch_import_metadata=not opts.no_batch_import_metadata,
+                imported_file_chunk_size=opts.imported_file_chunk_size,
+                auto_import_events=auto_import_events,
+                auto_export_events=self.split_list(opts.auto_export_events))
+            association = client.create_data_repository_association(**dra_args)['Association']
+            result['AssociationId'] = association['AssociationId']
+            if opts.wait:
+                association = AwsFsxHelper.wait_for_data_repository_association(
+                    client, association['AssociationId'], poll_interval=opts.poll_interval)
+            result['AssociationLifecycle'] = association.get('Lifecycle')
+
+        dns_name = file_system.get('DNSName')
+        mount_name = file_system.get('LustreConfiguration', {}).get('MountName')
+        if dns_name and mount_name:
+            result['MountCommand'] = f"sudo mount -t lustre -o relatime,flock {dns_name}@tcp:/{mount_name} /fsx"
+        return result
+
+    def require(self, opts, name, prompt):
+        # Returns the option value, prompting for it on a terminal or failing when prompting is disabled.
+        value = getattr(opts, name, None)
+        if value in (None, ''):
+            if not self.interactive:
+                raise ValueError(f"--{name.replace('_', '-')} is required")
+            value = prompt()
+            setattr(opts, name, value)
+        return value
+
+    def resolve_region(self, opts):
+        # The region comes from --aws-region or the profile/environment; it is only asked for when neither is set.
+        region = getattr(opts, 'aws_region', None) or self.discovery.session.region_name
+        if region is None:
+            region = self.require(opts, 'aws_region',
+                                  lambda: prompt_choice("Select the AWS Region:", self.discovery.fsx_regions()))
+        opts.aws_region = region
+        return region
+
+    def resolve_active_directory(self, opts):
+        # Fills in either --active-directory-id or the self-managed AD settings for FSx for Windows.
+        if opts.active_directory_id or opts.ad_domain_name:
+            pass
+        elif not self.interactive:
+            raise ValueError("--active-directory-id or --ad-domain-name is required for FSx for Windows")
+        elif prompt_choice("Select the Active Directory option:", ['managed', 'self-managed'],
+                           labels=['Use an existing AWS Managed Microsoft AD',
+                                   'Use an existing Self-Managed Active Directory']) == 'managed':
+            print("Querying AWS Managed ADs across all FSx regions...", file=sys.stderr)
+            directories = self.discovery.directories(self.discovery.fsx_regions())
+            if not directories:
+                raise ValueError("No AWS Managed ADs found in any region")
+            directory = prompt_choice("Select an AWS Managed AD:", directories,
+                                      labels=[f"{d['DirectoryId']}  {d['Name']}  {d['Region']}  {d['Stage']}"
+                                              for d in directories])
+            if directory['Region'] != opts.aws_region:
+                LOG.warning(f"Directory {directory['DirectoryId']} is in {directory['Region']}; it must be shared "
+                            f"with {opts.aws_region} to join the file system")
+            opts.active_directory_id = directory['DirectoryId']
+            if not opts.vpc_id and directory['Region'] == opts.aws_region:
+                opts.vpc_id = directory['VpcId']
+
+        if opts.active_directory_id:
+            return {'active_directory_id': opts.active_directory_id}
+
+        self.require(opts, 'ad_domain_name', lambda: prompt_value("Domain Name (e.g., ad.example.com)"))
+        self.require(opts, 'ad_dns_ips', lambda: prompt_value("DNS IP Addresses (e.g., 10.0.1.1,10.0.2.2)"))
+        self.require(opts, 'ad_username', lambda: prompt_value("Admin Username"))
+        self.require(opts, 'ad_password', lambda: prompt_value("Admin Password", secret=True))
+        return {'self_managed_active_directory': {
+            'DomainName': opts.ad_domain_name,
+            'DnsIps': self.split_list(opts.ad_dns_ips),
+            'UserName': opts.ad_username,
+            'Password': opts.ad_password,
+        }}
+
+    def resolve_subnets(self, opts, deployment_type):
+        # Returns the subnet list, picking a VPC and subnets from one concurrent VPC/subnet lookup if needed.
+        count = 2 if deployment_type.startswith('MULTI_AZ') else 1
+        if not opts.subnet_ids:
+            if not self.interactive:
+                raise ValueError("--subnet-ids is required")
+            vpcs, subnets = self.discovery.network(opts.aws_region)
+            if not opts.vpc_id:
+                vpc = prompt_choice("Select a VPC:", vpcs,
+                                    labels=[f"{v['VpcId']}  {v['Name']}  {v['CidrBlock']}" for v in vpcs])
+                opts.vpc_id = vpc['VpcId']
+            subnets = [subnet for subnet in subnets if subnet['VpcId'] == opts.vpc_id]
+            selected = prompt_choice(f"Select {count} subnet(s) in {opts.vpc_id}:", subnets, count=count,
+                                     labels=[f"{s['SubnetId']}  {s['AvailabilityZone']}  {s['CidrBlock']}"
+                                             for s in subnets])
+            selected = [selected] if count == 1 else selected
+            opts.subnet_ids = ','.join(subnet['SubnetId'] for subnet in selected)
+        subnet_ids = self.split_list(opts.subnet_ids)
+        if len(subnet_ids) != count:
+            raise ValueError(f"{deployment_type} deployments need exactly {count} subnet(s)")
+        return subnet_ids
+
+    def build_create_args(self, opts):
+        file_system_type = opts.file_system_type
+        storage_capacity = opts.storage_capacity or AwsFsxHelper.default_storage_capacity[file_system_type]
+        if file_system_type == 'LUSTRE':
+            self.resolve_subnets(opts, 'SINGLE_AZ')
+            return None
+
+        deployment_type = self.require(opts, 'deployment_type', lambda: prompt_choice(
+            f"Select the deployment type for {file_system_type}:",
+            AwsFsxHelper.deployment_types[file_system_type]))
+        if deployment_type not in AwsFsxHelper.deployment_types[file_system_type]:
+            raise ValueError(f"{deployment_type} is not a valid {file_system_type} deployment type")
+        throughput_capacity = (opts.throughput_capacity or
+                               AwsFsxHelper.default_throughput_capacity[file_system_type])
+        common_args = {
+            'deployment_type': deployment_type,
+            'throughput_capacity': throughput_capacity,
+            'storage_capacity': storage_capacity,
+            'security_group_ids': self.split_list(opts.security_group_ids),
+            'name': opts.name,
+        }
+        if file_system_type == 'WINDOWS':
+            active_directory_args = self.resolve_active_directory(opts)
+            subnet_ids = self.resolve_subnets(opts, deployment_type)
+            return AwsFsxHelper.build_windows_create_args(subnet_ids, **common_args, **active_directory_args)
+        subnet_ids = self.resolve_subnets(opts, deployment_type)
+        return AwsFsxHelper.build_ontap_create_args(subnet_ids, fsx_admin_password=opts.fsx_admin_password,
+                                                    **common_args)
+
+    @classmethod
+    def describe_create_args(cls, create_args):
+        # Returns the create arguments as JSON with secrets masked, for the confirmation summary.
+        masked = json.loads(json.dumps(create_args))
+        for configuration in masked.values():
+            if isinstance(configuration, dict):
+                if 'FsxAdminPassword' in configuration:
+                    configuration['FsxAdminPassword'] = '********'
+                self_managed = configuration.get('SelfManagedActiveDirectoryConfiguration')
+                if self_managed:
+                    self_managed['Password'] = '********'
+        return json.dumps(masked, indent=2)
+
+    def create(self, client, opts, create_args):
+        file_system = client.create_file_system(**create_args)['FileSystem']
+        result = {'FileSystemId': file_system['FileSystemId'], 'Lifecycle': file_system.get('Lifecycle')}
+        if opts.wait:
+            file_system = AwsFsxHelper.wait_for_file_system(client, file_system['FileSystemId'],
+                                                            poll_interval=opts.poll_interval)
+            result['Lifecycle'] = file_system['Lifecycle']
+            result['DNSName'] = file_system.get('DNSName')
+        return result
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        self.interactive = not opts.no_input and sys.stdin.isatty()
+        self.discovery = AwsNetworkDiscovery.from_opts(opts)
+
+        self.require(opts, 'file_system_type', lambda: prompt_choice(
+            "Select the Amazon FSx file system type:", self.file_system_types,
+            labels=['Amazon FSx for Lustre', 'Amazon FSx for Windows File Server', 'Amazon FSx for NetApp ONTAP']))
+        region = self.resolve_region(opts)
+        create_args = self.build_create_args(opts)
+
+        if self.interactive and not opts.yes:
+            print(f"\nFile system type: {opts.file_system_type}\nRegion: {region}", file=sys.stderr)
+            if create_args is not None:
+                print(self.describe_create_args(create_args), file=sys.stderr)
+            if not prompt_confirm("Would you like to proceed with the deployment?"):
+                return "Deployment canceled by user."
+
+        client = self.discovery.client('fsx', region)
+        if create_args is None:
+            result = self.create_lustre(client, opts)
+        else:
+            result = self.create(client, opts, create_args)
+        return json.dumps(result, indent=2)
+
+
+class EnvoiStorageFsxAwsPreloadCommand(EnvoiCommand):
+    # Hydrates an FSx for Lustre namespace linked to S3 so first reads don't pay lazy-load latency.
+    # Run it on a Lustre client: directories are walked concurrently and files are restored in batches with
+    # `lfs hsm_restore`, with a bounded number of restore processes in flight.
+
+    description = "Preload (hsm_restore) files of an S3-linked FSx for Lustre namespace"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('paths', nargs='+',
+                            help='Directories or files on the mounted Lustre file system')
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Number of parallel directory scanners')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Maximum number of hsm_restore processes running at once')
+        parser.add_argument('--batch-size', type=int, default=256,
+                            help='Number of files passed to each hsm_restore call')
+        parser.add_argument('--released-only', action='store_true',
+                            help='Check hsm_state first and only restore files that are still released')
+        parser.add_argument('--lfs-command', type=str, default='lfs',
+                            help='Path to the lfs utility')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the files that would be restored')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between progress lines (0 to disable)')
+        return parser
+
+    def __init__(self, opts=None, auto_exec=True):
+        self.progress = None
+        super().__init__(opts=opts, auto_exec=auto_exec)
+
+    @staticmethod
+    def scan_directory(path):
+        # Returns the subdirectories and regular files directly inside `path`.
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry.path)
+        except OSError as e:
+            LOG.warning(f"preload: {path}: {e}")
+        return subdirs, files
+
+    def released_files(self, files):
+        # Filters a batch down to files whose HSM state reports them as released (not yet hydrated).
+        output = subprocess.run([self.opts.lfs_command, 'hsm_state', *files],
+                                check=True, capture_output=True, text=True).stdout
+        released = []
+        for line in output.splitlines():
+            path, _, state = line.rpartition(': ')
+            if path and 'released' in state.split():
+                released.append(path)
+        return released
+
+    def restore_batch(self, files):
+        try:
+            if self.opts.released_only:
+                files = self.released_files(files)
+            if files and not self.opts.dry_run:
+                subprocess.run([self.opts.lfs_command, 'hsm_restore', *files], check=True, capture_output=True)
+            self.progress.add('files', len(files))
+            self.progress.add('batches')
+        except (OSError, subprocess.CalledProcessError) as e:
+            LOG.warning(f"preload: hsm_restore failed for a batch starting at {files[0]}: {e}")
+            self.progress.add('errors')
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        self.opts = opts
+        self.progress = ProgressReporter('preload', interval=opts.progress_interval).start()
+        batch_size = max(opts.batch_size, 1)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.workers, 1)) as scanners, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.concurrency, 1)) as restorers:
+                scans = set()
+                restores = []
+                pending_files = []
+                for path in opts.paths:
+                    if os.path.isdir(path):
+                        scans.add(scanners.submit(self.scan_directory, path))
+                    else:
+                        pending_files.append(path)
+                # Scan results come back to this thread, which fans subdirectories back out to the scanners
+                # and hands full batches to the restore pool.
+                while scans or pending_files:
+                    if scans:
+                        done, scans = concurrent.futures.wait(scans, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            subdirs, files = future.result()
+                            scans.update(scanners.submit(self.scan_directory, subdir) for subdir in subdirs)
+                            pending_files.extend(files)
+                    while len(pending_files) >= batch_size or (pending_files and not scans):
+                        batch, pending_files = pending_files[:batch_size], pending_files[batch_size:]
+                        restores.append(restorers.submit(self.restore_batch, batch))
+                concurrent.futures.wait(restores)
+        finally:
+            self.progress.stop()
+
+        verb = 'Would restore' if opts.dry_run else 'Restored'
+        response = f"{verb} {self.progress.get('files'):,} files in {self.progress.elapsed():.1f}s"
+        if self.progress.get('errors'):
+            response += f", {self.progress.get('errors'):,} failed batches"
+        return response
+
+
+class EnvoiStorageFsxAwsCommand(EnvoiCommand):
+    # Namespace class for Amazon FSx commands.
+    subcommands = {
+        'create-file-system': EnvoiStorageFsxAwsCreateFileSystemCommand,
+        'preload': EnvoiStorageFsxAwsPreloadCommand,
+    }
+
+
+class EnvoiStorageFsxCommand(EnvoiCommand):
+    # Namespace class for FSx commands.
+    subcommands = {
+        'aws': EnvoiStorageFsxAwsCommand,
+    }
+
+
+class ServiceReadinessProbe:
+    # Probes the service ports of every storage node concurrently with short TCP connect timeouts.
+    # A node is ready once all of its ports accept connections; waiting stops as soon as a quorum of nodes is ready,
+    # so clients can mount within seconds of the services coming up instead of after a fixed delay.
+
+    def __init__(self, nodes, ports, connect_timeout=1.0, max_workers=64):
+        self.nodes = list(nodes)
+        self.ports = list(ports)
+        self.connect_timeout = connect_timeout
+        self.max_workers = max_workers
+
+    def port_open(self, host, port):
+        try:
+            with socket.create_connection((host, port), timeout=self.connect_timeout):
+                return True
+        except OSError:
+            return False
+
+    def probe(self, nodes):
+        # Returns the subset of `nodes` whose ports are all open, probing every (node, port) pair at once.
+        pairs = [(node, port) for node in nodes for port in self.ports]
+        if not pairs:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(pairs))) as pool:
+            results = dict(zip(pairs, pool.map(lambda pair: self.port_open(*pair), pairs)))
+        return [node for node in nodes if all(results[(node, port)] for port in self.ports)]
+
+    def wait(self, quorum=None, interval=1.0, timeout=900, stop=None):
+        # Probes the nodes that aren't ready yet every `interval` seconds. Returns the ready nodes (in the original
+        # order) once at least `quorum` of them are ready; the default quorum is a majority. Setting the `stop`
+        # event raises WaitStopped.
+        quorum = quorum or len(self.nodes) // 2 + 1
+        if quorum > len(self.nodes):
+            raise ValueError(f"A quorum of {quorum} needs at least that many nodes, got {len(self.nodes)}")
+        deadline = time.monotonic() + timeout
+        ready = set()
+        while True:
+            ready.update(self.probe([node for node in self.nodes if node not in ready]))
+            LOG.info(f"{len(ready)}/{len(self.nodes)} nodes ready")
+            if len(ready) >= quorum:
+                return [node for node in self.nodes if node in ready]
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Only {len(ready)} of {len(self.nodes)} nodes became ready "
+                                 f"(ports {', '.join(map(str, self.ports))}), {quorum} needed")
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval):
+                raise WaitStopped(f"Stopped waiting for {', '.join(self.nodes)}")
+
+
+class MountMapBuilder:
+    # Builds fstab lines and autofs direct-map entries for clients of a storage cluster.
+    # Clients are spread round-robin over the ready nodes so their mounts don't all land on the first node.
+
+    default_options = {
+        'nfs': 'vers=3,proto=tcp,hard,nconnect=16,rsize=1048576,wsize=1048576,timeo=600,retrans=2,noatime,_netdev',
+        'smb': 'vers=3.1.1,rsize=4194304,wsize=4194304,cache=loose,actimeo=30,noperm,_netdev',
+    }
+
+    def __init__(self, nodes, protocol='nfs', export='/', mount_point='/mnt/storage', options=None):
+        if not nodes:
+            raise ValueError("No ready nodes to build mount maps for")
+        self.nodes = list(nodes)
+        self.protocol = protocol
+        self.export = export
+        self.mount_point = mount_point
+        self.options = options or self.default_options[protocol]
+
+    def source(self, node):
+        if self.protocol == 'smb':
+            return f"//{node}/{self.export.strip('/')}"
+        return f"{node}:{self.export}"
+
+    def fstab_entry(self, node):
+        fs_type = 'cifs' if self.protocol == 'smb' else 'nfs'
+        return f"{self.source(node)} {self.mount_point} {fs_type} {self.options} 0 0"
+
+    def autofs_entry(self, node):
+        fs_type = 'cifs' if self.protocol == 'smb' else 'nfs'
+        source = f":{self.source(node)}" if self.protocol == 'smb' else self.source(node)
+        return f"{self.mount_point} -fstype={fs_type},{self.options} {source}"
+
+    def build(self, clients):
+        # Returns {client: (fstab line, autofs line)}.
+        return {client: (self.fstab_entry(node), self.autofs_entry(node))
+                for client, node in zip(clients, (self.nodes[i % len(self.nodes)] for i in range(len(clients))))}
+
+    def write(self, clients, output_dir):
+        # Writes <client>.fstab and <client>.autofs for every client and returns the paths written.
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for client, entries in self.build(clients).items():
+            for suffix, entry in zip(('fstab', 'autofs'), entries):
+                path = os.path.join(output_dir, f"{client}.{suffix}")
+                with open(path, 'w') as f:
+                    f.write(entry + '\n')
+                paths.append(path)
+        return paths
+
+
+class EnvoiStorageAwsWaitReadyCommand(EnvoiCommand):
+    # Waits for a storage stack to finish, then for its file services to accept connections, and writes the
+    # client mount maps. The vendor subclasses only set the management port and default names.
+
+    vendor = None
+    management_port = None
+    default_stack_name = None
+    service_ports = {'nfs': 2049, 'smb': 445}
+    ipv4_pattern = re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b')
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        add_aws_arguments(parser)
+        parser.add_argument('--stack-name', type=str, default=cls.default_stack_name,
+                            help='Stack whose outputs list the node addresses')
+        parser.add_argument('--nodes', type=str, required=False,
+                            help='Comma-separated node addresses. Skips waiting for the stack and reading its outputs')
+        parser.add_argument('--output-keys', type=str, required=False,
+                            help='Comma-separated stack output keys holding node addresses (defaults to every '
+                                 'IPv4 address in the outputs)')
+        parser.add_argument('--protocol', choices=['nfs', 'smb'], default='nfs',
+                            help='Protocol the clients mount with')
+        parser.add_argument('--ports', type=str, required=False,
+                            help=f"Comma-separated ports that must accept connections (defaults to the protocol port "
+                                 f"and the management port {cls.management_port})")
+        parser.add_argument('--quorum', type=int, required=False,
+                            help='Number of ready nodes to wait for (defaults to a majority)')
+        parser.add_argument('--connect-timeout', type=float, default=1.0,
+                            help='Seconds before a single connection attempt gives up')
+        parser.add_argument('--probe-interval', type=float, default=1.0,
+                            help='Seconds between probe rounds')
+        parser.add_argument('--poll-interval', type=float, default=15,
+                            help='Seconds between stack status checks')
+        parser.add_argument('--timeout', type=float, default=900,
+                            help='Seconds to wait for the services once the stack is complete')
+        parser.add_argument('--clients', type=str, required=False,
+                            help='Comma-separated client names to write mount maps for')
+        parser.add_argument('--export', type=str, default='/',
+                            help='NFS export path or SMB share name')
+        parser.add_argument('--mount-point', type=str, default=f"/mnt/{cls.vendor or 'storage'}",
+                            help='Mount point on the clients')
+        parser.add_argument('--mount-options', type=str, required=False,
+                            help='Mount options (defaults to tuned options for the protocol)')
+        parser.add_argument('--output-dir', type=str, default='mount-maps',
+                            help='Directory the <client>.fstab and <client>.autofs files are written to')
+        return parser
+
+    @classmethod
+    def node_addresses(cls, outputs, output_keys=None):
+        # Collects node addresses from the stack outputs, in output order and without duplicates.
+        addresses = []
+        for key, value in outputs.items():
+            if output_keys and key not in output_keys:
+                continue
+            if output_keys:
+                found = [v.strip() for v in re.split(r'[,\s]+', value) if v.strip()]
+            else:
+                found = cls.ipv4_pattern.findall(value)
+            addresses.extend(address for address in found if address not in addresses)
+        return addresses
+
+    def ports(self, opts):
+        if opts.ports:
+            return [int(port) for port in opts.ports.split(',')]
+        return [self.service_ports[opts.protocol]] + ([self.management_port] if self.management_port else [])
+
+    def discover_nodes(self, client, opts):
+        # Shows an ETA from the history of earlier creates while the stack is still being created.
+        stack = AwsCloudFormationHelper.wait_with_eta(client, opts.stack_name, poll_interval=opts.poll_interval)
+        output_keys = opts.output_keys.split(',') if opts.output_keys else None
+        nodes = self.node_addresses(AwsCloudFormationHelper.stack_outputs(stack), output_keys)
+        if not nodes:
+            raise ValueError(f"No node addresses found in the outputs of stack {opts.stack_name}")
+        return nodes
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        if opts.nodes:
+            nodes = [node.strip() for node in opts.nodes.split(',') if node.strip()]
+        else:
+            nodes = self.discover_nodes(AwsCloudFormationHelper.client_from_opts(opts=opts), opts)
+        started_at = time.monotonic()
+        probe = ServiceReadinessProbe(nodes, self.ports(opts), connect_timeout=opts.connect_timeout)
+        ready = probe.wait(quorum=opts.quorum, interval=opts.probe_interval, timeout=opts.timeout)
+        response = f"{len(ready)}/{len(nodes)} nodes ready in {time.monotonic() - started_at:.1f}s: {', '.join(ready)}"
+
+        if opts.clients:
+            clients = [c.strip() for c in opts.clients.split(',') if c.strip()]
+            builder = MountMapBuilder(ready, protocol=opts.protocol, export=opts.export,
+                                      mount_point=opts.mount_point, options=opts.mount_options)
+            builder.write(clients, opts.output_dir)
+            response += f"\nWrote mount maps for {len(clients)} clients to {opts.output_dir}"
+        return response
+
+
+class EnvoiStorageQumuloAwsWaitReadyCommand(EnvoiStorageAwsWaitReadyCommand):
+    # Waits for a Qumulo cluster's NFS/SMB and REST API (port 8000) to be reachable.
+    description = "Wait until a Qumulo cluster is serving and write client mount maps"
+    vendor = 'qumulo'
+    management_port = 8000
+    default_stack_name = 'Qumulo'
+
+
+class EnvoiStorageWekaAwsWaitReadyCommand(EnvoiStorageAwsWaitReadyCommand):
+    # Waits for a Weka cluster's NFS/SMB and management API (port 14000) to be reachable.
+    description = "Wait until a Weka cluster is serving and write client mount maps"
+    vendor = 'weka'
+    management_port = 14000
+    default_stack_name = 'Weka'
+
+
+class EnvoiStorageHammerspaceAwsWaitReadyCommand(EnvoiStorageAwsWaitReadyCommand):
+    # Waits for a Hammerspace cluster's NFS/SMB and management API (port 8443) to be reachable.
+    description = "Wait until a Hammerspace cluster is serving and write client mount maps"
+    vendor = 'hammerspace'
+    management_port = 8443
+    default_stack_name = 'Hammerspace'
+
+
+class EnvoiStorageHammerspaceAwsCreateClusterCommand(EnvoiCommand):
+    # A command class for creating a Hammerspace cluster on AWS.
+
+    # Probes the cluster's services for standby pools.
+    wait_ready_command = EnvoiStorageHammerspaceAwsWaitReadyCommand
+
+    cfn_param_names = {
+        # A dictionary mapping command-line argument names to CloudFormation parameter names.
+        "DeploymentType": "deployment_type",
+        "AnvilConfiguration": "anvil_configuration",
+        "AnvilInstanceType": "anvil_instance_type",
+        "DsxInstanceType": "dsx_instance_type",
+        "DsxInstanceCount": "dsx_instance_count",
+        "AnvilMetaDiskSize": "anvil_meta_disk_size",
+        "DsxDataDiskSize": "dsx_data_disk_size",
+        "DsxAddVols": "dsx_add_vols",
+        "VpcId": "vpc_id",
+        "AvailZone1": "avail_zone1",
         "Subnet1Id": "subnet1_id",
         "HaSubnet1Cidr": "ha_subnet1_cidr",
         "ClusterIp": "cluster_ip",
@@ -366,6 +3027,7 @@ class EnvoiStorageHammerspaceAwsCreateClusterCommand(EnvoiCommand):
         parser.add_argument('--aws-profile', type=str, required=False,
                             default=argparse.SUPPRESS,
                             help='AWS profile. (defaults to the value from the AWS_PROFILE environment variable)')
+        add_aws_role_arguments(parser)
         parser.add_argument("--cfn-role-arn",
                             type=str,
                             required=False,
@@ -408,52 +3070,42 @@ class EnvoiStorageHammerspaceAwsCreateClusterCommand(EnvoiCommand):
         parser.add_argument("--cluster-enable-iam-user-group-id",
                             help="IAM user group ID to enable access for")
         parser.add_argument("--iam-instance-role-name")
+        add_create_wait_arguments(parser)
 
         return parser
 
     def run(self, opts=None):
         # The main execution method for the command.
-        # It prepares the CloudFormation stack creation parameters and calls the boto3 client.
         if opts is None:
             opts = self.opts
+        # Prepares the boto3 client with the correct profile and region.
+        client = AwsCloudFormationHelper.client_from_opts(opts=opts)
+        response = self.deploy(client, opts)
+        if opts.wait:
+            AwsCloudFormationHelper.wait_with_eta(client, opts.stack_name, poll_interval=opts.poll_interval)
+        return AwsCloudFormationHelper.format_create_response(response)
 
-        cfn_template_url = opts.get("template-url")
-
+    def deploy(self, client, opts):
+        # Prepares the CloudFormation stack creation parameters and creates the stack.
         template_parameters = []
         # Populates the CloudFormation template parameters from the parsed options.
         for template_param_name, arg_name in self.cfn_param_names.items():
-            value = getattr(opts, arg_name)
+            value = getattr(opts, arg_name, None)
             if value is not None:
                 template_parameters.append({'ParameterKey': template_param_name, 'ParameterValue': value})
 
-        cfn_create_stack_args = {
-            'StackName': opts.stack_name,
-            'Parameters': template_parameters,
-            'TemplateURL': cfn_template_url,
-            'Capabilities': ['CAPABILITY_IAM']
-        }
-
-        # Adds the optional IAM role ARN to the arguments.
-        if opts.cfn_role_arn is not None:
-            cfn_create_stack_args['RoleARN'] = opts.cfn_role_arn
-
-        # Prepares the boto3 client with the correct profile and region.
-        cfn_client_args = {}
-        if opts.aws_profile is not None:
-            cfn_client_args['profile_name'] = opts.aws_profile
-
-        if opts.aws_region is not None:
-            cfn_client_args['region_name'] = opts.aws_region
-
-        client = boto3.client('cloudformation', **cfn_client_args)
-        response = client.create_stack(**cfn_create_stack_args)
-        return response
+        # create_stack is idempotent, so a retried run attaches to the stack created by the first attempt.
+        return AwsCloudFormationHelper.create_stack(opts.stack_name, opts.template_url, cfn_role_arn=opts.cfn_role_arn,
+                                                    template_parameters=template_parameters, client=client,
+                                                    capabilities=['CAPABILITY_IAM'],
+                                                    tags=AwsCloudFormationHelper.envoi_tags('hammerspace'))
 
 
 class EnvoiStorageHammerspaceAwsCommand(EnvoiCommand):
     # This class serves as a namespace for the Hammerspace AWS commands.
     subcommands = {
         'create-cluster': EnvoiStorageHammerspaceAwsCreateClusterCommand,
+        'wait-ready': EnvoiStorageHammerspaceAwsWaitReadyCommand,
     }
 
 
@@ -468,6 +3120,9 @@ class EnvoiStorageQumuloAwsCreateClusterCommand(EnvoiCommand):
     # This command class handles the creation of a Qumulo cluster on AWS.
     # It defines a comprehensive set of arguments for configuring the Qumulo CloudFormation template.
 
+    # Probes the cluster's services for standby pools.
+    wait_ready_command = EnvoiStorageQumuloAwsWaitReadyCommand
+
     @classmethod
     def init_parser(cls, parent_parsers=None, **kwargs):
         parser = super().init_parser(parent_parsers=parent_parsers, **kwargs)
@@ -484,6 +3139,7 @@ class EnvoiStorageQumuloAwsCreateClusterCommand(EnvoiCommand):
         parser.add_argument('--aws-profile', type=str, required=False,
                             default=argparse.SUPPRESS,
                             help='AWS profile. (defaults to the value from the AWS_PROFILE environment variable)')
+        add_aws_role_arguments(parser)
         parser.add_argument('--cfn-role-arn', type=str, required=False,
                             help='IAM Role to use when creating the CloudFormation stack')
 
@@ -538,18 +3194,26 @@ class EnvoiStorageQumuloAwsCreateClusterCommand(EnvoiCommand):
         parser.add_argument("--q-permissions-boundary", default="", help="Qumulo permissions boundary policy name")
         parser.add_argument("--q-audit-log", default="NO", help="Qumulo audit-log messages to CloudWatch Logs")
         parser.add_argument("--term-protection", default="NO", help="Termination protection")
+        parser.add_argument("--skip-network-validation", action="store_true",
+                            help="Don't check that the VPC and subnets exist before creating the stack")
+        parser.add_argument("--skip-preflight", action="store_true",
+                            help="Don't check instance type offerings and vCPU quotas before creating the stack")
+        add_create_wait_arguments(parser)
         return parser
 
     def run(self, opts=None):
         # The main execution method for the Qumulo command.
         if opts is None:
             opts = self.opts
-        cfn_client_args = {}
-        # Populates the CloudFormation client arguments from the command-line options.
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_profile', cfn_client_args, 'profile_name')
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_region', cfn_client_args, 'region_name')
+        # Creates the CloudFormation client for the profile and region in the command-line options.
+        client = AwsCloudFormationHelper.client_from_opts(opts=opts)
+        response = self.deploy(client, opts)
+        if opts.wait:
+            AwsCloudFormationHelper.wait_with_eta(client, opts.stack_name, poll_interval=opts.poll_interval)
+        return AwsCloudFormationHelper.format_create_response(response)
 
-        client = boto3.client('cloudformation', **cfn_client_args)
+    def deploy(self, client, opts, discovery=None):
+        # Validates the network and capacity, then creates the stack and returns the create_stack response.
         template_parameters = []
 
         template_parameters_to_check = {
@@ -599,35 +3263,36 @@ class EnvoiStorageQumuloAwsCreateClusterCommand(EnvoiCommand):
                 if value is not None:
                     template_parameters.append({'ParameterKey': template_param_name, 'ParameterValue': value})
 
-        cfn_create_stack_args = {
-            'StackName': opts.stack_name,
-            'Parameters': template_parameters,
-            'Capabilities': ['CAPABILITY_IAM']
-        }
+        # Checks the VPC and subnet IDs against the (cached) discovery data before creating the stack.
+        subnet_ids = [opts.private_subnet_id, getattr(opts, 'public_subnet_id', None)]
+        subnet_ids += (getattr(opts, 'q_nlb_private_subnet_ids', None) or '').split(',')
+        AwsNetworkDiscovery.validate_network_from_opts(opts, vpc_id=opts.vpc_id,
+                                                       subnet_ids=[s.strip() for s in subnet_ids if s and s.strip()],
+                                                       discovery=discovery)
+        # Checks that the node instance type is offered in the subnet's zone and fits the account's vCPU quota.
+        AwsCapacityPreflight.check_from_opts(opts, {opts.q_instance_type: int(opts.q_node_count)},
+                                             subnet_id=opts.private_subnet_id, vpc_id=opts.vpc_id,
+                                             discovery=discovery)
 
         # Ensures the template URL is provided before creating the stack.
-        if hasattr(opts, 'template_url'):
-            cfn_create_stack_args['TemplateURL'] = opts.template_url
-        else:
+        if not hasattr(opts, 'template_url'):
             raise ValueError("Missing required parameter template_url")
 
-        # Adds the optional CloudFormation role ARN.
-        if opts.cfn_role_arn is not None:
-            cfn_create_stack_args['RoleARN'] = opts.cfn_role_arn
-
-        response = client.create_stack(**cfn_create_stack_args)
-        stack_id = response['StackId']
-        # Returns the stack ID if the creation request is successful.
-        if stack_id is not None:
-            response = f"Stack ID {stack_id}"
-
-        return response
+        # create_stack is idempotent, so a retried run attaches to the stack created by the first attempt.
+        return AwsCloudFormationHelper.create_stack(opts.stack_name, opts.template_url,
+                                                    cfn_role_arn=opts.cfn_role_arn,
+                                                    template_parameters=template_parameters, client=client,
+                                                    capabilities=['CAPABILITY_IAM'],
+                                                    tags=AwsCloudFormationHelper.envoi_tags('qumulo'))
 
 
 class EnvoiStorageQumuloLegacyAwsCreateClusterCommand(EnvoiCommand):
     # A legacy command for creating a Qumulo cluster on AWS with a simpler set of arguments.
     # It demonstrates how different versions or configurations can be handled with separate classes.
 
+    # Probes the cluster's services for standby pools.
+    wait_ready_command = EnvoiStorageQumuloAwsWaitReadyCommand
+
     @classmethod
     def init_parser(cls, parent_parsers=None, **kwargs):
         # Defines the argument parser for the legacy Qumulo command.
@@ -645,6 +3310,7 @@ class EnvoiStorageQumuloLegacyAwsCreateClusterCommand(EnvoiCommand):
         parser.add_argument('--aws-profile', type=str, required=False,
                             default=argparse.SUPPRESS,
                             help='AWS profile. (defaults to the value from the AWS_PROFILE environment variable)')
+        add_aws_role_arguments(parser)
         parser.add_argument('--cfn-role-arn', type=str, required=False,
                             help='IAM Role to use when creating the CloudFormation stack')
         parser.add_argument("--cluster-name", type=str, required=True,
@@ -665,6 +3331,9 @@ class EnvoiStorageQumuloLegacyAwsCreateClusterCommand(EnvoiCommand):
                             help="Security group CIDR")
         parser.add_argument("--volumes-encryption-key", type=str, default="",
                             help="Encryption Key for the Volumes")
+        parser.add_argument("--skip-network-validation", action="store_true",
+                            help="Don't check that the VPC and subnet exist before creating the stack")
+        add_create_wait_arguments(parser)
 
         return parser
 
@@ -672,11 +3341,7 @@ class EnvoiStorageQumuloLegacyAwsCreateClusterCommand(EnvoiCommand):
         # Execution method for the legacy Qumulo command, which is very similar to the main Qumulo command's logic.
         if opts is None:
             opts = self.opts
-        cfn_client_args = {}
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_profile', cfn_client_args, 'profile_name')
-        add_from_namespace_to_dict_if_not_none(opts, 'aws_region', cfn_client_args, 'region_name')
-
-        client = boto3.client('cloudformation', **cfn_client_args)
+        client = AwsCloudFormationHelper.client_from_opts(opts=opts)
         template_parameters = []
 
         template_parameters_to_check = {
@@ -697,32 +3362,26 @@ class EnvoiStorageQumuloLegacyAwsCreateClusterCommand(EnvoiCommand):
                 if value is not None:
                     template_parameters.append({'ParameterKey': template_param_name, 'ParameterValue': value})
 
-        cfn_create_stack_args = {
-            'StackName': opts.stack_name,
-            'Parameters': template_parameters,
-            'Capabilities': ['CAPABILITY_IAM']
-        }
+        AwsNetworkDiscovery.validate_network_from_opts(opts, vpc_id=opts.vpc_id, subnet_ids=[opts.subnet_id])
 
-        if hasattr(opts, 'template_url'):
-            cfn_create_stack_args['TemplateURL'] = opts.template_url
-        else:
+        if not hasattr(opts, 'template_url'):
             raise ValueError("Missing required parameter template_url")
 
-        if opts.cfn_role_arn is not None:
-            cfn_create_stack_args['RoleARN'] = opts.cfn_role_arn
-
-        response = client.create_stack(**cfn_create_stack_args)
-        stack_id = response['StackId']
-        if stack_id is not None:
-            response = f"Stack ID {stack_id}"
-
-        return response
+        response = AwsCloudFormationHelper.create_stack(opts.stack_name, opts.template_url,
+                                                        cfn_role_arn=opts.cfn_role_arn,
+                                                        template_parameters=template_parameters, client=client,
+                                                        capabilities=['CAPABILITY_IAM'],
+                                                        tags=AwsCloudFormationHelper.envoi_tags('qumulo'))
+        if opts.wait:
+            AwsCloudFormationHelper.wait_with_eta(client, opts.stack_name, poll_interval=opts.poll_interval)
+        return AwsCloudFormationHelper.format_create_response(response)
 
 
 class EnvoiStorageQumuloAwsCommand(EnvoiCommand):
     # Namespace class for Qumulo AWS commands.
     subcommands = {
         'create-cluster': EnvoiStorageQumuloAwsCreateClusterCommand,
+        'wait-ready': EnvoiStorageQumuloAwsWaitReadyCommand,
     }
 
 
@@ -736,6 +3395,19 @@ class EnvoiStorageQumuloCommand(EnvoiCommand):
 class EnvoiStorageWekaAwsCreateStackCommand(EnvoiCommand):
     # This class handles the creation of a WekaIO stack on AWS.
     # It's unique because it first uses the Weka API to dynamically generate a CloudFormation template.
+    # Generated templates that are too large to pass inline (or any template when --template-bucket is given) are
+    # staged to S3 under a content-addressed key, so repeat deploys of the same template don't upload it again.
+
+    description = "Generate a Weka CloudFormation template and create a stack from it"
+    # Probes the cluster's services for standby pools.
+    wait_ready_command = EnvoiStorageWekaAwsWaitReadyCommand
+
+    template_param_names = {
+        # Maps argument names to the parameter names of the Weka CloudFormation template.
+        'template_param_key_name': 'KeyName',
+        'template_param_subnet_id': 'SubnetId',
+        'template_param_vpc_id': 'VpcId',
+    }
 
     @classmethod
     def init_parser(cls, **kwargs):
@@ -743,12 +3415,29 @@ class EnvoiStorageWekaAwsCreateStackCommand(EnvoiCommand):
         parser = super().init_parser(**kwargs)
 
         # Defines arguments for Weka API token and template URL.
-        parser.add_argument('--token', type=str, required=True, help='API Token.')
-        parser.add_argument('--template-url', type=str, required=True,
-                            help='The URL to the CLoudFormation template')
+        parser.add_argument('--token', type=str, required=False, default=os.environ.get('WEKA_API_TOKEN'),
+                            help='API Token. (defaults to the value from the WEKA_API_TOKEN environment variable)')
+        parser.add_argument('--template-url', type=str, required=False,
+                            help='The URL to the CloudFormation template. When not given, a template is generated '
+                                 'with the Weka API')
+        parser.add_argument('--template-bucket', type=str, required=False,
+                            help='S3 bucket that generated templates are staged in. Required when the template is '
+                                 'too large to pass inline')
+        parser.add_argument('--template-prefix', type=str, default='cloudformation/templates/',
+                            help='Key prefix for staged templates')
+        parser.add_argument('--aws-endpoint-url', type=str, required=False,
+                            default=argparse.SUPPRESS,
+                            help='Override the AWS API endpoint, e.g. to use a local AWS stand-in')
+        parser.add_argument('--skip-preflight', action='store_true',
+                            help="Don't check instance type offerings and vCPU quotas before creating the stack")
+        parser.add_argument('--retarget-az', action='store_true',
+                            help='If the subnet\'s availability zone lacks an instance type, deploy into another '
+                                 'subnet of the VPC instead of failing')
+        add_create_wait_arguments(parser)
 
         # The following methods are used to add groups of arguments to the parser.
         parser = cls.add_uniq_arguments(parser)
+        parser = cls.add_template_generation_arguments(parser)
         parser = cls.add_template_param_arguments(parser, required_params_required=True)
         return parser
 
@@ -763,20 +3452,3355 @@ class EnvoiStorageWekaAwsCreateStackCommand(EnvoiCommand):
         parser.add_argument('--aws-profile', type=str, required=False,
                             default=argparse.SUPPRESS,
                             help='AWS profile. (defaults to the value from the AWS_PROFILE environment variable)')
+        add_aws_role_arguments(parser)
         parser.add_argument('--cfn-role-arn', type=str, required=False,
                             help='IAM Role to use when creating the CloudFormation stack')
         return parser
 
+    @classmethod
+    def add_template_generation_arguments(cls, parser):
+        # Adds the cluster layout sent to the Weka API when generating a template.
+        parser.add_argument('--weka-version', type=str, default='latest',
+                            help='Weka release to deploy')
+        parser.add_argument('--backend-instance-type', type=str, default='i3en.6xlarge',
+                            help='Backend instance type')
+        parser.add_argument('--backend-instance-count', type=int, default=6,
+                            help='Number of backend instances')
+        parser.add_argument('--client-instance-type', type=str, default='r5.xlarge',
+                            help='Client instance type')
+        parser.add_argument('--client-instance-count', type=int, required=False,
+                            help='Number of client instances')
+        parser.add_argument('--client-ami-id', type=str, required=False,
+                            help='Client AMI ID')
+        return parser
+
     @classmethod
     def add_template_param_arguments(cls, parser, required_params_required=True):
         # Adds arguments that correspond to the WekaIO CloudFormation template parameters.
         # These are crucial for configuring the WekaIO cluster.
         parser.add_argument('--template-param-key-name', type=str, required=required_params_required,
                             default=argparse.SUPPRESS,
-                            help='Subnet ID of the subnet in which the cluster will be installed. ')
+                            help='A key with which you can connect to the new instances. ')
         parser.add_argument('--template-param-subnet-id', type=str, required=required_params_required,
                             default=argparse.SUPPRESS,
-                            help='A key with which you can connect to the new instances. ')
+                            help='Subnet ID of the subnet in which the cluster will be installed. ')
         parser.add_argument('--template-param-vpc-id', type=str, required=required_params_required,
                             default=argparse.SUPPRESS,
                             help='VPC ID of the VPC. ')
+        return parser
+
+    @classmethod
+    def generate_template(cls, opts, weka_client=None):
+        # Asks the Weka API for a template. The API wraps the template in its response as "cfn".
+        if weka_client is None:
+            if not opts.token:
+                raise ValueError("A Weka API token is required to generate a template. Set --token or "
+                                 "$WEKA_API_TOKEN")
+            weka_client = WekaApiClient(opts.token)
+        response = weka_client.generate_cloudformation_template(
+            weka_version=opts.weka_version,
+            client_instance_type=opts.client_instance_type,
+            client_instance_count=opts.client_instance_count,
+            client_ami_id=opts.client_ami_id,
+            backend_instance_type=opts.backend_instance_type,
+            backend_instance_count=opts.backend_instance_count)
+        return response.get('cfn', response) if isinstance(response, dict) else response
+
+    @classmethod
+    def template_source(cls, opts, template, stager=None):
+        # Returns the create_stack arguments for the template: an inline body when it fits and no bucket is
+        # configured, otherwise the TemplateURL of the staged copy.
+        body = CloudFormationTemplateStager.serialize(template)
+        if stager is None and opts.template_bucket:
+            stager = CloudFormationTemplateStager.from_opts(opts, opts.template_bucket, prefix=opts.template_prefix)
+        if stager is None:
+            if len(body.encode('utf-8')) > CloudFormationTemplateStager.MAX_TEMPLATE_BODY_SIZE:
+                raise ValueError(f"The template is {format_size(len(body))}, larger than CloudFormation accepts "
+                                 f"inline. Set --template-bucket to stage it in S3")
+            return {'template_body': body}
+        return {'template_url': stager.stage(body)}
+
+    def create_stack(self, client, opts, template_source):
+        template_parameters = AwsCloudFormationHelper.populate_template_parameters_from_opts(
+            [], opts, self.template_param_names)
+        response = AwsCloudFormationHelper.create_stack(opts.stack_name, cfn_role_arn=opts.cfn_role_arn,
+                                                        template_parameters=template_parameters, client=client,
+                                                        capabilities=['CAPABILITY_IAM'],
+                                                        tags=AwsCloudFormationHelper.envoi_tags('weka'),
+                                                        **template_source)
+        return {**response, 'TemplateURL': template_source.get('template_url')}
+
+    @classmethod
+    def instance_requirements(cls, opts):
+        requirements = collections.Counter({opts.backend_instance_type: opts.backend_instance_count or 0})
+        if opts.client_instance_count:
+            requirements[opts.client_instance_type] += opts.client_instance_count
+        return {instance_type: count for instance_type, count in requirements.items() if count}
+
+    def deploy(self, client, opts, weka_client=None, stager=None, discovery=None):
+        # Runs the preflight, generates and stages the template, and creates the stack. Returns the create_stack
+        # response. Long-lived callers pass warm clients; otherwise they are created from the options.
+        if not opts.template_url:
+            # The instance types are only known when the template is generated from the arguments.
+            opts.template_param_subnet_id = AwsCapacityPreflight.check_from_opts(
+                opts, self.instance_requirements(opts), subnet_id=getattr(opts, 'template_param_subnet_id', None),
+                vpc_id=getattr(opts, 'template_param_vpc_id', None), retarget=opts.retarget_az, discovery=discovery)
+        if opts.template_url:
+            template_source = {'template_url': opts.template_url}
+        else:
+            template_source = self.template_source(opts, self.generate_template(opts, weka_client), stager=stager)
+        return self.create_stack(client, opts, template_source)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        client = AwsCloudFormationHelper.client_from_opts(opts=opts)
+        response = self.deploy(client, opts)
+        if opts.wait:
+            AwsCloudFormationHelper.wait_with_eta(client, opts.stack_name, poll_interval=opts.poll_interval)
+        return AwsCloudFormationHelper.format_create_response(response)
+
+
+class EnvoiStorageWekaAwsCommand(EnvoiCommand):
+    # Namespace class for Weka AWS commands.
+    subcommands = {
+        'create-stack': EnvoiStorageWekaAwsCreateStackCommand,
+        'wait-ready': EnvoiStorageWekaAwsWaitReadyCommand,
+    }
+
+
+class EnvoiStorageWekaCommand(EnvoiCommand):
+    # Namespace class for Weka commands.
+    subcommands = {
+        'aws': EnvoiStorageWekaAwsCommand,
+    }
+
+
+class EnvoiStoragePurgeCommand(EnvoiCommand):
+    # Deletes large directory trees (render scratch, caches) with many parallel unlink workers.
+    # Directories are scanned concurrently and each one is removed as soon as its files and subdirectories are gone,
+    # so the tree is deleted bottom-up without a separate ordering pass.
+
+    description = "Delete a directory tree using parallel unlink workers"
+
+    # Files in a single directory are unlinked in chunks of this size so huge flat directories are spread
+    # across workers.
+    unlink_chunk_size = 1000
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('paths', nargs='+',
+                            help='One or more directory trees to delete')
+        parser.add_argument('--workers', type=int, default=64,
+                            help='Number of parallel scan/unlink workers')
+        parser.add_argument('--max-ops-per-second', type=float, default=0,
+                            help='Maximum unlink/rmdir operations per second across all workers (0 for unlimited)')
+        parser.add_argument('--keep-root', action='store_true',
+                            help='Delete the contents of each path but keep the top-level directory')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the files, directories and bytes that would be deleted')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between progress lines (0 to disable)')
+        return parser
+
+    class Node:
+        # Tracks one directory while its children are being removed.
+        # `pending` counts outstanding subdirectories and file chunks; the directory is removed when it reaches zero.
+
+        def __init__(self, path, parent=None):
+            self.path = path
+            self.parent = parent
+            self.pending = 0
+            self.lock = threading.Lock()
+
+    def __init__(self, opts=None, auto_exec=True):
+        self.executor = None
+        self.limiter = None
+        self.progress = None
+        self.done = None
+        self.errors = []
+        self.errors_lock = threading.Lock()
+        super().__init__(opts=opts, auto_exec=auto_exec)
+
+    def record_error(self, path, error):
+        with self.errors_lock:
+            self.errors.append((path, error))
+        LOG.warning(f"purge: {path}: {error}")
+        self.progress.add('errors')
+
+    def complete(self, node):
+        # Marks one unit of work for `node` as finished and removes the directory once nothing is pending.
+        # Completion then cascades to the parent, which is how deletion proceeds bottom-up.
+        while node is not None:
+            with node.lock:
+                node.pending -= 1
+                if node.pending > 0:
+                    return
+            is_root = node.parent is None
+            if not self.opts.dry_run and not (is_root and self.opts.keep_root):
+                self.limiter.acquire()
+                try:
+                    os.rmdir(node.path)
+                except OSError as e:
+                    self.record_error(node.path, e)
+            if not (is_root and self.opts.keep_root):
+                self.progress.add('dirs')
+            if is_root:
+                self.done.set()
+            node = node.parent
+
+    def unlink_files(self, node, entries):
+        try:
+            for path, size in entries:
+                if self.opts.dry_run:
+                    self.progress.add('bytes', size)
+                else:
+                    self.limiter.acquire()
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        self.record_error(path, e)
+                        continue
+                self.progress.add('files')
+        finally:
+            self.complete(node)
+
+    def scan(self, node):
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(node.path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        size = entry.stat(follow_symlinks=False).st_size if self.opts.dry_run else 0
+                        files.append((entry.path, size))
+        except OSError as e:
+            self.record_error(node.path, e)
+
+        chunks = [files[i:i + self.unlink_chunk_size] for i in range(0, len(files), self.unlink_chunk_size)]
+        children = [self.Node(path, parent=node) for path in subdirs]
+
+        # The scan itself holds one pending unit until every child task has been queued,
+        # so a fast child can't complete the directory while we are still submitting work.
+        with node.lock:
+            node.pending += len(children) + len(chunks)
+        for child in children:
+            child.pending = 1
+            self.executor.submit(self.scan_task, child)
+        for chunk in chunks:
+            self.executor.submit(self.unlink_files, node, chunk)
+        self.complete(node)
+
+    def scan_task(self, node):
+        try:
+            self.scan(node)
+        except Exception as e:
+            # Unexpected failures must still release the node or the purge would never finish.
+            self.record_error(node.path, e)
+            self.complete(node)
+
+    def purge(self, path):
+        root_path = os.path.abspath(path)
+        if root_path == os.path.abspath(os.sep) or root_path == os.path.expanduser('~'):
+            raise ValueError(f"Refusing to purge {root_path}")
+        if not os.path.isdir(root_path) or os.path.islink(root_path):
+            raise ValueError(f"{root_path} is not a directory")
+
+        root = self.Node(root_path)
+        root.pending = 1
+        self.done = threading.Event()
+        self.executor.submit(self.scan_task, root)
+        self.done.wait()
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        self.opts = opts
+        self.limiter = TokenBucket(opts.max_ops_per_second)
+        self.progress = ProgressReporter('purge (dry run)' if opts.dry_run else 'purge',
+                                         interval=opts.progress_interval).start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.workers, 1)) as executor:
+                self.executor = executor
+                for path in opts.paths:
+                    self.purge(path)
+        finally:
+            self.progress.stop()
+
+        files = self.progress.get('files')
+        dirs = self.progress.get('dirs')
+        elapsed = self.progress.elapsed()
+        if opts.dry_run:
+            response = (f"Would delete {files:,} files and {dirs:,} directories "
+                        f"({self.progress.get('bytes'):,} bytes)")
+        else:
+            response = (f"Deleted {files:,} files and {dirs:,} directories in {elapsed:.1f}s "
+                        f"({files / max(elapsed, 1e-9):,.0f} files/s)")
+        if self.errors:
+            response += f", {len(self.errors):,} errors"
+        return response
+
+
+class EnvoiStorageGenerateDatasetCommand(EnvoiCommand):
+    # Builds a synthetic media tree (frame sequences, proxies, camera originals, sidecars) for benchmarking.
+    # The file list and sizes are planned up front from a seeded generator, so the same spec and seed always
+    # produce the same tree no matter how the parallel writers are scheduled.
+    #
+    # A spec is a JSON document with a list of groups. Each group names a path pattern and either a `count` or a
+    # number of `sequences` with `frames` each. Patterns are relative to the target and may use {index}, {seq} and
+    # {frame}. Sizes are a fixed value, {"min": ..., "max": ...} for a uniform distribution, or
+    # {"median": ..., "sigma": ...} for a log-normal one. `fill` is "sparse", "allocate" (fallocate, falling back to
+    # sparse) or "pattern" (real bytes).
+
+    description = "Generate a synthetic media dataset from a size/count distribution spec"
+
+    default_spec = {
+        "groups": [
+            {"name": "frames", "sequences": 4, "frames": 240,
+             "pattern": "shots/sh{seq:03d}/plate/sh{seq:03d}.{frame:04d}.exr",
+             "size": {"median": "12MiB", "sigma": 0.15}},
+            {"name": "proxies", "count": 24, "pattern": "proxies/proxy_{index:04d}.mov",
+             "size": {"min": "50MiB", "max": "200MiB"}},
+            {"name": "originals", "count": 4, "pattern": "camera/A001C{index:03d}.mxf",
+             "size": {"min": "2GiB", "max": "4GiB"}},
+            {"name": "sidecars", "count": 2000, "pattern": "sidecars/{index:05d}.xml",
+             "size": {"min": "1KiB", "max": "16KiB"}, "fill": "pattern"},
+        ]
+    }
+
+    fill_modes = ['sparse', 'allocate', 'pattern']
+
+    # Size of the repeating buffer used by the pattern fill.
+    pattern_buffer_size = 4 * 1024 * 1024
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('target',
+                            help='Directory in which the dataset is created')
+        parser.add_argument('--spec', type=str, required=False,
+                            help='Path to a JSON dataset spec (defaults to a built-in media spec)')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for sizes and pattern content')
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='Multiplier applied to every group count and sequence count')
+        parser.add_argument('--fill', choices=cls.fill_modes, required=False,
+                            help='Override the fill mode of every group')
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Number of parallel writers')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only print the number of files and bytes that would be written')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between progress lines (0 to disable)')
+        return parser
+
+    @classmethod
+    def load_spec(cls, spec_path=None):
+        if spec_path is None:
+            return cls.default_spec
+        with open(spec_path, 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def sample_size(cls, rng, size_spec):
+        # Draws one file size from a group's size specification.
+        if isinstance(size_spec, dict):
+            if 'median' in size_spec:
+                median = parse_size(size_spec['median'])
+                return max(0, int(rng.lognormvariate(0, float(size_spec.get('sigma', 0.25))) * median))
+            return rng.randint(parse_size(size_spec['min']), parse_size(size_spec['max']))
+        return parse_size(size_spec)
+
+    @classmethod
+    def check_group(cls, name, group):
+        # Rejects groups missing a required key, and patterns that would write outside the target directory.
+        required = ['pattern', 'size'] + (['frames'] if 'sequences' in group else ['count'])
+        missing = [key for key in required if key not in group]
+        if missing:
+            raise ValueError(f"Group {name} is missing {', '.join(missing)}")
+        pattern = os.path.normpath(group['pattern'])
+        if os.path.isabs(pattern) or pattern == os.pardir or pattern.startswith(os.pardir + os.sep):
+            raise ValueError(f"Pattern {group['pattern']!r} of group {name} is outside the target directory")
+
+    @classmethod
+    def plan(cls, spec, seed=0, scale=1.0, fill_override=None):
+        # Expands a spec into an ordered list of (relative path, size, fill mode) tuples.
+        # Each group gets its own generator derived from the seed, so editing one group doesn't shift the others.
+        entries = []
+        for group_index, group in enumerate(spec['groups']):
+            name = group.get('name', group_index)
+            cls.check_group(name, group)
+            rng = random.Random(f"{seed}:{name}")
+            fill = fill_override or group.get('fill', 'sparse')
+            if fill not in cls.fill_modes:
+                raise ValueError(f"Unknown fill mode {fill!r} in group {name}")
+            if 'sequences' in group:
+                sequences = max(1, round(int(group['sequences']) * scale))
+                slots = [(seq * int(group['frames']) + frame, seq, frame + int(group.get('first_frame', 1)))
+                         for seq in range(sequences) for frame in range(int(group['frames']))]
+            else:
+                slots = [(index, 0, 0) for index in range(max(1, round(int(group['count']) * scale)))]
+            for index, seq, frame in slots:
+                path = group['pattern'].format(index=index, seq=seq, frame=frame)
+                entries.append((path, cls.sample_size(rng, group['size']), fill))
+        return entries
+
+    def __init__(self, opts=None, auto_exec=True):
+        self.pattern = None
+        self.progress = None
+        super().__init__(opts=opts, auto_exec=auto_exec)
+
+    def write_file(self, path, size, fill):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if fill == 'pattern':
+                # A short per-file header keeps files distinct; the bulk is a shared buffer written without copies.
+                header = f"{os.path.basename(path)}:{size}\n".encode('utf-8')[:size]
+                written = os.write(fd, header)
+                view = memoryview(self.pattern)
+                while written < size:
+                    written += os.write(fd, view[:min(len(view), size - written)])
+            elif fill == 'allocate' and size > 0 and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    # Some network filesystems don't support fallocate; a sparse file is the closest substitute.
+                    os.ftruncate(fd, size)
+            else:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        self.progress.add('files')
+        self.progress.add('bytes', size)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        spec = self.load_spec(getattr(opts, 'spec', None))
+        entries = self.plan(spec, seed=opts.seed, scale=opts.scale, fill_override=opts.fill)
+        total_bytes = sum(size for _, size, _ in entries)
+        if opts.dry_run:
+            return f"Would write {len(entries):,} files ({format_size(total_bytes)}) to {opts.target}"
+
+        self.pattern = random.Random(opts.seed).randbytes(self.pattern_buffer_size)
+        self.progress = ProgressReporter('generate-dataset', interval=opts.progress_interval).start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.workers, 1)) as executor:
+                futures = [executor.submit(self.write_file, os.path.join(opts.target, path), size, fill)
+                           for path, size, fill in entries]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        finally:
+            self.progress.stop()
+
+        elapsed = max(self.progress.elapsed(), 1e-9)
+        return (f"Wrote {len(entries):,} files ({format_size(total_bytes)}) to {opts.target} in {elapsed:.1f}s "
+                f"({format_size(total_bytes / elapsed)}/s)")
+
+
+class LruByteCache:
+    # A thread-safe LRU cache bounded by the total number of bytes it holds rather than the number of entries.
+    # Entries may store `None` as their value, which lets callers track warmed files by size without keeping the data.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, default=None):
+        # Returns the cached value and marks it as most recently used.
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, size = self.entries.pop(key)
+            self.current_bytes -= size
+            return value
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+
+class FrameSequence:
+    # Describes a numbered frame sequence such as `shot.%04d.exr` and maps between frame numbers and paths.
+
+    printf_pattern = re.compile(r'%0?(\d*)d')
+    hash_pattern = re.compile(r'#+')
+    frame_pattern = re.compile(r'^(.*?)(\d+)(\.[^.\d][^.]*)?$')
+
+    def __init__(self, directory, prefix, padding, suffix, first_frame=None, last_frame=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.padding = padding
+        self.suffix = suffix
+        self.first_frame = first_frame
+        self.last_frame = last_frame
+
+    @property
+    def key(self):
+        return os.path.join(self.directory, f"{self.prefix}%0{self.padding}d{self.suffix}")
+
+    def __repr__(self):
+        return f"FrameSequence({self.key!r}, {self.first_frame}-{self.last_frame})"
+
+    @classmethod
+    def parse(cls, path):
+        # Builds a sequence from either a pattern (`shot.%04d.exr`, `shot.####.exr`) or the path of any one frame.
+        # Returns None when the name doesn't contain a frame number.
+        directory, name = os.path.split(path)
+        for pattern in (cls.printf_pattern, cls.hash_pattern):
+            match = pattern.search(name)
+            if match is not None:
+                padding = int(match.group(1) or 1) if pattern is cls.printf_pattern else len(match.group(0))
+                return cls(directory, name[:match.start()], padding, name[match.end():])
+        match = cls.frame_pattern.match(name)
+        if match is None:
+            return None
+        return cls(directory, match.group(1), len(match.group(2)), match.group(3) or '')
+
+    def path(self, frame):
+        return os.path.join(self.directory, f"{self.prefix}{frame:0{self.padding}d}{self.suffix}")
+
+    def frame_of(self, path):
+        name = os.path.basename(path)
+        if not (name.startswith(self.prefix) and name.endswith(self.suffix)):
+            return None
+        digits = name[len(self.prefix):len(name) - len(self.suffix)]
+        return int(digits) if digits.isdigit() else None
+
+    def scan_range(self):
+        # Lists the directory once to find the first and last frame on disk.
+        frames = []
+        with os.scandir(self.directory or '.') as it:
+            for entry in it:
+                frame = self.frame_of(entry.name)
+                if frame is not None:
+                    frames.append(frame)
+        if frames:
+            self.first_frame, self.last_frame = min(frames), max(frames)
+        return self.first_frame, self.last_frame
+
+
+class FramePrefetcher:
+    # Reads ahead of a player walking a frame sequence.
+    # Every `read()` schedules the next `window` frames on a bounded thread pool. In "buffer" mode the prefetched
+    # bytes are kept in a byte-budgeted LRU cache and served from memory; in "page-cache" mode the frames are only
+    # read (and fadvise'd) to warm the kernel/NFS client cache and the caller reads from disk as usual.
+
+    modes = ['buffer', 'page-cache']
+
+    # Sentinel distinguishing "not cached" from a page-cache entry, which is stored with a `None` value.
+    missing = object()
+
+    def __init__(self, window=24, workers=8, cache_bytes=2 * 1024 ** 3, mode='buffer', read_size=8 * 1024 * 1024):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown prefetch mode {mode!r}")
+        self.window = window
+        self.mode = mode
+        self.read_size = read_size
+        self.cache = LruByteCache(cache_bytes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.inflight = {}
+        # Frames the reader got to while their prefetch was running; the fetched data is dropped, not cached.
+        self.discarded = set()
+        self.sequences = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def stats(self):
+        # Returns a snapshot of the hit/miss counters.
+        with self.lock:
+            stats = dict(self.counters)
+        stats['evictions'] = self.cache.evictions
+        stats['cached_bytes'] = self.cache.current_bytes
+        for name in ('hits', 'misses', 'prefetched', 'prefetch_errors', 'bytes_prefetched'):
+            stats.setdefault(name, 0)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        return stats
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def sequence_for(self, path):
+        # Returns the (cached) sequence a frame path belongs to, scanning its directory only the first time.
+        sequence = FrameSequence.parse(path)
+        if sequence is None:
+            return None
+        with self.lock:
+            known = self.sequences.get(sequence.key)
+        if known is None:
+            try:
+                sequence.scan_range()
+            except OSError:
+                pass
+            with self.lock:
+                known = self.sequences.setdefault(sequence.key, sequence)
+        return known
+
+    def load(self, path):
+        # Reads a whole file with large sequential reads. In page-cache mode the data is discarded after reading.
+        total = 0
+        chunks = []
+        with open(path, 'rb', buffering=0) as f:
+            if self.mode == 'page-cache' and hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while True:
+                chunk = f.read(self.read_size)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if self.mode == 'buffer':
+                    chunks.append(chunk)
+        return (b''.join(chunks) if self.mode == 'buffer' else None), total
+
+    def prefetch_task(self, path):
+        try:
+            data, size = self.load(path)
+            # Cached under the prefetcher lock so `touch` either sees the frame in flight or finds it in the cache.
+            with self.lock:
+                if path not in self.discarded:
+                    self.cache.put(path, data, size)
+            self.count('prefetched')
+            self.count('bytes_prefetched', size)
+        except OSError as e:
+            LOG.debug(f"prefetch {path}: {e}")
+            self.count('prefetch_errors')
+        finally:
+            with self.lock:
+                self.inflight.pop(path, None)
+                self.discarded.discard(path)
+
+    def schedule(self, sequence, frame):
+        # Queues every frame in the window after `frame` that isn't already cached or being fetched.
+        for next_frame in range(frame + 1, frame + 1 + self.window):
+            if sequence.last_frame is not None and next_frame > sequence.last_frame:
+                break
+            path = sequence.path(next_frame)
+            if path in self.cache:
+                continue
+            with self.lock:
+                if path in self.inflight:
+                    continue
+                self.inflight[path] = self.executor.submit(self.prefetch_task, path)
+
+    def advance(self, path):
+        # Tells the prefetcher the reader is at `path` without reading it or counting a hit or miss.
+        sequence = self.sequence_for(path)
+        if sequence is not None:
+            frame = sequence.frame_of(path)
+            if frame is not None:
+                self.schedule(sequence, frame)
+        return sequence
+
+    def touch(self, path):
+        # Records a read the caller performed itself (hit if the frame was already warm) and moves the window forward.
+        # A frame still being fetched is a miss: its fetch is cancelled, or its result dropped once it finishes, so it
+        # doesn't sit in the cache behind the playhead.
+        with self.lock:
+            pending = self.inflight.get(path)
+            if pending is not None:
+                if pending.cancel():
+                    del self.inflight[path]
+                else:
+                    self.discarded.add(path)
+        warm = self.cache.pop(path, self.missing) is not self.missing
+        self.count('hits' if pending is None and warm else 'misses')
+        return self.advance(path)
+
+    def read(self, path):
+        # Returns the contents of `path`, served from the prefetch buffer when possible, and moves the window forward.
+        with self.lock:
+            pending = self.inflight.get(path)
+        if pending is not None:
+            pending.result()
+        self.advance(path)
+
+        # A frame that has been handed to the reader is dropped so the budget stays available for frames ahead.
+        data = self.cache.pop(path, self.missing)
+        if data is not self.missing:
+            self.count('hits')
+            if data is not None:
+                return data
+        else:
+            self.count('misses')
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class EnvoiStoragePrefetchCommand(EnvoiCommand):
+    # Runs the frame prefetcher as a daemon in front of a player.
+    # The playhead either advances on a clock at `--fps` from `--start-frame`, or follows frame paths/numbers
+    # written one per line to stdin (`--follow-stdin`), e.g. from a player wrapper.
+
+    description = "Read ahead of a numbered frame sequence to keep playback at full frame rate"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('sequence',
+                            help='Frame sequence pattern (shot.%%04d.exr or shot.####.exr) or the path of any frame')
+        parser.add_argument('--start-frame', type=int, required=False,
+                            help='Frame the playhead starts on (defaults to the first frame on disk)')
+        parser.add_argument('--fps', type=float, default=24.0,
+                            help='Playback rate used to advance the playhead')
+        parser.add_argument('--follow-stdin', action='store_true',
+                            help='Advance the playhead from frame paths or numbers read from stdin instead of a clock')
+        parser.add_argument('--window', type=int, default=48,
+                            help='Number of frames to keep prefetched ahead of the playhead')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Number of prefetch threads')
+        parser.add_argument('--mode', choices=FramePrefetcher.modes, default='page-cache',
+                            help='Keep prefetched frames in a local buffer or only warm the page/client cache')
+        parser.add_argument('--cache-size', type=str, default='2GiB',
+                            help='Byte budget of the prefetch buffer')
+        parser.add_argument('--stats-interval', type=float, default=10.0,
+                            help='Seconds between hit/miss counter lines (0 to disable)')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        sequence = FrameSequence.parse(opts.sequence)
+        if sequence is None:
+            raise ValueError(f"{opts.sequence} does not look like a numbered frame sequence")
+        first_frame, last_frame = sequence.scan_range()
+        if first_frame is None:
+            raise ValueError(f"No frames found for {sequence.key}")
+
+        prefetcher = FramePrefetcher(window=opts.window, workers=opts.workers,
+                                     cache_bytes=parse_size(opts.cache_size), mode=opts.mode)
+        prefetcher.sequences[sequence.key] = sequence
+        last_report = time.monotonic()
+        try:
+            if opts.follow_stdin:
+                for line in sys.stdin:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    prefetcher.touch(sequence.path(int(line)) if line.isdigit() else line)
+            else:
+                start_frame = opts.start_frame if opts.start_frame is not None else first_frame
+                frame = start_frame
+                started_at = time.monotonic()
+                while frame <= last_frame:
+                    # The player reads the frame itself; it's a hit if the prefetcher got to it first.
+                    prefetcher.touch(sequence.path(frame))
+                    frame += 1
+                    time.sleep(max(0.0, started_at + (frame - start_frame) / opts.fps - time.monotonic()))
+                    if opts.stats_interval and time.monotonic() - last_report >= opts.stats_interval:
+                        last_report = time.monotonic()
+                        print(f"prefetch: frame={frame} {json.dumps(prefetcher.stats())}", file=sys.stderr, flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            prefetcher.close()
+        return json.dumps(prefetcher.stats())
+
+
+class EnvoiStorageWarmCommand(EnvoiCommand):
+    # Pulls a set of files into the flash/SSD tier (Qumulo hybrid) or client cache (Weka) ahead of a session
+    # by reading them in parallel with large sequential reads.
+    # Large files are split into segments so a handful of camera originals still keep every worker busy, and each
+    # worker reuses one read buffer for its whole lifetime.
+
+    description = "Warm a cache tier by reading a list of files in parallel"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('paths', nargs='*',
+                            help='Files, directories (read recursively) or glob patterns (** is supported)')
+        parser.add_argument('--file-list', type=str, required=False,
+                            help='File with one path or glob pattern per line ("-" for stdin)')
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Number of parallel readers')
+        parser.add_argument('--block-size', type=str, default='8MiB',
+                            help='Size of each sequential read')
+        parser.add_argument('--segment-size', type=str, default='256MiB',
+                            help='Files larger than this are split into segments read by different workers')
+        parser.add_argument('--max-rate', type=float, default=0,
+                            help='Target read rate in GB/s across all workers (0 for unlimited)')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between progress lines (0 to disable)')
+        return parser
+
+    def __init__(self, opts=None, auto_exec=True):
+        self.buffers = threading.local()
+        self.block_size = None
+        self.limiter = None
+        self.progress = None
+        super().__init__(opts=opts, auto_exec=auto_exec)
+
+    @classmethod
+    def expand_paths(cls, patterns):
+        # Expands globs and directories into a de-duplicated, ordered list of regular files.
+        seen = set()
+        for pattern in patterns:
+            matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+            for match in matches:
+                if os.path.isdir(match):
+                    for dir_path, _, file_names in os.walk(match):
+                        for file_name in sorted(file_names):
+                            path = os.path.join(dir_path, file_name)
+                            if path not in seen:
+                                seen.add(path)
+                                yield path
+                elif match not in seen:
+                    seen.add(match)
+                    yield match
+
+    @classmethod
+    def read_patterns(cls, opts):
+        patterns = list(opts.paths)
+        if getattr(opts, 'file_list', None):
+            stream = sys.stdin if opts.file_list == '-' else open(opts.file_list, 'r')
+            try:
+                patterns.extend(line.strip() for line in stream if line.strip() and not line.startswith('#'))
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+        return patterns
+
+    @classmethod
+    def plan_segments(cls, paths, segment_size):
+        # Yields (path, offset, length) tuples covering every file.
+        for path in paths:
+            try:
+                size = os.stat(path).st_size
+            except OSError as e:
+                LOG.warning(f"warm: {path}: {e}")
+                continue
+            if size == 0:
+                yield path, 0, 0
+            for offset in range(0, size, segment_size):
+                yield path, offset, min(segment_size, size - offset)
+
+    def buffer(self):
+        # Each worker thread allocates its read buffer once and reuses it for every segment.
+        buffer = getattr(self.buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self.buffers.buffer = bytearray(self.block_size)
+        return buffer
+
+    def warm_segment(self, path, offset, length):
+        view = memoryview(self.buffer())
+        remaining = length
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_SEQUENTIAL)
+                f.seek(offset)
+                while remaining > 0:
+                    self.limiter.acquire(min(remaining, len(view)))
+                    read = f.readinto(view[:min(remaining, len(view))])
+                    if not read:
+                        break
+                    remaining -= read
+                    self.progress.add('bytes', read)
+        except OSError as e:
+            LOG.warning(f"warm: {path}: {e}")
+            self.progress.add('errors')
+            return
+        if offset == 0:
+            self.progress.add('files')
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        patterns = self.read_patterns(opts)
+        if not patterns:
+            raise ValueError("No paths given. Pass paths, globs or --file-list")
+
+        self.block_size = parse_size(opts.block_size)
+        # The bucket holds one second of bytes so short bursts are smoothed without overshooting the target rate.
+        rate = opts.max_rate * 1000 ** 3
+        self.limiter = TokenBucket(rate, capacity=max(rate, self.block_size))
+        self.progress = ProgressReporter('warm', interval=opts.progress_interval).start()
+        try:
+            segments = self.plan_segments(self.expand_paths(patterns), parse_size(opts.segment_size))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.workers, 1)) as executor:
+                # Submission is bounded so enormous file lists don't build an unbounded queue of futures.
+                pending = set()
+                for segment in segments:
+                    if len(pending) >= opts.workers * 4:
+                        done, pending = concurrent.futures.wait(pending,
+                                                                return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(self.warm_segment, *segment))
+                for future in concurrent.futures.as_completed(pending):
+                    future.result()
+        finally:
+            self.progress.stop()
+
+        elapsed = max(self.progress.elapsed(), 1e-9)
+        total_bytes = self.progress.get('bytes')
+        response = (f"Warmed {self.progress.get('files'):,} files ({format_size(total_bytes)}) in {elapsed:.1f}s "
+                    f"at {total_bytes / elapsed / 1000 ** 3:.2f} GB/s")
+        if self.progress.get('errors'):
+            response += f", {self.progress.get('errors'):,} errors"
+        return response
+
+
+class EnvoiStorageDiscoveryCacheShowCommand(EnvoiCommand):
+    # Lists the entries in the local discovery cache and when they expire.
+
+    description = "Show the cached AWS discovery entries"
+
+    def run(self, opts=None):
+        cache = DiscoveryCache()
+        now = time.time()
+        lines = [f"{key}  expires in {entry['expires_at'] - now:,.0f}s"
+                 for key, entry in sorted(cache.entries.items()) if entry['expires_at'] >= now]
+        return '\n'.join(lines) or "The discovery cache is empty"
+
+
+class EnvoiStorageDiscoveryCacheClearCommand(EnvoiCommand):
+    # Invalidates cached discovery entries, optionally limited to one profile, region or kind.
+
+    description = "Invalidate cached AWS discovery entries"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--aws-profile', type=str, required=False,
+                            help='Only clear entries for this profile')
+        parser.add_argument('--aws-region', type=str, required=False,
+                            help='Only clear entries for this region')
+        parser.add_argument('--kind', choices=['fsx-regions', 'directories', 'vpcs', 'subnets', 'instance-offerings',
+                                               'instance-types', 'ec2-quotas'], required=False,
+                            help='Only clear this kind of entry')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        count = DiscoveryCache().invalidate(profile=opts.aws_profile, region=opts.aws_region, kind=opts.kind)
+        return f"Cleared {count} discovery cache entries"
+
+
+class EnvoiStorageDiscoveryCacheCommand(EnvoiCommand):
+    # Namespace class for the discovery cache commands.
+    subcommands = {
+        'clear': EnvoiStorageDiscoveryCacheClearCommand,
+        'show': EnvoiStorageDiscoveryCacheShowCommand,
+    }
+
+
+def add_oci_arguments(parser):
+    # Adds the arguments every OCI command uses to locate credentials and the Object Storage endpoint.
+    parser.add_argument('--oci-config-file', type=str, default='~/.oci/config',
+                        help='OCI config file holding the API signing key')
+    parser.add_argument('--oci-profile', type=str, default='DEFAULT',
+                        help='Profile in the OCI config file')
+    parser.add_argument('--oci-region', type=str, required=False,
+                        help='OCI region. Defaults to the region in the OCI config file')
+    parser.add_argument('--oci-endpoint', type=str, required=False,
+                        help='Object Storage endpoint URL, e.g. http://localhost:8080 for a local stand-in')
+    parser.add_argument('--oci-auth', choices=['api_key', 'none'], default='api_key',
+                        help='Request signing. "none" sends unsigned requests, which only a local stand-in accepts')
+    parser.add_argument('--namespace', type=str, required=False,
+                        help='Object Storage namespace. Looked up from the service when not given')
+    return parser
+
+
+def oci_client_from_opts(opts):
+    # Returns (client, namespace) for the OCI options in opts.
+    signer = None
+    region = getattr(opts, 'oci_region', None)
+    if opts.oci_auth == 'api_key':
+        signer = OciRequestSigner.from_config(opts.oci_config_file, opts.oci_profile)
+        region = region or signer.region
+    endpoint = getattr(opts, 'oci_endpoint', None)
+    if endpoint is None:
+        if not region:
+            raise ValueError("An OCI region is required. Set --oci-region or region in the OCI config file")
+        endpoint = OciObjectStorageClient.DEFAULT_ENDPOINT.format(region=region)
+    client = OciObjectStorageClient(endpoint, signer=signer)
+    namespace = getattr(opts, 'namespace', None) or client.get_namespace()
+    if isinstance(namespace, bytes):
+        namespace = namespace.decode('utf-8')
+    return client, namespace.strip('"')
+
+
+class EnvoiStorageOciObjectStorageCreateBucketCommand(EnvoiCommand):
+    # Creates an Object Storage bucket. Replaces deploy-oci-object-storage.sh, without needing the OCI CLI
+    # to resolve the namespace.
+
+    description = "Create an OCI Object Storage bucket"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        add_oci_arguments(parser)
+        parser.add_argument('--compartment-id', type=str, required=False,
+                            help='Compartment OCID. Defaults to the tenancy (root compartment)')
+        parser.add_argument('--name', type=str, default=f"my-new-bucket-{time.strftime('%Y%m%d%H%M%S')}",
+                            help='Bucket name')
+        parser.add_argument('--storage-tier', choices=['Standard', 'Archive'], default='Standard',
+                            help='Storage tier')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        client, namespace = oci_client_from_opts(opts)
+        compartment_id = opts.compartment_id or getattr(client.signer, 'tenancy', None)
+        if not compartment_id:
+            raise ValueError("--compartment-id is required")
+        client.create_bucket(namespace, opts.name, compartment_id, storage_tier=opts.storage_tier)
+        return f"Bucket '{opts.name}' created in namespace '{namespace}'."
+
+
+class EnvoiStorageOciObjectStorageUploadCommand(EnvoiCommand):
+    # Uploads files or directory trees to a bucket. Small files are sent as single PUTs in parallel; large files
+    # use multipart uploads whose parts are spread across the same worker pool.
+
+    description = "Upload files to an OCI Object Storage bucket with parallel multipart uploads"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        add_oci_arguments(parser)
+        parser.add_argument('paths', nargs='+',
+                            help='Files, directories (uploaded recursively) or glob patterns')
+        parser.add_argument('--bucket', type=str, required=True,
+                            help='Bucket to upload to')
+        parser.add_argument('--prefix', type=str, default='',
+                            help='Prefix added to every object name')
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Number of parallel uploads (single objects and multipart parts)')
+        parser.add_argument('--part-size', type=str, default='auto',
+                            help='Multipart part size, or "auto" to size parts from the object size')
+        parser.add_argument('--multipart-threshold', type=str, default='128MiB',
+                            help='Files at least this large are uploaded in parts')
+        parser.add_argument('--no-resume', dest='resume', action='store_false',
+                            help='Always start new multipart uploads instead of resuming in-progress ones')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between progress lines (0 to disable)')
+        return parser
+
+    @classmethod
+    def object_names(cls, paths, prefix=''):
+        # Yields (path, object name). Files under a directory argument keep their path relative to it.
+        for pattern in paths:
+            matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+            for match in matches:
+                if os.path.isdir(match):
+                    root = os.path.normpath(match)
+                    for path in EnvoiStorageWarmCommand.expand_paths([match]):
+                        relative = os.path.relpath(path, os.path.dirname(root)).replace(os.sep, '/')
+                        yield path, prefix + relative
+                else:
+                    yield match, prefix + os.path.basename(match)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        client, namespace = oci_client_from_opts(opts)
+        part_size = None if opts.part_size == 'auto' else parse_size(opts.part_size)
+        progress = ProgressReporter('oci-upload', interval=opts.progress_interval).start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(opts.workers, 1)) as executor:
+                uploader = OciMultipartUploader(client, namespace, opts.bucket, executor, max(opts.workers, 1),
+                                                part_size=part_size,
+                                                multipart_threshold=parse_size(opts.multipart_threshold),
+                                                progress=progress)
+                futures = [future for path, object_name in self.object_names(opts.paths, opts.prefix)
+                           for future in [uploader.upload(path, object_name, resume=opts.resume)]
+                           if future is not None]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        finally:
+            progress.stop()
+
+        elapsed = max(progress.elapsed(), 1e-9)
+        total_bytes = progress.get('bytes')
+        response = (f"Uploaded {progress.get('objects'):,} objects ({format_size(total_bytes)}) to "
+                    f"{namespace}/{opts.bucket} in {elapsed:.1f}s at {total_bytes / elapsed / 1000 ** 2:.1f} MB/s")
+        if progress.get('parts_skipped'):
+            response += f", {progress.get('parts_skipped'):,} committed parts reused"
+        return response
+
+
+class EnvoiStorageOciObjectStorageCommand(EnvoiCommand):
+    # Namespace class for the OCI Object Storage commands.
+    subcommands = {
+        'create-bucket': EnvoiStorageOciObjectStorageCreateBucketCommand,
+        'upload': EnvoiStorageOciObjectStorageUploadCommand,
+    }
+
+
+class EnvoiStorageOciCommand(EnvoiCommand):
+    # Namespace class for the OCI commands.
+    subcommands = {
+        'object-storage': EnvoiStorageOciObjectStorageCommand,
+    }
+
+
+class SqliteStore:
+    # Base of the local SQLite stores. Subclasses name their database file in the cache directory, give its schema
+    # and write their own queries. The connection is shared by threads under `lock`, in autocommit mode, so
+    # transactions start with an explicit BEGIN.
+
+    filename = None
+    schema = ''
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(envoi_cache_dir(), self.filename)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.schema)
+
+    def close(self):
+        self.conn.close()
+
+    def update_row(self, table, key, fields):
+        # Sets the columns in `fields` on the row of `table` whose columns match `key`; both map columns to values.
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        conditions = ' AND '.join(f"{name} = ?" for name in key)
+        with self.lock:
+            self.conn.execute(f"UPDATE {table} SET {assignments} WHERE {conditions}",
+                              [*fields.values(), *key.values()])
+
+
+class StackEtaPredictor(SqliteStore):
+    # Predicts how long a stack create has left from the timings of earlier creates, kept in a local SQLite
+    # database. For every resource type it learns the mean create duration; for the stack as a whole, the mean
+    # total duration. History is kept per vendor, template and node count, with fallbacks to the vendor and
+    # template (any node count) and to the vendor alone. Resources running several times longer than their history
+    # are flagged: that is usually a stuck custom resource, and the stack is better deleted early.
+
+    stack_resource_type = 'AWS::CloudFormation::Stack'
+    # Template parameters that hold a stack's node count.
+    node_count_parameters = ('QNodeCount', 'DsxInstanceCount', 'BackendInstanceCount', 'InstanceCount', 'NodeCount')
+    # Later samples weigh at least this much, so the history follows changes in AWS or vendor behaviour.
+    min_sample_weight = 0.05
+
+    filename = 'eta.sqlite'
+    schema = """
+        CREATE TABLE IF NOT EXISTS durations (
+            history_key TEXT NOT NULL,
+            resource_type TEXT NOT NULL,
+            samples INTEGER NOT NULL,
+            seconds REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (history_key, resource_type)
+        );
+    """
+
+    def __init__(self, path=None, slow_factor=3.0, min_slow_seconds=300):
+        self.slow_factor = slow_factor
+        self.min_slow_seconds = min_slow_seconds
+        super().__init__(path)
+
+    @classmethod
+    def history_keys(cls, stack):
+        # The keys a stack's timings are recorded under, most specific first.
+        vendor = StackStatusCollector.vendor(stack)
+        tags = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+        # Stacks created before their template was tagged fall back to their description.
+        description = stack.get('Description')
+        template = tags.get(AwsCloudFormationHelper.template_tag_key) or (
+            hashlib.sha256(description.encode('utf-8')).hexdigest()[:12] if description else '-')
+        parameters = {p['ParameterKey']: p.get('ParameterValue') for p in stack.get('Parameters', [])}
+        nodes = next((parameters[name] for name in cls.node_count_parameters if parameters.get(name)), '-')
+        return [f"{vendor}|{template}|{nodes}", f"{vendor}|{template}|*", f"{vendor}|*|*"]
+
+    @classmethod
+    def timings(cls, stack, events):
+        # Returns (stack start, stack end, {logical ID: (resource type, start, end)}) in epoch seconds from the
+        # create events, oldest first. Unfinished times are None.
+        started = finished = None
+        resources = {}
+        for event in events:
+            timestamp = event['Timestamp'].timestamp()
+            status = event['ResourceStatus']
+            if event.get('PhysicalResourceId') == stack['StackId'] or event['LogicalResourceId'] == stack['StackName']:
+                if status == 'CREATE_IN_PROGRESS' and started is None:
+                    started = timestamp
+                elif status == 'CREATE_COMPLETE':
+                    finished = timestamp
+                continue
+            resource_type, resource_started, resource_finished = resources.get(
+                event['LogicalResourceId'], (event.get('ResourceType'), None, None))
+            if status == 'CREATE_IN_PROGRESS' and resource_started is None:
+                resource_started = timestamp
+            elif status == 'CREATE_COMPLETE':
+                resource_finished = timestamp
+            resources[event['LogicalResourceId']] = (resource_type, resource_started, resource_finished)
+        if started is None and stack.get('CreationTime'):
+            started = stack['CreationTime'].timestamp()
+        return started, finished, resources
+
+    def record(self, stack, events):
+        # Adds a completed create to the history. Returns False when the events don't cover the whole create.
+        started, finished, resources = self.timings(stack, events)
+        if started is None or finished is None:
+            return False
+        samples = collections.defaultdict(list)
+        samples[self.stack_resource_type].append(finished - started)
+        for resource_type, resource_started, resource_finished in resources.values():
+            if resource_type and resource_started is not None and resource_finished is not None:
+                samples[resource_type].append(resource_finished - resource_started)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            for key in self.history_keys(stack):
+                for resource_type, durations in samples.items():
+                    row = self.conn.execute('SELECT samples, seconds FROM durations WHERE history_key = ? AND '
+                                            'resource_type = ?', (key, resource_type)).fetchone()
+                    count, seconds = (row['samples'], row['seconds']) if row else (0, 0.0)
+                    for duration in durations:
+                        count += 1
+                        seconds += (duration - seconds) * max(1 / count, self.min_sample_weight)
+                    self.conn.execute('INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?, ?)',
+                                      (key, resource_type, count, seconds, now))
+        return True
+
+    def history(self, stack):
+        # Returns {resource type: mean seconds} of the most specific key with a recorded stack total.
+        with self.lock:
+            for key in self.history_keys(stack):
+                rows = self.conn.execute('SELECT resource_type, seconds FROM durations WHERE history_key = ?',
+                                         (key,)).fetchall()
+                history = {row['resource_type']: row['seconds'] for row in rows}
+                if self.stack_resource_type in history:
+                    return history
+        return {}
+
+    def estimate(self, stack, events, now=None):
+        # Returns {'elapsed', 'expected', 'remaining', 'slow': [(logical ID, message)]} in seconds, or None without
+        # history. The remaining time is the longer of the expected total and the resources still being created.
+        history = self.history(stack)
+        if not history:
+            return None
+        now = time.time() if now is None else now
+        started, _, resources = self.timings(stack, events)
+        elapsed = now - (started if started is not None else now)
+        expected = history[self.stack_resource_type]
+        remaining = expected - elapsed
+        slow = []
+        for logical_id, (resource_type, resource_started, resource_finished) in sorted(resources.items()):
+            if resource_started is None or resource_finished is not None or resource_type not in history:
+                continue
+            running = now - resource_started
+            remaining = max(remaining, history[resource_type] - running)
+            if running > max(self.min_slow_seconds, self.slow_factor * history[resource_type]):
+                slow.append((logical_id, f"{logical_id} ({resource_type}) has been creating for "
+                                         f"{StackStatusCollector.format_age(running)}, usually "
+                                         f"{StackStatusCollector.format_age(history[resource_type])}"))
+        if elapsed > max(self.min_slow_seconds, self.slow_factor * expected):
+            slow.append((stack['StackName'], f"the stack has been creating for "
+                                             f"{StackStatusCollector.format_age(elapsed)}, usually "
+                                             f"{StackStatusCollector.format_age(expected)}"))
+        return {'elapsed': elapsed, 'expected': expected, 'remaining': max(0.0, remaining), 'slow': slow}
+
+    def observe(self, stack, progress, new_events, stream=None):
+        # Called on every poll of a waiter with the stack's description and its new events. `progress` is the
+        # waiter's state (a dict). Prints the ETA to `stream`, warns once per slow resource, and records the
+        # timings when a create the waiter saw in progress completes. Errors only cost the ETA.
+        events = progress.setdefault('events', [])
+        events.extend(new_events)
+        status = stack['StackStatus']
+        try:
+            if status == 'CREATE_COMPLETE':
+                if progress.get('in_progress'):
+                    self.record(stack, events)
+                return None
+            if status != 'CREATE_IN_PROGRESS':
+                return None
+            progress['in_progress'] = True
+            estimate = self.estimate(stack, events)
+        except Exception as e:
+            LOG.debug(f"No ETA for {stack['StackName']}: {e}")
+            return None
+        if estimate is None:
+            return None
+        warned = progress.setdefault('warned', set())
+        for logical_id, message in estimate['slow']:
+            if logical_id not in warned:
+                warned.add(logical_id)
+                LOG.warning(f"{stack['StackName']}: {message}. It may be stuck")
+        if stream is not None:
+            print(f"{stack['StackName']}: {status}, {StackStatusCollector.format_age(estimate['elapsed'])} elapsed, "
+                  f"about {StackStatusCollector.format_age(estimate['remaining'])} left", file=stream, flush=True)
+        return estimate
+
+
+class DeploymentJournal(SqliteStore):
+    # A SQLite journal of multi-stack rollouts. Every stack operation is recorded as planned, then in_flight (with
+    # its StackId and the last stack event seen), then completed or failed, so a rollout that dies halfway can be
+    # resumed without redoing or re-checking the stacks that already finished.
+
+    filename = 'journal.sqlite'
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS operations (
+            run_id TEXT NOT NULL REFERENCES runs (run_id),
+            seq INTEGER NOT NULL,
+            stack_name TEXT NOT NULL,
+            argv TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stack_id TEXT,
+            last_event_id TEXT,
+            last_event TEXT,
+            error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (run_id, seq)
+        );
+    """
+
+    def create_run(self, operations):
+        # Records a new run with its operations, each given as (stack name, argv). Returns the run ID.
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{random.getrandbits(24):06x}"
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute('INSERT INTO runs (run_id, created_at) VALUES (?, ?)', (run_id, now))
+            self.conn.executemany(
+                'INSERT INTO operations (run_id, seq, stack_name, argv, status, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(run_id, seq, stack_name, json.dumps(argv), 'planned', now)
+                 for seq, (stack_name, argv) in enumerate(operations)])
+        return run_id
+
+    def operations(self, run_id):
+        with self.lock:
+            rows = self.conn.execute('SELECT * FROM operations WHERE run_id = ? ORDER BY seq', (run_id,)).fetchall()
+        return [{**dict(row), 'argv': json.loads(row['argv'])} for row in rows]
+
+    def update(self, run_id, seq, **fields):
+        self.update_row('operations', {'run_id': run_id, 'seq': seq}, {**fields, 'updated_at': time.time()})
+
+    def finish_run(self, run_id):
+        self.update_row('runs', {'run_id': run_id}, {'finished_at': time.time()})
+
+    def latest_unfinished_run(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT run_id FROM runs WHERE EXISTS (SELECT 1 FROM operations o WHERE o.run_id = runs.run_id "
+                "AND o.status != 'completed') ORDER BY created_at DESC LIMIT 1").fetchone()
+        return row['run_id'] if row else None
+
+
+class DeploymentRunner:
+    # Executes the operations of a journaled run concurrently. Each operation is the command line of a create
+    # command (e.g. "qumulo aws create-cluster ..."), run in-process; the runner then follows the stack's events
+    # until it is complete. Creates are idempotent, so an operation interrupted between the create call and the
+    # journal update simply attaches to its stack when resumed. A recorded stack that failed or rolled back is
+    # deleted and created again.
+
+    # Statuses of a recorded stack that can't be followed to completion, so the stack is created again.
+    recreate_stack_statuses = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED',
+                               'DELETE_COMPLETE')
+    # Statuses of a followed stack that count as done. Any other final status fails the operation, and resuming
+    # it goes through discard_failed_stack.
+    done_stack_statuses = ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
+    def __init__(self, journal, workers=8, poll_interval=15, parser=None, client_factory=None, predictor=None):
+        self.journal = journal
+        self.predictor = predictor
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.parser = parser
+        self.client_factory = client_factory or (lambda opts: AwsCloudFormationHelper.client_from_opts(opts=opts))
+
+    def parse(self, argv):
+        if self.parser is None:
+            self.parser = build_command_parser()
+        return self.parser.parse_args(argv)
+
+    def plan(self, argvs):
+        # Returns (stack name, argv) for every command line, checking they all parse before anything is created.
+        operations = []
+        for argv in argvs:
+            stack_name = getattr(self.parse(argv), 'stack_name', None)
+            if not stack_name:
+                raise ValueError(f"Not a stack create command: {' '.join(argv)}")
+            operations.append((stack_name, argv))
+        names = [name for name, _ in operations]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Stack names used more than once: {', '.join(duplicates)}")
+        return operations
+
+    def follow(self, run_id, operation, client):
+        # Polls the stack, journaling each new event, until it reaches a final status.
+        stack_id, last_event_id = operation['stack_id'], operation['last_event_id']
+        progress = {}
+        while True:
+            events = AwsCloudFormationHelper.new_stack_events(client, stack_id, last_event_id)
+            if events:
+                last_event_id = events[-1]['EventId']
+                self.journal.update(run_id, operation['seq'], last_event_id=last_event_id,
+                                    last_event=f"{events[-1]['LogicalResourceId']} {events[-1]['ResourceStatus']}")
+            stack = AwsCloudFormationHelper.describe_stack(client, stack_id)
+            status = stack['StackStatus']
+            if self.predictor is not None:
+                # Flags stacks much slower than their history and learns from the ones that complete.
+                self.predictor.observe(stack, progress, events)
+            if status in self.done_stack_statuses:
+                return status
+            if status.endswith('_FAILED') or status.endswith('_COMPLETE'):
+                raise ValueError(f"Stack {operation['stack_name']} is {status}")
+            time.sleep(self.poll_interval)
+
+    def discard_failed_stack(self, run_id, operation, client):
+        # CloudFormation won't create a stack under the name of one that failed or rolled back, so the failed stack
+        # is deleted (waiting for DELETE_COMPLETE) and forgotten before it is created again.
+        stack = AwsCloudFormationHelper.describe_stack(client, operation['stack_id'])
+        if stack['StackStatus'] not in self.recreate_stack_statuses:
+            return
+        if stack['StackStatus'] != 'DELETE_COMPLETE':
+            LOG.warning(f"{operation['stack_name']}: deleting the {stack['StackStatus']} stack to create it again")
+            StackTeardown(client, poll_interval=self.poll_interval).delete(stack)
+        operation['stack_id'] = operation['last_event_id'] = None
+        self.journal.update(run_id, operation['seq'], stack_id=None, last_event_id=None, last_event=None)
+
+    def execute(self, run_id, operation):
+        seq = operation['seq']
+        try:
+            opts = self.parse(operation['argv'])
+            client = self.client_factory(opts)
+            if operation['stack_id'] is not None:
+                self.discard_failed_stack(run_id, operation, client)
+            if operation['stack_id'] is None:
+                self.journal.update(run_id, seq, status='in_flight', error=None)
+                opts.handler(opts, auto_exec=False).run()
+                operation['stack_id'] = AwsCloudFormationHelper.describe_stack(client, opts.stack_name)['StackId']
+                self.journal.update(run_id, seq, stack_id=operation['stack_id'])
+            self.follow(run_id, operation, client)
+        except Exception as e:
+            LOG.error(f"{operation['stack_name']}: {e}")
+            self.journal.update(run_id, seq, status='failed', error=str(e))
+            return False
+        self.journal.update(run_id, seq, status='completed')
+        return True
+
+    def run(self, run_id):
+        # Runs every operation of the run that isn't completed and returns (completed, failed, skipped) counts.
+        operations = self.journal.operations(run_id)
+        pending = [operation for operation in operations if operation['status'] != 'completed']
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            results = list(pool.map(lambda operation: self.execute(run_id, operation), pending))
+        if all(results):
+            self.journal.finish_run(run_id)
+        return results.count(True), results.count(False), len(operations) - len(pending)
+
+
+def add_journal_arguments(parser):
+    parser.add_argument('--journal', type=str, required=False,
+                        help='Journal database (defaults to journal.sqlite in the cache directory)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of stacks created and followed at once')
+    parser.add_argument('--poll-interval', type=float, default=15,
+                        help='Seconds between stack status checks')
+    return parser
+
+
+class EnvoiStorageRolloutCommand(EnvoiCommand):
+    # Creates many stacks concurrently from a plan file, journaling every step so `resume` can finish the rollout.
+
+    description = "Create the stacks of a rollout plan, journaling progress for resume"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('plan', type=str,
+                            help='JSON plan: {"stacks": [{"command": ["qumulo", "aws", "create-cluster", ...]}]}')
+        return add_journal_arguments(parser)
+
+    @classmethod
+    def load_plan(cls, path):
+        with open(path, 'r') as f:
+            plan = json.load(f)
+        stacks = plan.get('stacks', []) if isinstance(plan, dict) else plan
+        return [stack['command'] if isinstance(stack, dict) else stack for stack in stacks]
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        journal = DeploymentJournal(opts.journal)
+        predictor = StackEtaPredictor()
+        try:
+            runner = DeploymentRunner(journal, workers=opts.workers, poll_interval=opts.poll_interval,
+                                      predictor=predictor)
+            run_id = journal.create_run(runner.plan(self.load_plan(opts.plan)))
+            completed, failed, _ = runner.run(run_id)
+        finally:
+            predictor.close()
+            journal.close()
+        response = f"Run {run_id}: {completed} stacks completed"
+        if failed:
+            response += f", {failed} failed. Run 'resume --run-id {run_id}' to retry them"
+        return response
+
+
+class EnvoiStorageResumeCommand(EnvoiCommand):
+    # Resumes a journaled rollout: completed stacks are skipped, stacks that were being created are followed
+    # from their last recorded event, stacks that were never created are created, and stacks that failed or
+    # rolled back are deleted and created again.
+
+    description = "Resume an interrupted rollout from the deployment journal"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--run-id', type=str, required=False,
+                            help='Run to resume (defaults to the most recent unfinished run)')
+        return add_journal_arguments(parser)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        journal = DeploymentJournal(opts.journal)
+        predictor = StackEtaPredictor()
+        try:
+            run_id = opts.run_id or journal.latest_unfinished_run()
+            if run_id is None:
+                return "No unfinished runs in the journal"
+            if not journal.operations(run_id):
+                raise ValueError(f"Run {run_id} not found in the journal")
+            runner = DeploymentRunner(journal, workers=opts.workers, poll_interval=opts.poll_interval,
+                                      predictor=predictor)
+            completed, failed, skipped = runner.run(run_id)
+        finally:
+            predictor.close()
+            journal.close()
+        response = f"Run {run_id}: {completed} stacks completed, {skipped} already complete"
+        if failed:
+            response += f", {failed} failed"
+        return response
+
+
+class StackStatusCollector:
+    # Lists the envoi stacks of many (profile, region) pairs at once. Every pair is listed with a paginated
+    # describe_stacks on its own thread, so checking ten regions takes about one API round trip. Watching only
+    # describes the stacks that are still in progress again.
+
+    vendors = ('hammerspace', 'qumulo', 'weka', 'fsx')
+
+    def __init__(self, profiles=None, regions=None, name_prefixes=None, tags=None, workers=16, client_factory=None):
+        self.targets = [(profile, region) for profile in profiles or [None] for region in regions or [None]]
+        self.name_prefixes = name_prefixes or []
+        self.tags = tags or {}
+        self.workers = workers
+        self.client_factory = client_factory or (lambda opts: AwsCloudFormationHelper.client_from_opts(opts=opts))
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_tags(values):
+        # "KEY=VALUE" matches the value, "KEY" matches any value.
+        tags = {}
+        for value in values or []:
+            key, _, tag_value = value.partition('=')
+            tags[key] = tag_value or None
+        return tags
+
+    def client(self, profile, region):
+        with self.lock:
+            if (profile, region) not in self.clients:
+                # Role ARNs are listed with the role's cached credentials.
+                if profile and profile.startswith('arn:'):
+                    opts = SimpleNamespace(aws_profile=None, aws_role_arn=[profile], aws_region=region)
+                else:
+                    opts = SimpleNamespace(aws_profile=profile, aws_region=region)
+                self.clients[(profile, region)] = self.client_factory(opts)
+            return self.clients[(profile, region)]
+
+    def matches(self, stack):
+        # Without filters, every stack tagged by the create commands matches.
+        tags = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+        if not self.name_prefixes and not self.tags:
+            return AwsCloudFormationHelper.vendor_tag_key in tags
+        if any(stack['StackName'].startswith(prefix) for prefix in self.name_prefixes):
+            return True
+        return bool(self.tags) and all(key in tags and value in (None, tags[key]) for key, value in self.tags.items())
+
+    @classmethod
+    def vendor(cls, stack):
+        for tag in stack.get('Tags', []):
+            if tag['Key'] == AwsCloudFormationHelper.vendor_tag_key:
+                return tag['Value']
+        # Stacks created before they were tagged are recognised by name.
+        return next((vendor for vendor in cls.vendors if vendor in stack['StackName'].lower()), '-')
+
+    def row(self, profile, region, stack):
+        return {'profile': profile, 'region': region, 'stack_name': stack['StackName'], 'stack_id': stack['StackId'],
+                'status': stack['StackStatus'], 'created': stack.get('CreationTime'), 'vendor': self.vendor(stack),
+                'outputs': AwsCloudFormationHelper.stack_outputs(stack)}
+
+    def list_target(self, target):
+        profile, region = target
+        rows = []
+        for page in self.client(profile, region).get_paginator('describe_stacks').paginate():
+            rows.extend(self.row(profile, region, stack) for stack in page['Stacks'] if self.matches(stack))
+        return rows
+
+    def fan_out(self, func, items):
+        # Runs func for every item concurrently and returns the results in order. Failures (opt-in regions,
+        # missing permissions) are logged and give None.
+        def call(item):
+            try:
+                return func(item)
+            except Exception as e:
+                LOG.warning(f"Skipping {item}: {e}")
+                return None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(items)))) as pool:
+            return list(pool.map(call, items))
+
+    def collect(self):
+        rows = []
+        for target_rows in self.fan_out(self.list_target, self.targets):
+            rows.extend(target_rows or [])
+        return sorted(rows, key=lambda row: (row['profile'] or '', row['region'] or '', row['stack_name']))
+
+    @staticmethod
+    def in_progress(row):
+        return row['status'].endswith('_IN_PROGRESS')
+
+    def refresh(self, rows):
+        # Describes the in-progress stacks again (by StackId, so a stack deleted meanwhile is still found) and
+        # returns the updated rows. Settled stacks are returned as they were, without any API call.
+        def describe(row):
+            stack = AwsCloudFormationHelper.describe_stack(self.client(row['profile'], row['region']), row['stack_id'])
+            return self.row(row['profile'], row['region'], stack)
+        pending = [index for index, row in enumerate(rows) if self.in_progress(row)]
+        rows = list(rows)
+        for index, row in zip(pending, self.fan_out(describe, [rows[index] for index in pending])):
+            if row is not None:
+                rows[index] = row
+        return rows
+
+    @staticmethod
+    def format_age(seconds):
+        seconds = int(max(0, seconds))
+        if seconds >= 86400:
+            return f"{seconds // 86400}d{seconds % 86400 // 3600}h"
+        if seconds >= 3600:
+            return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+        if seconds >= 60:
+            return f"{seconds // 60}m{seconds % 60:02d}s"
+        return f"{seconds}s"
+
+    @classmethod
+    def format_table(cls, rows, now=None):
+        now = time.time() if now is None else now
+        columns = ['profile', 'region', 'stack', 'status', 'age', 'vendor', 'outputs']
+        table = [[row['profile'] or 'default', row['region'] or 'default', row['stack_name'], row['status'],
+                  cls.format_age(now - row['created'].timestamp()) if row['created'] else '-', row['vendor'],
+                  ' '.join(f"{key}={value}" for key, value in sorted(row['outputs'].items()))] for row in rows]
+        widths = [max(len(value) for value in column) for column in zip(columns, *table)]
+        return '\n'.join(' '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+                         for line in [columns, *table])
+
+
+class EnvoiStorageStatusCommand(EnvoiCommand):
+    # Prints the stacks created by the create commands across profiles and regions.
+
+    description = "Show the status of storage stacks across AWS profiles and regions"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--profiles', type=str, required=False,
+                            help='Comma-separated AWS profiles (defaults to the current profile). A role ARN lists '
+                                 'the account of that role, assumed from the current credentials')
+        parser.add_argument('--regions', type=str, required=False,
+                            help='Comma-separated AWS regions (defaults to the current region)')
+        parser.add_argument('--name-prefix', action='append', default=[],
+                            help='Show stacks whose name starts with this prefix. May be repeated')
+        parser.add_argument('--tag', action='append', default=[],
+                            help='Show stacks with this tag, as KEY or KEY=VALUE. May be repeated. Without '
+                                 '--name-prefix or --tag, stacks tagged envoi:vendor are shown')
+        parser.add_argument('--workers', type=int, default=16, help='Number of concurrent API calls')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling the stacks that are in progress until every stack has settled')
+        parser.add_argument('--interval', type=float, default=15, help='Seconds between polls in --watch mode')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        profiles = [profile.strip() for profile in (opts.profiles or '').split(',') if profile.strip()]
+        regions = [region.strip() for region in (opts.regions or '').split(',') if region.strip()]
+        collector = StackStatusCollector(profiles=profiles, regions=regions,
+                                         name_prefixes=opts.name_prefix,
+                                         tags=StackStatusCollector.parse_tags(opts.tag), workers=opts.workers)
+        rows = collector.collect()
+        while opts.watch and any(collector.in_progress(row) for row in rows):
+            print(collector.format_table(rows), end='\n\n', flush=True)
+            time.sleep(opts.interval)
+            rows = collector.refresh(rows)
+        if not rows:
+            return "No stacks found"
+        return collector.format_table(rows)
+
+
+class StackTeardown:
+    # Deletes a set of stacks in dependency order. A stack depends on another when it imports one of the other
+    # stack's exports, or when its envoi:depends-on tag (a comma-separated list of stack names) names it. Stacks
+    # that nothing left depends on are deleted concurrently, level by level, so the teardown takes as long as the
+    # deepest chain rather than the number of stacks. Each delete is followed through its stack events.
+
+    depends_on_tag_key = 'envoi:depends-on'
+
+    def __init__(self, client, s3_client=None, workers=8, poll_interval=15, timeout=7200, retries=1,
+                 empty_buckets=False, retain_failed=False):
+        self.client = client
+        self.s3_client = s3_client
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.empty_buckets = empty_buckets
+        self.retain_failed = retain_failed
+
+    def select(self, names=None, name_prefixes=None, tags=None):
+        # Returns the descriptions of the named stacks and of the stacks matching the prefixes or tags.
+        stacks = {}
+        if name_prefixes or tags:
+            matcher = StackStatusCollector(name_prefixes=name_prefixes, tags=tags)
+            for page in self.client.get_paginator('describe_stacks').paginate():
+                stacks.update((stack['StackName'], stack) for stack in page['Stacks'] if matcher.matches(stack))
+        for name in names or []:
+            stacks[name] = AwsCloudFormationHelper.describe_stack(self.client, name)
+        return list(stacks.values())
+
+    def dependencies(self, stacks):
+        # Returns {stack name: names of the selected stacks it depends on}. A stack outside the selection that
+        # imports a selected stack's export would make its delete fail, so that is an error.
+        names_by_id = {stack['StackId']: stack['StackName'] for stack in stacks}
+        depends_on = {stack['StackName']: set() for stack in stacks}
+        for stack in stacks:
+            for tag in stack.get('Tags', []):
+                if tag['Key'] == self.depends_on_tag_key:
+                    depends_on[stack['StackName']].update(
+                        name.strip() for name in tag['Value'].split(',') if name.strip() in depends_on)
+        for page in self.client.get_paginator('list_exports').paginate():
+            for export in page['Exports']:
+                exporter = names_by_id.get(export['ExportingStackId'])
+                if exporter is None:
+                    continue
+                for importer in self.importers(export['Name']):
+                    if importer not in depends_on:
+                        raise ValueError(f"Stack {exporter} can't be deleted: its export {export['Name']} is "
+                                         f"imported by {importer}, which isn't being destroyed")
+                    if importer != exporter:
+                        depends_on[importer].add(exporter)
+        return depends_on
+
+    def importers(self, export_name):
+        try:
+            return [name for page in self.client.get_paginator('list_imports').paginate(ExportName=export_name)
+                    for name in page['Imports']]
+        except Exception as e:
+            # CloudFormation reports an export that nothing imports as a ValidationError.
+            if aws_error_code(e) == 'ValidationError':
+                return []
+            raise
+
+    def levels(self, depends_on):
+        # Groups the stacks into deletion levels: every stack of a level only has dependents in earlier levels.
+        remaining = {name: set(names) for name, names in depends_on.items()}
+        levels = []
+        while remaining:
+            needed = set().union(*remaining.values())
+            level = sorted(name for name in remaining if name not in needed)
+            if not level:
+                raise ValueError(f"Stacks depend on each other in a cycle: {', '.join(sorted(remaining))}")
+            levels.append(level)
+            for name in level:
+                del remaining[name]
+        return levels
+
+    def latest_event_id(self, stack_id):
+        for page in self.client.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+            return next((event['EventId'] for event in page['StackEvents']), None)
+        return None
+
+    def wait(self, name, stack_id, last_event_id):
+        # Logs the stack's new events until the delete completes or fails. Returns the final status and the events
+        # of the resources that failed to delete, by logical ID.
+        deadline = time.monotonic() + self.timeout
+        failed = {}
+        while True:
+            for event in AwsCloudFormationHelper.new_stack_events(self.client, stack_id, last_event_id):
+                last_event_id = event['EventId']
+                LOG.info(f"{name}: {event['LogicalResourceId']} {event['ResourceStatus']} "
+                         f"{event.get('ResourceStatusReason', '')}".rstrip())
+                if event['ResourceStatus'] == 'DELETE_FAILED' and event.get('PhysicalResourceId') != stack_id:
+                    failed[event['LogicalResourceId']] = event
+            status = AwsCloudFormationHelper.describe_stack(self.client, stack_id)['StackStatus']
+            if status in ('DELETE_COMPLETE', 'DELETE_FAILED'):
+                return status, failed
+            if time.monotonic() > deadline:
+                raise ValueError(f"Timed out waiting for stack {name} to be deleted; it is {status}")
+            time.sleep(self.poll_interval)
+
+    def clean_up(self, name, failed):
+        # Prepares failed resources for another delete. Non-empty buckets are the usual cause and are emptied when
+        # allowed; other failures (e.g. network interfaces released late) often just need the retry.
+        for logical_id, event in failed.items():
+            if event.get('ResourceType') == 'AWS::S3::Bucket' and self.empty_buckets and self.s3_client:
+                LOG.warning(f"{name}: emptying bucket {event['PhysicalResourceId']} ({logical_id})")
+                self.empty_bucket(event['PhysicalResourceId'])
+
+    def empty_bucket(self, bucket):
+        paginator = self.s3_client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=bucket):
+            objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                       for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+            # A page holds at most 1000 versions, which is also the delete_objects limit.
+            if objects:
+                self.s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+    def delete(self, stack):
+        # Deletes one stack. A failed delete is retried after cleaning up the failed resources; with retain_failed
+        # a last attempt keeps the resources that still fail. Returns the logical IDs of retained resources.
+        name, stack_id = stack['StackName'], stack['StackId']
+        retained = []
+        attempts = 0
+        while True:
+            delete_args = {'StackName': stack_id}
+            if retained:
+                delete_args['RetainResources'] = retained
+            last_event_id = self.latest_event_id(stack_id)
+            self.client.delete_stack(**delete_args)
+            status, failed = self.wait(name, stack_id, last_event_id)
+            if status == 'DELETE_COMPLETE':
+                return retained
+            if attempts < self.retries:
+                attempts += 1
+                self.clean_up(name, failed)
+            elif self.retain_failed and failed and not retained:
+                retained = sorted(failed)
+                LOG.warning(f"{name}: retaining {', '.join(retained)}")
+            else:
+                reasons = '; '.join(f"{logical_id}: {event.get('ResourceStatusReason', 'failed')}"
+                                    for logical_id, event in sorted(failed.items()))
+                raise ValueError(f"Stack {name} is {status}. {reasons}".rstrip('. '))
+
+    def destroy(self, stacks, levels=None):
+        # Deletes the stacks level by level and returns {stack name: retained logical IDs}. When a level fails,
+        # the stacks the failed ones depend on are left alone.
+        by_name = {stack['StackName']: stack for stack in stacks}
+        if levels is None:
+            levels = self.levels(self.dependencies(stacks))
+        retained = {}
+
+        def delete(name):
+            try:
+                return name, self.delete(by_name[name]), None
+            except Exception as e:
+                LOG.error(f"{name}: {e}")
+                return name, None, str(e)
+
+        for index, level in enumerate(levels):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(level)))) as pool:
+                results = list(pool.map(delete, level))
+            retained.update((name, kept) for name, kept, error in results if kept)
+            errors = [f"{name}: {error}" for name, _, error in results if error]
+            if errors:
+                left = [name for later in levels[index + 1:] for name in later]
+                raise ValueError(f"Teardown stopped. {' '.join(errors)}" +
+                                 (f" Not deleted: {', '.join(left)}" if left else ''))
+        return retained
+
+
+class EnvoiStorageDestroyCommand(EnvoiCommand):
+    # Deletes storage stacks in dependency order (see StackTeardown).
+
+    description = "Delete storage stacks concurrently in dependency order"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('stack_names', nargs='*', help='Stacks to delete')
+        parser.add_argument('--name-prefix', action='append', default=[],
+                            help='Also delete the stacks whose name starts with this prefix. May be repeated')
+        parser.add_argument('--tag', action='append', default=[],
+                            help='Also delete the stacks with this tag, as KEY or KEY=VALUE. May be repeated')
+        add_aws_arguments(parser)
+        parser.add_argument('--workers', type=int, default=8, help='Number of stacks deleted at once')
+        parser.add_argument('--poll-interval', type=float, default=15, help='Seconds between stack event polls')
+        parser.add_argument('--timeout', type=float, default=7200, help='Seconds to wait for each delete')
+        parser.add_argument('--retries', type=int, default=1,
+                            help='Times a DELETE_FAILED stack is deleted again after cleaning up')
+        parser.add_argument('--empty-buckets', action='store_true',
+                            help='Empty S3 buckets (every object version) that fail to delete before retrying')
+        parser.add_argument('--retain-failed', action='store_true',
+                            help='As a last attempt, delete the stack but keep the resources that still fail')
+        parser.add_argument('--dry-run', action='store_true', help='Only print the deletion order')
+        parser.add_argument('--yes', action='store_true', help='Do not ask for confirmation')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        if not (opts.stack_names or opts.name_prefix or opts.tag):
+            raise ValueError("Name the stacks to delete, or select them with --name-prefix or --tag")
+        teardown = StackTeardown(AwsCloudFormationHelper.client_from_opts(opts=opts),
+                                 s3_client=aws_client_from_opts('s3', opts=opts) if opts.empty_buckets else None,
+                                 workers=opts.workers, poll_interval=opts.poll_interval, timeout=opts.timeout,
+                                 retries=opts.retries, empty_buckets=opts.empty_buckets,
+                                 retain_failed=opts.retain_failed)
+        stacks = teardown.select(opts.stack_names, opts.name_prefix, StackStatusCollector.parse_tags(opts.tag))
+        if not stacks:
+            return "No stacks found"
+        levels = teardown.levels(teardown.dependencies(stacks))
+        plan = '\n'.join(f"Level {index + 1}: {', '.join(level)}" for index, level in enumerate(levels))
+        if opts.dry_run:
+            return plan
+        if not opts.yes:
+            print(plan, file=sys.stderr)
+            if not prompt_confirm(f"Delete {len(stacks)} stacks?"):
+                return "Teardown canceled by user."
+        retained = teardown.destroy(stacks, levels)
+        lines = [f"Deleted {len(stacks)} stacks in {len(levels)} levels"]
+        lines.extend(f"{name} retained {', '.join(kept)}" for name, kept in sorted(retained.items()))
+        return '\n'.join(lines)
+
+
+class StandbyPoolLedger(SqliteStore):
+    # A SQLite ledger of the members of standby pools. A member is provisioning until its stack is complete, then
+    # available until it is assigned to a requester. Claims run in an immediate transaction, so concurrent
+    # `pool assign` calls (from any process) never get the same cluster.
+
+    filename = 'pool.sqlite'
+    schema = """
+        CREATE TABLE IF NOT EXISTS members (
+            stack_name TEXT PRIMARY KEY,
+            pool TEXT NOT NULL,
+            argv TEXT NOT NULL,
+            state TEXT NOT NULL,
+            stack_id TEXT,
+            outputs TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            ready_at REAL,
+            assigned_to TEXT,
+            assigned_at REAL
+        );
+    """
+
+    @staticmethod
+    def member(row):
+        return {**dict(row), 'argv': json.loads(row['argv']), 'outputs': json.loads(row['outputs'] or '{}')}
+
+    def add(self, pool, stack_name, argv):
+        with self.lock:
+            self.conn.execute('INSERT INTO members (stack_name, pool, argv, state, created_at) VALUES (?, ?, ?, ?, ?)',
+                              (stack_name, pool, json.dumps(argv), 'provisioning', time.time()))
+
+    def update(self, stack_name, **fields):
+        if 'outputs' in fields:
+            fields['outputs'] = json.dumps(fields['outputs'])
+        self.update_row('members', {'stack_name': stack_name}, fields)
+
+    def remove(self, stack_name):
+        with self.lock:
+            self.conn.execute('DELETE FROM members WHERE stack_name = ?', (stack_name,))
+
+    def members(self, pool=None, states=None):
+        query, args = 'SELECT * FROM members WHERE 1 = 1', []
+        if pool is not None:
+            query += ' AND pool = ?'
+            args.append(pool)
+        if states:
+            query += f" AND state IN ({', '.join('?' * len(states))})"
+            args.extend(states)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY pool, created_at', args).fetchall()
+        return [self.member(row) for row in rows]
+
+    def claim(self, pool, requester):
+        # Marks the oldest available member of the pool as assigned and returns it, or None when the pool is empty.
+        # The oldest goes first so members are used before they expire.
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute("SELECT * FROM members WHERE pool = ? AND state = 'available' "
+                                    "ORDER BY ready_at LIMIT 1", (pool,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.conn.execute("UPDATE members SET state = 'assigned', assigned_to = ?, assigned_at = ? "
+                              "WHERE stack_name = ?", (requester, now, row['stack_name']))
+        return {**self.member(row), 'state': 'assigned', 'assigned_to': requester, 'assigned_at': now}
+
+
+class StandbyPoolManager:
+    # Keeps standby pools of pre-created clusters. Each pool is a create command line and a size; `maintain`
+    # creates members (with generated stack names) until the pool is full, waits for their stacks to complete and
+    # for their services to accept connections (the `wait-ready` probe of the create command's vendor), and
+    # deletes members that stayed unassigned longer than the pool's max age or that failed. `assign` hands a
+    # ready member to a requester straight from the ledger and tags its stack, so the requester doesn't wait for
+    # a deployment.
+
+    pool_tag_key = 'envoi:pool'
+    assigned_to_tag_key = 'envoi:assigned-to'
+
+    def __init__(self, ledger, pools=None, workers=4, poll_interval=15, parser=None, client_factory=None,
+                 predictor=None, ready_timeout=900, probe_factory=None):
+        self.ledger = ledger
+        self.predictor = predictor
+        self.pools = pools or {}
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.parser = parser
+        self.client_factory = client_factory or (lambda opts: AwsCloudFormationHelper.client_from_opts(opts=opts))
+        self.ready_timeout = ready_timeout
+        self.probe_factory = probe_factory or ServiceReadinessProbe
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self.stopping = threading.Event()
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load_pools(cls, path):
+        # {"pools": [{"name": "weka-small", "size": 2, "max_age_hours": 72, "command": ["weka", "aws", ...]}]}
+        with open(path, 'r') as f:
+            config = json.load(f)
+        pools = {}
+        for pool in config.get('pools', []):
+            if not pool.get('name') or not pool.get('command'):
+                raise ValueError(f"Every pool in {path} needs a name and a command")
+            pools[pool['name']] = {'size': int(pool.get('size', 1)), 'command': list(pool['command']),
+                                   'max_age_hours': float(pool.get('max_age_hours', 168))}
+        return pools
+
+    def parse(self, argv):
+        if self.parser is None:
+            self.parser = build_command_parser()
+        try:
+            return self.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(f"Invalid pool command line: {' '.join(argv)}")
+
+    def client(self, member):
+        return self.client_factory(self.parse(member['argv']))
+
+    def provision(self, stack_name):
+        # Creates a member's stack (unless it exists already) and follows it until it is complete. After stop(),
+        # the member is left provisioning for the next process to follow.
+        try:
+            if self.stopping.is_set():
+                return
+            member = next((m for m in self.ledger.members(states=['provisioning'])
+                           if m['stack_name'] == stack_name), None)
+            if member is None:
+                return
+            opts = self.parse(member['argv'])
+            client = self.client_factory(opts)
+            if member['stack_id'] is None:
+                opts.handler(opts, auto_exec=False).run()
+                self.ledger.update(stack_name, stack_id=AwsCloudFormationHelper.describe_stack(
+                    client, stack_name)['StackId'])
+            stack = AwsCloudFormationHelper.wait_for_stack(client, stack_name, poll_interval=self.poll_interval,
+                                                           predictor=self.predictor, stop=self.stopping)
+            self.check_ready(opts, stack)
+        except WaitStopped:
+            LOG.info(f"{stack_name}: stopped, left provisioning")
+        except Exception as e:
+            LOG.error(f"{stack_name}: {e}")
+            self.ledger.update(stack_name, state='failed', error=str(e))
+        else:
+            self.ledger.update(stack_name, state='available', ready_at=time.time(),
+                               outputs=AwsCloudFormationHelper.stack_outputs(stack))
+        finally:
+            with self.lock:
+                self.in_flight.discard(stack_name)
+
+    def check_ready(self, opts, stack):
+        # Waits for a majority of the cluster's nodes to accept connections on the NFS and management ports, like
+        # `wait-ready`, so a member is only handed out once it is serving. Create commands without a wait-ready
+        # command are available as soon as their stack is complete.
+        wait_ready_command = getattr(opts.handler, 'wait_ready_command', None)
+        if wait_ready_command is None:
+            return
+        nodes = wait_ready_command.node_addresses(AwsCloudFormationHelper.stack_outputs(stack))
+        if not nodes:
+            raise ValueError(f"No node addresses found in the outputs of stack {stack['StackName']}")
+        ports = [wait_ready_command.service_ports['nfs'], wait_ready_command.management_port]
+        self.probe_factory(nodes, ports).wait(timeout=self.ready_timeout, stop=self.stopping)
+
+    def start(self, stack_name):
+        with self.lock:
+            if stack_name in self.in_flight:
+                return None
+            self.in_flight.add(stack_name)
+        return self.executor.submit(self.provision, stack_name)
+
+    def delete(self, member):
+        # Starts deleting the member's stack and drops it from the ledger; the delete itself isn't waited for.
+        try:
+            self.client(member).delete_stack(StackName=member['stack_id'] or member['stack_name'])
+        except Exception as e:
+            LOG.error(f"Couldn't delete {member['stack_name']}: {e}")
+            return False
+        self.ledger.remove(member['stack_name'])
+        return True
+
+    def expire(self, pool, now=None):
+        # Deletes failed members and available members older than the pool's max age. Returns the deleted names.
+        now = time.time() if now is None else now
+        max_age = self.pools[pool]['max_age_hours'] * 3600
+        stale = [member for member in self.ledger.members(pool, ['available', 'failed'])
+                 if member['state'] == 'failed' or now - member['ready_at'] > max_age]
+        return [member['stack_name'] for member in stale if self.delete(member)]
+
+    def replenish(self, pool):
+        # Starts creating members until the pool has `size` provisioning or available members. Members left
+        # provisioning by a previous process are followed again. Returns the names of the new members.
+        spec = self.pools[pool]
+        live = self.ledger.members(pool, ['provisioning', 'available'])
+        for member in live:
+            if member['state'] == 'provisioning':
+                self.start(member['stack_name'])
+        created = []
+        for _ in range(max(0, spec['size'] - len(live))):
+            stack_name = f"{pool}-{random.getrandbits(32):08x}"
+            self.ledger.add(pool, stack_name, [*spec['command'], '--stack-name', stack_name])
+            self.start(stack_name)
+            created.append(stack_name)
+        return created
+
+    def maintain(self):
+        # One maintenance pass over every pool. Returns {pool: (created, expired)} counts.
+        summary = {}
+        for pool in self.pools:
+            expired = self.expire(pool)
+            summary[pool] = (len(self.replenish(pool)), len(expired))
+        return summary
+
+    def assign(self, pool, requester):
+        member = self.ledger.claim(pool, requester)
+        if member is None:
+            raise ValueError(f"No cluster is available in pool {pool}")
+        try:
+            AwsCloudFormationHelper.update_stack_tags(self.client(member), member['stack_id'], {
+                self.pool_tag_key: pool, self.assigned_to_tag_key: requester})
+        except Exception as e:
+            # The ledger already records the assignment; the tags are for people looking at the console.
+            LOG.warning(f"Couldn't tag {member['stack_name']}: {e}")
+        return member
+
+    def stop(self):
+        # Makes the provisioning threads stop waiting on stacks and probes, and drops the members not started yet.
+        self.stopping.set()
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=self.stopping.is_set())
+
+
+def add_pool_ledger_argument(parser):
+    parser.add_argument('--ledger', type=str, required=False,
+                        help='Pool ledger database (defaults to pool.sqlite in the cache directory)')
+    return parser
+
+
+class EnvoiStoragePoolMaintainCommand(EnvoiCommand):
+    # Runs maintenance passes over the pools of a config file until interrupted (or once, with --once).
+    description = "Keep standby pools full, replacing failed and expired members"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('config', type=str,
+                            help='JSON pools: {"pools": [{"name": ..., "size": 2, "max_age_hours": 72, '
+                                 '"command": ["weka", "aws", "create-stack", ...]}]}')
+        parser.add_argument('--once', action='store_true',
+                            help='Run one pass and wait for the new members instead of running until interrupted')
+        parser.add_argument('--interval', type=float, default=300, help='Seconds between maintenance passes')
+        parser.add_argument('--workers', type=int, default=4, help='Number of members created at once')
+        parser.add_argument('--poll-interval', type=float, default=15, help='Seconds between stack status checks')
+        return add_pool_ledger_argument(parser)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        ledger = StandbyPoolLedger(opts.ledger)
+        predictor = StackEtaPredictor()
+        manager = StandbyPoolManager(ledger, StandbyPoolManager.load_pools(opts.config), workers=opts.workers,
+                                     poll_interval=opts.poll_interval, predictor=predictor)
+        try:
+            while True:
+                for pool, (created, expired) in manager.maintain().items():
+                    if created or expired:
+                        LOG.warning(f"Pool {pool}: creating {created}, expired {expired}")
+                if opts.once:
+                    break
+                time.sleep(opts.interval)
+        except KeyboardInterrupt:
+            # The provisioning threads use the ledger and predictor, so they are stopped and waited for first.
+            manager.stop()
+        finally:
+            manager.close()
+            counts = collections.Counter((member['pool'], member['state']) for member in ledger.members())
+            ledger.close()
+            predictor.close()
+        return '\n'.join(f"{pool}: " + ', '.join(f"{counts[(pool, state)]} {state}" for state in
+                                                 ('available', 'provisioning', 'failed'))
+                         for pool in manager.pools)
+
+
+class EnvoiStoragePoolAssignCommand(EnvoiCommand):
+    # Prints the assigned member's stack and outputs as JSON.
+    description = "Assign an available cluster from a standby pool"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('pool', type=str, help='Pool name')
+        parser.add_argument('--requester', type=str, required=True,
+                            help='Who the cluster is for (e.g. a show or production code). Tagged on the stack')
+        return add_pool_ledger_argument(parser)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        ledger = StandbyPoolLedger(opts.ledger)
+        manager = StandbyPoolManager(ledger)
+        try:
+            member = manager.assign(opts.pool, opts.requester)
+        finally:
+            manager.close()
+            ledger.close()
+        return json.dumps({key: member[key] for key in ('stack_name', 'stack_id', 'outputs', 'assigned_to')},
+                          indent=2)
+
+
+class EnvoiStoragePoolListCommand(EnvoiCommand):
+    # Prints one line per member: pool, stack name, state and who it is assigned to.
+    description = "List the members of the standby pools"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--pool', type=str, required=False, help='Only list this pool')
+        return add_pool_ledger_argument(parser)
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        ledger = StandbyPoolLedger(opts.ledger)
+        try:
+            members = ledger.members(opts.pool)
+        finally:
+            ledger.close()
+        if not members:
+            return "No pool members"
+        return '\n'.join(f"{m['pool']} {m['stack_name']} {m['state']}" +
+                         (f" {m['assigned_to']}" if m['assigned_to'] else '') for m in members)
+
+
+class EnvoiStoragePoolCommand(EnvoiCommand):
+    # Namespace class for the standby pool commands.
+    subcommands = {
+        'assign': EnvoiStoragePoolAssignCommand,
+        'list': EnvoiStoragePoolListCommand,
+        'maintain': EnvoiStoragePoolMaintainCommand,
+    }
+
+
+@dataclasses.dataclass
+class DeploymentConfig:
+    # The settings shared by the library API's deployment configurations. Fields are the create command's argument
+    # destinations (or are mapped to them with `field_dests`); anything without a field can be set in `options` by
+    # its destination name, e.g. options={'q_disk_config': '128GiB-Write-Cache'}. Unset fields take the command's
+    # defaults.
+
+    stack_name: str = None
+    aws_profile: str = None
+    aws_region: str = None
+    aws_endpoint_url: str = None
+    aws_role_arn: list = None
+    cfn_role_arn: str = None
+    template_url: str = None
+    skip_preflight: bool = None
+    options: dict = dataclasses.field(default_factory=dict)
+
+    vendor = None
+    command_class = None
+    field_dests = {}
+    # The argument defaults and required destinations of each command class, so the parser is only built once.
+    command_defaults = {}
+
+    @classmethod
+    def parser_defaults(cls):
+        if cls.command_class not in cls.command_defaults:
+            parser = cls.command_class.init_parser()
+            defaults = dict(parser._defaults)
+            for action in parser._actions:
+                if action.dest != 'help' and action.default is not argparse.SUPPRESS:
+                    defaults[action.dest] = action.default
+            required = [action.dest for action in parser._actions if action.required]
+            cls.command_defaults[cls.command_class] = (defaults, required)
+        return cls.command_defaults[cls.command_class]
+
+    def to_opts(self):
+        # Builds the namespace the command would have parsed: every argument's default, then the set fields.
+        defaults, required = self.parser_defaults()
+        opts = argparse.Namespace(**copy.deepcopy(defaults))
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if field.name != 'options' and value is not None:
+                setattr(opts, self.field_dests.get(field.name, field.name), value)
+        for dest, value in self.options.items():
+            setattr(opts, dest, value)
+
+        field_names = {dest: name for name, dest in self.field_dests.items()}
+        missing = [field_names.get(dest, dest) for dest in required if getattr(opts, dest, None) is None]
+        if missing:
+            raise ValueError(f"{type(self).__name__} is missing {', '.join(missing)}")
+        return opts
+
+
+@dataclasses.dataclass
+class QumuloClusterConfig(DeploymentConfig):
+    qs_s3_bucket_name: str = None
+    qs_s3_key_prefix: str = None
+    qs_s3_region: str = None
+    key_pair_name: str = None
+    env_type: str = None
+    vpc_id: str = None
+    private_subnet_id: str = None
+    q_instance_type: str = None
+    q_node_count: str = None
+    q_cluster_name: str = None
+    q_cluster_admin_pwd: str = None
+
+    vendor = 'qumulo'
+    command_class = EnvoiStorageQumuloAwsCreateClusterCommand
+
+    def deploy_kwargs(self, deployer, opts):
+        return {'discovery': deployer.discovery(opts)}
+
+
+@dataclasses.dataclass
+class WekaClusterConfig(DeploymentConfig):
+    token: str = None
+    key_name: str = None
+    subnet_id: str = None
+    vpc_id: str = None
+    weka_version: str = None
+    backend_instance_type: str = None
+    backend_instance_count: int = None
+    client_instance_type: str = None
+    client_instance_count: int = None
+    client_ami_id: str = None
+    template_bucket: str = None
+    template_prefix: str = None
+    retarget_az: bool = None
+
+    vendor = 'weka'
+    command_class = EnvoiStorageWekaAwsCreateStackCommand
+    field_dests = {
+        'key_name': 'template_param_key_name',
+        'subnet_id': 'template_param_subnet_id',
+        'vpc_id': 'template_param_vpc_id',
+    }
+
+    def deploy_kwargs(self, deployer, opts):
+        # Generated templates come from the deployer's Weka API connection and are staged with its S3 client.
+        kwargs = {}
+        if not opts.template_url and not opts.skip_preflight:
+            kwargs['discovery'] = deployer.discovery(opts)
+        if opts.token:
+            kwargs['weka_client'] = deployer.weka_client(opts.token)
+        if opts.template_bucket:
+            kwargs['stager'] = deployer.stager(opts, opts.template_bucket, opts.template_prefix)
+        return kwargs
+
+
+@dataclasses.dataclass
+class HammerspaceClusterConfig(DeploymentConfig):
+    anvil_configuration: str = None
+    anvil_instance_type: str = None
+    dsx_node_instance_type: str = None
+    dsx_node_instance_count: int = None
+    cluster_vpc_id: str = None
+    cluster_availability_zone: str = None
+    cluster_key_pair_name: str = None
+
+    vendor = 'hammerspace'
+    command_class = EnvoiStorageHammerspaceAwsCreateClusterCommand
+
+    def deploy_kwargs(self, deployer, opts):
+        return {}
+
+
+@dataclasses.dataclass
+class DeploymentResult:
+    # What a library deployment returns. `error` is only set by deploy_many, which reports failures instead of
+    # raising them.
+
+    vendor: str
+    stack_name: str
+    stack_id: str = None
+    status: str = None
+    already_exists: bool = False
+    template_url: str = None
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class StorageDeployer:
+    # The library entry point for deploying storage clusters in-process, e.g. from an orchestration service:
+    #
+    #     with StorageDeployer() as deployer:
+    #         result = deployer.deploy(WekaClusterConfig(key_name='key', subnet_id='subnet-1', vpc_id='vpc-1'))
+    #
+    # Unlike the command line, the deployer keeps its clients warm: AWS clients are created once per service,
+    # profile, region and endpoint and shared by every deployment (boto3 clients are thread-safe), the network and
+    # capacity checks share one AwsNetworkDiscovery per account and region, and each worker thread keeps its own
+    # Weka API connection. deploy_async runs deployments on the deployer's thread pool.
+
+    def __init__(self, max_workers=8, client_factory=None, weka_client_factory=None, discovery_factory=None):
+        self.max_workers = max_workers
+        self.client_factory = client_factory or aws_client_from_opts
+        self.weka_client_factory = weka_client_factory or WekaApiClient
+        self.discovery_factory = discovery_factory or AwsNetworkDiscovery.from_opts
+        self.clients = {}
+        self.discoveries = {}
+        self.stagers = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = None
+
+    def client(self, service_name, opts):
+        key = (service_name, getattr(opts, 'aws_profile', None), tuple(getattr(opts, 'aws_role_arn', None) or ()),
+               getattr(opts, 'aws_region', None), getattr(opts, 'aws_endpoint_url', None))
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.client_factory(service_name, opts=opts)
+            return self.clients[key]
+
+    def discovery(self, opts):
+        # Discovery objects keep their own EC2 and Service Quotas clients, so one per account and region is enough.
+        key = (getattr(opts, 'aws_profile', None), tuple(getattr(opts, 'aws_role_arn', None) or ()),
+               getattr(opts, 'aws_region', None), getattr(opts, 'aws_endpoint_url', None))
+        with self.lock:
+            if key not in self.discoveries:
+                self.discoveries[key] = self.discovery_factory(opts)
+            return self.discoveries[key]
+
+    def weka_client(self, token):
+        # http.client connections aren't thread-safe, so Weka API clients are kept per thread (and per token).
+        weka_clients = self.local.__dict__.setdefault('weka_clients', {})
+        if token not in weka_clients:
+            weka_clients[token] = self.weka_client_factory(token)
+        return weka_clients[token]
+
+    def stager(self, opts, bucket, prefix='cloudformation/templates/'):
+        # Stagers are shared so the keys already known to exist are remembered across deployments.
+        s3_client = self.client('s3', opts)
+        key = (id(s3_client), bucket, prefix)
+        with self.lock:
+            if key not in self.stagers:
+                self.stagers[key] = CloudFormationTemplateStager(
+                    s3_client, bucket, prefix=prefix, region=s3_client.meta.region_name,
+                    endpoint_url=getattr(opts, 'aws_endpoint_url', None))
+            return self.stagers[key]
+
+    def deploy(self, config):
+        # Creates the stack for a configuration and returns a DeploymentResult. Errors are raised.
+        opts = config.to_opts()
+        command = config.command_class(opts, auto_exec=False)
+        response = command.deploy(self.client('cloudformation', opts), opts, **config.deploy_kwargs(self, opts))
+        return DeploymentResult(vendor=config.vendor, stack_name=opts.stack_name, stack_id=response['StackId'],
+                                status=response.get('StackStatus'),
+                                already_exists=response.get('AlreadyExists', False),
+                                template_url=response.get('TemplateURL', opts.template_url))
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    async def deploy_async(self, config):
+        return await asyncio.get_running_loop().run_in_executor(self.pool(), self.deploy, config)
+
+    def deploy_many(self, configs):
+        # Deploys the configurations concurrently and returns their results in order. A failed deployment doesn't
+        # stop the others; its result carries the error instead.
+        def deploy(config):
+            try:
+                return self.deploy(config)
+            except Exception as e:
+                LOG.error(f"{config.stack_name or config.vendor}: {e}")
+                return DeploymentResult(vendor=config.vendor, stack_name=config.stack_name, error=str(e))
+        return list(self.pool().map(deploy, configs))
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+            self.clients.clear()
+            self.discoveries.clear()
+            self.stagers.clear()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JobQueue:
+    # Runs deploy, status and command jobs from a priority queue on a pool of worker threads. Jobs with a higher
+    # priority run first; jobs of the same priority run in submission order. Every job shares one StorageDeployer,
+    # so AWS clients, Weka API connections and staged template keys stay warm between jobs. Command jobs run a
+    # command line in-process (e.g. "prefetch ..." for a read benchmark or "oci object-storage upload ..." for an
+    # ingest) and return what the command would have printed. Only the read-only and deploy commands in
+    # `command_classes` can be run this way; destructive ones such as purge and destroy are refused.
+
+    kinds = ('deploy', 'status', 'command')
+    config_classes = {
+        'hammerspace': 'HammerspaceClusterConfig',
+        'qumulo': 'QumuloClusterConfig',
+        'weka': 'WekaClusterConfig',
+    }
+    command_classes = (
+        'EnvoiStorageDiscoveryCacheShowCommand',
+        'EnvoiStorageHammerspaceAwsCreateClusterCommand',
+        'EnvoiStorageHammerspaceAwsWaitReadyCommand',
+        'EnvoiStorageOciObjectStorageUploadCommand',
+        'EnvoiStoragePoolListCommand',
+        'EnvoiStoragePrefetchCommand',
+        'EnvoiStorageQumuloAwsCreateClusterCommand',
+        'EnvoiStorageQumuloAwsWaitReadyCommand',
+        'EnvoiStorageStatusCommand',
+        'EnvoiStorageWarmCommand',
+        'EnvoiStorageWekaAwsCreateStackCommand',
+        'EnvoiStorageWekaAwsWaitReadyCommand',
+    )
+
+    def __init__(self, deployer=None, workers=8, max_finished_jobs=1000, parser=None, allowed_commands=None):
+        self.deployer = deployer or StorageDeployer(max_workers=workers)
+        self.workers = workers
+        self.max_finished_jobs = max_finished_jobs
+        self.parser = parser
+        self.allowed_commands = set(allowed_commands or (globals()[name] for name in self.command_classes))
+        self.queue = queue.PriorityQueue()
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.threads = []
+
+    def submit(self, kind, payload=None, priority=0):
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown job kind {kind!r}. Expected one of: {', '.join(self.kinds)}")
+        with self.lock:
+            self.sequence += 1
+            job = {'id': f"job-{self.sequence}", 'kind': kind, 'priority': int(priority), 'payload': payload or {},
+                   'status': 'queued', 'submitted': time.time(), 'started': None, 'finished': None,
+                   'result': None, 'error': None}
+            self.jobs[job['id']] = job
+            self.queue.put((-job['priority'], self.sequence, job['id']))
+            return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def update(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+            # Finished jobs are kept for status queries, up to a limit, oldest first out.
+            finished = [key for key, job in self.jobs.items() if job['finished'] is not None]
+            for key in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                del self.jobs[key]
+
+    def run_deploy(self, payload):
+        vendor = payload.get('vendor')
+        if vendor not in self.config_classes:
+            raise ValueError(f"Unknown vendor {vendor!r}. Expected one of: {', '.join(self.config_classes)}")
+        try:
+            config = globals()[self.config_classes[vendor]](**payload.get('config', {}))
+        except TypeError as e:
+            raise ValueError(f"Invalid {vendor} configuration: {e}")
+        return dataclasses.asdict(self.deployer.deploy(config))
+
+    def run_status(self, payload):
+        opts = SimpleNamespace(aws_profile=payload.get('aws_profile'), aws_region=payload.get('aws_region'),
+                               aws_endpoint_url=payload.get('aws_endpoint_url'),
+                               aws_role_arn=payload.get('aws_role_arn'))
+        stack = AwsCloudFormationHelper.describe_stack(self.deployer.client('cloudformation', opts),
+                                                       payload['stack_name'])
+        return {'StackId': stack['StackId'], 'StackStatus': stack['StackStatus'],
+                'Outputs': AwsCloudFormationHelper.stack_outputs(stack)}
+
+    def run_command(self, payload):
+        argv = [str(arg) for arg in payload.get('argv', [])]
+        if not argv or argv[0] == 'serve':
+            raise ValueError("A command job needs the argv of a command other than serve")
+        if self.parser is None:
+            self.parser = build_command_parser()
+        try:
+            opts = self.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(f"Invalid command line: {' '.join(argv)}")
+        if opts.handler not in self.allowed_commands:
+            raise ValueError(f"Command jobs can't run {' '.join(arg for arg in argv if not arg.startswith('-'))[:80]}. "
+                             f"Only read-only and deploy commands are allowed")
+        return opts.handler(opts, auto_exec=False).run()
+
+    def execute(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return
+        self.update(job_id, status='running', started=time.time())
+        try:
+            result = getattr(self, f"run_{job['kind']}")(job['payload'])
+        except Exception as e:
+            LOG.error(f"{job_id} ({job['kind']}) failed: {e}")
+            self.update(job_id, status='failed', error=str(e), finished=time.time())
+        else:
+            self.update(job_id, status='succeeded', result=result, finished=time.time())
+
+    def work(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            if job_id is None:
+                return
+            self.execute(job_id)
+
+    def start(self):
+        for _ in range(max(1, self.workers)):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Workers finish their current job; queued jobs are left unrun.
+        for index, _ in enumerate(self.threads):
+            self.queue.put((float('-inf'), index, None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.deployer.close()
+
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    # The HTTP API of the job service:
+    #   POST /jobs          {"kind": "deploy", "priority": 10, "payload": {...}} -> 202 and the queued job
+    #   GET  /jobs          every job
+    #   GET  /jobs/<id>     one job
+    #   GET  /health        worker count and queue depth
+    # On TCP every request needs an "Authorization: Bearer <token>" header; the Unix socket is only reachable by its
+    # owner. POST bodies must be sent as application/json.
+
+    # Larger POST bodies are refused with 413 without being read.
+    max_body_size = 1024 * 1024
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        token = getattr(self.server, 'token', None)
+        if token is None:
+            return True
+        if secrets.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                  f"Bearer {token}".encode('utf-8')):
+            return True
+        self.send_json(401, {'error': 'Missing or invalid bearer token'}, {'WWW-Authenticate': 'Bearer'})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        jobs = self.server.jobs
+        if self.path == '/health':
+            return self.send_json(200, {'workers': len(jobs.threads), 'queued': jobs.queue.qsize()})
+        if self.path == '/jobs':
+            return self.send_json(200, jobs.list())
+        if self.path.startswith('/jobs/'):
+            job = jobs.get(self.path[len('/jobs/'):])
+            if job is not None:
+                return self.send_json(200, job)
+        self.send_json(404, {'error': f"Not found: {self.path}"})
+
+    def do_POST(self):
+        # The body is read before any error is sent so the client isn't still writing it when the reply arrives.
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self.send_json(400, {'error': 'Invalid Content-Length'})
+        if length > self.max_body_size:
+            self.close_connection = True
+            return self.send_json(413, {'error': f"Request bodies are limited to {format_size(self.max_body_size)}"})
+        data = self.rfile.read(length)
+        if not self.authorized():
+            return
+        if self.path != '/jobs':
+            return self.send_json(404, {'error': f"Not found: {self.path}"})
+        if self.headers.get_content_type() != 'application/json':
+            return self.send_json(415, {'error': 'Jobs must be submitted as application/json'})
+        try:
+            body = json.loads(data or b'{}')
+            job = self.server.jobs.submit(body.get('kind'), body.get('payload'), body.get('priority', 0))
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, job)
+
+    def address_string(self):
+        # Unix socket peers have no address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        LOG.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class EnvoiStorageServeCommand(EnvoiCommand):
+    # Runs the job service until interrupted. It listens on localhost TCP by default, where every request needs the
+    # bearer token given with --token (or generated at startup and printed), or on a Unix socket that only its
+    # owner can connect to.
+
+    description = "Run a local job service that keeps clients warm between deploy, status and command jobs"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8750, help='Port to listen on')
+        parser.add_argument('--socket', type=str, required=False,
+                            help='Listen on this Unix socket instead of TCP')
+        parser.add_argument('--workers', type=int, default=8, help='Number of jobs run at once')
+        parser.add_argument('--token', type=str, default=os.environ.get('ENVOI_STORAGE_SERVE_TOKEN'),
+                            help='Bearer token TCP clients must send. Generated at startup when not given')
+        return parser
+
+    @classmethod
+    def create_server(cls, opts, jobs):
+        if opts.socket:
+            if os.path.exists(opts.socket):
+                os.unlink(opts.socket)
+            # The socket is created owner-only, so there is no moment where other users can connect to it.
+            umask = os.umask(0o177)
+            try:
+                server = UnixHTTPServer(opts.socket, JobRequestHandler)
+            finally:
+                os.umask(umask)
+            server.token = None
+        else:
+            server = http.server.ThreadingHTTPServer((opts.host, opts.port), JobRequestHandler)
+            server.token = opts.token or secrets.token_urlsafe(32)
+        server.jobs = jobs
+        return server
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        jobs = JobQueue(workers=opts.workers)
+        server = self.create_server(opts, jobs)
+        jobs.start()
+        print(f"Serving jobs on {opts.socket or f'http://{opts.host}:{server.server_address[1]}'}", file=sys.stderr)
+        if server.token and not opts.token:
+            print(f"Bearer token: {server.token}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            jobs.stop()
+            if opts.socket and os.path.exists(opts.socket):
+                os.unlink(opts.socket)
+
+
+class EnvoiStorageBenchmarkOrchestrationCommand(EnvoiCommand):
+    # Runs the orchestration benchmark once per stack count and prints a row per run.
+
+    description = "Measure deployment throughput against local CloudFormation and Weka API stand-ins"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--stacks', type=str, default='1,10,100,500',
+                            help='Comma-separated stack counts, one run each')
+        parser.add_argument('--vendor', choices=['weka', 'hammerspace'], default='weka',
+                            help='Configuration deployed; weka also generates every template with the Weka API '
+                                 'stand-in')
+        parser.add_argument('--workers', type=int, default=64, help='Number of stacks deployed and followed at once')
+        parser.add_argument('--create-seconds', type=float, default=5.0, help='How long a stack create takes')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between stack status polls')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds every API call takes')
+        parser.add_argument('--rate-limit', type=int, default=25,
+                            help='Calls per second per API above which CloudFormation calls are throttled '
+                                 '(0 for no limit)')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of API calls that fail with a retryable error')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of stack creates that roll back')
+        parser.add_argument('--seed', type=int, required=False, help='Seed for repeatable jitter and failures')
+        parser.add_argument('--json', action='store_true', help='Print a JSON line per run instead of a table')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        try:
+            stack_counts = [int(count) for count in opts.stacks.split(',') if count.strip()]
+        except ValueError:
+            raise ValueError(f"--stacks must be comma-separated numbers, not {opts.stacks}")
+        if not stack_counts or min(stack_counts) < 1:
+            raise ValueError("--stacks needs at least one count of 1 or more")
+        # The stand-ins are only needed here, so they are kept in their own module.
+        from envoi_storage_standin import OrchestrationBenchmark
+        benchmark = OrchestrationBenchmark(vendor=opts.vendor, workers=opts.workers, poll_interval=opts.poll_interval,
+                                           latency=opts.latency, rate_limit=opts.rate_limit or None,
+                                           error_rate=opts.error_rate, failure_rate=opts.failure_rate,
+                                           create_seconds=opts.create_seconds, seed=opts.seed)
+        results = []
+        for stacks in stack_counts:
+            results.append(benchmark.run(stacks))
+            LOG.info(f"{stacks} stacks: {results[-1]}")
+        if opts.json:
+            return '\n'.join(json.dumps(result) for result in results)
+        return OrchestrationBenchmark.format_table(results)
+
+
+class EnvoiStorageBenchmarkCommand(EnvoiCommand):
+    # Namespace class for the benchmark commands.
+    subcommands = {
+        'orchestration': EnvoiStorageBenchmarkOrchestrationCommand,
+    }
+
+
+class AmiReplicator:
+    # Copies an AMI from its source region to many target regions at once. Every copy is started concurrently and
+    # progress is polled with one describe_images call per region for all of that region's copies, so preparing
+    # new regions takes about as long as a single copy. Copies are started with a ClientToken derived from the source
+    # image and target region, and an image of the same name that already exists in a target region is reused,
+    # so re-running after an interruption doesn't copy again.
+
+    source_tag_key = 'envoi:source-image'
+    failed_states = ('failed', 'invalid', 'error', 'deregistered')
+
+    def __init__(self, client_factory, workers=16, poll_interval=15, timeout=7200):
+        self.client_factory = client_factory
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, region):
+        with self.lock:
+            if region not in self.clients:
+                self.clients[region] = self.client_factory(region)
+            return self.clients[region]
+
+    def fan_out(self, func, regions):
+        # Runs func for every region concurrently and returns {region: result}. Errors are returned as results.
+        def call(region):
+            try:
+                return func(region)
+            except Exception as e:
+                return e
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(regions)))) as pool:
+            return dict(zip(regions, pool.map(call, regions)))
+
+    def source_image(self, source_region, image_id):
+        images = self.client(source_region).describe_images(ImageIds=[image_id])['Images']
+        if not images:
+            raise ValueError(f"AMI {image_id} was not found in {source_region}")
+        return images[0]
+
+    @staticmethod
+    def client_token(source_region, image_id, region):
+        return f"envoi-{hashlib.sha256(f'{source_region}|{image_id}|{region}'.encode('utf-8')).hexdigest()[:48]}"
+
+    def start_copy(self, region, source_region, source, name):
+        # Returns the ID of the copy in the region: an existing image of the same name, or a new copy.
+        client = self.client(region)
+        existing = client.describe_images(Owners=['self'], Filters=[{'Name': 'name', 'Values': [name]}])['Images']
+        alive = [image for image in existing if image.get('State') not in self.failed_states]
+        if alive:
+            LOG.info(f"{region}: reusing {alive[0]['ImageId']} ({alive[0].get('State')})")
+            return alive[0]['ImageId']
+        copy_args = {'SourceImageId': source['ImageId'], 'SourceRegion': source_region, 'Name': name,
+                     'ClientToken': self.client_token(source_region, source['ImageId'], region),
+                     'TagSpecifications': [{'ResourceType': 'image', 'Tags': [
+                         {'Key': self.source_tag_key, 'Value': f"{source_region}/{source['ImageId']}"}]}]}
+        if source.get('Description'):
+            copy_args['Description'] = source['Description']
+        image_id = client.copy_image(**copy_args)['ImageId']
+        LOG.info(f"{region}: copying {source['ImageId']} to {image_id}")
+        return image_id
+
+    def poll(self, pending):
+        # Describes every pending copy with one call per region and returns {region: (state, reason)}.
+        def describe(region):
+            images = self.client(region).describe_images(ImageIds=[pending[region]])['Images']
+            if not images:
+                # A new copy can take a moment to become visible.
+                return 'pending', None
+            return images[0]['State'], images[0].get('StateReason', {}).get('Message')
+        return self.fan_out(describe, list(pending))
+
+    def replicate(self, image_id, source_region, regions, name=None, wait=True):
+        # Returns ({region: image ID}, {region: error}). The source region maps to the source image.
+        source = self.source_image(source_region, image_id)
+        name = name or source['Name']
+        targets = [region for region in dict.fromkeys(regions) if region != source_region]
+        images = {source_region: image_id}
+        errors = {}
+        for region, result in self.fan_out(lambda r: self.start_copy(r, source_region, source, name),
+                                           targets).items():
+            if isinstance(result, Exception):
+                errors[region] = str(result)
+            else:
+                images[region] = result
+        pending = {region: images[region] for region in targets if region in images}
+        deadline = time.monotonic() + self.timeout
+        while wait and pending:
+            for region, result in self.poll(pending).items():
+                if isinstance(result, Exception):
+                    # Describe errors are retried on the next poll.
+                    LOG.warning(f"{region}: couldn't check {pending[region]}: {result}")
+                    continue
+                state, reason = result
+                if state == 'available':
+                    del pending[region]
+                elif state in self.failed_states:
+                    errors[region] = f"{pending.pop(region)} is {state}: {reason or ''}".strip()
+                    del images[region]
+            if not pending:
+                break
+            if time.monotonic() >= deadline:
+                for region in list(pending):
+                    errors[region] = f"Timed out waiting for {pending.pop(region)}"
+                    del images[region]
+                break
+            LOG.info(f"Waiting for {len(pending)} AMI copies: {', '.join(sorted(pending))}")
+            time.sleep(self.poll_interval)
+        return images, errors
+
+    @staticmethod
+    def format_map(images, regions=None):
+        # The "ami-... | region, ami-... | region" form --client-ami-id takes, in the order of `regions`.
+        regions = list(regions or [])
+        order = sorted(images, key=lambda region: (regions.index(region) if region in regions else len(regions),
+                                                   region))
+        return ', '.join(f"{images[region]} | {region}" for region in order)
+
+
+class EnvoiStorageAmiReplicateCommand(EnvoiCommand):
+    # Copies an AMI (e.g. an HP Anyware client image) to every target region and prints the region map for
+    # --client-ami-id.
+
+    description = "Copy an AMI to several regions at once and print the region map the create commands take"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('image_id', type=str, help='ID of the AMI to copy')
+        parser.add_argument('--source-region', type=str, required=False,
+                            help='Region of the AMI (defaults to --aws-region)')
+        parser.add_argument('--regions', type=str, required=True, help='Comma-separated target regions')
+        parser.add_argument('--name', type=str, required=False,
+                            help="Name of the copies (defaults to the source AMI's name)")
+        parser.add_argument('--no-wait', action='store_true',
+                            help="Print the map as soon as the copies are started, without waiting for them")
+        parser.add_argument('--poll-interval', type=float, default=15, help='Seconds between progress checks')
+        parser.add_argument('--timeout', type=float, default=7200, help='Seconds to wait for the copies')
+        parser.add_argument('--workers', type=int, default=16, help='Number of regions handled at once')
+        parser.add_argument('--json', action='store_true', help='Print the map as a JSON object')
+        add_aws_arguments(parser)
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        source_region = opts.source_region or getattr(opts, 'aws_region', None)
+        if not source_region:
+            raise ValueError("Set --source-region (or --aws-region) to the AMI's region")
+        regions = [region.strip() for region in opts.regions.split(',') if region.strip()]
+        replicator = AmiReplicator(
+            lambda region: aws_client_from_opts('ec2', opts=SimpleNamespace(**{**vars(opts), 'aws_region': region})),
+            workers=opts.workers, poll_interval=opts.poll_interval, timeout=opts.timeout)
+        images, errors = replicator.replicate(opts.image_id, source_region, regions, name=opts.name,
+                                              wait=not opts.no_wait)
+        ami_map = json.dumps(images) if opts.json else AmiReplicator.format_map(images, [source_region, *regions])
+        if errors:
+            failed = '; '.join(f"{region}: {error}" for region, error in sorted(errors.items()))
+            raise ValueError(f"AMI copies failed in {failed}. Copied: {ami_map}")
+        return ami_map
+
+
+class EnvoiStorageAmiCommand(EnvoiCommand):
+    # Namespace class for the AMI commands.
+    subcommands = {
+        'replicate': EnvoiStorageAmiReplicateCommand,
+    }
+
+
+class MountOptionTuner:
+    # Ranks candidate NFS/SMB mount option sets by benchmarking them. The caller mounts the same export once per
+    # candidate (e.g. /mnt/t1 with nconnect=4, /mnt/t2 with nconnect=16,rsize=1048576) and passes the mount points.
+    # Each one gets the same short benchmark: parallel streaming writes (fsynced), reads of the same files with their
+    # cached pages dropped, and a metadata pass that creates, stats, lists and deletes small files. Candidates are
+    # measured round-robin for several rounds and ranked on the median of each metric, normalized to the best
+    # candidate and weighted. Any directories work, so the tuner can be tried locally with plain directories.
+    #
+    # read_ahead_kb=N in a candidate's options is not a mount option: it is left out of the fstab line and printed
+    # as the /sys/class/bdi setting to apply after mounting.
+
+    metrics = ('write', 'read', 'metadata')
+    default_weights = {'write': 0.35, 'read': 0.45, 'metadata': 0.2}
+    block_size = 1024 * 1024
+
+    def __init__(self, candidates, file_size=64 * 1024 * 1024, file_count=4, threads=4, metadata_files=500, rounds=3,
+                 weights=None):
+        self.candidates = candidates
+        self.file_size = file_size
+        self.file_count = file_count
+        self.threads = threads
+        self.metadata_files = metadata_files
+        self.rounds = rounds
+        self.weights = weights or self.default_weights
+        # Random data, so filers that compress or deduplicate don't flatter the write numbers.
+        self.block = os.urandom(self.block_size)
+
+    @staticmethod
+    def read_mounts(path='/proc/self/mounts'):
+        # Returns [(source, mount point, fs type, options)], with the octal escapes of /proc/mounts decoded.
+        def unescape(value):
+            return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+        try:
+            with open(path, 'r') as f:
+                return [tuple(unescape(field) for field in line.split()[:4]) for line in f if len(line.split()) >= 4]
+        except OSError:
+            return []
+
+    @classmethod
+    def parse_candidate(cls, value, mounts=()):
+        # "PATH=OPTIONS" or just "PATH", whose options, source and fs type are then read from the mount table.
+        path, _, options = value.partition('=')
+        path = os.path.realpath(path)
+        if not os.path.isdir(path):
+            raise ValueError(f"{path} is not a directory")
+        mount = max((m for m in mounts if path == m[1] or path.startswith(m[1].rstrip('/') + '/')),
+                    key=lambda m: len(m[1]), default=None)
+        return {'path': path, 'options': options or (mount[3] if mount else 'defaults'),
+                'source': mount[0] if mount else None, 'fs_type': mount[2] if mount else None}
+
+    def write_file(self, path):
+        remaining = self.file_size
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                remaining -= f.write(self.block[:min(remaining, self.block_size)])
+            f.flush()
+            os.fsync(f.fileno())
+            self.drop_cache(f.fileno())
+
+    @staticmethod
+    def drop_cache(fd):
+        # Drops the file's cached pages so the read pass goes to the server.
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def read_file(self, path):
+        with open(path, 'rb', buffering=0) as f:
+            self.drop_cache(f.fileno())
+            while f.read(self.block_size):
+                pass
+
+    def throughput(self, func, paths):
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(func, paths))
+        return self.file_size * len(paths) / max(time.perf_counter() - started, 1e-9) / 1000 ** 2
+
+    def metadata(self, directory):
+        # Creates, stats, lists and deletes small files; returns operations per second.
+        paths = [os.path.join(directory, f"meta-{index:05d}") for index in range(self.metadata_files)]
+        started = time.perf_counter()
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(b'x')
+        for path in paths:
+            os.stat(path)
+        os.listdir(directory)
+        for path in paths:
+            os.unlink(path)
+        return (3 * len(paths) + 1) / max(time.perf_counter() - started, 1e-9)
+
+    def measure(self, path):
+        # Runs the benchmark once in a scratch directory under `path`, which is removed afterwards.
+        directory = os.path.join(path, f".envoi-tune-{os.getpid()}-{threading.get_ident()}")
+        os.makedirs(directory)
+        try:
+            paths = [os.path.join(directory, f"stream-{index}") for index in range(self.file_count)]
+            write = self.throughput(self.write_file, paths)
+            read = self.throughput(self.read_file, paths)
+            for stream_path in paths:
+                os.unlink(stream_path)
+            return {'write': write, 'read': read, 'metadata': self.metadata(directory)}
+        finally:
+            for name in os.listdir(directory):
+                os.unlink(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def run(self):
+        # Returns the candidates with their median metrics and score, best first.
+        samples = [collections.defaultdict(list) for _ in self.candidates]
+        for round_index in range(self.rounds):
+            for candidate, candidate_samples in zip(self.candidates, samples):
+                for metric, value in self.measure(candidate['path']).items():
+                    candidate_samples[metric].append(value)
+                LOG.info(f"Round {round_index + 1}/{self.rounds}: measured {candidate['path']}")
+        results = []
+        for candidate, candidate_samples in zip(self.candidates, samples):
+            results.append({**candidate, **{metric: sorted(values)[len(values) // 2]
+                                            for metric, values in candidate_samples.items()}})
+        best = {metric: max(result[metric] for result in results) or 1 for metric in self.metrics}
+        for result in results:
+            result['score'] = round(sum(self.weights.get(metric, 0) * result[metric] / best[metric]
+                                        for metric in self.metrics), 4)
+        return sorted(results, key=lambda result: result['score'], reverse=True)
+
+    @classmethod
+    def parse_weights(cls, value):
+        # "read=0.5,write=0.3,metadata=0.2"; metrics left out weigh nothing.
+        weights = {}
+        for item in value.split(','):
+            metric, _, weight = item.partition('=')
+            if metric.strip() not in cls.metrics:
+                raise ValueError(f"Unknown metric {metric.strip()!r} in --weights. Use {', '.join(cls.metrics)}")
+            try:
+                weights[metric.strip()] = float(weight)
+            except ValueError:
+                raise ValueError(f"Invalid weight for {metric.strip()} in --weights: {weight!r}")
+        return weights
+
+    @staticmethod
+    def fstab_lines(result, mount_point=None, source=None, protocol='nfs'):
+        # Returns the fstab line of a result, and the read-ahead setting to apply after mounting when it has one.
+        options = [option for option in result['options'].split(',') if option]
+        read_ahead = [option.partition('=')[2] for option in options if option.startswith('read_ahead_kb=')]
+        options = [option for option in options if not option.startswith('read_ahead_kb=')]
+        fs_type = result.get('fs_type')
+        # The mounted source is only used when the candidate is a network mount, not a local stand-in directory.
+        if fs_type in ('nfs', 'nfs4', 'cifs', 'smb3'):
+            source = source or result.get('source')
+        else:
+            fs_type = 'cifs' if protocol == 'smb' else 'nfs'
+        source = source or ('//SERVER/SHARE' if fs_type in ('cifs', 'smb3') else 'SERVER:/EXPORT')
+        lines = [f"{source} {mount_point or result['path']} {fs_type} {','.join(options) or 'defaults'} 0 0"]
+        if read_ahead:
+            lines.append(f"# after mounting: echo {read_ahead[0]} > "
+                         f"/sys/class/bdi/$(mountpoint -d {mount_point or result['path']})/read_ahead_kb")
+        return lines
+
+    @staticmethod
+    def format_table(results):
+        rows = [['rank', 'path', 'write MB/s', 'read MB/s', 'metadata ops/s', 'score', 'options']]
+        rows += [[str(rank), result['path'], f"{result['write']:.1f}", f"{result['read']:.1f}",
+                  f"{result['metadata']:.0f}", f"{result['score']:.3f}", result['options']]
+                 for rank, result in enumerate(results, 1)]
+        widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]) - 1)]
+        return '\n'.join(' '.join([*(value.ljust(width) for value, width in zip(row, widths)), row[-1]])
+                         for row in rows)
+
+
+class EnvoiStorageTuneMountCommand(EnvoiCommand):
+    # Benchmarks mount points of the same export mounted with different options, ranks them and prints the
+    # fstab line of the best one.
+
+    description = "Rank NFS/SMB mount option sets by benchmarking mount points and print the best fstab line"
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('candidates', nargs='+',
+                            help='Mount points to compare as PATH or PATH=OPTIONS (options are read from the mount '
+                                 'table when not given)')
+        parser.add_argument('--file-size', type=str, default='64MiB', help='Size of each streamed file')
+        parser.add_argument('--file-count', type=int, default=4, help='Number of files streamed per pass')
+        parser.add_argument('--threads', type=int, default=4, help='Number of files streamed at once')
+        parser.add_argument('--metadata-files', type=int, default=500,
+                            help='Number of small files created, stated and deleted per pass')
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='Passes per candidate; each metric is the median of the passes')
+        parser.add_argument('--weights', type=str, required=False,
+                            help='Score weights, e.g. read=0.45,write=0.35,metadata=0.2')
+        parser.add_argument('--protocol', choices=['nfs', 'smb'], default='nfs',
+                            help='Protocol of the fstab line when the mount table does not say')
+        parser.add_argument('--source', type=str, required=False,
+                            help='Source of the fstab line, e.g. 10.0.0.5:/export (defaults to the mounted source)')
+        parser.add_argument('--mount-point', type=str, required=False,
+                            help="Mount point of the fstab line (defaults to the best candidate's path)")
+        parser.add_argument('--json', action='store_true', help='Print the ranked results as JSON')
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        mounts = MountOptionTuner.read_mounts()
+        candidates = [MountOptionTuner.parse_candidate(value, mounts) for value in opts.candidates]
+        tuner = MountOptionTuner(candidates, file_size=parse_size(opts.file_size), file_count=opts.file_count,
+                                 threads=opts.threads, metadata_files=opts.metadata_files, rounds=opts.rounds,
+                                 weights=MountOptionTuner.parse_weights(opts.weights) if opts.weights else None)
+        results = tuner.run()
+        fstab = MountOptionTuner.fstab_lines(results[0], mount_point=opts.mount_point, source=opts.source,
+                                             protocol=opts.protocol)
+        if opts.json:
+            return json.dumps({'results': results, 'fstab': fstab}, indent=2)
+        return '\n'.join([MountOptionTuner.format_table(results), '', 'Best:', *fstab])
+
+
+class EnvoiStorageCommand(EnvoiCommand):
+    # The root command. Each key is the first positional argument on the command line.
+    description = "Envoi Cloud Storage"
+    subcommands = {
+        'ami': EnvoiStorageAmiCommand,
+        'benchmark': EnvoiStorageBenchmarkCommand,
+        'destroy': EnvoiStorageDestroyCommand,
+        'discovery-cache': EnvoiStorageDiscoveryCacheCommand,
+        'fsx': EnvoiStorageFsxCommand,
+        'generate-dataset': EnvoiStorageGenerateDatasetCommand,
+        'hammerspace': EnvoiStorageHammerspaceCommand,
+        'oci': EnvoiStorageOciCommand,
+        'pool': EnvoiStoragePoolCommand,
+        'prefetch': EnvoiStoragePrefetchCommand,
+        'purge': EnvoiStoragePurgeCommand,
+        'qumulo': EnvoiStorageQumuloCommand,
+        'resume': EnvoiStorageResumeCommand,
+        'rollout': EnvoiStorageRolloutCommand,
+        'serve': EnvoiStorageServeCommand,
+        'status': EnvoiStorageStatusCommand,
+        'tune-mount': EnvoiStorageTuneMountCommand,
+        'warm': EnvoiStorageWarmCommand,
+        'weka': EnvoiStorageWekaCommand,
+    }
+
+
+def init_common_parser():
+    # Builds the parent parser holding the arguments shared by every command.
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--log-level', type=str, default='warning',
+                               choices=['debug', 'info', 'warning', 'error', 'critical'],
+                               help='Set the logging level')
+    common_parser.add_argument('--profile-output', type=str, required=False,
+                               help='Profile the command and write the result to this file')
+    common_parser.add_argument('--profile-mode', choices=['cprofile', 'sample'], default='cprofile',
+                               help='"cprofile" writes pstats data; "sample" writes collapsed stacks for a flamegraph')
+    common_parser.add_argument('--profile-sample-interval', type=float, default=0.005,
+                               help='Seconds between stack samples in sample mode')
+    common_parser.add_argument('--trace-output', type=str, required=False,
+                               help='Write a JSON line per AWS/Weka API call to this file and print a latency '
+                                    'summary to stderr')
+    return common_parser
+
+
+def build_command_parser():
+    return EnvoiStorageCommand.init_parser(parent_parsers=[init_common_parser()])
+
+
+def main():
+    parser = build_command_parser()
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, opts.log_level.upper()),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if opts.handler is EnvoiStorageCommand:
+        parser.print_help()
+        return 1
+
+    API_LATENCY.enabled = bool(opts.trace_output)
+    try:
+        command = opts.handler(opts, auto_exec=False)
+        with profile_command(opts.profile_output, opts.profile_mode, opts.profile_sample_interval):
+            response = command.run()
+    except (ValueError, OSError, OciApiError) as e:
+        LOG.error(e)
+        return 1
+    finally:
+        if opts.trace_output:
+            API_LATENCY.write_jsonl(opts.trace_output)
+            print(API_LATENCY.summary(), file=sys.stderr)
+
+    if response is not None:
+        print(response)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+#
+# Local stand-ins for the CloudFormation and Weka APIs, and the orchestration benchmark that runs against them.
+# They are only needed for load testing and the `benchmark orchestration` command, so they live outside
+# envoi_storage.py and are imported when used.
+
+import argparse
+# Empty option namespaces for the deployer's client cache.
+import collections
+# Counters of calls and injected errors.
+import concurrent.futures
+# Runs the benchmark's deployments on a thread pool.
+import datetime
+# Timestamps of stack events.
+import http.server
+# Serves the Weka API stand-in.
+import json
+# Encodes templates and API responses.
+import logging
+# Logs the benchmark's failed stacks.
+import random
+# Seeded jitter and failure injection.
+import threading
+# Locks the stand-in state and runs the HTTP server.
+import time
+# Wall-clock stack progress, latency and rate limits.
+import urllib.parse
+# Parses the Weka API stand-in's request paths.
+from types import SimpleNamespace
+# Paginator objects of the CloudFormation stand-in.
+
+from envoi_storage import (AwsCloudFormationHelper, AwsRateLimiter, AwsThrottledClient, HammerspaceClusterConfig,
+                           LatencyRecorder, StorageDeployer, WekaApiClient, WekaClusterConfig, botocore)
+# The orchestration code under test.
+
+LOG = logging.getLogger(__name__)
+# Initializes a logger object for the current module.
+
+
+class AwsStandInError(Exception):
+    # The errors raised by CloudFormationStandIn, and by the fake AWS clients of the tests. Like botocore's
+    # ClientError, the code is in `response`, so aws_error_code and the rate limiter's retries treat them the same way.
+
+    def __init__(self, code, message):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class CloudFormationStandIn:
+    # A local, in-process stand-in for the CloudFormation calls the tool makes, for load testing the orchestration
+    # code without an AWS account: create_stack, describe_stacks, update_stack, delete_stack, the change set calls,
+    # and the describe_stacks, describe_stack_events, list_exports and list_imports paginators. Wrap it in an
+    # AwsThrottledClient and pass it wherever a CloudFormation client is taken.
+    #
+    # Stacks move through their statuses on the wall clock: a create takes about `create_seconds` (+-20%) and logs
+    # an event as each resource of the template starts and completes. Failure injection:
+    #   latency       every call sleeps about this many seconds (+-50%)
+    #   rate_limit    calls per second per API above which calls are throttled (None for no limit)
+    #   error_rate    the fraction of calls that fail with InternalFailure, which callers retry
+    #   failure_rate  the fraction of creates that roll back
+
+    default_resources = [('Instance0', 'AWS::EC2::Instance'), ('Instance1', 'AWS::EC2::Instance'),
+                         ('Instance2', 'AWS::EC2::Instance'), ('ClusterInit', 'AWS::CloudFormation::CustomResource')]
+
+    def __init__(self, create_seconds=5.0, delete_seconds=2.0, latency=0.0, rate_limit=None, error_rate=0.0,
+                 failure_rate=0.0, seed=None):
+        self.create_seconds = create_seconds
+        self.delete_seconds = delete_seconds
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stacks = collections.OrderedDict()
+        self.names = {}
+        self.change_sets = {}
+        self.windows = {}
+        self.calls = collections.Counter()
+        self.injected = collections.Counter()
+
+    def call(self, operation_name):
+        # Applies the latency, throttling and errors injected into every call.
+        with self.lock:
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.calls[operation_name] += 1
+            window = int(time.time())
+            start, count = self.windows.get(operation_name, (window, 0))
+            if start != window:
+                count = 0
+            if self.rate_limit and count >= self.rate_limit:
+                self.injected['Throttling'] += 1
+                raise AwsStandInError('Throttling', 'Rate exceeded')
+            self.windows[operation_name] = (window, count + 1)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.injected['InternalFailure'] += 1
+                raise AwsStandInError('InternalFailure', 'The request processing has failed')
+
+    @classmethod
+    def template_resources(cls, template_body):
+        try:
+            resources = json.loads(template_body or '')['Resources']
+            return [(name, resource.get('Type', 'AWS::CloudFormation::CustomResource'))
+                    for name, resource in resources.items()] or cls.default_resources
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return cls.default_resources
+
+    def new_stack(self, name, template_args, now=None):
+        stack_id = f"arn:aws:cloudformation:local:000000000000:stack/{name}/{self.random.getrandbits(64):016x}"
+        stack = {'StackName': name, 'StackId': stack_id, 'created': now, 'deleted': None, 'update_status': None,
+                 'fails': False, 'duration': None, 'token': None, 'resources': self.default_resources,
+                 'Parameters': [], 'Tags': [], 'Capabilities': []}
+        self.apply(stack, template_args)
+        self.stacks[stack_id] = stack
+        self.names[name] = stack_id
+        return stack
+
+    def start_create(self, stack, token=None, now=None):
+        stack['created'] = now or time.time()
+        stack['duration'] = self.create_seconds * self.random.uniform(0.8, 1.2)
+        stack['fails'] = self.random.random() < self.failure_rate
+        stack['token'] = token
+
+    @classmethod
+    def apply(cls, stack, template_args):
+        # Applies the template, parameters and tags of a create or update.
+        if template_args.get('TemplateBody') is not None or template_args.get('TemplateURL') is not None:
+            stack['resources'] = cls.template_resources(template_args.get('TemplateBody'))
+        previous = {parameter['ParameterKey']: parameter['ParameterValue'] for parameter in stack['Parameters']}
+        for key in ('Parameters', 'Tags', 'Capabilities'):
+            if template_args.get(key) is not None:
+                stack[key] = [dict(item) if isinstance(item, dict) else item for item in template_args[key]]
+        for parameter in stack['Parameters']:
+            if parameter.pop('UsePreviousValue', False):
+                parameter['ParameterValue'] = previous.get(parameter['ParameterKey'])
+
+    def status(self, stack, now):
+        if stack['deleted'] is not None:
+            return 'DELETE_COMPLETE' if now - stack['deleted'] >= self.delete_seconds else 'DELETE_IN_PROGRESS'
+        if stack['duration'] is None:
+            return 'REVIEW_IN_PROGRESS'
+        if now - stack['created'] < stack['duration']:
+            return 'CREATE_IN_PROGRESS'
+        if stack['fails']:
+            return 'ROLLBACK_COMPLETE'
+        return stack['update_status'] or 'CREATE_COMPLETE'
+
+    def lookup(self, name_or_id, now):
+        stack = self.stacks.get(name_or_id) or self.stacks.get(self.names.get(name_or_id))
+        # Like CloudFormation, deleted stacks can only be described by their ID.
+        if stack is None or (name_or_id not in self.stacks and self.status(stack, now) == 'DELETE_COMPLETE'):
+            raise AwsStandInError('ValidationError', f"Stack with id {name_or_id} does not exist")
+        return stack
+
+    def describe(self, stack, now):
+        status = self.status(stack, now)
+        description = {'StackName': stack['StackName'], 'StackId': stack['StackId'], 'StackStatus': status,
+                       'CreationTime': datetime.datetime.fromtimestamp(stack['created'] or now,
+                                                                       datetime.timezone.utc),
+                       'Parameters': stack['Parameters'], 'Tags': stack['Tags'], 'Capabilities': stack['Capabilities']}
+        if status == 'ROLLBACK_COMPLETE':
+            description['StackStatusReason'] = 'The following resource(s) failed to create: [ClusterInit].'
+        if status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+            description['Outputs'] = [{'OutputKey': 'ManagementUrl',
+                                       'OutputValue': f"https://{stack['StackName']}.local"}]
+        return description
+
+    def events(self, stack, now):
+        # The stack's events up to now, newest first. Resources are created one after another over the create.
+        name = stack['StackName']
+        events = []
+        if stack['duration'] is not None:
+            resources = stack['resources']
+            step = stack['duration'] / (len(resources) + 1)
+            events.append((0, name, 'AWS::CloudFormation::Stack', 'CREATE_IN_PROGRESS', None))
+            for index, (logical_id, resource_type) in enumerate(resources):
+                events.append((step * index + step / 2, logical_id, resource_type, 'CREATE_IN_PROGRESS', None))
+                if stack['fails'] and index == len(resources) - 1:
+                    events.append((stack['duration'], logical_id, resource_type, 'CREATE_FAILED',
+                                   'Injected failure'))
+                else:
+                    events.append((step * (index + 1) + step / 2, logical_id, resource_type, 'CREATE_COMPLETE', None))
+            events.append((stack['duration'], name, 'AWS::CloudFormation::Stack',
+                           'ROLLBACK_COMPLETE' if stack['fails'] else 'CREATE_COMPLETE', None))
+        if stack['deleted'] is not None:
+            deleted = stack['deleted'] - stack['created']
+            events.append((deleted, name, 'AWS::CloudFormation::Stack', 'DELETE_IN_PROGRESS', None))
+            events.append((deleted + self.delete_seconds, name, 'AWS::CloudFormation::Stack', 'DELETE_COMPLETE',
+                           None))
+        result = []
+        for index, (offset, logical_id, resource_type, status, reason) in enumerate(events):
+            if stack['created'] + offset > now:
+                continue
+            event = {'EventId': f"{logical_id}-{status}-{index}", 'StackName': name, 'StackId': stack['StackId'],
+                     'LogicalResourceId': logical_id, 'ResourceType': resource_type, 'ResourceStatus': status,
+                     'PhysicalResourceId': stack['StackId'] if logical_id == name else f"{name}-{logical_id}",
+                     'Timestamp': datetime.datetime.fromtimestamp(stack['created'] + offset, datetime.timezone.utc)}
+            if reason:
+                event['ResourceStatusReason'] = reason
+            result.append(event)
+        return result[::-1]
+
+    def create_stack(self, StackName, TemplateURL=None, TemplateBody=None, ClientRequestToken=None, **kwargs):
+        self.call('create_stack')
+        if TemplateURL is None and TemplateBody is None:
+            raise AwsStandInError('ValidationError', 'Either Template URL or Template Body must be specified.')
+        now = time.time()
+        with self.lock:
+            existing = self.stacks.get(self.names.get(StackName))
+            if existing is not None and self.status(existing, now) != 'DELETE_COMPLETE':
+                # A retried request with the same token is the original call.
+                if ClientRequestToken is not None and existing['token'] == ClientRequestToken:
+                    return {'StackId': existing['StackId']}
+                raise AwsStandInError('AlreadyExistsException', f"Stack [{StackName}] already exists")
+            stack = self.new_stack(StackName, {'TemplateURL': TemplateURL, 'TemplateBody': TemplateBody, **kwargs})
+            self.start_create(stack, ClientRequestToken, now)
+            return {'StackId': stack['StackId']}
+
+    def describe_stacks(self, StackName=None):
+        self.call('describe_stacks')
+        return {'Stacks': self.list_stacks(StackName)}
+
+    def list_stacks(self, stack_name=None):
+        now = time.time()
+        with self.lock:
+            if stack_name is not None:
+                return [self.describe(self.lookup(stack_name, now), now)]
+            return [self.describe(stack, now) for stack in self.stacks.values()
+                    if self.status(stack, now) != 'DELETE_COMPLETE']
+
+    def describe_stack_events(self, StackName):
+        self.call('describe_stack_events')
+        return {'StackEvents': self.stack_events(StackName)}
+
+    def stack_events(self, stack_name):
+        now = time.time()
+        with self.lock:
+            return self.events(self.lookup(stack_name, now), now)
+
+    def update_stack(self, StackName, UsePreviousTemplate=False, **kwargs):
+        # Updates complete straight away.
+        self.call('update_stack')
+        now = time.time()
+        with self.lock:
+            stack = self.lookup(StackName, now)
+            status = self.status(stack, now)
+            if status not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+                raise AwsStandInError('ValidationError', f"Stack:{stack['StackId']} is in {status} state and can "
+                                                         f"not be updated.")
+            self.apply(stack, kwargs)
+            stack['update_status'] = 'UPDATE_COMPLETE'
+            return {'StackId': stack['StackId']}
+
+    def delete_stack(self, StackName, RetainResources=None, **kwargs):
+        # Like CloudFormation, deleting a stack that doesn't exist succeeds.
+        self.call('delete_stack')
+        now = time.time()
+        with self.lock:
+            try:
+                stack = self.lookup(StackName, now)
+            except AwsStandInError:
+                return {}
+            if stack['deleted'] is None:
+                stack['created'] = stack['created'] or now
+                stack['deleted'] = now
+            return {}
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType='UPDATE', **kwargs):
+        self.call('create_change_set')
+        now = time.time()
+        with self.lock:
+            if ChangeSetType == 'CREATE':
+                existing = self.stacks.get(self.names.get(StackName))
+                if existing is not None and self.status(existing, now) != 'DELETE_COMPLETE':
+                    raise AwsStandInError('AlreadyExistsException', f"Stack [{StackName}] already exists")
+                stack = self.new_stack(StackName, {})
+            else:
+                stack = self.lookup(StackName, now)
+            change_set_id = (f"arn:aws:cloudformation:local:000000000000:changeSet/{ChangeSetName}/"
+                             f"{self.random.getrandbits(64):016x}")
+            resources = self.template_resources(kwargs.get('TemplateBody'))
+            self.change_sets[change_set_id] = {
+                'ChangeSetId': change_set_id, 'ChangeSetName': ChangeSetName, 'StackId': stack['StackId'],
+                'StackName': StackName, 'ChangeSetType': ChangeSetType, 'Status': 'CREATE_COMPLETE',
+                'ExecutionStatus': 'AVAILABLE', 'args': kwargs,
+                'Changes': [{'Type': 'Resource', 'ResourceChange': {
+                    'Action': 'Add' if ChangeSetType == 'CREATE' else 'Modify', 'LogicalResourceId': logical_id,
+                    'ResourceType': resource_type}} for logical_id, resource_type in resources]}
+            return {'Id': change_set_id, 'StackId': stack['StackId']}
+
+    def change_set(self, change_set_name, stack_name=None):
+        change_set = self.change_sets.get(change_set_name)
+        if change_set is None:
+            change_set = next((c for c in self.change_sets.values() if c['ChangeSetName'] == change_set_name and
+                               stack_name in (c['StackName'], c['StackId'])), None)
+        if change_set is None:
+            raise AwsStandInError('ChangeSetNotFound', f"ChangeSet [{change_set_name}] does not exist")
+        return change_set
+
+    def describe_change_set(self, ChangeSetName, StackName=None):
+        self.call('describe_change_set')
+        with self.lock:
+            change_set = self.change_set(ChangeSetName, StackName)
+            return {key: value for key, value in change_set.items() if key != 'args'}
+
+    def execute_change_set(self, ChangeSetName, StackName=None, ClientRequestToken=None):
+        self.call('execute_change_set')
+        now = time.time()
+        with self.lock:
+            change_set = self.change_set(ChangeSetName, StackName)
+            if change_set['ExecutionStatus'] != 'AVAILABLE':
+                raise AwsStandInError('InvalidChangeSetStatus', f"ChangeSet [{change_set['ChangeSetId']}] cannot be "
+                                                                f"executed in its current execution status of "
+                                                                f"[{change_set['ExecutionStatus']}]")
+            stack = self.stacks[change_set['StackId']]
+            self.apply(stack, change_set['args'])
+            if change_set['ChangeSetType'] == 'CREATE':
+                self.start_create(stack, ClientRequestToken, now)
+            else:
+                stack['update_status'] = 'UPDATE_COMPLETE'
+            change_set['ExecutionStatus'] = 'EXECUTE_COMPLETE'
+            return {}
+
+    def get_paginator(self, operation_name):
+        if operation_name not in ('describe_stacks', 'describe_stack_events', 'list_exports', 'list_imports'):
+            raise AwsStandInError('OperationNotPageable', f"Operation cannot be paginated: {operation_name}")
+        return SimpleNamespace(paginate=lambda **kwargs: self.paginate(operation_name, **kwargs))
+
+    def paginate(self, operation_name, page_size=100, PaginationConfig=None, **kwargs):
+        # Every page is a call, so it is slowed, throttled and failed like one. Pages after the first carry a
+        # NextToken, the offset of the next page, which is taken back as the StartingToken.
+        first = int(self.decode_token((PaginationConfig or {}).get('StartingToken')) or 0)
+        self.call(operation_name)
+        if operation_name == 'describe_stacks':
+            key, items = 'Stacks', self.list_stacks(kwargs.get('StackName'))
+        elif operation_name == 'describe_stack_events':
+            key, items = 'StackEvents', self.stack_events(kwargs['StackName'])
+        elif operation_name == 'list_exports':
+            key, items = 'Exports', []
+        else:
+            raise AwsStandInError('ValidationError', f"Export '{kwargs.get('ExportName')}' is not imported by any "
+                                                     f"stack.")
+        for start in range(first, max(len(items), 1), page_size):
+            if start > first:
+                self.call(operation_name)
+            page = {key: items[start:start + page_size]}
+            if start + page_size < len(items):
+                page['NextToken'] = str(start + page_size)
+            yield page
+
+    @staticmethod
+    def decode_token(token):
+        # Starting tokens are encoded by botocore when it is installed.
+        if token is None or botocore is None:
+            return token
+        return botocore.paginate.TokenDecoder().decode(token)['NextToken']
+
+
+class WekaApiStandInHandler(http.server.BaseHTTPRequestHandler):
+    # The Weka API endpoints the create command uses, served by a WekaApiStandIn:
+    #   GET  /dist/v1/release                the template releases, newest first
+    #   POST /dist/v1/aws/cfn/<version>      a CloudFormation template for {"cluster": [...]} as "cfn"
+
+    # HTTP/1.1 keeps WekaApiClient's connection open between requests, as the real API does.
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.send_json(*self.server.standin.handle('GET', self.path, None, self.headers.get('Authorization')))
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(*self.server.standin.handle('POST', self.path, body, self.headers.get('Authorization')))
+
+    def log_message(self, format, *args):
+        LOG.debug(f"Weka API stand-in: {format % args}")
+
+
+class WekaApiStandIn:
+    # A local HTTP stand-in for the Weka template API (WekaApiClient with secure=False talks to it), with the same
+    # latency and error injection as CloudFormationStandIn: `error_rate` of the requests fail with a 503.
+    #
+    #     with WekaApiStandIn() as weka:
+    #         template = weka.client('token').generate_cloudformation_template(backend_instance_count=6)
+
+    def __init__(self, releases=('4.2.7', '4.2.6'), latency=0.0, error_rate=0.0, seed=None, host='127.0.0.1',
+                 port=0):
+        self.releases = list(releases)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.injected = collections.Counter()
+        self.address = (host, port)
+        self.server = None
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(self.address, WekaApiStandInHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def client(self, token, **kwargs):
+        return WekaApiClient(token, host=self.server.server_address[0], host_port=self.port, secure=False, **kwargs)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle(self, method, path, body, authorization):
+        # Returns the status and JSON body of a request.
+        path = urllib.parse.urlsplit(path).path
+        base_path = WekaApiClient.DEFAULT_BASE_PATH
+        with self.lock:
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+            self.calls[f"{method} {path}"] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.injected['503'] += 1
+        if delay:
+            time.sleep(delay)
+        if not authorization:
+            return 401, {'error': 'Authentication credentials were not provided'}
+        if failed:
+            return 503, {'error': 'Service temporarily unavailable'}
+        if method == 'GET' and path == f"{base_path}/release":
+            return 200, {'objects': [{'id': release} for release in self.releases], 'num_results': len(self.releases),
+                         'page': 1, 'total_pages': 1}
+        if method == 'POST' and path.startswith(f"{base_path}/aws/cfn/"):
+            version = path.rpartition('/')[2]
+            if version not in self.releases:
+                return 404, {'error': f"Release {version} not found"}
+            return 200, {'url': f"https://{self.address[0]}/cfn/{version}.json",
+                         'cfn': self.template(version, (body or {}).get('cluster', []))}
+        return 404, {'error': f"Not found: {path}"}
+
+    @classmethod
+    def template(cls, version, cluster):
+        # A template with an instance per requested node and a custom resource that installs the cluster.
+        resources = {}
+        for group in cluster:
+            for index in range(int(group.get('count') or 0)):
+                resources[f"{str(group.get('role')).capitalize()}{index}"] = {
+                    'Type': 'AWS::EC2::Instance',
+                    'Properties': {'InstanceType': group.get('instance_type'), 'KeyName': {'Ref': 'KeyName'},
+                                   'SubnetId': {'Ref': 'SubnetId'}}}
+        resources['ClusterInit'] = {'Type': 'Custom::WekaInit', 'Properties': {'Version': version}}
+        return {'AWSTemplateFormatVersion': '2010-09-09', 'Description': f"WEKA {version} cluster",
+                'Parameters': {name: {'Type': 'String'} for name in ('KeyName', 'SubnetId', 'VpcId')},
+                'Resources': resources}
+
+
+class OrchestrationBenchmark:
+    # Measures how deployment throughput scales with the number of stacks, against the local stand-ins. A run
+    # deploys `stacks` clusters through a StorageDeployer (as library callers and the job service do) on `workers`
+    # threads and follows every stack with wait_for_stack. All calls share one rate limiter, like a single
+    # orchestration process would. Every run gets fresh stand-ins and a fresh limiter, so runs don't affect each
+    # other.
+
+    def __init__(self, vendor='weka', workers=64, poll_interval=1.0, latency=0.0, rate_limit=None, error_rate=0.0,
+                 failure_rate=0.0, create_seconds=5.0, seed=None, timeout=3600):
+        self.vendor = vendor
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout = timeout
+        self.seed = seed
+        self.standin_options = {'create_seconds': create_seconds, 'latency': latency, 'rate_limit': rate_limit,
+                                'error_rate': error_rate, 'failure_rate': failure_rate}
+
+    def config(self, index):
+        stack_name = f"bench-{self.vendor}-{index:04d}"
+        if self.vendor == 'weka':
+            return WekaClusterConfig(stack_name=stack_name, token='stand-in', key_name='bench',
+                                     subnet_id='subnet-bench', vpc_id='vpc-bench', skip_preflight=True)
+        return HammerspaceClusterConfig(stack_name=stack_name)
+
+    def run(self, stacks):
+        # Deploys and waits for `stacks` stacks and returns the run's figures. Stacks that fail are counted, not
+        # raised.
+        cloudformation = CloudFormationStandIn(seed=self.seed, **self.standin_options)
+        limiter = AwsRateLimiter()
+        weka = WekaApiStandIn(latency=self.latency, error_rate=self.error_rate, seed=self.seed).start() \
+            if self.vendor == 'weka' else None
+        deployer = StorageDeployer(
+            max_workers=self.workers,
+            client_factory=lambda service_name, opts=None: AwsThrottledClient(cloudformation, service_name,
+                                                                              region='local', limiter=limiter),
+            weka_client_factory=weka.client if weka else None)
+        client = deployer.client('cloudformation', argparse.Namespace())
+
+        def deploy(index):
+            started = time.monotonic()
+            result = deployer.deploy(self.config(index))
+            AwsCloudFormationHelper.wait_for_stack(client, result.stack_id, poll_interval=self.poll_interval,
+                                                   timeout=self.timeout)
+            return time.monotonic() - started
+
+        durations = []
+        errors = collections.Counter()
+        started = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for future in concurrent.futures.as_completed([executor.submit(deploy, i) for i in range(stacks)]):
+                    try:
+                        durations.append(future.result())
+                    except Exception as e:
+                        LOG.debug(f"Benchmark stack failed: {e}")
+                        errors[type(e).__name__] += 1
+        finally:
+            elapsed = time.monotonic() - started
+            deployer.close()
+            if weka is not None:
+                weka.stop()
+        durations.sort()
+        return {'stacks': stacks, 'completed': len(durations), 'failed': sum(errors.values()),
+                'seconds': round(elapsed, 3), 'stacks_per_minute': round(len(durations) / elapsed * 60, 2),
+                'p50': round(LatencyRecorder.percentile(durations, 0.5), 3) if durations else None,
+                'p95': round(LatencyRecorder.percentile(durations, 0.95), 3) if durations else None,
+                'api_calls': sum(cloudformation.calls.values()), 'throttled': cloudformation.injected['Throttling'],
+                'errors': cloudformation.injected['InternalFailure'] + (weka.injected['503'] if weka else 0)}
+
+    @classmethod
+    def format_table(cls, results):
+        columns = ['stacks', 'completed', 'failed', 'seconds', 'stacks_per_minute', 'p50', 'p95', 'api_calls',
+                   'throttled', 'errors']
+        headers = {'stacks_per_minute': 'stacks/min', 'api_calls': 'calls'}
+        rows = [[headers.get(column, column) for column in columns]]
+        rows += [['-' if result[column] is None else str(result[column]) for column in columns]
+                 for result in results]
+        widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+        return '\n'.join(' '.join(value.rjust(width) for value, width in zip(row, widths)) for row in rows)
@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import envoi_storage  # noqa: E402
+from envoi_storage import AwsCloudFormationHelper, EnvoiCommand, EnvoiStorageWekaAwsWaitReadyCommand  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keeps every cache and state file the tests touch out of the real ~/.cache/envoi-storage, and gives boto3
+    # fake credentials so nothing can reach a real account.
+    directory = tmp_path / 'cache'
+    directory.mkdir()
+    monkeypatch.setenv('ENVOI_STORAGE_CACHE_DIR', str(directory))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKIDTEST')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    for name in ('AWS_PROFILE', 'AWS_SESSION_TOKEN'):
+        monkeypatch.delenv(name, raising=False)
+    return directory
+
+
+@pytest.fixture
+def cli(monkeypatch, capsys):
+    # Runs the command line through main() and returns (exit status, stdout).
+    def run(*argv):
+        monkeypatch.setattr(sys, 'argv', ['envoi_storage.py', *argv])
+        status = envoi_storage.main()
+        return status, capsys.readouterr().out
+    return run
+
+
+class FakeCloudFormation:
+    # Stacks complete on their `complete_after`th describe. Stacks created with a Fail parameter are rolled back,
+    # and names starting with "bad-" are rejected at create time. A NodeIps parameter becomes the NodeIps output.
+
+    def __init__(self, complete_after=2):
+        self.complete_after = complete_after
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+
+    def create_stack(self, StackName, Parameters=(), **kwargs):
+        parameters = {p['ParameterKey']: p['ParameterValue'] for p in Parameters}
+        with self.lock:
+            self.creates.append(StackName)
+            if StackName.startswith('bad-'):
+                raise ValueError(f"{StackName} rejected")
+            outputs = [{'OutputKey': 'ManagementUrl', 'OutputValue': f"https://{StackName}"}]
+            if 'NodeIps' in parameters:
+                outputs = [{'OutputKey': 'NodeIps', 'OutputValue': parameters['NodeIps']}]
+            self.stacks.setdefault(StackName, {
+                'StackName': StackName, 'StackId': f"stack/{StackName}", 'describes': 0,
+                'fail': 'Fail' in parameters,
+                'Parameters': [p for p in Parameters if p['ParameterKey'] not in ('Fail', 'NodeIps')],
+                'Tags': [{'Key': 'envoi:vendor', 'Value': 'weka'}], 'Outputs': outputs})
+            return {'StackId': f"stack/{StackName}"}
+
+    def describe_stacks(self, StackName):
+        with self.lock:
+            stack = self.stacks[StackName.rpartition('/')[2]]
+            stack['describes'] += 1
+            status = 'CREATE_IN_PROGRESS'
+            if stack['describes'] >= self.complete_after:
+                status = 'ROLLBACK_COMPLETE' if stack['fail'] else 'CREATE_COMPLETE'
+            return {'Stacks': [{**stack, 'StackStatus': status}]}
+
+    def get_paginator(self, operation):
+        # Lists one CREATE_COMPLETE event per describe so far, newest first.
+        def paginate(StackName):
+            stack = self.stacks[StackName.rpartition('/')[2]]
+            events = [{'EventId': f"{StackName}-{i}", 'LogicalResourceId': f"Node{i}",
+                       'ResourceStatus': 'CREATE_COMPLETE'} for i in range(stack['describes'] + 1)]
+            return [{'StackEvents': events[::-1]}]
+        return type('Paginator', (), {'paginate': lambda _, **kw: paginate(**kw)})()
+
+    def update_stack(self, **kwargs):
+        self.updates.append(kwargs)
+
+    def delete_stack(self, StackName):
+        self.deletes.append(StackName)
+
+
+class FakeCreateCommand(EnvoiCommand):
+    # Creates its stack in FakeRootCommand.cloudformation through AwsCloudFormationHelper, like the vendor commands.
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('--stack-name', required=True)
+        parser.add_argument('--fail', action='store_true')
+        parser.add_argument('--nodes', required=False)
+        return parser
+
+    def run(self, opts=None):
+        if opts is None:
+            opts = self.opts
+        parameters = [{'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-1'}]
+        if opts.fail:
+            parameters.append({'ParameterKey': 'Fail', 'ParameterValue': 'yes'})
+        if opts.nodes is not None:
+            parameters.append({'ParameterKey': 'NodeIps', 'ParameterValue': opts.nodes})
+        return AwsCloudFormationHelper.create_stack(opts.stack_name, template_body='{}', template_parameters=parameters,
+                                                    client=FakeRootCommand.cloudformation)
+
+
+class FakeWekaCreateCommand(FakeCreateCommand):
+    wait_ready_command = EnvoiStorageWekaAwsWaitReadyCommand
+
+
+class FakeRootCommand(EnvoiCommand):
+    subcommands = {'create': FakeCreateCommand, 'create-weka': FakeWekaCreateCommand}
+    cloudformation = None
+
+
+@pytest.fixture
+def fake_commands(monkeypatch):
+    # A command tree with `create` and `create-weka` commands for the orchestration tests. The stacks are created in
+    # `fake_commands.cloudformation`, a fresh FakeCloudFormation that tests may replace, e.g. with a stand-in.
+    monkeypatch.setattr(FakeRootCommand, 'cloudformation', FakeCloudFormation())
+    return FakeRootCommand
+
+
+@pytest.fixture
+def cloudformation(fake_commands):
+    return fake_commands.cloudformation
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from envoi_storage import AmiReplicator, EnvoiStorageAmiReplicateCommand
+
+SOURCE = {'ImageId': 'ami-source', 'Name': 'hp-anyware-centos', 'Description': 'HP Anyware CentOS',
+          'State': 'available'}
+
+
+class FakeEc2:
+    # Copies become available after `polls` describes; a region in FAILING fails its copy.
+
+    FAILING = set()
+
+    def __init__(self, region, calls, polls=2, existing=()):
+        self.region = region
+        self.calls = calls
+        self.polls = polls
+        self.images = {image['ImageId']: dict(image) for image in existing}
+        self.describes = {}
+
+    def describe_images(self, ImageIds=None, Owners=None, Filters=None):
+        self.calls.append((self.region, 'describe_images'))
+        if ImageIds is None:
+            names = Filters[0]['Values']
+            return {'Images': [image for image in self.images.values() if image['Name'] in names]}
+        images = []
+        for image_id in ImageIds:
+            image = self.images.get(image_id)
+            if image is not None and image['State'] == 'pending':
+                self.describes[image_id] = self.describes.get(image_id, 0) + 1
+                if self.describes[image_id] >= self.polls:
+                    image['State'] = 'failed' if self.region in self.FAILING else 'available'
+                    image['StateReason'] = {'Message': 'Snapshot copy failed'}
+            if image is not None:
+                images.append(image)
+        return {'Images': images}
+
+    def copy_image(self, **kwargs):
+        self.calls.append((self.region, 'copy_image'))
+        self.copy_args = kwargs
+        image_id = f"ami-{self.region}"
+        self.images[image_id] = {'ImageId': image_id, 'Name': kwargs['Name'], 'State': 'pending'}
+        return {'ImageId': image_id}
+
+
+def replicator(existing=None, **kwargs):
+    calls = []
+    clients = {}
+    lock = threading.Lock()
+
+    def client_factory(region):
+        with lock:
+            images = [SOURCE] if region == 'us-east-1' else (existing or {}).get(region, ())
+            return clients.setdefault(region, FakeEc2(region, calls, existing=images))
+
+    result = AmiReplicator(client_factory, poll_interval=0, **kwargs)
+    result.calls = calls
+    result.fake_clients = clients
+    return result
+
+
+def test_copies_start_at_once_and_are_polled_per_region():
+    ami = replicator(existing={'eu-west-1': [{'ImageId': 'ami-old', 'Name': 'hp-anyware-centos',
+                                              'State': 'available'}]})
+    images, errors = ami.replicate('ami-source', 'us-east-1', ['us-west-2', 'eu-west-1', 'us-east-1', 'us-west-2'])
+    assert errors == {}
+    assert images == {'us-east-1': 'ami-source', 'us-west-2': 'ami-us-west-2', 'eu-west-1': 'ami-old'}
+    copy_args = ami.fake_clients['us-west-2'].copy_args
+    assert (copy_args['SourceRegion'], copy_args['Description'], copy_args['ClientToken']) == (
+        'us-east-1', 'HP Anyware CentOS', AmiReplicator.client_token('us-east-1', 'ami-source', 'us-west-2'))
+    # One describe to find existing copies, then one per poll until the copy is available.
+    assert ami.calls.count(('us-west-2', 'describe_images')) == 3
+    assert ('eu-west-1', 'copy_image') not in ami.calls
+    assert AmiReplicator.format_map(images, ['us-east-1', 'us-west-2', 'eu-west-1']) == \
+        'ami-source | us-east-1, ami-us-west-2 | us-west-2, ami-old | eu-west-1'
+
+
+def test_failed_copies_and_timeouts_are_reported(monkeypatch):
+    monkeypatch.setattr(FakeEc2, 'FAILING', {'ap-south-1'})
+    images, errors = replicator().replicate('ami-source', 'us-east-1', ['ap-south-1', 'us-west-2'])
+    assert images == {'us-east-1': 'ami-source', 'us-west-2': 'ami-us-west-2'}
+    assert errors == {'ap-south-1': 'ami-ap-south-1 is failed: Snapshot copy failed'}
+
+    images, errors = replicator(timeout=0).replicate('ami-source', 'us-east-1', ['us-west-2'])
+    assert errors == {'us-west-2': 'Timed out waiting for ami-us-west-2'}
+    with pytest.raises(ValueError, match='was not found in us-east-1'):
+        replicator().replicate('ami-missing', 'us-east-1', ['us-west-2'])
+
+
+def test_replicate_command(monkeypatch):
+    ami = replicator()
+    monkeypatch.setattr('envoi_storage.aws_client_from_opts', lambda service_name, opts=None: ami.client(
+        opts.aws_region))
+    parser = EnvoiStorageAmiReplicateCommand.init_parser()
+    opts = parser.parse_args(['ami-source', '--aws-region', 'us-east-1', '--regions', 'us-west-2,us-west-1',
+                              '--poll-interval', '0'])
+    assert EnvoiStorageAmiReplicateCommand(opts, auto_exec=False).run() == \
+        'ami-source | us-east-1, ami-us-west-2 | us-west-2, ami-us-west-1 | us-west-1'
+    with pytest.raises(ValueError, match='Set --source-region'):
+        EnvoiStorageAmiReplicateCommand(parser.parse_args(['ami-source', '--regions', 'us-west-2']),
+                                        auto_exec=False).run()
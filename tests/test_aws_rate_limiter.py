@@ -0,0 +1,146 @@
+from types import SimpleNamespace
+
+import pytest
+
+import envoi_storage
+from envoi_storage import AdaptiveTokenBucket, AwsRateLimiter, AwsThrottledClient, aws_client_from_opts
+from envoi_storage_standin import AwsStandInError, CloudFormationStandIn
+
+
+class FakeCloudFormation:
+    # Throttles the first `throttled` calls of every operation.
+
+    def __init__(self, throttled=0, error=None):
+        self.throttled = throttled
+        self.error = error
+        self.calls = []
+
+    def create_stack(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise AwsStandInError(self.error, 'Injected error')
+        if len(self.calls) <= self.throttled:
+            raise AwsStandInError('Throttling', 'Rate exceeded')
+        return {'StackId': 'stack-1'}
+
+    def get_paginator(self, operation_name):
+        pages = [{'Stacks': [1]}, {'Stacks': [2]}]
+        return type('Paginator', (), {'paginate': lambda _, **kw: iter(pages)})()
+
+
+@pytest.fixture
+def limiter():
+    return AwsRateLimiter(initial_rate=1000, max_rate=2000, backoff_base=0)
+
+
+def test_aimd_rate_adjustments():
+    bucket = AdaptiveTokenBucket(10, min_rate=1, max_rate=10.5, increase=0.25)
+    assert bucket.on_throttle() == 5
+    assert bucket.on_success() == 5.25
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 10.5
+    for _ in range(10):
+        bucket.on_throttle()
+    assert bucket.rate == 1
+
+
+def test_throttled_calls_are_retried_and_slow_the_api_down(limiter):
+    cfn = FakeCloudFormation(throttled=3)
+    client = AwsThrottledClient(cfn, 'cloudformation', region='us-east-1', limiter=limiter)
+    assert client.create_stack(StackName='a') == {'StackId': 'stack-1'}
+    assert len(cfn.calls) == 4
+    key = ('default', 'us-east-1', 'cloudformation', 'create_stack')
+    assert limiter.rates() == {key: pytest.approx(1000 / 8 + 0.1)}
+
+
+def test_limiters_are_shared_per_profile_region_and_operation(limiter):
+    cfn = FakeCloudFormation()
+    AwsThrottledClient(cfn, 'cloudformation', region='us-east-1', limiter=limiter).create_stack(StackName='a')
+    AwsThrottledClient(cfn, 'cloudformation', region='us-east-1', limiter=limiter).create_stack(StackName='b')
+    AwsThrottledClient(cfn, 'cloudformation', region='us-west-2', profile='prod', limiter=limiter).create_stack()
+    assert sorted(limiter.rates()) == [('default', 'us-east-1', 'cloudformation', 'create_stack'),
+                                       ('prod', 'us-west-2', 'cloudformation', 'create_stack')]
+    assert limiter.rates()[('default', 'us-east-1', 'cloudformation', 'create_stack')] == pytest.approx(1000.2)
+
+
+def test_other_errors_are_not_retried(limiter):
+    cfn = FakeCloudFormation(error='AlreadyExistsException')
+    with pytest.raises(AwsStandInError):
+        AwsThrottledClient(cfn, 'cloudformation', limiter=limiter).create_stack(StackName='a')
+    assert len(cfn.calls) == 1
+
+
+def test_gives_up_after_max_attempts():
+    limiter = AwsRateLimiter(initial_rate=1000, max_attempts=3, backoff_base=0)
+    cfn = FakeCloudFormation(throttled=10)
+    with pytest.raises(AwsStandInError, match='Throttling'):
+        AwsThrottledClient(cfn, 'cloudformation', limiter=limiter).create_stack(StackName='a')
+    assert len(cfn.calls) == 3
+
+
+def test_paginated_calls_take_a_token_per_page(limiter):
+    client = AwsThrottledClient(FakeCloudFormation(), 'cloudformation', region='us-east-1', limiter=limiter)
+    pages = list(client.get_paginator('describe_stacks').paginate())
+    assert pages == [{'Stacks': [1]}, {'Stacks': [2]}]
+    assert limiter.rates()[('default', 'us-east-1', 'cloudformation', 'describe_stacks')] == pytest.approx(1000.2)
+
+
+class FlakyPaginator:
+    # Three pages linked by NextToken. Each page is throttled the first time it is requested.
+
+    def __init__(self):
+        self.requests = []
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        start = int(CloudFormationStandIn.decode_token((PaginationConfig or {}).get('StartingToken')) or 0)
+        for index in range(start, 3):
+            self.requests.append(index)
+            if self.requests.count(index) == 1:
+                raise AwsStandInError('Throttling', 'Rate exceeded')
+            yield {'Stacks': [index], **({'NextToken': str(index + 1)} if index < 2 else {})}
+
+
+def test_throttled_pages_are_retried_where_they_left_off(limiter):
+    paginator = FlakyPaginator()
+    cfn = FakeCloudFormation()
+    cfn.get_paginator = lambda operation_name: paginator
+    client = AwsThrottledClient(cfn, 'cloudformation', limiter=limiter)
+    assert [page['Stacks'] for page in client.get_paginator('describe_stacks').paginate()] == [[0], [1], [2]]
+    # Every page after a throttle is asked for again from its NextToken, not from the first page.
+    assert paginator.requests == [0, 0, 1, 1, 2, 2]
+
+
+def test_marker_paged_apis_are_only_retried_before_the_first_page(limiter):
+    paginator = FlakyPaginator()
+    paginator.requests.append(0)
+    cfn = FakeCloudFormation()
+    cfn.get_paginator = lambda operation_name: SimpleNamespace(paginate=lambda **kwargs: (
+        {key: value for key, value in page.items() if key != 'NextToken'} for page in paginator.paginate(**kwargs)))
+    pages = AwsThrottledClient(cfn, 'cloudformation', limiter=limiter).get_paginator('list_objects').paginate()
+    assert next(pages) == {'Stacks': [0]}
+    with pytest.raises(AwsStandInError, match='Throttling'):
+        next(pages)
+
+
+class FakeConfig:
+
+    def __init__(self, **kwargs):
+        self.settings = kwargs
+
+    def merge(self, other):
+        return FakeConfig(**{**self.settings, **other.settings})
+
+
+def test_wrapped_clients_leave_retries_to_the_limiter(monkeypatch):
+    created = []
+    monkeypatch.setattr(envoi_storage, 'botocore', SimpleNamespace(config=SimpleNamespace(Config=FakeConfig)),
+                        raising=False)
+    monkeypatch.setattr(envoi_storage, 'boto3', SimpleNamespace(
+        client=lambda service_name, **kwargs: created.append(kwargs) or SimpleNamespace()), raising=False)
+    aws_client_from_opts('ec2', opts=SimpleNamespace(aws_region='us-west-2'))
+    aws_client_from_opts('ec2', client_args={'config': FakeConfig(connect_timeout=5)})
+    assert created[0]['region_name'] == 'us-west-2'
+    assert [kwargs['config'].settings for kwargs in created] == [
+        {'retries': {'total_max_attempts': 1, 'mode': 'standard'}},
+        {'connect_timeout': 5, 'retries': {'total_max_attempts': 1, 'mode': 'standard'}}]
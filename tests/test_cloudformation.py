@@ -0,0 +1,78 @@
+import pytest
+
+from envoi_storage import AwsCloudFormationHelper
+from envoi_storage_standin import AwsStandInError
+
+PARAMETERS = [{'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-1'},
+              {'ParameterKey': 'AdminPassword', 'ParameterValue': 'secret'}]
+
+
+class FakeCloudFormation:
+    # Keeps stacks by name. A create for an existing name fails like CloudFormation does, unless it repeats the
+    # token of the call that created the stack.
+
+    def __init__(self):
+        self.stacks = {}
+        self.calls = []
+
+    def create_stack(self, **kwargs):
+        self.calls.append(kwargs)
+        stack = self.stacks.get(kwargs['StackName'])
+        if stack is not None:
+            if stack['token'] == kwargs['ClientRequestToken']:
+                return {'StackId': stack['StackId']}
+            raise AwsStandInError('AlreadyExistsException', 'Stack already exists')
+        self.stacks[kwargs['StackName']] = {
+            'StackId': f"stack/{kwargs['StackName']}/{len(self.stacks) + 1}", 'StackStatus': 'CREATE_IN_PROGRESS',
+            'token': kwargs['ClientRequestToken'],
+            'Parameters': [{'ParameterKey': p['ParameterKey'],
+                            'ParameterValue': '****' if p['ParameterKey'] == 'AdminPassword' else p['ParameterValue']}
+                           for p in kwargs.get('Parameters', [])]}
+        return {'StackId': self.stacks[kwargs['StackName']]['StackId']}
+
+    def describe_stacks(self, StackName):
+        return {'Stacks': [self.stacks[StackName]]}
+
+
+def create(client, parameters=PARAMETERS, template_url='https://templates/a.json'):
+    return AwsCloudFormationHelper.create_stack('qumulo', template_url, template_parameters=parameters,
+                                                client=client, capabilities=['CAPABILITY_IAM'])
+
+
+def test_tokens_are_deterministic():
+    client = FakeCloudFormation()
+    create(client)
+    create(client)
+    create(client, template_url='https://templates/b.json')
+    tokens = [call['ClientRequestToken'] for call in client.calls]
+    assert tokens[0] == tokens[1] != tokens[2]
+    assert tokens[0].startswith('envoi-') and len(tokens[0]) <= 128
+
+
+def test_repeated_create_attaches_to_the_existing_stack():
+    client = FakeCloudFormation()
+    first = create(client)
+    # The same parameters through a different template URL (e.g. re-staged) still attach; NoEcho values match.
+    again = create(client, template_url='https://templates/b.json')
+    assert again == {'StackId': first['StackId'], 'StackStatus': 'CREATE_IN_PROGRESS', 'AlreadyExists': True}
+    assert AwsCloudFormationHelper.format_create_response(again) == \
+        f"Stack ID {first['StackId']} (already exists, CREATE_IN_PROGRESS)"
+
+
+def test_existing_stack_with_other_parameters_or_failed_status_is_an_error():
+    client = FakeCloudFormation()
+    create(client)
+    with pytest.raises(ValueError, match='different parameters: VpcId'):
+        create(client, parameters=[{'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-2'}])
+    client.stacks['qumulo']['StackStatus'] = 'ROLLBACK_COMPLETE'
+    with pytest.raises(ValueError, match='already exists in status ROLLBACK_COMPLETE'):
+        create(client, template_url='https://templates/b.json')
+
+
+def test_other_errors_are_raised():
+    class DeniedCloudFormation(FakeCloudFormation):
+        def create_stack(self, **kwargs):
+            raise AwsStandInError('AccessDenied', 'User is not authorized to perform cloudformation:CreateStack')
+
+    with pytest.raises(AwsStandInError):
+        create(DeniedCloudFormation())
@@ -0,0 +1,129 @@
+import datetime
+import os
+import stat
+import threading
+import time
+from types import SimpleNamespace
+
+import envoi_storage
+from envoi_storage import AssumeRoleCredentialCache, LatencyRecorder, StackStatusCollector, aws_role_opts
+
+ACCOUNTS = [f"arn:aws:iam::{index:012d}:role/EnvoiDeploy" for index in range(20)]
+HUB = 'arn:aws:iam::999999999999:role/EnvoiHub'
+
+
+class FakeEvents:
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event, handler):
+        self.handlers[event] = handler
+
+
+class FakeSts:
+    # Records every assume_role call with the credentials it was made with. Calls fire botocore's before-call and
+    # after-call events.
+
+    def __init__(self, calls, source, lifetime=3600):
+        self.calls = calls
+        self.source = source
+        self.lifetime = lifetime
+        self.meta = SimpleNamespace(events=FakeEvents(), region_name=None)
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+        context = {}
+        model = SimpleNamespace(name='AssumeRole', service_model=SimpleNamespace(service_name='sts'))
+        self.meta.events.handlers['before-call'](model=model, context=context)
+        time.sleep(0.01)
+        self.meta.events.handlers['after-call'](http_response=SimpleNamespace(status_code=200), context=context)
+        self.calls.append((self.source['AccessKeyId'] if self.source else None, RoleArn))
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.lifetime)
+        return {'Credentials': {'AccessKeyId': f"AK-{RoleArn}-{len(self.calls)}", 'SecretAccessKey': 'secret',
+                                'SessionToken': 'token', 'Expiration': expiration}}
+
+
+def credential_cache(tmp_path, lifetime=3600, identity='AKIDOPS'):
+    calls = []
+    cache = AssumeRoleCredentialCache(str(tmp_path / 'credentials.json'),
+                                      sts_client_factory=lambda profile, source, region: FakeSts(calls, source,
+                                                                                                 lifetime),
+                                      source_identity_factory=lambda profile: f"{identity}-{profile}")
+    cache.calls = calls
+    return cache
+
+
+def test_fleet_threads_share_one_sts_call_per_account(tmp_path):
+    cache = credential_cache(tmp_path)
+
+    def poll(account):
+        for _ in range(5):
+            assert cache.credentials('ops', [HUB, account])['AccessKeyId'].startswith(f"AK-{account}-")
+
+    threads = [threading.Thread(target=poll, args=(account,)) for account in ACCOUNTS for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The hub role is assumed once from the profile; every account once from the hub's credentials.
+    assert len(cache.calls) == 21
+    assert cache.calls.count((None, HUB)) == 1
+    assert {source for source, role in cache.calls if role != HUB} == {'AK-arn:aws:iam::999999999999:role/EnvoiHub-1'}
+
+
+def test_credentials_are_shared_on_disk_and_refreshed_before_expiry(tmp_path):
+    cache = credential_cache(tmp_path)
+    first = cache.credentials(None, [ACCOUNTS[0]])
+    assert stat.S_IMODE(os.stat(tmp_path / 'credentials.json').st_mode) == 0o600
+
+    later_run = credential_cache(tmp_path)
+    assert later_run.credentials(None, [ACCOUNTS[0]]) == first and later_run.calls == []
+    # Another session name or profile is another set of credentials.
+    later_run.credentials(None, [ACCOUNTS[0]], session_name='nightly')
+    assert len(later_run.calls) == 1
+
+    # Credentials inside the refresh margin are assumed again.
+    (tmp_path / 'short').mkdir()
+    short_lived = credential_cache(tmp_path / 'short', lifetime=600)
+    short_lived.credentials(None, [ACCOUNTS[1]])
+    short_lived.credentials(None, [ACCOUNTS[1]])
+    assert len(short_lived.calls) == 2
+
+
+def test_credentials_follow_the_source_identity(tmp_path):
+    first = credential_cache(tmp_path).credentials('ops', [ACCOUNTS[0]])
+    # The ops profile now resolves to other credentials, which must not get the roles the old ones assumed.
+    rotated = credential_cache(tmp_path, identity='AKIDOTHER')
+    assert rotated.credentials('ops', [ACCOUNTS[0]]) != first and len(rotated.calls) == 1
+
+
+def test_saves_keep_credentials_other_processes_assumed(tmp_path):
+    first, second = credential_cache(tmp_path), credential_cache(tmp_path)
+    # Both load the file before either has saved anything.
+    assert first.cached('unknown') is None and second.cached('unknown') is None
+    first.credentials(None, [ACCOUNTS[0]])
+    second.credentials(None, [ACCOUNTS[1]])
+    later_run = credential_cache(tmp_path)
+    later_run.credentials(None, [ACCOUNTS[0]])
+    later_run.credentials(None, [ACCOUNTS[1]])
+    assert later_run.calls == []
+
+
+def test_sts_calls_are_timed(tmp_path, monkeypatch):
+    recorder = LatencyRecorder(enabled=True)
+    monkeypatch.setattr(envoi_storage, 'API_LATENCY', recorder)
+    credential_cache(tmp_path).credentials('ops', [HUB, ACCOUNTS[0]])
+    assert [(span['name'], span['status']) for span in recorder.spans] == [('sts.AssumeRole', 'ok')] * 2
+
+
+def test_role_options_and_status_targets():
+    assert aws_role_opts(SimpleNamespace(aws_profile='ops')) == (None, None, None)
+    assert aws_role_opts(SimpleNamespace(aws_role_arn=[HUB, ACCOUNTS[0]])) == ([HUB, ACCOUNTS[0]], 'envoi-storage',
+                                                                               ACCOUNTS[0])
+    seen = []
+    collector = StackStatusCollector(profiles=['ops', ACCOUNTS[0]], regions=['us-east-1'],
+                                     client_factory=lambda opts: seen.append(opts) or object())
+    collector.client('ops', 'us-east-1')
+    collector.client(ACCOUNTS[0], 'us-east-1')
+    assert seen[0].aws_profile == 'ops' and not hasattr(seen[0], 'aws_role_arn')
+    assert (seen[1].aws_profile, seen[1].aws_role_arn) == (None, [ACCOUNTS[0]])
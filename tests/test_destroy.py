@@ -0,0 +1,133 @@
+import pytest
+
+from envoi_storage import AwsCloudFormationHelper, EnvoiStorageDestroyCommand, StackTeardown
+from envoi_storage_standin import AwsStandInError
+
+
+class FakeCloudFormation:
+    # Stacks are deleted synchronously. `failures` makes a stack's delete fail that many times on its bucket;
+    # `imports` maps export names to the stacks importing them.
+
+    def __init__(self, stacks, exports=(), imports=None, failures=None):
+        self.stacks = {name: {'StackName': name, 'StackId': f"stack/{name}", 'StackStatus': 'CREATE_COMPLETE',
+                              'Tags': [{'Key': key, 'Value': value} for key, value in tags]}
+                       for name, tags in stacks.items()}
+        self.exports = [{'ExportingStackId': f"stack/{exporter}", 'Name': name} for exporter, name in exports]
+        self.imports = imports or {}
+        self.failures = dict(failures or {})
+        self.events = {name: [] for name in stacks}
+        self.deletes = []
+
+    def stack(self, name_or_id):
+        return self.stacks[name_or_id.rpartition('/')[2]]
+
+    def event(self, stack, logical_id, status, **extra):
+        events = self.events[stack['StackName']]
+        events.insert(0, {'EventId': f"{stack['StackName']}-{len(events)}", 'LogicalResourceId': logical_id,
+                          'ResourceStatus': status, **extra})
+
+    def delete_stack(self, StackName, RetainResources=None):
+        stack = self.stack(StackName)
+        self.deletes.append((stack['StackName'], RetainResources))
+        if self.failures.get(stack['StackName']) and not RetainResources:
+            self.failures[stack['StackName']] -= 1
+            self.event(stack, 'Media', 'DELETE_FAILED', ResourceType='AWS::S3::Bucket',
+                       PhysicalResourceId=f"{stack['StackName']}-media", ResourceStatusReason='The bucket is not empty')
+            self.event(stack, stack['StackName'], 'DELETE_FAILED', PhysicalResourceId=stack['StackId'])
+            stack['StackStatus'] = 'DELETE_FAILED'
+        else:
+            self.event(stack, stack['StackName'], 'DELETE_COMPLETE', PhysicalResourceId=stack['StackId'])
+            stack['StackStatus'] = 'DELETE_COMPLETE'
+
+    def describe_stacks(self, StackName):
+        return {'Stacks': [self.stack(StackName)]}
+
+    def get_paginator(self, operation):
+        def paginate(**kwargs):
+            if operation == 'describe_stacks':
+                return [{'Stacks': list(self.stacks.values())}]
+            if operation == 'list_exports':
+                return [{'Exports': self.exports}]
+            if operation == 'list_imports':
+                if kwargs['ExportName'] not in self.imports:
+                    raise AwsStandInError('ValidationError', 'Export is not imported by any stack')
+                return [{'Imports': self.imports[kwargs['ExportName']]}]
+            return [{'StackEvents': self.events[kwargs['StackName'].rpartition('/')[2]]}]
+        return type('Paginator', (), {'paginate': lambda _, **kwargs: paginate(**kwargs)})()
+
+
+class FakeS3:
+
+    def __init__(self):
+        self.deleted = []
+
+    def get_paginator(self, operation):
+        pages = [{'Versions': [{'Key': 'a.exr', 'VersionId': '1'}], 'DeleteMarkers': [{'Key': 'b.exr',
+                                                                                       'VersionId': '2'}]}]
+        return type('Paginator', (), {'paginate': lambda _, Bucket: pages})()
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted.append((Bucket, [o['Key'] for o in Delete['Objects']]))
+
+
+def show_stacks(**kwargs):
+    # net exports the VPC to storage and app; the client stack is tagged as depending on storage.
+    return FakeCloudFormation({'net': [], 'storage': [('envoi:vendor', 'qumulo')], 'app': [],
+                               'client': [('envoi:depends-on', 'storage, unknown')], 'other': []},
+                              exports=[('net', 'show-vpc'), ('storage', 'show-unused')],
+                              imports={'show-vpc': ['storage', 'app']}, **kwargs)
+
+
+def test_levels_follow_imports_and_tags():
+    client = show_stacks()
+    teardown = StackTeardown(client)
+    stacks = teardown.select(['net', 'app'], tags={'envoi:vendor': 'qumulo'}, name_prefixes=['cli'])
+    assert sorted(stack['StackName'] for stack in stacks) == ['app', 'client', 'net', 'storage']
+    assert teardown.levels(teardown.dependencies(stacks)) == [['app', 'client'], ['storage'], ['net']]
+
+
+def test_dependencies_outside_the_selection_and_cycles_are_errors():
+    client = show_stacks()
+    teardown = StackTeardown(client)
+    with pytest.raises(ValueError, match="imported by app, which isn't being destroyed"):
+        teardown.dependencies(teardown.select(['net', 'storage']))
+    with pytest.raises(ValueError, match='cycle: a, b'):
+        teardown.levels({'a': {'b'}, 'b': {'a'}, 'c': set()})
+
+
+def test_destroy_deletes_level_by_level_and_cleans_up_buckets():
+    client = show_stacks(failures={'storage': 1})
+    s3 = FakeS3()
+    teardown = StackTeardown(client, s3_client=s3, poll_interval=0, empty_buckets=True)
+    stacks = teardown.select(['net', 'storage', 'app', 'client'])
+    assert teardown.destroy(stacks) == {}
+    assert [name for name, _ in client.deletes] == ['app', 'client', 'storage', 'storage', 'net']
+    assert s3.deleted == [('storage-media', ['a.exr', 'b.exr'])]
+
+
+def test_failed_resources_are_retained_or_stop_the_teardown():
+    client = show_stacks(failures={'storage': 5})
+    teardown = StackTeardown(client, poll_interval=0, retries=0, retain_failed=True)
+    assert teardown.destroy(teardown.select(['storage', 'net', 'app', 'client'])) == {'storage': ['Media']}
+    assert client.deletes[-2:] == [('storage', ['Media']), ('net', None)]
+
+    client = show_stacks(failures={'storage': 5})
+    teardown = StackTeardown(client, poll_interval=0, retries=1)
+    with pytest.raises(ValueError, match='storage: Stack storage is DELETE_FAILED. Media: The bucket is not empty '
+                                         'Not deleted: net'):
+        teardown.destroy(teardown.select(['storage', 'net', 'app', 'client']))
+    assert client.stacks['net']['StackStatus'] == 'CREATE_COMPLETE'
+
+
+def test_destroy_command(monkeypatch):
+    client = show_stacks()
+    monkeypatch.setattr(AwsCloudFormationHelper, 'client_from_opts',
+                        classmethod(lambda cls, cfn_client_args=None, opts=None: client))
+    parser = EnvoiStorageDestroyCommand.init_parser()
+    with pytest.raises(ValueError, match='Name the stacks'):
+        EnvoiStorageDestroyCommand(parser.parse_args([]), auto_exec=False).run()
+    opts = parser.parse_args(['app', 'client', '--name-prefix', 'n', '--tag', 'envoi:vendor', '--dry-run'])
+    assert EnvoiStorageDestroyCommand(opts, auto_exec=False).run() == \
+        'Level 1: app, client\nLevel 2: storage\nLevel 3: net'
+    opts = parser.parse_args(['app', 'other', '--yes', '--poll-interval', '0'])
+    assert EnvoiStorageDestroyCommand(opts, auto_exec=False).run() == 'Deleted 2 stacks in 1 levels'
@@ -0,0 +1,179 @@
+import multiprocessing
+import time
+
+import pytest
+
+from envoi_storage import AwsNetworkDiscovery, DiscoveryCache, SimpleNamespace
+
+
+class FakeEc2:
+    # Serves describe_vpcs/describe_subnets from the session's current network and counts the calls.
+
+    def __init__(self, session):
+        self.session = session
+
+    def get_paginator(self, operation):
+        self.session.calls.append(operation)
+        if self.session.broken:
+            raise RuntimeError('UnauthorizedOperation')
+        key = 'Vpcs' if operation == 'describe_vpcs' else 'Subnets'
+        return type('Paginator', (), {'paginate': lambda _, **kw: [{key: self.session.network[key]}]})()
+
+
+class FakeSession:
+    region_name = 'us-east-1'
+
+    def __init__(self, profile_name=None):
+        self.profile_name = profile_name
+        self.calls = []
+        self.broken = False
+        self.network = {
+            'Vpcs': [{'VpcId': 'vpc-1'}],
+            'Subnets': [{'SubnetId': 'subnet-a', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-1a',
+                         'CidrBlock': '10.0.1.0/24'},
+                        {'SubnetId': 'subnet-x', 'VpcId': 'vpc-2', 'AvailabilityZone': 'us-east-1b',
+                         'CidrBlock': '10.1.1.0/24'}],
+        }
+
+    def client(self, service_name, **kwargs):
+        return FakeEc2(self)
+
+
+@pytest.fixture
+def session():
+    return FakeSession()
+
+
+@pytest.fixture
+def discovery(session):
+    return AwsNetworkDiscovery(session=session)
+
+
+def test_cache_round_trip_and_expiry(cache_dir):
+    cache = DiscoveryCache(ttl=60)
+    cache.put('prod', 'us-east-1', 'vpcs', [{'VpcId': 'vpc-1'}])
+    assert (cache_dir / 'discovery.json').exists()
+    assert DiscoveryCache().get('prod', 'us-east-1', 'vpcs') == [{'VpcId': 'vpc-1'}]
+    assert cache.get('prod', 'us-west-2', 'vpcs') is None
+    cache.put('prod', 'us-east-1', 'subnets', [], ttl=-1)
+    assert cache.get('prod', 'us-east-1', 'subnets') is None
+
+
+def test_get_or_load_only_loads_misses():
+    cache = DiscoveryCache()
+    loads = []
+    for _ in range(3):
+        cache.get_or_load(None, None, 'fsx-regions', lambda: loads.append(1) or ['us-east-1'])
+    assert loads == [1]
+    assert cache.get('default', 'global', 'fsx-regions') == ['us-east-1']
+
+
+def test_invalidate_matches_profile_region_and_kind():
+    cache = DiscoveryCache()
+    for profile in ('prod', 'dev'):
+        for region in ('us-east-1', 'eu-west-1'):
+            for kind in ('vpcs', 'subnets'):
+                cache.put(profile, region, kind, [])
+    assert cache.invalidate(profile='dev', region='eu-west-1') == 2
+    assert cache.invalidate(kind='subnets') == 3
+    assert cache.invalidate() == 3
+    assert DiscoveryCache().entries == {}
+
+
+def put_entries(name, count):
+    cache = DiscoveryCache()
+    for index in range(count):
+        cache.put(name, 'us-east-1', 'vpcs', [index], index)
+
+
+def test_saves_merge_entries_from_other_processes():
+    first, second = DiscoveryCache(), DiscoveryCache()
+    first.put('prod', 'us-east-1', 'vpcs', [])
+    second.put('dev', 'us-east-1', 'vpcs', [])
+    first.invalidate(profile='dev')
+    second.put('dev', 'eu-west-1', 'vpcs', [])
+    assert sorted(DiscoveryCache().entries) == ['dev|eu-west-1|vpcs', 'prod|us-east-1|vpcs']
+
+    processes = [multiprocessing.get_context('fork').Process(target=put_entries, args=(f"p{index}", 20))
+                 for index in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert len(DiscoveryCache().entries) == 2 + 4 * 20
+
+
+def put_entry_under_the_file_lock(locked):
+    cache = DiscoveryCache()
+    with cache.file_lock():
+        locked.set()
+        time.sleep(0.2)
+        cache.entries['late|us-east-1|vpcs'] = {'expires_at': time.time() + 60, 'value': []}
+        cache.changed.add('late|us-east-1|vpcs')
+        cache.merge_and_write()
+
+
+def test_invalidate_waits_for_saves_in_progress():
+    context = multiprocessing.get_context('fork')
+    locked = context.Event()
+    process = context.Process(target=put_entry_under_the_file_lock, args=(locked,))
+    process.start()
+    assert locked.wait(5)
+    assert DiscoveryCache().invalidate(profile='late') == 1
+    process.join()
+    assert DiscoveryCache().entries == {}
+
+
+def test_discovery_is_cached_per_profile_and_endpoint(session):
+    first = AwsNetworkDiscovery(session=session)
+    assert first.subnets('us-east-1', vpc_id='vpc-1') == [session.network['Subnets'][0]]
+    assert AwsNetworkDiscovery(session=session).subnets('us-east-1') == session.network['Subnets']
+    assert session.calls == ['describe_subnets']
+    standin = AwsNetworkDiscovery(session=session, endpoint_url='http://127.0.0.1:4566')
+    assert standin.profile == 'default@http://127.0.0.1:4566'
+    standin.subnets('us-east-1')
+    assert session.calls == ['describe_subnets'] * 2
+
+
+def test_validate_network(discovery):
+    assert discovery.validate_network('us-east-1', vpc_id='vpc-1', subnet_ids=['subnet-a', '']) == [
+        {'SubnetId': 'subnet-a', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-1a', 'CidrBlock': '10.0.1.0/24'}]
+    with pytest.raises(ValueError, match='Subnet subnet-x is in vpc-2, not vpc-1'):
+        discovery.validate_network('us-east-1', vpc_id='vpc-1', subnet_ids=['subnet-x'])
+
+
+def test_unknown_ids_refresh_the_cache_once(discovery, session):
+    discovery.network('us-east-1')
+    session.network['Subnets'].append({'SubnetId': 'subnet-new', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-1c',
+                                       'CidrBlock': '10.0.2.0/24'})
+    assert discovery.validate_network('us-east-1', subnet_ids=['subnet-new'])[0]['SubnetId'] == 'subnet-new'
+    assert sorted(session.calls) == ['describe_subnets'] * 2 + ['describe_vpcs'] * 2
+    with pytest.raises(ValueError, match='Not found in us-east-1: vpc-9, subnet-9'):
+        discovery.validate_network('us-east-1', vpc_id='vpc-9', subnet_ids=['subnet-9'])
+
+
+def test_validate_network_from_opts(monkeypatch, session):
+    monkeypatch.setattr(AwsNetworkDiscovery, 'from_opts',
+                        classmethod(lambda cls, opts=None: AwsNetworkDiscovery(session=session)))
+    opts = SimpleNamespace(aws_region='us-east-1', skip_network_validation=False)
+    with pytest.raises(ValueError, match='Not found'):
+        AwsNetworkDiscovery.validate_network_from_opts(opts, vpc_id='vpc-9')
+    opts.skip_network_validation = True
+    assert AwsNetworkDiscovery.validate_network_from_opts(opts, vpc_id='vpc-9') is None
+    # A failed lookup (e.g. missing permissions) doesn't block the deployment.
+    opts.skip_network_validation = False
+    session.broken = True
+    DiscoveryCache().invalidate()
+    assert AwsNetworkDiscovery.validate_network_from_opts(opts, vpc_id='vpc-9') is None
+
+
+def test_discovery_cache_commands(cli):
+    cache = DiscoveryCache()
+    cache.put('prod', 'us-east-1', 'vpcs', [])
+    cache.put('prod', 'us-east-1', 'subnets', [])
+    status, output = cli('discovery-cache', 'show')
+    assert status == 0
+    assert output.splitlines()[0].startswith('prod|us-east-1|subnets  expires in ')
+    assert cli('discovery-cache', 'clear', '--kind', 'vpcs') == (0, 'Cleared 1 discovery cache entries\n')
+    assert cli('discovery-cache', 'clear') == (0, 'Cleared 1 discovery cache entries\n')
+    assert cli('discovery-cache', 'show') == (0, 'The discovery cache is empty\n')
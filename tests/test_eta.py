@@ -0,0 +1,119 @@
+import datetime
+import io
+
+import pytest
+
+from envoi_storage import AwsCloudFormationHelper, EnvoiStorageHammerspaceAwsCreateClusterCommand, StackEtaPredictor
+from envoi_storage_standin import CloudFormationStandIn
+
+START = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def stack(name='weka-1', status='CREATE_IN_PROGRESS', nodes='6'):
+    return {'StackName': name, 'StackId': f"stack/{name}", 'StackStatus': status, 'CreationTime': START,
+            'Description': 'Weka cluster', 'Tags': [{'Key': 'envoi:vendor', 'Value': 'weka'}],
+            'Parameters': [{'ParameterKey': 'BackendInstanceCount', 'ParameterValue': nodes}]}
+
+
+def event(stack_name, logical_id, status, seconds, resource_type='AWS::EC2::Instance'):
+    if logical_id == stack_name:
+        resource_type = 'AWS::CloudFormation::Stack'
+    return {'EventId': f"{logical_id}-{status}-{seconds}", 'LogicalResourceId': logical_id, 'ResourceStatus': status,
+            'ResourceType': resource_type, 'Timestamp': START + datetime.timedelta(seconds=seconds),
+            'PhysicalResourceId': f"stack/{stack_name}" if logical_id == stack_name else logical_id}
+
+
+def create_events(name='weka-1', total=600):
+    return [event(name, name, 'CREATE_IN_PROGRESS', 0),
+            event(name, 'Backend0', 'CREATE_IN_PROGRESS', 10), event(name, 'Backend1', 'CREATE_IN_PROGRESS', 10),
+            event(name, 'Backend0', 'CREATE_COMPLETE', 190), event(name, 'Backend1', 'CREATE_COMPLETE', 210),
+            event(name, 'Init', 'CREATE_IN_PROGRESS', 220, 'Custom::WekaInit'),
+            event(name, 'Init', 'CREATE_COMPLETE', total - 20, 'Custom::WekaInit'),
+            event(name, name, 'CREATE_COMPLETE', total)]
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    predictor = StackEtaPredictor(str(tmp_path / 'eta.sqlite'))
+    yield predictor
+    predictor.close()
+
+
+def test_history_is_learned_per_vendor_template_and_node_count(predictor):
+    assert predictor.estimate(stack(), []) is None
+    assert predictor.record(stack(status='CREATE_COMPLETE'), create_events())
+    assert not predictor.record(stack(), create_events()[:-1])
+    history = predictor.history(stack())
+    assert history == {'AWS::CloudFormation::Stack': 600.0, 'AWS::EC2::Instance': 190.0, 'Custom::WekaInit': 360.0}
+
+    predictor.record(stack(status='CREATE_COMPLETE'), create_events(total=800))
+    assert predictor.history(stack())['AWS::CloudFormation::Stack'] == 700.0
+    # Another node count falls back to the template's history.
+    assert predictor.history(stack(nodes='12'))['AWS::CloudFormation::Stack'] == 700.0
+    assert predictor.history_keys(stack())[0].startswith('weka|') and predictor.history_keys(stack())[0].endswith('|6')
+
+
+def test_history_follows_the_template_tag(predictor):
+    predictor.record(stack(status='CREATE_COMPLETE'), create_events())
+    retemplated = stack()
+    retemplated['Tags'] = retemplated['Tags'] + [{'Key': 'envoi:template', 'Value': 'abc123'}]
+    # Same description and node count, another template: only the vendor's history applies.
+    assert predictor.history_keys(retemplated)[0] == 'weka|abc123|6'
+    assert predictor.history_keys(retemplated)[0] != predictor.history_keys(stack())[0]
+    assert predictor.history(retemplated)['AWS::CloudFormation::Stack'] == 600.0
+    predictor.record(dict(retemplated, StackStatus='CREATE_COMPLETE'), create_events(total=900))
+    assert predictor.history(retemplated)['AWS::CloudFormation::Stack'] == 900.0
+    assert predictor.history(stack())['AWS::CloudFormation::Stack'] == 600.0
+
+
+def test_create_command_records_the_create_it_waits_for(monkeypatch):
+    cloudformation = CloudFormationStandIn(create_seconds=0.05)
+    monkeypatch.setattr(AwsCloudFormationHelper, 'client_from_opts',
+                        classmethod(lambda cls, cfn_client_args=None, opts=None: cloudformation))
+    opts = EnvoiStorageHammerspaceAwsCreateClusterCommand.init_parser().parse_args(
+        ['--stack-name', 'hs-1', '--wait', '--poll-interval', '0.01'])
+    assert EnvoiStorageHammerspaceAwsCreateClusterCommand(opts, auto_exec=False).run().startswith('Stack ID ')
+    created = AwsCloudFormationHelper.describe_stack(cloudformation, 'hs-1')
+    assert created['StackStatus'] == 'CREATE_COMPLETE'
+    predictor = StackEtaPredictor()
+    try:
+        assert predictor.history(created)['AWS::CloudFormation::Stack'] > 0
+    finally:
+        predictor.close()
+
+
+def test_estimate_and_slow_resources(predictor):
+    predictor.record(stack(status='CREATE_COMPLETE'), create_events())
+    now = START.timestamp() + 100
+    estimate = predictor.estimate(stack(), create_events()[:3], now=now)
+    assert (estimate['elapsed'], estimate['remaining'], estimate['slow']) == (100, 500, [])
+
+    # The custom resource usually takes 6 minutes; after 30 it is flagged, and the ETA is at least what it needs.
+    running = create_events()[:6]
+    estimate = predictor.estimate(stack(), running, now=START.timestamp() + 220 + 1800)
+    assert estimate['remaining'] == 0
+    assert estimate['slow'] == [('Init', 'Init (Custom::WekaInit) has been creating for 30m00s, usually 6m00s'),
+                                ('weka-1', 'the stack has been creating for 33m40s, usually 10m00s')]
+
+
+def test_wait_for_stack_shows_an_eta_and_records_the_create(predictor):
+    predictor.record(stack(status='CREATE_COMPLETE'), create_events())
+
+    class FakeCloudFormation:
+        def __init__(self):
+            self.polls = 0
+
+        def describe_stacks(self, StackName):
+            self.polls += 1
+            return {'Stacks': [stack('weka-2', 'CREATE_COMPLETE' if self.polls == 3 else 'CREATE_IN_PROGRESS')]}
+
+        def get_paginator(self, operation):
+            events = create_events('weka-2', total=1200)[:2 + 2 * self.polls][::-1]
+            return type('Paginator', (), {'paginate': lambda _, StackName: [{'StackEvents': events}]})()
+
+    stream = io.StringIO()
+    AwsCloudFormationHelper.wait_for_stack(FakeCloudFormation(), 'weka-2', poll_interval=0, predictor=predictor,
+                                           stream=stream)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2 and lines[0].startswith('weka-2: CREATE_IN_PROGRESS, ') and 'left' in lines[0]
+    assert predictor.history(stack())['AWS::CloudFormation::Stack'] == 900.0
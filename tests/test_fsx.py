@@ -0,0 +1,199 @@
+import os
+import stat
+
+import pytest
+
+from envoi_storage import AwsFsxHelper, EnvoiStorageFsxAwsCreateFileSystemCommand, EnvoiStorageFsxAwsPreloadCommand
+
+
+class FakeFsx:
+    # Records the FSx calls. File systems are AVAILABLE on the first describe.
+
+    def __init__(self):
+        self.calls = []
+
+    def create_file_system(self, **kwargs):
+        self.calls.append(('create_file_system', kwargs))
+        return {'FileSystem': {'FileSystemId': 'fs-1', 'Lifecycle': 'CREATING'}}
+
+    def describe_file_systems(self, FileSystemIds):
+        self.calls.append(('describe_file_systems', FileSystemIds))
+        return {'FileSystems': [{'FileSystemId': 'fs-1', 'Lifecycle': 'AVAILABLE', 'DNSName': 'fs-1.fsx.local',
+                                 'LustreConfiguration': {'MountName': 'abcd'}}]}
+
+    def create_data_repository_association(self, **kwargs):
+        self.calls.append(('create_data_repository_association', kwargs))
+        return {'Association': {'AssociationId': 'dra-1', 'Lifecycle': 'CREATING'}}
+
+
+def create_opts(*argv):
+    return EnvoiStorageFsxAwsCreateFileSystemCommand.init_parser().parse_args(
+        ['--subnet-ids', 'subnet-1', '--poll-interval', '0', *argv])
+
+
+def test_persistent_2_create_args():
+    args = AwsFsxHelper.build_lustre_create_args(['subnet-1'], storage_capacity=2400, security_group_ids=['sg-1'],
+                                                 name='renders')
+    assert args == {
+        'FileSystemType': 'LUSTRE', 'StorageCapacity': 2400, 'StorageType': 'SSD', 'SubnetIds': ['subnet-1'],
+        'FileSystemTypeVersion': '2.15', 'SecurityGroupIds': ['sg-1'], 'Tags': [{'Key': 'Name', 'Value': 'renders'}],
+        'LustreConfiguration': {'DeploymentType': 'PERSISTENT_2', 'DataCompressionType': 'LZ4',
+                                'PerUnitStorageThroughput': 250},
+    }
+
+
+def test_per_unit_storage_throughput_follows_the_deployment_type():
+    lustre = AwsFsxHelper.build_lustre_create_args(['subnet-1'], deployment_type='PERSISTENT_1')['LustreConfiguration']
+    assert lustre['PerUnitStorageThroughput'] == 200
+    lustre = AwsFsxHelper.build_lustre_create_args(['subnet-1'], deployment_type='PERSISTENT_2',
+                                                   per_unit_storage_throughput=1000)['LustreConfiguration']
+    assert lustre['PerUnitStorageThroughput'] == 1000
+    with pytest.raises(ValueError, match='PERSISTENT_1 supports a per-unit storage throughput of 50, 100, 200'):
+        AwsFsxHelper.build_lustre_create_args(['subnet-1'], deployment_type='PERSISTENT_1',
+                                              per_unit_storage_throughput=250)
+    with pytest.raises(ValueError, match='PERSISTENT_2 supports'):
+        AwsFsxHelper.build_lustre_create_args(['subnet-1'], per_unit_storage_throughput=200)
+    with pytest.raises(ValueError, match='SCRATCH_2 file systems have no per-unit storage throughput'):
+        AwsFsxHelper.build_lustre_create_args(['subnet-1'], deployment_type='SCRATCH_2',
+                                              per_unit_storage_throughput=200)
+
+
+def test_scratch_create_args_link_s3_by_import_path():
+    lustre = AwsFsxHelper.build_lustre_create_args(
+        ['subnet-1'], deployment_type='SCRATCH_2', import_path='s3://bucket/in', export_path='s3://bucket/out',
+        imported_file_chunk_size=1024, auto_import_policy='NEW_CHANGED')['LustreConfiguration']
+    assert lustre == {'DeploymentType': 'SCRATCH_2', 'DataCompressionType': 'LZ4', 'ImportPath': 's3://bucket/in',
+                      'ExportPath': 's3://bucket/out', 'ImportedFileChunkSize': 1024, 'AutoImportPolicy': 'NEW_CHANGED'}
+
+
+def test_export_settings_need_an_import_path():
+    lustre = AwsFsxHelper.build_lustre_create_args(['subnet-1'], deployment_type='PERSISTENT_1',
+                                                   export_path='s3://bucket/out')['LustreConfiguration']
+    assert 'ExportPath' not in lustre and 'ImportPath' not in lustre
+
+
+def test_data_repository_association_args():
+    assert AwsFsxHelper.build_data_repository_association_args('fs-1', 's3://bucket/prefix') == {
+        'FileSystemId': 'fs-1', 'FileSystemPath': '/', 'DataRepositoryPath': 's3://bucket/prefix',
+        'BatchImportMetaDataOnCreate': True}
+    args = AwsFsxHelper.build_data_repository_association_args(
+        'fs-1', 's3://bucket/prefix', file_system_path='/renders', batch_import_metadata=False,
+        imported_file_chunk_size=512, auto_import_events=['NEW', 'CHANGED'], auto_export_events=['NEW'])
+    assert args['FileSystemPath'] == '/renders'
+    assert args['BatchImportMetaDataOnCreate'] is False
+    assert args['ImportedFileChunkSize'] == 512
+    assert args['S3'] == {'AutoImportPolicy': {'Events': ['NEW', 'CHANGED']}, 'AutoExportPolicy': {'Events': ['NEW']}}
+
+
+def test_wait_for_lifecycle():
+    states = iter(['CREATING', 'CREATING', 'AVAILABLE'])
+    assert AwsFsxHelper.wait_for_lifecycle(lambda: {'Lifecycle': next(states)}, poll_interval=0) == {
+        'Lifecycle': 'AVAILABLE'}
+    with pytest.raises(ValueError, match='entered FAILED: no subnet'):
+        AwsFsxHelper.wait_for_lifecycle(lambda: {'Lifecycle': 'FAILED', 'FailureDetails': {'Message': 'no subnet'}})
+    with pytest.raises(ValueError, match='Timed out'):
+        AwsFsxHelper.wait_for_lifecycle(lambda: {'Lifecycle': 'CREATING'}, poll_interval=0, timeout=0)
+
+
+def test_persistent_2_links_s3_with_an_association():
+    client = FakeFsx()
+    result = EnvoiStorageFsxAwsCreateFileSystemCommand(auto_exec=False).create_lustre(
+        client, create_opts('--data-repository-path', 's3://bucket/prefix'))
+    assert [name for name, _ in client.calls] == ['create_file_system', 'describe_file_systems',
+                                                  'create_data_repository_association']
+    assert 'ImportPath' not in client.calls[0][1]['LustreConfiguration']
+    assert client.calls[2][1]['S3'] == {'AutoImportPolicy': {'Events': ['NEW', 'CHANGED', 'DELETED']}}
+    assert result == {'FileSystemId': 'fs-1', 'Lifecycle': 'AVAILABLE', 'AssociationId': 'dra-1',
+                      'AssociationLifecycle': 'CREATING',
+                      'MountCommand': 'sudo mount -t lustre -o relatime,flock fs-1.fsx.local@tcp:/abcd /fsx'}
+
+
+def test_other_deployment_types_link_s3_by_import_path():
+    client = FakeFsx()
+    result = EnvoiStorageFsxAwsCreateFileSystemCommand(auto_exec=False).create_lustre(
+        client, create_opts('--lustre-deployment-type', 'SCRATCH_2', '--data-repository-path', 's3://bucket/in'))
+    assert [name for name, _ in client.calls] == ['create_file_system']
+    lustre = client.calls[0][1]['LustreConfiguration']
+    assert (lustre['ImportPath'], lustre['AutoImportPolicy']) == ('s3://bucket/in', 'NEW_CHANGED_DELETED')
+    assert 'PerUnitStorageThroughput' not in lustre
+    assert result == {'FileSystemId': 'fs-1', 'Lifecycle': 'CREATING'}
+
+
+def test_import_path_policy_follows_the_auto_import_events():
+    for events, policy in [('NEW', 'NEW'), ('changed,new', 'NEW_CHANGED'), ('', 'NONE')]:
+        client = FakeFsx()
+        EnvoiStorageFsxAwsCreateFileSystemCommand(auto_exec=False).create_lustre(
+            client, create_opts('--lustre-deployment-type', 'PERSISTENT_1', '--data-repository-path', 's3://bucket/in',
+                                '--auto-import-events', events))
+        lustre = client.calls[0][1]['LustreConfiguration']
+        assert (lustre['AutoImportPolicy'], lustre['PerUnitStorageThroughput']) == (policy, 200)
+    client = FakeFsx()
+    with pytest.raises(ValueError, match='CHANGED,DELETED have no ImportPath equivalent'):
+        EnvoiStorageFsxAwsCreateFileSystemCommand(auto_exec=False).create_lustre(
+            client, create_opts('--lustre-deployment-type', 'SCRATCH_2', '--data-repository-path', 's3://bucket/in',
+                                '--auto-import-events', 'CHANGED,DELETED'))
+    assert client.calls == []
+
+
+@pytest.fixture
+def lfs(tmp_path):
+    # A stand-in lfs that logs its arguments and reports every file whose name starts with "r" as released.
+    log = tmp_path / 'lfs.log'
+    script = tmp_path / 'lfs'
+    script.write_text(f"""#!/bin/sh
+echo "$@" >> {log}
+if [ "$1" = hsm_state ]; then
+    shift
+    for f in "$@"; do
+        case "$(basename "$f")" in
+            r*) echo "$f: (0x0000000d) released exists archived" ;;
+            *) echo "$f: (0x00000009) exists archived" ;;
+        esac
+    done
+fi
+""")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script), log
+
+
+@pytest.fixture
+def namespace(tmp_path):
+    root = tmp_path / 'fsx'
+    for directory in ('a', 'a/b', 'c'):
+        (root / directory).mkdir(parents=True)
+    for path in ('a/r1', 'a/h1', 'a/b/r2', 'a/b/r3', 'c/h2', 'top'):
+        (root / path).write_bytes(b'')
+    return root
+
+
+def preload(lfs_command, *argv):
+    opts = EnvoiStorageFsxAwsPreloadCommand.init_parser().parse_args(
+        [*argv, '--lfs-command', lfs_command, '--batch-size', '2', '--progress-interval', '0'])
+    command = EnvoiStorageFsxAwsPreloadCommand(opts, auto_exec=False)
+    return command, command.run()
+
+
+def test_preload_restores_every_file_in_batches(lfs, namespace):
+    command, response = preload(lfs[0], str(namespace))
+    assert response.startswith('Restored 6 files')
+    calls = lfs[1].read_text().splitlines()
+    assert all(call.startswith('hsm_restore ') for call in calls)
+    restored = sorted(os.path.relpath(path, namespace) for call in calls for path in call.split()[1:])
+    assert restored == ['a/b/r2', 'a/b/r3', 'a/h1', 'a/r1', 'c/h2', 'top']
+    assert all(len(call.split()) <= 3 for call in calls)
+
+
+def test_preload_released_only(lfs, namespace):
+    command, response = preload(lfs[0], str(namespace), '--released-only')
+    assert response.startswith('Restored 3 files')
+    restored = sorted(os.path.basename(path) for call in lfs[1].read_text().splitlines()
+                      if call.startswith('hsm_restore') for path in call.split()[1:])
+    assert restored == ['r1', 'r2', 'r3']
+
+
+def test_preload_dry_run_and_failures(lfs, namespace, tmp_path):
+    _, response = preload(lfs[0], str(namespace), '--dry-run')
+    assert response.startswith('Would restore 6 files')
+    assert not lfs[1].exists()
+    _, response = preload(str(tmp_path / 'missing-lfs'), str(namespace))
+    assert response.endswith('3 failed batches')
@@ -0,0 +1,168 @@
+import builtins
+import json
+
+import pytest
+
+from envoi_storage import (AwsFsxHelper, AwsNetworkDiscovery, EnvoiStorageFsxAwsCreateFileSystemCommand,
+                           prompt_choice)
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeClient:
+    # Serves the paginated discovery calls of one region. Regions named "broken-*" fail every call.
+
+    def __init__(self, service_name, region):
+        self.service_name = service_name
+        self.region = region
+        self.created = []
+
+    def get_paginator(self, operation):
+        if self.region and self.region.startswith('broken'):
+            raise RuntimeError('AccessDenied')
+        pages = {
+            'get_parameters_by_path': lambda **kw: [{'Parameters': [{'Value': 'us-west-2'}]},
+                                                    {'Parameters': [{'Value': 'eu-west-1'}]}],
+            'describe_directories': lambda **kw: [{'DirectoryDescriptions': [
+                {'DirectoryId': f"d-{self.region}", 'Name': 'corp.example.com', 'Stage': 'Active',
+                 'VpcSettings': {'VpcId': 'vpc-1', 'SubnetIds': ['subnet-a']}}]}],
+            'describe_vpcs': lambda **kw: [{'Vpcs': [{'VpcId': 'vpc-1', 'CidrBlock': '10.0.0.0/16',
+                                                      'Tags': [{'Key': 'Name', 'Value': 'main'}]}]}],
+            'describe_subnets': lambda **kw: [{'Subnets': [
+                {'SubnetId': 'subnet-a', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-west-2a'},
+                {'SubnetId': 'subnet-b', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-west-2b'},
+                {'SubnetId': 'subnet-z', 'VpcId': 'vpc-2', 'AvailabilityZone': 'us-west-2a'}]}],
+        }
+        return FakePaginator(pages[operation])
+
+    def create_file_system(self, **kwargs):
+        self.created.append(kwargs)
+        return {'FileSystem': {'FileSystemId': 'fs-1', 'Lifecycle': 'CREATING'}}
+
+
+class FakeSession:
+    region_name = 'us-west-2'
+    profile_name = None
+
+    def __init__(self):
+        self.clients = []
+
+    def client(self, service_name, region_name=None, endpoint_url=None):
+        self.clients.append(FakeClient(service_name, region_name))
+        return self.clients[-1]
+
+
+@pytest.fixture
+def discovery(monkeypatch):
+    discovery = AwsNetworkDiscovery(session=FakeSession())
+    monkeypatch.setattr(AwsNetworkDiscovery, 'from_opts', classmethod(lambda cls, opts=None: discovery))
+    return discovery
+
+
+@pytest.fixture
+def answers(monkeypatch, capsys):
+    # Feeds the given answers to input() and getpass().
+    def feed(*values):
+        values = iter(values)
+        monkeypatch.setattr(builtins, 'input', lambda prompt='': next(values))
+        monkeypatch.setattr('getpass.getpass', lambda prompt='': next(values))
+    return feed
+
+
+def create(*argv, interactive=False):
+    opts = EnvoiStorageFsxAwsCreateFileSystemCommand.init_parser().parse_args([*argv] + (
+        [] if interactive else ['--no-input']))
+    command = EnvoiStorageFsxAwsCreateFileSystemCommand(opts, auto_exec=False)
+    return command, command.run()
+
+
+def test_prompt_choice_by_number_or_value(answers, capsys):
+    answers('3', 'b')
+    assert prompt_choice('Pick', ['a', 'b']) == 'b'
+    assert 'Invalid choice.' in capsys.readouterr().err
+    answers('2, a')
+    assert prompt_choice('Pick two', ['a', 'b', 'c'], count=2) == ['b', 'a']
+    with pytest.raises(ValueError, match='Nothing to choose from'):
+        prompt_choice('Pick', [])
+
+
+def test_windows_create_args():
+    args = AwsFsxHelper.build_windows_create_args(['subnet-a', 'subnet-b'], 'MULTI_AZ_1', active_directory_id='d-1',
+                                                  security_group_ids=['sg-1'], name='edit')
+    assert args == {'FileSystemType': 'WINDOWS', 'StorageCapacity': 32, 'StorageType': 'SSD',
+                    'SubnetIds': ['subnet-a', 'subnet-b'], 'SecurityGroupIds': ['sg-1'],
+                    'Tags': [{'Key': 'Name', 'Value': 'edit'}],
+                    'WindowsConfiguration': {'DeploymentType': 'MULTI_AZ_1', 'ThroughputCapacity': 32,
+                                             'ActiveDirectoryId': 'd-1', 'PreferredSubnetId': 'subnet-a'}}
+    self_managed = {'DomainName': 'ad.example.com', 'DnsIps': ['10.0.1.1'], 'UserName': 'admin', 'Password': 'pw'}
+    windows = AwsFsxHelper.build_windows_create_args(['subnet-a'], 'SINGLE_AZ_2',
+                                                     self_managed_active_directory=self_managed)
+    assert windows['WindowsConfiguration'] == {'DeploymentType': 'SINGLE_AZ_2', 'ThroughputCapacity': 32,
+                                               'SelfManagedActiveDirectoryConfiguration': self_managed}
+    with pytest.raises(ValueError, match='requires an Active Directory'):
+        AwsFsxHelper.build_windows_create_args(['subnet-a'], 'SINGLE_AZ_2')
+
+
+def test_ontap_create_args_and_masking():
+    args = AwsFsxHelper.build_ontap_create_args(['subnet-a'], 'SINGLE_AZ_1', fsx_admin_password='hunter2')
+    assert args['OntapConfiguration'] == {'DeploymentType': 'SINGLE_AZ_1', 'ThroughputCapacity': 128,
+                                          'FsxAdminPassword': 'hunter2'}
+    described = json.loads(EnvoiStorageFsxAwsCreateFileSystemCommand.describe_create_args(args))
+    assert described['OntapConfiguration']['FsxAdminPassword'] == '********'
+    assert args['OntapConfiguration']['FsxAdminPassword'] == 'hunter2'
+
+
+def test_discovery_fans_out_and_skips_failing_regions(discovery):
+    assert discovery.fsx_regions() == ['eu-west-1', 'us-west-2']
+    directories = discovery.directories(['us-west-2', 'broken-1', 'eu-west-1'])
+    assert [(d['DirectoryId'], d['Region'], d['VpcId']) for d in directories] == [
+        ('d-eu-west-1', 'eu-west-1', 'vpc-1'), ('d-us-west-2', 'us-west-2', 'vpc-1')]
+    vpcs, subnets = discovery.network('us-west-2')
+    assert vpcs == [{'VpcId': 'vpc-1', 'Name': 'main', 'CidrBlock': '10.0.0.0/16'}]
+    assert len(subnets) == 3
+    assert discovery.client('ec2', 'us-west-2') is discovery.client('ec2', 'us-west-2')
+
+
+def test_non_interactive_ontap(discovery):
+    _, response = create('--file-system-type', 'ONTAP', '--deployment-type', 'MULTI_AZ_1',
+                         '--subnet-ids', 'subnet-a,subnet-b', '--throughput-capacity', '256')
+    assert json.loads(response) == {'FileSystemId': 'fs-1', 'Lifecycle': 'CREATING'}
+    [fsx] = [client for client in discovery.session.clients if client.service_name == 'fsx']
+    assert fsx.region == 'us-west-2'
+    assert fsx.created[0]['OntapConfiguration']['ThroughputCapacity'] == 256
+    assert fsx.created[0]['StorageCapacity'] == 1024
+
+
+@pytest.mark.parametrize('argv, message', [
+    (['--file-system-type', 'WINDOWS', '--deployment-type', 'SINGLE_AZ_2', '--subnet-ids', 'subnet-a'],
+     '--active-directory-id or --ad-domain-name is required'),
+    (['--file-system-type', 'ONTAP', '--subnet-ids', 'subnet-a'], '--deployment-type is required'),
+    (['--file-system-type', 'ONTAP', '--deployment-type', 'MULTI_AZ_1', '--subnet-ids', 'subnet-a'],
+     'need exactly 2 subnet'),
+    (['--file-system-type', 'WINDOWS', '--deployment-type', 'MULTI_AZ_2', '--subnet-ids', 'subnet-a'],
+     'not a valid WINDOWS deployment type'),
+    (['--file-system-type', 'LUSTRE'], '--subnet-ids is required'),
+])
+def test_non_interactive_missing_values_fail(discovery, argv, message):
+    with pytest.raises(ValueError, match=message):
+        create(*argv)
+
+
+def test_interactive_windows_with_self_managed_ad(discovery, answers, monkeypatch):
+    monkeypatch.setattr('sys.stdin.isatty', lambda: True, raising=False)
+    answers('2', '1', '2', 'ad.example.com', '10.0.1.1, 10.0.2.2', 'admin', 's3cret', '1', '2', 'y')
+    _, response = create(interactive=True)
+    [fsx] = [client for client in discovery.session.clients if client.service_name == 'fsx']
+    configuration = fsx.created[0]['WindowsConfiguration']
+    assert configuration['DeploymentType'] == 'SINGLE_AZ_1'
+    assert configuration['SelfManagedActiveDirectoryConfiguration'] == {
+        'DomainName': 'ad.example.com', 'DnsIps': ['10.0.1.1', '10.0.2.2'], 'UserName': 'admin',
+        'Password': 's3cret'}
+    assert fsx.created[0]['SubnetIds'] == ['subnet-b']
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import re
+
+import pytest
+
+from envoi_storage import EnvoiStorageGenerateDatasetCommand, format_size, parse_size
+
+SPEC = {
+    "groups": [
+        {"name": "frames", "sequences": 2, "frames": 5, "pattern": "sh{seq:02d}/f.{frame:04d}.exr",
+         "size": {"median": "8KiB", "sigma": 0.2}, "fill": "pattern"},
+        {"name": "sidecars", "count": 6, "pattern": "meta/{index:03d}.xml",
+         "size": {"min": "100", "max": "4KiB"}, "fill": "pattern"},
+        {"name": "originals", "count": 2, "pattern": "camera/{index}.mxf", "size": "64KiB"},
+    ]
+}
+
+
+@pytest.fixture
+def spec_path(tmp_path):
+    path = tmp_path / 'spec.json'
+    path.write_text(json.dumps(SPEC))
+    return str(path)
+
+
+def generate(target, spec_path, *argv):
+    opts = EnvoiStorageGenerateDatasetCommand.init_parser().parse_args(
+        [str(target), '--spec', spec_path, '--progress-interval', '0', '--workers', '4', *argv])
+    return EnvoiStorageGenerateDatasetCommand(opts, auto_exec=False).run()
+
+
+def tree_digest(root):
+    # {relative path: (size, sha256)} of every file under root.
+    return {str(path.relative_to(root)): (path.stat().st_size, hashlib.sha256(path.read_bytes()).hexdigest())
+            for path in sorted(root.rglob('*')) if path.is_file()}
+
+
+@pytest.mark.parametrize('value, expected', [('512KiB', 512 * 1024), ('12MB', 12 * 1000 ** 2),
+                                             ('1.5GiB', int(1.5 * 1024 ** 3)), (' 7 ', 7), (4096, 4096)])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', '12 parsecs', 'MiB', '-1'])
+def test_parse_size_rejects_garbage(value):
+    with pytest.raises(ValueError, match='Invalid size'):
+        parse_size(value)
+
+
+def test_format_size():
+    assert format_size(512) == '512B'
+    assert format_size(1536) == '1.5KiB'
+    assert format_size(3 * 1024 ** 5) == '3,072.0TiB'
+
+
+def test_plan_is_deterministic_per_seed():
+    plan = EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=7)
+    assert plan == EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=7)
+    assert plan != EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=8)
+    assert [path for path, _, _ in plan[:3]] == ['sh00/f.0001.exr', 'sh00/f.0002.exr', 'sh00/f.0003.exr']
+    assert len(plan) == 10 + 6 + 2
+    assert plan[-1] == ('camera/1.mxf', 64 * 1024, 'sparse')
+    assert all(100 <= size <= 4096 for path, size, _ in plan if path.startswith('meta/'))
+
+
+def test_editing_one_group_keeps_the_others():
+    edited = dict(SPEC, groups=[dict(SPEC['groups'][0], frames=9)] + SPEC['groups'][1:])
+    sidecars = [entry for entry in EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=1) if entry[0][:5] == 'meta/']
+    assert [entry for entry in EnvoiStorageGenerateDatasetCommand.plan(edited, seed=1)
+            if entry[0][:5] == 'meta/'] == sidecars
+
+
+def test_scale_and_fill_override():
+    plan = EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=1, scale=2, fill_override='allocate')
+    assert len(plan) == 20 + 12 + 4
+    assert {fill for _, _, fill in plan} == {'allocate'}
+    with pytest.raises(ValueError, match='Unknown fill mode'):
+        EnvoiStorageGenerateDatasetCommand.plan(SPEC, fill_override='zeros')
+
+
+def test_plan_rejects_incomplete_groups_and_escaping_patterns():
+    originals = SPEC['groups'][2]
+    for group, message in [({'name': 'plates', 'pattern': 'p/{index}.exr', 'size': '1KiB'}, 'plates is missing count'),
+                           ({'sequences': 2, 'size': '1KiB'}, 'Group 0 is missing pattern, frames'),
+                           (dict(originals, pattern='../camera/{index}.mxf'), "'../camera/{index}.mxf' of group orig"),
+                           (dict(originals, pattern='camera/../../{index}.mxf'), 'outside the target directory'),
+                           (dict(originals, pattern='/tmp/{index}.mxf'), 'outside the target directory')]:
+        with pytest.raises(ValueError, match=re.escape(message)):
+            EnvoiStorageGenerateDatasetCommand.plan({'groups': [group]})
+    assert EnvoiStorageGenerateDatasetCommand.plan({'groups': [dict(originals, pattern='camera/../{index}.mxf')]})
+
+
+def test_same_seed_writes_the_same_tree(tmp_path, spec_path):
+    generate(tmp_path / 'a', spec_path, '--seed', '3')
+    generate(tmp_path / 'b', spec_path, '--seed', '3')
+    generate(tmp_path / 'c', spec_path, '--seed', '4')
+    first = tree_digest(tmp_path / 'a')
+    assert len(first) == 18
+    assert first == tree_digest(tmp_path / 'b')
+    assert first != tree_digest(tmp_path / 'c')
+    sizes = {path: size for path, size, _ in EnvoiStorageGenerateDatasetCommand.plan(SPEC, seed=3)}
+    assert {path: size for path, (size, _) in first.items()} == sizes
+
+
+def test_dry_run_writes_nothing(tmp_path, spec_path):
+    response = generate(tmp_path / 'out', spec_path, '--dry-run')
+    assert response.startswith('Would write 18 files')
+    assert not (tmp_path / 'out').exists()
@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from envoi_storage import DeploymentJournal, DeploymentRunner, EnvoiStorageRolloutCommand, EnvoiStorageResumeCommand
+from envoi_storage_standin import CloudFormationStandIn
+
+
+@pytest.fixture
+def cfn(cloudformation):
+    # Stacks complete on their third describe.
+    cloudformation.complete_after = 3
+    return cloudformation
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = DeploymentJournal(str(tmp_path / 'journal.sqlite'))
+    yield journal
+    journal.close()
+
+
+def runner(journal, fake_commands):
+    return DeploymentRunner(journal, poll_interval=0, parser=fake_commands.init_parser(),
+                            client_factory=lambda opts: fake_commands.cloudformation)
+
+
+def test_plan_rejects_duplicate_stacks(journal, fake_commands):
+    with pytest.raises(ValueError, match='more than once: a'):
+        runner(journal, fake_commands).plan([['create', '--stack-name', 'a'], ['create', '--stack-name', 'a']])
+
+
+def test_run_journals_every_stack(cfn, journal, fake_commands):
+    plan = runner(journal, fake_commands).plan([['create', '--stack-name', 'a'], ['create', '--stack-name', 'b']])
+    run_id = journal.create_run(plan)
+    assert runner(journal, fake_commands).run(run_id) == (2, 0, 0)
+    operations = journal.operations(run_id)
+    assert [(o['stack_name'], o['status'], o['stack_id']) for o in operations] == [
+        ('a', 'completed', 'stack/a'), ('b', 'completed', 'stack/b')]
+    assert operations[0]['argv'] == ['create', '--stack-name', 'a']
+    assert operations[0]['last_event'] == 'Node2 CREATE_COMPLETE'
+    assert journal.latest_unfinished_run() is None
+
+
+def test_resume_skips_completed_and_follows_in_flight_stacks(cfn, journal, fake_commands):
+    plan = runner(journal, fake_commands).plan([['create', '--stack-name', 'done'],
+                                                ['create', '--stack-name', 'creating'],
+                                                ['create', '--stack-name', 'bad-1']])
+    run_id = journal.create_run(plan)
+    # The first stack finished and the second was created before the previous process died.
+    journal.update(run_id, 0, status='completed', stack_id='stack/done')
+    cfn.create_stack(StackName='creating')
+    journal.update(run_id, 1, status='in_flight', stack_id='stack/creating', last_event_id='stack/creating-0')
+    cfn.creates.clear()
+
+    assert journal.latest_unfinished_run() == run_id
+    assert runner(journal, fake_commands).run(run_id) == (1, 1, 1)
+    assert cfn.creates == ['bad-1']
+    statuses = {o['stack_name']: (o['status'], o['error']) for o in journal.operations(run_id)}
+    assert statuses == {'done': ('completed', None), 'creating': ('completed', None),
+                        'bad-1': ('failed', 'bad-1 rejected')}
+
+
+def test_resume_recreates_failed_stacks(journal, fake_commands, monkeypatch):
+    cloudformation = CloudFormationStandIn(create_seconds=0, delete_seconds=0, failure_rate=1)
+    monkeypatch.setattr(fake_commands, 'cloudformation', cloudformation)
+    run_id = journal.create_run(runner(journal, fake_commands).plan([['create', '--stack-name', 'a']]))
+    # The first attempt's stack rolled back.
+    failed_id = cloudformation.create_stack(StackName='a', TemplateBody='{}')['StackId']
+    journal.update(run_id, 0, status='failed', stack_id=failed_id)
+    cloudformation.failure_rate = 0
+
+    assert runner(journal, fake_commands).run(run_id) == (1, 0, 0)
+    operation = journal.operations(run_id)[0]
+    assert operation['status'] == 'completed' and operation['stack_id'] != failed_id
+    assert cloudformation.describe_stacks(StackName=failed_id)['Stacks'][0]['StackStatus'] == 'DELETE_COMPLETE'
+    assert cloudformation.describe_stacks(StackName='a')['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE'
+
+
+def test_stacks_deleted_while_followed_are_created_again(journal, fake_commands, monkeypatch):
+    cloudformation = CloudFormationStandIn(create_seconds=0, delete_seconds=0)
+    monkeypatch.setattr(fake_commands, 'cloudformation', cloudformation)
+    run_id = journal.create_run(runner(journal, fake_commands).plan([['create', '--stack-name', 'a']]))
+    # Someone deleted the stack while it was being followed.
+    deleted_id = cloudformation.create_stack(StackName='a', TemplateBody='{}')['StackId']
+    cloudformation.delete_stack(StackName=deleted_id)
+    journal.update(run_id, 0, status='in_flight', stack_id=deleted_id)
+    with pytest.raises(ValueError, match='Stack a is DELETE_COMPLETE'):
+        runner(journal, fake_commands).follow(run_id, journal.operations(run_id)[0], cloudformation)
+
+    assert runner(journal, fake_commands).run(run_id) == (1, 0, 0)
+    operation = journal.operations(run_id)[0]
+    assert operation['status'] == 'completed' and operation['stack_id'] != deleted_id
+    assert cloudformation.describe_stacks(StackName='a')['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE'
+
+
+def test_rollout_and_resume_commands(tmp_path, monkeypatch):
+    plan = tmp_path / 'plan.json'
+    plan.write_text(json.dumps({'stacks': [{'command': ['qumulo', 'aws', 'create-cluster']}]}))
+    monkeypatch.setattr(DeploymentRunner, 'plan', lambda self, argvs: [('q1', argvs[0])])
+    monkeypatch.setattr(DeploymentRunner, 'run', lambda self, run_id: (0, 1, 0))
+    opts = EnvoiStorageRolloutCommand.init_parser().parse_args([str(plan), '--journal', str(tmp_path / 'j.sqlite')])
+    response = EnvoiStorageRolloutCommand(opts, auto_exec=False).run()
+    assert response.endswith("1 failed. Run 'resume --run-id " + response.split()[1][:-1] + "' to retry them")
+
+    opts = EnvoiStorageResumeCommand.init_parser().parse_args(['--journal', str(tmp_path / 'j.sqlite')])
+    assert EnvoiStorageResumeCommand(opts, auto_exec=False).run().endswith('0 already complete, 1 failed')
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from envoi_storage import (AwsCapacityPreflight, AwsNetworkDiscovery, DeploymentResult, HammerspaceClusterConfig,
+                           QumuloClusterConfig, StorageDeployer, WekaClusterConfig)
+
+
+class FakeCloudFormation:
+
+    def __init__(self):
+        self.stacks = []
+
+    def create_stack(self, **kwargs):
+        if kwargs['StackName'] == 'bad':
+            raise ValueError('bad rejected')
+        self.stacks.append(kwargs)
+        return {'StackId': f"stack/{kwargs['StackName']}"}
+
+
+@pytest.fixture
+def deployer():
+    created = []
+
+    def client_factory(service_name, opts=None):
+        created.append((service_name, getattr(opts, 'aws_region', None)))
+        return FakeCloudFormation()
+
+    with StorageDeployer(max_workers=2, client_factory=client_factory) as deployer:
+        deployer.created = created
+        yield deployer
+
+
+def test_configs_build_command_options():
+    opts = WekaClusterConfig(key_name='key', subnet_id='subnet-1', vpc_id='vpc-1', backend_instance_count=8,
+                             options={'client_ami_id': 'ami-1'}).to_opts()
+    assert (opts.template_param_key_name, opts.template_param_subnet_id) == ('key', 'subnet-1')
+    assert (opts.backend_instance_count, opts.client_ami_id, opts.stack_name) == (8, 'ami-1', 'Weka')
+    assert opts.skip_preflight is False
+    with pytest.raises(ValueError, match='WekaClusterConfig is missing key_name, subnet_id'):
+        WekaClusterConfig(vpc_id='vpc-1').to_opts()
+    with pytest.raises(ValueError, match='qs_s3_bucket_name'):
+        QumuloClusterConfig(vpc_id='vpc-1').to_opts()
+
+
+def test_deploy_returns_structured_results_and_reuses_clients(deployer):
+    first = deployer.deploy(HammerspaceClusterConfig(stack_name='hs-1', dsx_node_instance_count=4,
+                                                     aws_region='us-west-2'))
+    second = deployer.deploy(WekaClusterConfig(stack_name='weka-1', key_name='key', subnet_id='subnet-1',
+                                               vpc_id='vpc-1', template_url='https://templates/weka.json',
+                                               aws_region='us-west-2'))
+    assert first == DeploymentResult(vendor='hammerspace', stack_name='hs-1', stack_id='stack/hs-1',
+                                     template_url=first.template_url)
+    assert second.stack_id == 'stack/weka-1' and second.template_url == 'https://templates/weka.json'
+    assert deployer.created == [('cloudformation', 'us-west-2')]
+    cfn = deployer.client('cloudformation', WekaClusterConfig(aws_region='us-west-2'))
+    assert [stack['StackName'] for stack in cfn.stacks] == ['hs-1', 'weka-1']
+
+
+def test_qumulo_deploy_validates_the_network(monkeypatch):
+    checks = []
+    monkeypatch.setattr(AwsNetworkDiscovery, 'validate_network_from_opts',
+                        classmethod(lambda cls, opts, vpc_id, subnet_ids, discovery: checks.append(
+                            (vpc_id, subnet_ids, discovery))))
+    monkeypatch.setattr(AwsCapacityPreflight, 'check_from_opts',
+                        classmethod(lambda cls, opts, requirements, discovery, **kw: checks.append(
+                            (requirements, discovery))))
+    discoveries = []
+    deployer = StorageDeployer(client_factory=lambda service_name, opts=None: FakeCloudFormation(),
+                               discovery_factory=lambda opts: discoveries.append(opts.aws_region) or object())
+    for name in ('q1', 'q2'):
+        result = deployer.deploy(QumuloClusterConfig(stack_name=name, qs_s3_bucket_name='b', qs_s3_key_prefix='p/',
+                                                     qs_s3_region='us-east-1', key_pair_name='key', env_type='prod',
+                                                     vpc_id='vpc-1', private_subnet_id='subnet-1',
+                                                     q_cluster_name=name, q_cluster_admin_pwd='secret',
+                                                     aws_region='us-west-2'))
+        assert result.stack_name == name and result.ok
+    # Both deployments share one discovery object, and so its cached session and EC2 clients.
+    assert discoveries == ['us-west-2']
+    discovery = deployer.discovery(QumuloClusterConfig(aws_region='us-west-2'))
+    assert checks == [('vpc-1', ['subnet-1'], discovery), ({'m6idn.xlarge': 4}, discovery)] * 2
+
+
+def test_configs_reuse_parser_defaults(monkeypatch):
+    WekaClusterConfig(key_name='key', subnet_id='subnet-1', vpc_id='vpc-1').to_opts()
+    monkeypatch.setattr(WekaClusterConfig.command_class, 'init_parser',
+                        classmethod(lambda cls, **kwargs: pytest.fail('parser rebuilt')))
+    first = WekaClusterConfig(key_name='key', subnet_id='subnet-1', vpc_id='vpc-1').to_opts()
+    second = WekaClusterConfig(key_name='key', subnet_id='subnet-2', vpc_id='vpc-1').to_opts()
+    assert (first.template_param_subnet_id, second.template_param_subnet_id) == ('subnet-1', 'subnet-2')
+
+
+def test_deploy_many_and_async(deployer):
+    results = deployer.deploy_many([HammerspaceClusterConfig(stack_name='a'),
+                                    HammerspaceClusterConfig(stack_name='bad')])
+    assert [(r.stack_name, r.ok, r.error) for r in results] == [('a', True, None), ('bad', False, 'bad rejected')]
+
+    async def deploy_both():
+        return await asyncio.gather(deployer.deploy_async(HammerspaceClusterConfig(stack_name='c')),
+                                    deployer.deploy_async(HammerspaceClusterConfig(stack_name='d')))
+    assert [r.stack_id for r in asyncio.run(deploy_both())] == ['stack/c', 'stack/d']
@@ -0,0 +1,193 @@
+import base64
+import hashlib
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+from envoi_storage import (EnvoiStorageOciObjectStorageCreateBucketCommand, EnvoiStorageOciObjectStorageUploadCommand,
+                           OciApiError, OciMultipartUploader, OciObjectStorageClient)
+
+MIB = 1024 ** 2
+
+
+class ObjectStorageStandIn:
+    # The Object Storage API calls the upload commands make, kept in memory.
+
+    def __init__(self):
+        self.buckets = {}
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def md5(data):
+        return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+    def start_upload(self, object_name, parts=None):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = {'object': object_name, 'parts': dict(parts or {}),
+                                   'timeCreated': f"2026-01-01T00:00:{len(self.uploads):02d}Z"}
+        return upload_id
+
+    def handle(self, method, path, query, body):
+        # Returns (status, JSON-serialisable body or None, headers).
+        parts = path.strip('/').split('/')
+        with self.lock:
+            self.requests.append((method, path, dict(query)))
+            if parts == ['n']:
+                return 200, 'testns', {}
+            if method == 'POST' and parts[2:] == ['b']:
+                bucket = json.loads(body)
+                self.buckets[bucket['name']] = bucket
+                return 200, bucket, {}
+            bucket = parts[3]
+            if bucket not in self.buckets:
+                return 404, {'code': 'BucketNotFound', 'message': f"{bucket} not found"}, {}
+            if parts[4] == 'o' and method == 'PUT':
+                self.objects[(bucket, urllib.parse.unquote(parts[5]))] = body
+                return 200, None, {'etag': self.md5(body)}
+            if len(parts) == 5 and method == 'POST':
+                upload_id = self.start_upload(json.loads(body)['object'])
+                return 200, {'uploadId': upload_id}, {}
+            if len(parts) == 5 and method == 'GET':
+                return 200, [{'object': u['object'], 'uploadId': upload_id, 'timeCreated': u['timeCreated']}
+                             for upload_id, u in self.uploads.items()], {}
+            upload = self.uploads[query['uploadId']]
+            if method == 'PUT':
+                etag = f"etag-{query['uploadPartNum']}-{self.md5(body)}"
+                upload['parts'][int(query['uploadPartNum'])] = body
+                return 200, None, {'etag': etag}
+            if method == 'GET':
+                return 200, [{'partNumber': number, 'size': len(data), 'md5': self.md5(data),
+                              'etag': f"etag-{number}-{self.md5(data)}"}
+                             for number, data in sorted(upload['parts'].items())], {}
+            if method == 'POST':
+                committed = json.loads(body)['partsToCommit']
+                for part in committed:
+                    data = upload['parts'][part['partNum']]
+                    assert part['etag'] == f"etag-{part['partNum']}-{self.md5(data)}"
+                self.objects[(bucket, upload['object'])] = b''.join(
+                    upload['parts'][part['partNum']] for part in committed)
+                del self.uploads[query['uploadId']]
+                return 200, None, {}
+        return 400, {'code': 'NotImplemented'}, {}
+
+
+class ObjectStorageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        status, payload, headers = self.server.standin.handle(
+            self.command, url.path, dict(urllib.parse.parse_qsl(url.query)), body)
+        data = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def object_storage():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ObjectStorageHandler)
+    server.standin = ObjectStorageStandIn()
+    server.standin.buckets['media'] = {'name': 'media'}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.standin, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def oci_args(endpoint):
+    return ['--oci-endpoint', endpoint, '--oci-auth', 'none']
+
+
+def upload(endpoint, *argv):
+    opts = EnvoiStorageOciObjectStorageUploadCommand.init_parser().parse_args(
+        [*argv, *oci_args(endpoint), '--bucket', 'media', '--progress-interval', '0', '--workers', '4'])
+    return EnvoiStorageOciObjectStorageUploadCommand(opts, auto_exec=False).run()
+
+
+@pytest.mark.parametrize('size, workers, part_size, expected', [
+    (100 * MIB, 16, None, 16 * MIB),
+    (1024 * MIB, 16, None, 32 * MIB),
+    (100 * 1024 * MIB, 16, None, 128 * MIB),
+    (100 * MIB, 16, 5 * MIB, 10 * MIB),
+    (100 * MIB, 16, 20 * MIB + 1, 21 * MIB),
+    (10 * 1024 ** 4, 16, 64 * MIB, 1049 * MIB),
+    (10 ** 15, 16, None, 50 * 1024 ** 3),
+])
+def test_choose_part_size(size, workers, part_size, expected):
+    chosen = OciMultipartUploader.choose_part_size(size, workers, part_size)
+    assert chosen == expected
+    assert chosen % MIB == 0
+
+
+def test_create_bucket_looks_up_the_namespace(object_storage):
+    standin, endpoint = object_storage
+    opts = EnvoiStorageOciObjectStorageCreateBucketCommand.init_parser().parse_args(
+        [*oci_args(endpoint), '--name', 'renders', '--compartment-id', 'ocid1.compartment.oc1..x'])
+    response = EnvoiStorageOciObjectStorageCreateBucketCommand(opts, auto_exec=False).run()
+    assert response == "Bucket 'renders' created in namespace 'testns'."
+    assert standin.buckets['renders']['compartmentId'] == 'ocid1.compartment.oc1..x'
+
+
+def test_uploads_small_and_multipart_objects(object_storage, tmp_path):
+    standin, endpoint = object_storage
+    (tmp_path / 'show' / 'edit').mkdir(parents=True)
+    (tmp_path / 'show' / 'notes.txt').write_bytes(b'notes')
+    big = bytes(range(256)) * (25 * MIB // 256)
+    (tmp_path / 'show' / 'edit' / 'cut.mov').write_bytes(big)
+    response = upload(endpoint, str(tmp_path / 'show'), '--prefix', 'jobs/', '--multipart-threshold', '1KiB',
+                      '--part-size', '10MiB')
+    assert response.startswith('Uploaded 2 objects (25.0MiB) to testns/media')
+    assert standin.objects[('media', 'jobs/show/notes.txt')] == b'notes'
+    assert standin.objects[('media', 'jobs/show/edit/cut.mov')] == big
+    assert sum(1 for method, path, query in standin.requests if 'uploadPartNum' in query) == 3
+
+
+def test_resume_reuses_matching_committed_parts(object_storage, tmp_path):
+    standin, endpoint = object_storage
+    data = b''.join(bytes([i]) * (10 * MIB) for i in range(3))
+    (tmp_path / 'plate.exr').write_bytes(data)
+    # An earlier run committed parts 1 and 2, but part 2 with different content.
+    standin.start_upload('plate.exr', {1: data[:10 * MIB], 2: b'x' * (10 * MIB)})
+    response = upload(endpoint, str(tmp_path / 'plate.exr'), '--multipart-threshold', '1KiB', '--part-size', '10MiB')
+    assert response.endswith('1 committed parts reused')
+    sent = sorted(int(query['uploadPartNum']) for method, path, query in standin.requests if 'uploadPartNum' in query)
+    assert sent == [2, 3]
+    assert standin.objects[('media', 'plate.exr')] == data
+    assert standin.uploads == {}
+
+
+def test_no_resume_starts_a_new_upload(object_storage, tmp_path):
+    standin, endpoint = object_storage
+    data = b'y' * (11 * MIB)
+    (tmp_path / 'plate.exr').write_bytes(data)
+    stale = standin.start_upload('plate.exr', {1: data[:10 * MIB]})
+    upload(endpoint, str(tmp_path / 'plate.exr'), '--multipart-threshold', '1KiB', '--part-size', '10MiB',
+           '--no-resume')
+    assert stale in standin.uploads
+    assert standin.objects[('media', 'plate.exr')] == data
+
+
+def test_api_errors_are_raised(object_storage, tmp_path):
+    _, endpoint = object_storage
+    client = OciObjectStorageClient(endpoint)
+    with pytest.raises(OciApiError, match='404 BucketNotFound: missing not found') as error:
+        client.put_object('testns', 'missing', 'a', b'data')
+    assert error.value.status == 404
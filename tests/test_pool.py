@@ -0,0 +1,129 @@
+import json
+import time
+
+import pytest
+
+from envoi_storage import (EnvoiStoragePoolAssignCommand, EnvoiStoragePoolListCommand, StandbyPoolLedger,
+                           StandbyPoolManager)
+
+
+class FakeProbe:
+    # Nodes starting with 10.9. never come up.
+    probed = []
+
+    def __init__(self, nodes, ports):
+        self.nodes = nodes
+        FakeProbe.probed.append((nodes, ports))
+
+    def wait(self, timeout, stop):
+        if any(node.startswith('10.9.') for node in self.nodes):
+            raise ValueError(f"Only 0 of {len(self.nodes)} nodes became ready")
+        return self.nodes
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = StandbyPoolLedger(str(tmp_path / 'pool.sqlite'))
+    yield ledger
+    ledger.close()
+
+
+def manager(ledger, fake_commands, pools=None, poll_interval=0, **kwargs):
+    return StandbyPoolManager(ledger, pools, poll_interval=poll_interval, parser=fake_commands.init_parser(),
+                              client_factory=lambda opts: fake_commands.cloudformation, **kwargs)
+
+
+def test_load_pools(tmp_path):
+    path = tmp_path / 'pools.json'
+    path.write_text(json.dumps({'pools': [{'name': 'weka-small', 'size': 2, 'command': ['create']}]}))
+    assert StandbyPoolManager.load_pools(str(path)) == {
+        'weka-small': {'size': 2, 'command': ['create'], 'max_age_hours': 168.0}}
+    path.write_text(json.dumps({'pools': [{'name': 'weka-small'}]}))
+    with pytest.raises(ValueError, match='needs a name and a command'):
+        StandbyPoolManager.load_pools(str(path))
+
+
+def test_pools_are_filled_assigned_and_replenished(ledger, fake_commands, cloudformation):
+    pools = {'weka': {'size': 2, 'command': ['create'], 'max_age_hours': 1}}
+    pool = manager(ledger, fake_commands, pools)
+    assert pool.maintain() == {'weka': (2, 0)}
+    pool.close()
+    # Members are assigned oldest first.
+    members = sorted(ledger.members('weka'), key=lambda member: member['ready_at'])
+    assert [m['state'] for m in members] == ['available', 'available']
+    assert members[0]['outputs'] == {'ManagementUrl': f"https://{members[0]['stack_name']}"}
+
+    pool = manager(ledger, fake_commands, pools)
+    assigned = pool.assign('weka', 'show01')
+    assert assigned['stack_name'] == members[0]['stack_name'] and assigned['assigned_to'] == 'show01'
+    assert cloudformation.updates == [{'StackName': assigned['stack_id'], 'UsePreviousTemplate': True,
+                                       'Parameters': [{'ParameterKey': 'VpcId', 'UsePreviousValue': True}],
+                                       'Tags': [{'Key': 'envoi:vendor', 'Value': 'weka'},
+                                                {'Key': 'envoi:pool', 'Value': 'weka'},
+                                                {'Key': 'envoi:assigned-to', 'Value': 'show01'}]}]
+    assert pool.assign('weka', 'show02')['stack_name'] == members[1]['stack_name']
+    with pytest.raises(ValueError, match='No cluster is available in pool weka'):
+        pool.assign('weka', 'show03')
+    assert pool.maintain() == {'weka': (2, 0)}
+    pool.close()
+    assert [m['state'] for m in ledger.members('weka')] == ['assigned', 'assigned', 'available', 'available']
+
+
+def test_failed_and_stale_members_are_deleted(ledger, fake_commands, cloudformation):
+    pools = {'rolled-back': {'size': 1, 'command': ['create', '--fail'], 'max_age_hours': 1},
+             'good': {'size': 1, 'command': ['create'], 'max_age_hours': 1}}
+    pool = manager(ledger, fake_commands, pools)
+    pool.maintain()
+    pool.close()
+    failed = ledger.members('rolled-back')[0]
+    assert failed['state'] == 'failed' and 'ROLLBACK_COMPLETE' in failed['error']
+    assert pool.expire('rolled-back') == [failed['stack_name']]
+    good = ledger.members('good')[0]
+    assert pool.expire('good') == []
+    assert pool.expire('good', now=good['ready_at'] + 3601) == [good['stack_name']]
+    assert cloudformation.deletes == [failed['stack_id'], good['stack_id']]
+    assert ledger.members() == []
+
+
+def test_members_are_only_available_once_serving(ledger, fake_commands):
+    FakeProbe.probed = []
+    pools = {'serving': {'size': 1, 'command': ['create-weka', '--nodes', '10.0.0.1,10.0.0.2'], 'max_age_hours': 1},
+             'down': {'size': 1, 'command': ['create-weka', '--nodes', '10.9.0.1'], 'max_age_hours': 1},
+             'no-nodes': {'size': 1, 'command': ['create-weka'], 'max_age_hours': 1}}
+    pool = manager(ledger, fake_commands, pools, probe_factory=FakeProbe)
+    pool.maintain()
+    pool.close()
+    states = {member['pool']: (member['state'], member['error']) for member in ledger.members()}
+    assert states['serving'] == ('available', None)
+    assert states['down'] == ('failed', 'Only 0 of 1 nodes became ready')
+    assert states['no-nodes'][0] == 'failed' and 'No node addresses' in states['no-nodes'][1]
+    # The NFS and Weka management ports are probed, as `weka aws wait-ready` does.
+    assert sorted(FakeProbe.probed) == [(['10.0.0.1', '10.0.0.2'], [2049, 14000]), (['10.9.0.1'], [2049, 14000])]
+
+
+def test_stop_leaves_members_provisioning(ledger, fake_commands, cloudformation):
+    cloudformation.complete_after = 10
+    pools = {'weka': {'size': 3, 'command': ['create'], 'max_age_hours': 1}}
+    pool = manager(ledger, fake_commands, pools, poll_interval=30, workers=2)
+    pool.maintain()
+    while len(cloudformation.stacks) < 2:
+        time.sleep(0.01)
+    started = time.monotonic()
+    pool.stop()
+    pool.close()
+    # The workers stop polling straight away, and the members are followed again by the next pass.
+    assert time.monotonic() - started < 5
+    assert [member['state'] for member in ledger.members('weka')] == ['provisioning'] * 3
+    assert len(cloudformation.stacks) == 2
+
+
+def test_pool_commands(ledger):
+    ledger.add('weka', 'weka-1', ['create', '--stack-name', 'weka-1'])
+    ledger.update('weka-1', state='available', stack_id='stack/weka-1', ready_at=1.0, outputs={'Url': 'https://x'})
+    opts = EnvoiStoragePoolListCommand.init_parser().parse_args(['--ledger', ledger.path])
+    assert EnvoiStoragePoolListCommand(opts, auto_exec=False).run() == 'weka weka-1 available'
+    opts = EnvoiStoragePoolAssignCommand.init_parser().parse_args(['weka', '--requester', 'show01',
+                                                                   '--ledger', ledger.path])
+    # Tagging needs the real create commands; a failure to tag is only a warning.
+    assert json.loads(EnvoiStoragePoolAssignCommand(opts, auto_exec=False).run()) == {
+        'stack_name': 'weka-1', 'stack_id': 'stack/weka-1', 'outputs': {'Url': 'https://x'}, 'assigned_to': 'show01'}
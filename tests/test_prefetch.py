@@ -0,0 +1,146 @@
+import io
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+from envoi_storage import EnvoiStoragePrefetchCommand, FramePrefetcher, FrameSequence, LruByteCache
+
+
+@pytest.fixture
+def frames(tmp_path):
+    # Twenty 1 KiB frames, sh010.0101.exr to sh010.0120.exr, each filled with its own frame number.
+    for frame in range(101, 121):
+        (tmp_path / f"sh010.{frame:04d}.exr").write_bytes(frame.to_bytes(2, 'big') * 512)
+    return FrameSequence.parse(str(tmp_path / 'sh010.%04d.exr'))
+
+
+def settle(prefetcher, timeout=5):
+    # Waits for every scheduled prefetch to finish.
+    deadline = time.monotonic() + timeout
+    while prefetcher.inflight and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert not prefetcher.inflight
+
+
+def test_lru_byte_cache_evicts_least_recently_used_bytes():
+    cache = LruByteCache(10)
+    assert cache.put('a', b'xxxx') and cache.put('b', b'xxxx')
+    cache.get('a')
+    cache.put('c', b'xxxx')
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert (cache.current_bytes, cache.evictions) == (8, 1)
+    assert cache.put('warm', None, size=2)
+    assert cache.pop('warm', 'missing') is None
+    assert cache.put('huge', b'x' * 11) is False
+    assert cache.current_bytes == 8
+
+
+@pytest.mark.parametrize('pattern, prefix, padding, suffix', [
+    ('/shots/sh010.%04d.exr', 'sh010.', 4, '.exr'),
+    ('/shots/sh010.####.exr', 'sh010.', 4, '.exr'),
+    ('/shots/sh010.%d.dpx', 'sh010.', 1, '.dpx'),
+    ('/shots/sh010_00017.exr', 'sh010_', 5, '.exr'),
+    ('/shots/plate.1001', 'plate.', 4, ''),
+])
+def test_frame_sequence_parse(pattern, prefix, padding, suffix):
+    sequence = FrameSequence.parse(pattern)
+    assert (sequence.directory, sequence.prefix, sequence.padding, sequence.suffix) == (
+        '/shots', prefix, padding, suffix)
+
+
+def test_frame_sequence_paths_and_range(frames):
+    assert FrameSequence.parse('/shots/readme.txt') is None
+    assert frames.path(7).endswith('sh010.0007.exr')
+    assert frames.frame_of(frames.path(113)) == 113
+    assert frames.frame_of('sh011.0113.exr') is None
+    assert frames.scan_range() == (101, 120)
+
+
+def test_buffer_mode_serves_frames_ahead_from_memory(frames):
+    frames.scan_range()
+    with FramePrefetcher(window=4, workers=2, cache_bytes=1024 ** 2, mode='buffer') as prefetcher:
+        assert prefetcher.read(frames.path(101)) == (101).to_bytes(2, 'big') * 512
+        settle(prefetcher)
+        for frame in range(102, 106):
+            assert prefetcher.read(frames.path(frame)) == frame.to_bytes(2, 'big') * 512
+        stats = prefetcher.stats()
+    assert (stats['hits'], stats['misses']) == (4, 1)
+    assert stats['hit_rate'] == pytest.approx(0.8)
+    assert stats['bytes_prefetched'] == stats['prefetched'] * 1024
+
+
+def test_window_stops_at_the_last_frame(frames):
+    frames.scan_range()
+    with FramePrefetcher(window=10, workers=2, mode='buffer') as prefetcher:
+        prefetcher.advance(frames.path(117))
+        settle(prefetcher)
+        assert prefetcher.stats()['prefetched'] == 3
+
+
+def test_page_cache_mode_only_tracks_warm_frames(frames):
+    frames.scan_range()
+    with FramePrefetcher(window=3, workers=2, mode='page-cache') as prefetcher:
+        prefetcher.touch(frames.path(101))
+        settle(prefetcher)
+        assert prefetcher.cache.current_bytes == 3 * 1024
+        prefetcher.touch(frames.path(102))
+        stats = prefetcher.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_frames_touched_while_in_flight_are_not_cached(frames):
+    frames.scan_range()
+    started, release = threading.Event(), threading.Event()
+    with FramePrefetcher(window=2, workers=1, mode='buffer') as prefetcher:
+        load = prefetcher.load
+
+        def slow_load(path):
+            started.set()
+            release.wait(5)
+            return load(path)
+
+        prefetcher.load = slow_load
+        prefetcher.advance(frames.path(101))
+        assert started.wait(5)
+        # 102 is being read and 103 is still queued: the queued fetch is cancelled, the running one is dropped.
+        prefetcher.touch(frames.path(102))
+        prefetcher.touch(frames.path(103))
+        release.set()
+        settle(prefetcher)
+        assert frames.path(102) not in prefetcher.cache and frames.path(103) not in prefetcher.cache
+        assert not prefetcher.discarded
+        stats = prefetcher.stats()
+    assert (stats['hits'], stats['misses']) == (0, 2)
+
+
+def test_missing_frames_count_as_prefetch_errors(tmp_path):
+    sequence = FrameSequence.parse(str(tmp_path / 'gap.%04d.exr'))
+    with FramePrefetcher(window=2, workers=1, mode='buffer') as prefetcher:
+        prefetcher.advance(sequence.path(1))
+        settle(prefetcher)
+        assert prefetcher.stats()['prefetch_errors'] == 2
+
+
+def test_prefetch_command_follows_stdin(frames, monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('101\n\n102\n103\n'))
+    opts = EnvoiStoragePrefetchCommand.init_parser().parse_args(
+        [frames.key, '--follow-stdin', '--window', '2', '--workers', '1', '--mode', 'buffer'])
+    stats = json.loads(EnvoiStoragePrefetchCommand(opts, auto_exec=False).run())
+    assert stats['hits'] + stats['misses'] == 3
+
+
+def test_prefetch_command_counts_clock_frames(frames):
+    opts = EnvoiStoragePrefetchCommand.init_parser().parse_args(
+        [frames.key, '--fps', '1000', '--start-frame', '115', '--window', '2', '--workers', '2', '--mode', 'buffer'])
+    stats = json.loads(EnvoiStoragePrefetchCommand(opts, auto_exec=False).run())
+    # Frames 115 to 120 pass the playhead; the first one is never prefetched.
+    assert stats['hits'] + stats['misses'] == 6 and stats['misses'] >= 1
+
+
+def test_prefetch_command_needs_a_sequence(tmp_path):
+    opts = EnvoiStoragePrefetchCommand.init_parser().parse_args([str(tmp_path / 'none.%04d.exr')])
+    with pytest.raises(ValueError, match='No frames found'):
+        EnvoiStoragePrefetchCommand(opts, auto_exec=False).run()
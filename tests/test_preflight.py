@@ -0,0 +1,124 @@
+import pytest
+
+from envoi_storage import AwsCapacityPreflight, AwsNetworkDiscovery, EnvoiStorageWekaAwsCreateStackCommand
+from envoi_storage_standin import AwsStandInError
+
+OFFERINGS = {'i3en.6xlarge': ['us-east-1a', 'us-east-1b'], 'g5.12xlarge': ['us-east-1b', 'us-east-1c']}
+VCPUS = {'i3en.6xlarge': 24, 'g5.12xlarge': 48, 'm5.large': 2}
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeClient:
+
+    def __init__(self, session, service_name):
+        self.session = session
+        self.service_name = service_name
+
+    def get_paginator(self, operation):
+        self.session.calls.append(operation)
+        if operation == 'describe_instance_type_offerings':
+            return FakePaginator(lambda **kw: [{'InstanceTypeOfferings': [
+                {'Location': zone} for zone in OFFERINGS.get(kw['Filters'][0]['Values'][0], [])]}])
+        if operation == 'describe_instances':
+            return FakePaginator(lambda **kw: [{'Reservations': [{'Instances': [
+                {'InstanceType': 'm5.large'}, {'InstanceType': 'g5.12xlarge'}]}]}])
+        return FakePaginator(lambda **kw: [{'Subnets': [
+            {'SubnetId': 'subnet-a', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-1a'},
+            {'SubnetId': 'subnet-b', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-1b'}]}])
+
+    def describe_instance_types(self, InstanceTypes):
+        self.session.calls.append('describe_instance_types')
+        return {'InstanceTypes': [{'VCpuInfo': {'DefaultVCpus': VCPUS[InstanceTypes[0]]}}]}
+
+    def get_service_quota(self, ServiceCode, QuotaCode):
+        self.session.calls.append('get_service_quota')
+        if QuotaCode not in self.session.quotas:
+            raise AwsStandInError('NoSuchResourceException', 'The quota does not exist')
+        return {'Quota': {'Value': self.session.quotas[QuotaCode]}}
+
+    def get_aws_default_service_quota(self, ServiceCode, QuotaCode):
+        return {'Quota': {'Value': 64.0}}
+
+
+class FakeSession:
+    region_name = 'us-east-1'
+    profile_name = None
+
+    def __init__(self):
+        self.calls = []
+        self.quotas = {'L-1216C47A': 512.0}
+
+    def client(self, service_name, **kwargs):
+        return FakeClient(self, service_name)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession()
+    discovery = AwsNetworkDiscovery(session=session)
+    monkeypatch.setattr(AwsNetworkDiscovery, 'from_opts', classmethod(lambda cls, opts=None: discovery))
+    return session
+
+
+def test_quota_codes_by_family():
+    assert AwsCapacityPreflight.quota_code('i3en.6xlarge') == 'L-1216C47A'
+    assert AwsCapacityPreflight.quota_code('g5.12xlarge') == 'L-DB2E81BA'
+    assert AwsCapacityPreflight.quota_code('inf2.xlarge') == 'L-1945791B'
+    assert AwsCapacityPreflight.quota_code('p4d.24xlarge') == 'L-417A185B'
+    assert AwsCapacityPreflight.quota_code('mac2.metal') is None
+
+
+def test_check_reports_zones_and_quotas(session):
+    report = AwsCapacityPreflight(AwsNetworkDiscovery(session=session)).check(
+        'us-east-1', {'i3en.6xlarge': 6, 'g5.12xlarge': 2}, availability_zone='us-east-1a')
+    assert report['offered_zones'] == ['us-east-1b']
+    assert report['quotas'] == {'L-1216C47A': {'needed': 144, 'used': 2, 'limit': 512.0},
+                                'L-DB2E81BA': {'needed': 96, 'used': 48, 'limit': 64.0}}
+    assert report['problems'] == [
+        'g5.12xlarge is not offered in us-east-1a (offered in us-east-1b, us-east-1c)',
+        'g5.12xlarge needs 96 vCPUs but quota L-DB2E81BA allows 64 with 48 in use']
+
+
+def test_offerings_specs_and_quotas_are_cached(session):
+    AwsCapacityPreflight(AwsNetworkDiscovery(session=session)).check('us-east-1', {'i3en.6xlarge': 1})
+    session.calls.clear()
+    AwsCapacityPreflight(AwsNetworkDiscovery(session=session)).check('us-east-1', {'i3en.6xlarge': 1})
+    # Only the current usage is looked up again (m5.large and g5.12xlarge specs were cached by the first run).
+    assert session.calls == ['describe_instances']
+
+
+def weka_opts(*argv):
+    return EnvoiStorageWekaAwsCreateStackCommand.init_parser().parse_args(
+        ['--template-param-key-name', 'key', '--template-param-subnet-id', 'subnet-a',
+         '--template-param-vpc-id', 'vpc-1', '--backend-instance-count', '6', *argv])
+
+
+def test_weka_requirements():
+    opts = weka_opts('--client-instance-type', 'g5.12xlarge', '--client-instance-count', '2')
+    assert EnvoiStorageWekaAwsCreateStackCommand.instance_requirements(opts) == {'i3en.6xlarge': 6,
+                                                                                 'g5.12xlarge': 2}
+
+
+def test_preflight_refuses_or_retargets_the_zone(session):
+    session.quotas['L-DB2E81BA'] = 128.0
+    opts = weka_opts()
+    with pytest.raises(ValueError, match='not offered in us-east-1a'):
+        AwsCapacityPreflight.check_from_opts(opts, {'g5.12xlarge': 1}, subnet_id='subnet-a', vpc_id='vpc-1')
+    assert AwsCapacityPreflight.check_from_opts(opts, {'g5.12xlarge': 1}, subnet_id='subnet-a', vpc_id='vpc-1',
+                                                retarget=True) == 'subnet-b'
+    assert AwsCapacityPreflight.check_from_opts(opts, {'i3en.6xlarge': 6}, subnet_id='subnet-a',
+                                                vpc_id='vpc-1') == 'subnet-a'
+
+
+def test_failed_lookups_skip_the_preflight(session, monkeypatch):
+    monkeypatch.setattr(FakeClient, 'describe_instance_types', lambda self, **kw: (_ for _ in ()).throw(
+        AwsStandInError('UnauthorizedOperation', 'You are not authorized to perform this operation')))
+    assert AwsCapacityPreflight.check_from_opts(weka_opts(), {'i3en.6xlarge': 6}, subnet_id='subnet-a') == 'subnet-a'
@@ -0,0 +1,151 @@
+import concurrent.futures
+import json
+import pstats
+import threading
+import time
+
+import pytest
+
+import envoi_storage
+from envoi_storage import LatencyRecorder, StackSampler, WekaApiClient
+
+
+class FakeEvents:
+    # Stands in for botocore's event emitter: handlers are keyed by event name without the service/operation suffix.
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler):
+        self.handlers[event_name] = handler
+
+
+class FakeModel:
+    name = 'DescribeStacks'
+    service_model = type('ServiceModel', (), {'service_name': 'cloudformation'})
+
+
+class FakeResponse:
+
+    def __init__(self, status, body):
+        self.status = self.status_code = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name):
+        return 'application/json; charset=utf-8'
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, body=None, headers=None):
+        self.requests.append((method, url))
+
+    def getresponse(self):
+        return FakeResponse(200, b'{"objects": [{"id": "4.2.1"}]}')
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = LatencyRecorder(enabled=True)
+    monkeypatch.setattr(envoi_storage, 'API_LATENCY', recorder)
+    return recorder
+
+
+def test_disabled_recorder_keeps_nothing():
+    recorder = LatencyRecorder()
+    with recorder.span('weka.GET release'):
+        pass
+    assert not recorder.spans and not recorder.operations
+
+
+def test_summary_percentiles(tmp_path):
+    recorder = LatencyRecorder(enabled=True)
+    for ms in range(1, 101):
+        recorder.record('ec2.DescribeVpcs', 0, ms / 1000)
+    recorder.record('s3.HeadObject', 0, 0.002, status='error')
+    lines = recorder.summary().splitlines()
+    assert lines[0].split() == ['operation', 'count', 'errors', 'p50', 'ms', 'p95', 'ms', 'max', 'ms']
+    assert lines[1].split() == ['ec2.DescribeVpcs', '100', '0', '50.0', '95.0', '100.0']
+    assert lines[2].split() == ['s3.HeadObject', '1', '1', '2.0', '2.0', '2.0']
+
+    path = tmp_path / 'spans.jsonl'
+    assert recorder.write_jsonl(path) == 101
+    assert json.loads(path.read_text().splitlines()[0])['name'] == 'ec2.DescribeVpcs'
+
+
+def test_recorder_memory_is_bounded():
+    recorder = LatencyRecorder(enabled=True, max_spans=50, max_samples=10)
+    for ms in range(1, 101):
+        recorder.record('ec2.DescribeVpcs', 0, ms / 1000, status='error' if ms == 1 else 'ok')
+    assert len(recorder.spans) == 50 and recorder.spans[0]['duration'] == 0.051
+    # Counts, errors and max cover every call; the percentiles cover the latest ten.
+    assert recorder.summary().splitlines()[1].split() == ['ec2.DescribeVpcs', '100', '1', '95.0', '100.0', '100.0']
+
+
+def test_boto_operations_are_timed_through_events(recorder):
+    client = type('Client', (), {'meta': type('Meta', (), {'events': FakeEvents()})})()
+    recorder.instrument_boto_client(client)
+    handlers = client.meta.events.handlers
+    context = {}
+    handlers['before-call'](model=FakeModel(), params={}, context=context)
+    handlers['after-call'](http_response=FakeResponse(400, b''), parsed={}, model=FakeModel(), context=context)
+    handlers['before-call'](model=FakeModel(), params={}, context=context)
+    handlers['after-call-error'](exception=ConnectionResetError(), context=context)
+    assert [(span['name'], span['status']) for span in recorder.spans] == [
+        ('cloudformation.DescribeStacks', 'error'), ('cloudformation.DescribeStacks', 'error')]
+    assert recorder.spans[0]['http_status'] == 400
+    assert recorder.spans[1]['error'] == 'ConnectionResetError'
+
+
+def test_weka_requests_are_timed(recorder):
+    client = WekaApiClient('token')
+    client.conn = FakeConnection()
+    assert client.get_latest_template_release() == {'id': '4.2.1'}
+    assert [span['name'] for span in recorder.spans] == ['weka.GET release']
+
+
+def test_stack_sampler_collapses_stacks():
+    stop = threading.Event()
+
+    def render_frames():
+        while not stop.is_set():
+            time.sleep(0.001)
+
+    worker = threading.Thread(target=render_frames, name='worker')
+    worker.start()
+    sampler = StackSampler(interval=0.001).start()
+    time.sleep(0.05)
+    sampler.stop()
+    stop.set()
+    worker.join()
+    stacks = [stack for stack in sampler.counts if stack.startswith('worker;')]
+    assert stacks and all('render_frames (test_profiling.py' in stack for stack in stacks)
+
+
+def test_cprofile_mode_profiles_worker_threads(tmp_path):
+    def render_frames():
+        sum(range(10000))
+
+    with envoi_storage.profile_command(str(tmp_path / 'run.prof')):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda _: render_frames(), range(4)))
+    functions = {name for _, _, name in pstats.Stats(str(tmp_path / 'run.prof')).stats}
+    assert 'render_frames' in functions
+
+
+def test_profile_output_and_trace_output(cli, tmp_path):
+    profile, trace = tmp_path / 'run.prof', tmp_path / 'spans.jsonl'
+    status, _ = cli('discovery-cache', 'show', '--profile-output', str(profile), '--trace-output', str(trace))
+    assert status == 0
+    assert pstats.Stats(str(profile)).total_calls > 0
+    assert trace.read_text() == ''
+
+    collapsed = tmp_path / 'run.folded'
+    status, _ = cli('discovery-cache', 'show', '--profile-output', str(collapsed), '--profile-mode', 'sample')
+    assert status == 0 and collapsed.exists()
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from envoi_storage import EnvoiStoragePurgeCommand
+
+
+def make_tree(root, depth=3, width=3, files=4):
+    # Builds a tree of `width` subdirectories per level, each holding `files` small files. Returns the file count.
+    count = 0
+    for i in range(files):
+        (root / f"f{i}.bin").write_bytes(b'x' * (i + 1))
+        count += 1
+    if depth:
+        for i in range(width):
+            child = root / f"d{i}"
+            child.mkdir()
+            count += make_tree(child, depth - 1, width, files)
+    return count
+
+
+def purge(*argv):
+    opts = EnvoiStoragePurgeCommand.init_parser().parse_args([*argv, '--progress-interval', '0', '--workers', '8'])
+    return EnvoiStoragePurgeCommand(opts, auto_exec=False)
+
+
+def test_deletes_the_whole_tree(tmp_path):
+    root = tmp_path / 'scratch'
+    root.mkdir()
+    files = make_tree(root)
+    command = purge(str(root))
+    response = command.run()
+    assert not root.exists()
+    assert command.progress.get('files') == files
+    assert command.progress.get('dirs') == 1 + 3 + 9 + 27
+    assert response.startswith(f"Deleted {files:,} files and 40 directories")
+
+
+def test_keep_root_empties_the_top_directory(tmp_path):
+    root = tmp_path / 'scratch'
+    root.mkdir()
+    make_tree(root, depth=1)
+    command = purge(str(root), '--keep-root')
+    command.run()
+    assert root.is_dir()
+    assert os.listdir(root) == []
+    assert command.progress.get('dirs') == 3
+
+
+def test_flat_directories_are_unlinked_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(EnvoiStoragePurgeCommand, 'unlink_chunk_size', 7)
+    root = tmp_path / 'flat'
+    root.mkdir()
+    for i in range(100):
+        (root / f"frame.{i:04d}.exr").write_bytes(b'')
+    command = purge(str(root))
+    command.run()
+    assert not root.exists()
+    assert command.progress.get('files') == 100
+
+
+def test_dry_run_only_counts(tmp_path):
+    root = tmp_path / 'scratch'
+    root.mkdir()
+    files = make_tree(root, depth=1, files=2)
+    response = purge(str(root), '--dry-run').run()
+    assert response == f"Would delete {files:,} files and 4 directories ({files // 2 * 3:,} bytes)"
+    assert len(list(root.rglob('*'))) == files + 3
+
+
+def test_refuses_root_and_home(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    for path in (os.sep, str(home), '~'):
+        with pytest.raises(ValueError, match='Refusing to purge'):
+            purge(os.path.expanduser(path)).run()
+    assert home.is_dir()
+
+
+def test_refuses_files_and_symlinks(tmp_path):
+    target = tmp_path / 'target'
+    target.mkdir()
+    (target / 'keep').write_bytes(b'')
+    link = tmp_path / 'link'
+    link.symlink_to(target)
+    for path in (target / 'keep', link):
+        with pytest.raises(ValueError, match='is not a directory'):
+            purge(str(path)).run()
+    assert (target / 'keep').exists()
+
+
+def test_cli_exit_status(tmp_path, cli):
+    root = tmp_path / 'scratch'
+    root.mkdir()
+    (root / 'a').write_bytes(b'')
+    assert cli('purge', str(root), '--progress-interval', '0')[0] == 0
+    assert not root.exists()
+    assert cli('purge', str(root), '--progress-interval', '0')[0] == 1
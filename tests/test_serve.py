@@ -0,0 +1,157 @@
+import http.client
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from envoi_storage import EnvoiCommand, EnvoiStorageServeCommand, JobQueue, StorageDeployer
+
+
+class FakeEchoCommand(EnvoiCommand):
+
+    @classmethod
+    def init_parser(cls, **kwargs):
+        parser = super().init_parser(**kwargs)
+        parser.add_argument('words', nargs='+')
+        return parser
+
+    def run(self, opts=None):
+        return ' '.join(self.opts.words)
+
+
+class FakeRmCommand(FakeEchoCommand):
+    pass
+
+
+class FakeJobCommands(EnvoiCommand):
+    subcommands = {'echo': FakeEchoCommand, 'rm': FakeRmCommand}
+
+
+@pytest.fixture
+def jobs(cloudformation):
+    clients = []
+    deployer = StorageDeployer(client_factory=lambda service_name, opts=None: clients.append(service_name) or
+                               cloudformation)
+    jobs = JobQueue(deployer, workers=1, parser=FakeJobCommands.init_parser(), allowed_commands=[FakeEchoCommand])
+    jobs.clients = clients
+    return jobs
+
+
+def wait_for(jobs, job_id):
+    deadline = time.monotonic() + 5
+    while jobs.get(job_id)['finished'] is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return jobs.get(job_id)
+
+
+def test_jobs_run_by_priority_with_shared_clients(jobs, cloudformation):
+    cloudformation.complete_after = 1
+    cloudformation.create_stack(StackName='high')
+    low = jobs.submit('deploy', {'vendor': 'hammerspace', 'config': {'stack_name': 'low'}})
+    high = jobs.submit('status', {'stack_name': 'high'}, priority=10)
+    bad = jobs.submit('deploy', {'vendor': 'hammerspace', 'config': {'nodes': 3}}, priority=5)
+    echo = jobs.submit('command', {'argv': ['echo', 'hello', 'world']})
+    jobs.start()
+    try:
+        results = [wait_for(jobs, job['id']) for job in (low, high, bad, echo)]
+    finally:
+        jobs.stop()
+
+    assert results[0]['result']['stack_id'] == 'stack/low'
+    assert results[1]['result'] == {'StackId': 'stack/high', 'StackStatus': 'CREATE_COMPLETE',
+                                    'Outputs': {'ManagementUrl': 'https://high'}}
+    assert results[2]['status'] == 'failed' and 'Invalid hammerspace configuration' in results[2]['error']
+    assert results[3]['result'] == 'hello world'
+    assert results[1]['started'] <= results[2]['started'] <= results[0]['started']
+    assert jobs.clients == ['cloudformation']
+
+
+def test_submit_rejects_unknown_kinds_and_command_errors(jobs):
+    with pytest.raises(ValueError, match='Unknown job kind'):
+        jobs.submit('benchmark')
+    with pytest.raises(ValueError, match='other than serve'):
+        jobs.run_command({'argv': ['serve']})
+    with pytest.raises(ValueError, match='Invalid command line'):
+        jobs.run_command({'argv': ['nope']})
+    with pytest.raises(ValueError, match="can't run rm everything"):
+        jobs.run_command({'argv': ['rm', 'everything']})
+    # Without an explicit list only the read-only and deploy commands of the tool are allowed.
+    allowed = {cls.__name__ for cls in JobQueue(StorageDeployer()).allowed_commands}
+    assert {'EnvoiStorageStatusCommand', 'EnvoiStorageWekaAwsCreateStackCommand'} <= allowed
+    assert not allowed & {'EnvoiStoragePurgeCommand', 'EnvoiStorageDestroyCommand', 'EnvoiStorageServeCommand'}
+
+
+def request(connection, method, path, body=None, token=None, content_type='application/json'):
+    headers = {'Content-Type': content_type} if body is not None else {}
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+@pytest.mark.parametrize('transport', ['tcp', 'unix'])
+def test_http_api(transport, tmp_path, jobs):
+    argv = ['--port', '0'] if transport == 'tcp' else ['--socket', str(tmp_path / 'envoi.sock')]
+    opts = EnvoiStorageServeCommand.init_parser().parse_args(argv)
+    server = EnvoiStorageServeCommand.create_server(opts, jobs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    jobs.start()
+    try:
+        if transport == 'tcp':
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+            token = server.token
+            assert len(token) >= 32
+            assert request(connection, 'GET', '/health')[0] == 401
+            assert request(connection, 'GET', '/health', token='wrong')[0] == 401
+        else:
+            connection = UnixConnection(opts.socket)
+            token = None
+            assert stat.S_IMODE(os.stat(opts.socket).st_mode) == 0o600
+        submit = {'kind': 'command', 'payload': {'argv': ['echo', 'hi']}}
+        assert request(connection, 'POST', '/jobs', submit, token, content_type='text/plain')[0] == 415
+        status, job = request(connection, 'POST', '/jobs', submit, token)
+        assert status == 202 and job['status'] == 'queued'
+        wait_for(jobs, job['id'])
+        assert request(connection, 'GET', f"/jobs/{job['id']}", token=token)[1]['result'] == 'hi'
+        assert [j['id'] for j in request(connection, 'GET', '/jobs', token=token)[1]] == [job['id']]
+        assert request(connection, 'GET', '/health', token=token) == (200, {'workers': 1, 'queued': 0})
+        assert request(connection, 'POST', '/jobs', {'kind': 'nope'}, token)[0] == 400
+        assert request(connection, 'GET', '/jobs/job-99', token=token)[0] == 404
+        # Oversized bodies are refused from their Content-Length alone.
+        connection.putrequest('POST', '/jobs')
+        connection.putheader('Content-Type', 'application/json')
+        connection.putheader('Content-Length', str(2 * 1024 * 1024))
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 413
+        assert json.loads(response.read()) == {'error': 'Request bodies are limited to 1.0MiB'}
+    finally:
+        server.shutdown()
+        server.server_close()
+        jobs.stop()
+
+
+def test_token_option(jobs):
+    opts = EnvoiStorageServeCommand.init_parser().parse_args(['--port', '0', '--token', 'secret'])
+    server = EnvoiStorageServeCommand.create_server(opts, jobs)
+    try:
+        assert server.token == 'secret'
+    finally:
+        server.server_close()
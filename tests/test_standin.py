@@ -0,0 +1,152 @@
+import http.client
+import json
+import time
+
+import pytest
+
+from envoi_storage import (AwsCloudFormationHelper, AwsRateLimiter, AwsThrottledClient,
+                           EnvoiStorageBenchmarkOrchestrationCommand, StackTeardown, aws_error_code)
+from envoi_storage_standin import AwsStandInError, CloudFormationStandIn, OrchestrationBenchmark, WekaApiStandIn
+
+
+def test_stacks_are_created_idempotently_and_deleted():
+    cloudformation = CloudFormationStandIn(create_seconds=0.05, delete_seconds=0.05, seed=1)
+    stack_id = AwsCloudFormationHelper.create_stack('show01', 'https://templates/a.json', client=cloudformation,
+                                                    tags=AwsCloudFormationHelper.envoi_tags('weka'))['StackId']
+    # The same request again is the original call; another request for the name attaches to the stack.
+    assert AwsCloudFormationHelper.create_stack('show01', 'https://templates/a.json', client=cloudformation,
+                                                tags=AwsCloudFormationHelper.envoi_tags('weka'))['StackId'] == stack_id
+    assert AwsCloudFormationHelper.describe_stack(cloudformation, 'show01')['StackStatus'] == 'CREATE_IN_PROGRESS'
+    stack = AwsCloudFormationHelper.wait_for_stack(cloudformation, 'show01', poll_interval=0.01)
+    assert stack['Outputs'] == [{'OutputKey': 'ManagementUrl', 'OutputValue': 'https://show01.local'}]
+    assert AwsCloudFormationHelper.create_stack('show01', template_body='{}', client=cloudformation) == {
+        'StackId': stack_id, 'StackStatus': 'CREATE_COMPLETE', 'AlreadyExists': True}
+
+    events = AwsCloudFormationHelper.new_stack_events(cloudformation, stack_id)
+    assert [(e['LogicalResourceId'], e['ResourceStatus']) for e in events][:3] == [
+        ('show01', 'CREATE_IN_PROGRESS'), ('Instance0', 'CREATE_IN_PROGRESS'), ('Instance0', 'CREATE_COMPLETE')]
+    assert events[-1]['ResourceStatus'] == 'CREATE_COMPLETE'
+
+    StackTeardown(cloudformation, poll_interval=0.01).destroy([stack])
+    with pytest.raises(AwsStandInError, match='does not exist'):
+        cloudformation.describe_stacks(StackName='show01')
+    assert cloudformation.describe_stacks(StackName=stack_id)['Stacks'][0]['StackStatus'] == 'DELETE_COMPLETE'
+
+
+def test_tag_updates_keep_parameters():
+    cloudformation = CloudFormationStandIn(create_seconds=0)
+    cloudformation.create_stack(StackName='show01', TemplateBody='{}',
+                                Parameters=[{'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-1'}])
+    AwsCloudFormationHelper.update_stack_tags(cloudformation, 'show01', {'envoi:pool': 'weka'})
+    stack = cloudformation.describe_stacks(StackName='show01')['Stacks'][0]
+    assert (stack['StackStatus'], stack['Parameters'], stack['Tags']) == (
+        'UPDATE_COMPLETE', [{'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-1'}],
+        [{'Key': 'envoi:pool', 'Value': 'weka'}])
+
+
+def test_change_sets():
+    cloudformation = CloudFormationStandIn(create_seconds=0)
+    template = json.dumps({'Resources': {'Bucket': {'Type': 'AWS::S3::Bucket'}}})
+    change_set = cloudformation.create_change_set(StackName='show01', ChangeSetName='create', ChangeSetType='CREATE',
+                                                  TemplateBody=template)
+    assert cloudformation.describe_stacks(StackName='show01')['Stacks'][0]['StackStatus'] == 'REVIEW_IN_PROGRESS'
+    described = cloudformation.describe_change_set(ChangeSetName='create', StackName='show01')
+    assert described['ChangeSetId'] == change_set['Id'] and described['Changes'][0]['ResourceChange'] == {
+        'Action': 'Add', 'LogicalResourceId': 'Bucket', 'ResourceType': 'AWS::S3::Bucket'}
+    cloudformation.execute_change_set(ChangeSetName=change_set['Id'])
+    assert cloudformation.describe_stacks(StackName='show01')['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE'
+    with pytest.raises(AwsStandInError, match='cannot be executed'):
+        cloudformation.execute_change_set(ChangeSetName=change_set['Id'])
+
+
+def test_throttling_errors_and_failures_are_injected():
+    cloudformation = CloudFormationStandIn(create_seconds=0, rate_limit=2, seed=1)
+    cloudformation.describe_stacks()
+    cloudformation.describe_stacks()
+    with pytest.raises(AwsStandInError) as error:
+        cloudformation.describe_stacks()
+    assert aws_error_code(error.value) == 'Throttling'
+
+    # The rate limiter slows down and retries throttled and failed calls.
+    cloudformation = CloudFormationStandIn(create_seconds=0, rate_limit=10, error_rate=0.2, seed=1)
+    client = AwsThrottledClient(cloudformation, 'cloudformation', region='local',
+                                limiter=AwsRateLimiter(initial_rate=100, max_rate=1000, backoff_base=0.01))
+    for _ in range(50):
+        client.describe_stacks()
+        if cloudformation.injected['Throttling'] and cloudformation.injected['InternalFailure']:
+            break
+    assert cloudformation.injected['Throttling'] and cloudformation.injected['InternalFailure']
+
+    cloudformation = CloudFormationStandIn(create_seconds=0, failure_rate=1)
+    cloudformation.create_stack(StackName='show01', TemplateBody='{}')
+    with pytest.raises(ValueError, match='ROLLBACK_COMPLETE: The following resource'):
+        AwsCloudFormationHelper.wait_for_stack(cloudformation, 'show01', poll_interval=0)
+
+    cloudformation = CloudFormationStandIn(create_seconds=0, delete_seconds=60)
+    stack_id = cloudformation.create_stack(StackName='show02', TemplateBody='{}')['StackId']
+    cloudformation.delete_stack(StackName='show02')
+    with pytest.raises(ValueError, match='stack/show02/.* is DELETE_IN_PROGRESS'):
+        AwsCloudFormationHelper.wait_for_stack(cloudformation, stack_id, poll_interval=0)
+
+
+class DroppedConnection:
+
+    def request(self, *args, **kwargs):
+        raise http.client.RemoteDisconnected('Remote end closed connection without response')
+
+    def close(self):
+        pass
+
+
+def test_weka_api_stand_in():
+    with WekaApiStandIn(seed=1) as weka:
+        client = weka.client('token', backoff_base=0)
+        template = client.generate_cloudformation_template(backend_instance_type='i3en.2xlarge',
+                                                           backend_instance_count=2)['cfn']
+        assert sorted(template['Resources']) == ['Backend0', 'Backend1', 'ClusterInit']
+        assert template['Resources']['Backend0']['Properties']['InstanceType'] == 'i3en.2xlarge'
+        with pytest.raises(ValueError, match='failed with 404: .*Release 3.0 not found'):
+            client.generate_cloudformation_template(weka_version='3.0')
+        assert weka.calls == {'GET /dist/v1/release': 1, 'POST /dist/v1/aws/cfn/4.2.7': 1,
+                              'POST /dist/v1/aws/cfn/3.0': 1}
+        # A kept-alive connection the server has dropped is replaced and the request sent again.
+        client.conn = DroppedConnection()
+        assert client.get_template_releases()['objects'][0]['id'] == '4.2.7'
+        weka.error_rate = 1
+        with pytest.raises(ValueError, match='failed with 503'):
+            client.get_template_releases()
+        assert weka.injected['503'] == 5
+        # Injected errors are retryable: a request is retried until it gets through.
+        weka.error_rate = 0.3
+        for _ in range(10):
+            client.get_template_releases()
+
+
+@pytest.mark.parametrize('vendor', ['weka', 'hammerspace'])
+def test_orchestration_benchmark(vendor):
+    benchmark = OrchestrationBenchmark(vendor=vendor, workers=4, poll_interval=0.01, create_seconds=0.02,
+                                       failure_rate=0.3, seed=3)
+    started = time.monotonic()
+    result = benchmark.run(10)
+    assert time.monotonic() - started < 5
+    assert result['completed'] + result['failed'] == 10 and 0 < result['failed'] < 10
+    assert result['p50'] <= result['p95'] and result['api_calls'] >= 20
+
+
+def test_benchmark_retries_injected_errors():
+    benchmark = OrchestrationBenchmark(vendor='weka', workers=4, poll_interval=0.01, create_seconds=0.02,
+                                       error_rate=0.2, seed=5)
+    result = benchmark.run(3)
+    assert result['errors'] > 0 and (result['completed'], result['failed']) == (3, 0)
+
+
+def test_benchmark_command():
+    parser = EnvoiStorageBenchmarkOrchestrationCommand.init_parser()
+    opts = parser.parse_args(['--stacks', '1,3', '--create-seconds', '0', '--poll-interval', '0', '--latency', '0',
+                              '--vendor', 'hammerspace'])
+    lines = EnvoiStorageBenchmarkOrchestrationCommand(opts, auto_exec=False).run().splitlines()
+    assert lines[0].split() == ['stacks', 'completed', 'failed', 'seconds', 'stacks/min', 'p50', 'p95', 'calls',
+                                'throttled', 'errors']
+    assert [line.split()[:3] for line in lines[1:]] == [['1', '1', '0'], ['3', '3', '0']]
+    with pytest.raises(ValueError, match='comma-separated numbers'):
+        EnvoiStorageBenchmarkOrchestrationCommand(parser.parse_args(['--stacks', 'ten']), auto_exec=False).run()
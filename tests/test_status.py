@@ -0,0 +1,106 @@
+import datetime
+
+from envoi_storage import AwsCloudFormationHelper, EnvoiStorageStatusCommand, StackStatusCollector
+
+CREATED = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def stack(name, status, tags=(), outputs=()):
+    return {'StackName': name, 'StackId': f"stack/{name}", 'StackStatus': status, 'CreationTime': CREATED,
+            'Tags': [{'Key': key, 'Value': value} for key, value in tags],
+            'Outputs': [{'OutputKey': key, 'OutputValue': value} for key, value in outputs]}
+
+
+class FakeCloudFormation:
+    # Two pages of stacks. The Weka stack completes on its second describe.
+
+    def __init__(self, region):
+        self.region = region
+        self.calls = []
+        self.describes = 0
+
+    def get_paginator(self, operation):
+        self.calls.append(operation)
+        pages = [{'Stacks': [stack('weka-1', 'CREATE_IN_PROGRESS', [('envoi:vendor', 'weka')])]},
+                 {'Stacks': [stack('qumulo-1', 'CREATE_COMPLETE', [('envoi:vendor', 'qumulo')],
+                                   [('ManagementUrl', 'https://10.0.0.1')]),
+                             stack('show01-legacy', 'UPDATE_COMPLETE'),
+                             stack('unrelated', 'CREATE_COMPLETE', [('team', 'web')])]}]
+        return type('Paginator', (), {'paginate': lambda _: pages})()
+
+    def describe_stacks(self, StackName):
+        self.calls.append('describe_stacks')
+        self.describes += 1
+        status = 'CREATE_COMPLETE' if self.describes >= 2 else 'CREATE_IN_PROGRESS'
+        return {'Stacks': [stack('weka-1', status, [('envoi:vendor', 'weka')])]}
+
+
+def collector(**kwargs):
+    clients = {}
+
+    def client_factory(opts):
+        if opts.aws_region == 'ap-east-1':
+            raise ValueError('region not enabled')
+        return clients.setdefault(opts.aws_region, FakeCloudFormation(opts.aws_region))
+
+    result = StackStatusCollector(regions=['us-east-1', 'us-west-2', 'ap-east-1'], client_factory=client_factory,
+                                  **kwargs)
+    result.fake_clients = clients
+    return result
+
+
+def test_collect_filters_by_tag_and_prefix():
+    rows = collector().collect()
+    assert [(r['region'], r['stack_name'], r['vendor']) for r in rows] == [
+        ('us-east-1', 'qumulo-1', 'qumulo'), ('us-east-1', 'weka-1', 'weka'),
+        ('us-west-2', 'qumulo-1', 'qumulo'), ('us-west-2', 'weka-1', 'weka')]
+
+    rows = collector(name_prefixes=['show01-'], tags=StackStatusCollector.parse_tags(['team=web'])).collect()
+    assert [(r['stack_name'], r['vendor']) for r in rows][:2] == [('show01-legacy', '-'), ('unrelated', '-')]
+    assert collector(tags={'envoi:vendor': 'weka'}).collect()[0]['stack_name'] == 'weka-1'
+
+
+def test_refresh_only_describes_stacks_in_progress():
+    status = collector()
+    rows = status.collect()
+    for client in status.fake_clients.values():
+        client.calls.clear()
+    rows = status.refresh(status.refresh(rows))
+    assert [r['status'] for r in rows] == ['CREATE_COMPLETE'] * 4
+    assert status.fake_clients['us-east-1'].calls == ['describe_stacks', 'describe_stacks']
+
+
+def test_format_table():
+    rows = collector().collect()[:2]
+    now = CREATED.timestamp() + 2 * 3600 + 5 * 60
+    assert StackStatusCollector.format_table(rows, now=now).splitlines() == [
+        'profile region    stack    status             age   vendor outputs',
+        'default us-east-1 qumulo-1 CREATE_COMPLETE    2h05m qumulo ManagementUrl=https://10.0.0.1',
+        'default us-east-1 weka-1   CREATE_IN_PROGRESS 2h05m weka',
+    ]
+    assert StackStatusCollector.format_age(42) == '42s'
+    assert StackStatusCollector.format_age(3 * 86400 + 7200) == '3d2h'
+
+
+def test_created_stacks_are_tagged():
+    class FakeCreate:
+        def create_stack(self, **kwargs):
+            self.kwargs = kwargs
+            return {'StackId': 'stack/weka'}
+
+    client = FakeCreate()
+    AwsCloudFormationHelper.create_stack('weka', 'https://templates/a.json', client=client,
+                                         tags=AwsCloudFormationHelper.envoi_tags('weka'))
+    assert client.kwargs['Tags'] == [{'Key': 'envoi:vendor', 'Value': 'weka'},
+                                     {'Key': 'envoi:template',
+                                      'Value': AwsCloudFormationHelper.template_digest('https://templates/a.json')}]
+
+
+def test_status_command(monkeypatch):
+    monkeypatch.setattr(AwsCloudFormationHelper, 'client_from_opts',
+                        classmethod(lambda cls, cfn_client_args=None, opts=None: FakeCloudFormation(opts.aws_region)))
+    opts = EnvoiStorageStatusCommand.init_parser().parse_args(['--regions', 'us-east-1', '--watch', '--interval', '0',
+                                                               '--name-prefix', 'nothing-'])
+    assert EnvoiStorageStatusCommand(opts, auto_exec=False).run() == 'No stacks found'
+    opts = EnvoiStorageStatusCommand.init_parser().parse_args(['--regions', 'us-east-1'])
+    assert 'weka-1' in EnvoiStorageStatusCommand(opts, auto_exec=False).run()
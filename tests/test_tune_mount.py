@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from envoi_storage import EnvoiStorageTuneMountCommand, MountOptionTuner
+
+
+def test_candidates_come_from_the_mount_table(tmp_path):
+    mounts_path = tmp_path / 'mounts'
+    mount_point = tmp_path / 'nfs\\040a'
+    (tmp_path / 'nfs a' / 'shots').mkdir(parents=True)
+    mounts_path.write_text(f"/dev/sda1 / ext4 rw,relatime 0 0\n"
+                           f"10.0.0.5:/export {mount_point} nfs4 rw,nconnect=16,rsize=1048576 0 0\n")
+    mounts = MountOptionTuner.read_mounts(str(mounts_path))
+    candidate = MountOptionTuner.parse_candidate(str(tmp_path / 'nfs a' / 'shots'), mounts)
+    assert (candidate['source'], candidate['fs_type'], candidate['options']) == (
+        '10.0.0.5:/export', 'nfs4', 'rw,nconnect=16,rsize=1048576')
+    assert MountOptionTuner.parse_candidate(f"{tmp_path}=nconnect=4", [])['options'] == 'nconnect=4'
+    with pytest.raises(ValueError, match='is not a directory'):
+        MountOptionTuner.parse_candidate(str(tmp_path / 'missing'))
+
+
+def test_run_ranks_candidates_and_cleans_up(tmp_path, monkeypatch):
+    paths = []
+    for name in ('slow', 'fast'):
+        (tmp_path / name).mkdir()
+        paths.append(str(tmp_path / name))
+    tuner = MountOptionTuner([MountOptionTuner.parse_candidate(f"{path}=nconnect={index}")
+                              for index, path in enumerate(paths)],
+                             file_size=256 * 1024, file_count=2, threads=2, metadata_files=10, rounds=3)
+    measured = tuner.measure(paths[0])
+    assert all(measured[metric] > 0 for metric in MountOptionTuner.metrics)
+    assert list((tmp_path / 'slow').iterdir()) == []
+
+    calls = []
+
+    def fake_measure(path):
+        calls.append(path)
+        speed = 2 if path.endswith('fast') else 1
+        return {'write': 100 * speed, 'read': 200 * speed, 'metadata': 1000 * speed * (10 if len(calls) <= 2 else 1)}
+
+    monkeypatch.setattr(tuner, 'measure', fake_measure)
+    results = tuner.run()
+    # Candidates are measured round-robin, and each metric is the median of the rounds, ignoring the outlier.
+    assert calls == paths * 3
+    assert [(r['path'], r['metadata'], r['score']) for r in results] == [(paths[1], 2000, 1.0),
+                                                                         (paths[0], 1000, 0.5)]
+
+
+def test_fstab_lines_and_weights():
+    result = {'path': '/mnt/t2', 'options': 'vers=3,nconnect=16,read_ahead_kb=16384', 'source': None, 'fs_type': None}
+    assert MountOptionTuner.fstab_lines(result, mount_point='/mnt/storage', source='10.0.0.5:/export') == [
+        '10.0.0.5:/export /mnt/storage nfs vers=3,nconnect=16 0 0',
+        '# after mounting: echo 16384 > /sys/class/bdi/$(mountpoint -d /mnt/storage)/read_ahead_kb']
+    assert MountOptionTuner.fstab_lines({**result, 'options': 'vers=3.1.1', 'source': '/dev/sda1'},
+                                        protocol='smb') == ['//SERVER/SHARE /mnt/t2 cifs vers=3.1.1 0 0']
+    assert MountOptionTuner.fstab_lines({**result, 'source': 'nas:/media', 'fs_type': 'nfs4'})[0] == \
+        'nas:/media /mnt/t2 nfs4 vers=3,nconnect=16 0 0'
+    assert MountOptionTuner.parse_weights('read=1,metadata=0.5') == {'read': 1.0, 'metadata': 0.5}
+    with pytest.raises(ValueError, match="Unknown metric 'latency'"):
+        MountOptionTuner.parse_weights('latency=1')
+
+
+def test_tune_mount_command(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name).mkdir()
+    opts = EnvoiStorageTuneMountCommand.init_parser().parse_args(
+        [f"{tmp_path / 'a'}=nconnect=4", f"{tmp_path / 'b'}=nconnect=16", '--file-size', '128KiB',
+         '--file-count', '2', '--metadata-files', '5', '--rounds', '1', '--source', 'nas:/media', '--json'])
+    output = json.loads(EnvoiStorageTuneMountCommand(opts, auto_exec=False).run())
+    assert sorted(r['options'] for r in output['results']) == ['nconnect=16', 'nconnect=4']
+    best = output['results'][0]
+    assert output['fstab'] == [f"nas:/media {best['path']} nfs {best['options']} 0 0"]
@@ -0,0 +1,94 @@
+import socket
+
+import pytest
+
+from envoi_storage import (EnvoiStorageAwsWaitReadyCommand, EnvoiStorageQumuloAwsWaitReadyCommand, MountMapBuilder,
+                           ServiceReadinessProbe)
+
+
+@pytest.fixture
+def listeners():
+    # Listens on the same port on 127.0.0.1 and 127.0.0.2; nothing listens on 127.0.0.3.
+    first = socket.create_server(('127.0.0.1', 0))
+    port = first.getsockname()[1]
+    second = socket.create_server(('127.0.0.2', port))
+    yield port
+    first.close()
+    second.close()
+
+
+class FakeCloudFormation:
+    # The stack completes on the second describe.
+
+    def __init__(self):
+        self.describes = 0
+
+    def describe_stacks(self, StackName):
+        self.describes += 1
+        status = 'CREATE_COMPLETE' if self.describes > 1 else 'CREATE_IN_PROGRESS'
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': status, 'Outputs': [
+            {'OutputKey': 'ClusterPrivateIPs', 'OutputValue': '10.0.1.10, 10.0.1.11,10.0.1.12'},
+            {'OutputKey': 'FloatingIPs', 'OutputValue': '10.0.1.100'},
+            {'OutputKey': 'ManagementUrl', 'OutputValue': 'https://10.0.1.10:8000'},
+        ]}]}
+
+
+def wait_ready(*argv):
+    opts = EnvoiStorageQumuloAwsWaitReadyCommand.init_parser().parse_args(
+        [*argv, '--probe-interval', '0', '--poll-interval', '0'])
+    return EnvoiStorageQumuloAwsWaitReadyCommand(opts, auto_exec=False), opts
+
+
+def test_probe_returns_once_a_quorum_is_ready(listeners):
+    probe = ServiceReadinessProbe(['127.0.0.3', '127.0.0.1', '127.0.0.2'], [listeners], connect_timeout=0.5)
+    assert probe.wait(interval=0, timeout=5) == ['127.0.0.1', '127.0.0.2']
+    with pytest.raises(ValueError, match='Only 2 of 3 nodes'):
+        probe.wait(quorum=3, interval=0, timeout=0)
+
+
+def test_a_node_needs_every_port(listeners):
+    closed = socket.create_server(('127.0.0.1', 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    probe = ServiceReadinessProbe(['127.0.0.1'], [listeners, closed_port], connect_timeout=0.5)
+    assert probe.probe(['127.0.0.1']) == []
+
+
+def test_node_addresses_from_stack_outputs():
+    stack = FakeCloudFormation().describe_stacks('Qumulo')['Stacks'][0]
+    outputs = {o['OutputKey']: o['OutputValue'] for o in stack['Outputs']}
+    assert EnvoiStorageAwsWaitReadyCommand.node_addresses(outputs) == [
+        '10.0.1.10', '10.0.1.11', '10.0.1.12', '10.0.1.100']
+    assert EnvoiStorageAwsWaitReadyCommand.node_addresses(outputs, ['ClusterPrivateIPs']) == [
+        '10.0.1.10', '10.0.1.11', '10.0.1.12']
+
+
+def test_discover_nodes_waits_for_the_stack():
+    command, opts = wait_ready('--output-keys', 'ClusterPrivateIPs')
+    client = FakeCloudFormation()
+    assert command.discover_nodes(client, opts) == ['10.0.1.10', '10.0.1.11', '10.0.1.12']
+    assert client.describes == 2
+    assert command.ports(opts) == [2049, 8000]
+    assert command.ports(wait_ready('--protocol', 'smb')[1]) == [445, 8000]
+
+
+def test_mount_maps_spread_clients_over_nodes():
+    builder = MountMapBuilder(['10.0.1.10', '10.0.1.11'], mount_point='/mnt/qumulo', options='vers=3,hard')
+    assert builder.build(['c1', 'c2', 'c3']) == {
+        'c1': ('10.0.1.10:/ /mnt/qumulo nfs vers=3,hard 0 0', '/mnt/qumulo -fstype=nfs,vers=3,hard 10.0.1.10:/'),
+        'c2': ('10.0.1.11:/ /mnt/qumulo nfs vers=3,hard 0 0', '/mnt/qumulo -fstype=nfs,vers=3,hard 10.0.1.11:/'),
+        'c3': ('10.0.1.10:/ /mnt/qumulo nfs vers=3,hard 0 0', '/mnt/qumulo -fstype=nfs,vers=3,hard 10.0.1.10:/'),
+    }
+    smb = MountMapBuilder(['fs1'], protocol='smb', export='media', mount_point='/mnt/media', options='vers=3.1.1')
+    assert smb.build(['c1'])['c1'] == ('//fs1/media /mnt/media cifs vers=3.1.1 0 0',
+                                       '/mnt/media -fstype=cifs,vers=3.1.1 ://fs1/media')
+
+
+def test_run_with_explicit_nodes_writes_mount_maps(listeners, tmp_path):
+    command, opts = wait_ready('--nodes', '127.0.0.1,127.0.0.2,127.0.0.3', '--ports', str(listeners),
+                               '--clients', 'ws1,ws2', '--output-dir', str(tmp_path / 'maps'))
+    response = command.run()
+    assert response.startswith('2/3 nodes ready')
+    assert sorted(p.name for p in (tmp_path / 'maps').iterdir()) == ['ws1.autofs', 'ws1.fstab', 'ws2.autofs',
+                                                                     'ws2.fstab']
+    assert (tmp_path / 'maps' / 'ws2.fstab').read_text().startswith('127.0.0.2:/ /mnt/qumulo nfs vers=3,')
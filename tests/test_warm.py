@@ -0,0 +1,73 @@
+import pytest
+
+from envoi_storage import EnvoiStorageWarmCommand
+
+
+@pytest.fixture
+def session(tmp_path):
+    # A review session: two plates, an empty sidecar and a large camera original.
+    (tmp_path / 'plates').mkdir()
+    (tmp_path / 'plates' / 'a.exr').write_bytes(b'a' * 3000)
+    (tmp_path / 'plates' / 'b.exr').write_bytes(b'b' * 5000)
+    (tmp_path / 'plates' / 'notes.txt').write_bytes(b'')
+    (tmp_path / 'camera.mxf').write_bytes(b'c' * 10000)
+    return tmp_path
+
+
+def warm(*argv):
+    opts = EnvoiStorageWarmCommand.init_parser().parse_args(
+        [*argv, '--progress-interval', '0', '--workers', '3', '--block-size', '1KiB', '--segment-size', '4KiB'])
+    command = EnvoiStorageWarmCommand(opts, auto_exec=False)
+    return command, command.run()
+
+
+def test_expand_paths_walks_directories_and_globs_once(session):
+    paths = list(EnvoiStorageWarmCommand.expand_paths(
+        [str(session / 'plates'), str(session / '**' / '*.exr'), str(session / 'camera.mxf')]))
+    assert paths == [str(session / 'plates' / name) for name in ('a.exr', 'b.exr', 'notes.txt')] + [
+        str(session / 'camera.mxf')]
+
+
+def test_plan_segments_splits_large_files():
+    segments = list(EnvoiStorageWarmCommand.plan_segments([__file__], 1000))
+    assert segments[0] == (__file__, 0, 1000)
+    assert sum(length for _, _, length in segments) == len(open(__file__, 'rb').read())
+    assert all(offset % 1000 == 0 for _, offset, _ in segments)
+
+
+def test_plan_segments_keeps_empty_files(session):
+    assert list(EnvoiStorageWarmCommand.plan_segments([str(session / 'plates' / 'notes.txt')], 1000)) == [
+        (str(session / 'plates' / 'notes.txt'), 0, 0)]
+
+
+def test_file_list_patterns(session, tmp_path_factory):
+    file_list = tmp_path_factory.mktemp('lists') / 'session.txt'
+    file_list.write_text(f"# review 12\n{session / 'camera.mxf'}\n\n{session / 'plates' / '*.exr'}\n")
+    opts = EnvoiStorageWarmCommand.init_parser().parse_args(['--file-list', str(file_list)])
+    assert EnvoiStorageWarmCommand.read_patterns(opts) == [str(session / 'camera.mxf'),
+                                                           str(session / 'plates' / '*.exr')]
+
+
+def test_warm_reads_every_byte(session):
+    command, response = warm(str(session))
+    assert command.progress.get('bytes') == 18000
+    assert command.progress.get('files') == 4
+    assert response.startswith('Warmed 4 files (17.6KiB)')
+
+
+def test_warm_needs_paths():
+    with pytest.raises(ValueError, match='No paths given'):
+        warm()
+
+
+def test_warm_raises_worker_errors(session, monkeypatch):
+    warm_segment = EnvoiStorageWarmCommand.warm_segment
+
+    def failing_warm_segment(self, path, offset, length):
+        if path.endswith('camera.mxf') and offset:
+            raise RuntimeError('segment lost')
+        warm_segment(self, path, offset, length)
+
+    monkeypatch.setattr(EnvoiStorageWarmCommand, 'warm_segment', failing_warm_segment)
+    with pytest.raises(RuntimeError, match='segment lost'):
+        warm(str(session))
@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+from envoi_storage import CloudFormationTemplateStager, EnvoiStorageWekaAwsCreateStackCommand
+from envoi_storage_standin import AwsStandInError
+
+
+class FakeS3:
+    # An in-memory bucket that records every call.
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Key))
+        if Key not in self.objects:
+            raise AwsStandInError('404', 'Not Found')
+        return {'ContentLength': len(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.calls.append(('put_object', Key))
+        self.objects[Key] = Body
+
+
+class FakeCloudFormation:
+
+    def __init__(self):
+        self.stacks = []
+
+    def create_stack(self, **kwargs):
+        self.stacks.append(kwargs)
+        return {'StackId': f"arn:aws:cloudformation:us-east-1:123456789012:stack/{kwargs['StackName']}/1"}
+
+
+class FakeWekaApiClient:
+
+    def __init__(self, template):
+        self.template = template
+        self.requests = []
+
+    def generate_cloudformation_template(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'url': 'https://weka.example/template', 'cfn': self.template}
+
+
+LARGE_TEMPLATE = {'Resources': {f"Backend{i}": {'Type': 'AWS::EC2::Instance', 'Properties': {'UserData': 'x' * 512}}
+                                for i in range(200)}}
+
+
+def create_opts(*argv):
+    return EnvoiStorageWekaAwsCreateStackCommand.init_parser().parse_args(
+        ['--template-param-key-name', 'key', '--template-param-subnet-id', 'subnet-1',
+         '--template-param-vpc-id', 'vpc-1', *argv])
+
+
+def test_stage_uploads_once_per_template():
+    s3 = FakeS3()
+    stager = CloudFormationTemplateStager(s3, 'templates', region='us-west-2')
+    url = stager.stage({'b': 1, 'a': 2})
+    key = url.split('.amazonaws.com/')[1]
+    assert url == f"https://templates.s3.us-west-2.amazonaws.com/{key}"
+    assert s3.calls == [('head_object', key), ('put_object', key)]
+    assert json.loads(s3.objects[key]) == {'a': 2, 'b': 1}
+
+    # The same template (in any key order) from another process only costs a HEAD request.
+    restaged = CloudFormationTemplateStager(s3, 'templates', region='us-west-2').stage({'a': 2, 'b': 1})
+    assert restaged == url
+    assert s3.calls[2:] == [('head_object', key)]
+    # Within one process the key is remembered, so there is no request at all.
+    assert stager.stage('{"a":2,"b":1}') == url
+    assert len(s3.calls) == 3
+
+
+def test_stage_raises_errors_other_than_not_found():
+    class DeniedS3(FakeS3):
+        def head_object(self, Bucket, Key):
+            raise AwsStandInError('403', 'Forbidden')
+
+    with pytest.raises(AwsStandInError):
+        CloudFormationTemplateStager(DeniedS3(), 'templates').stage('{}')
+
+
+def test_template_url_for_the_default_region_and_endpoints():
+    assert CloudFormationTemplateStager(None, 'b').template_url('k.json') == 'https://b.s3.amazonaws.com/k.json'
+    assert CloudFormationTemplateStager(None, 'b', endpoint_url='http://localhost:4566/').template_url(
+        'k.json') == 'http://localhost:4566/b/k.json'
+
+
+def test_small_templates_are_passed_inline():
+    opts = create_opts()
+    weka = FakeWekaApiClient({'Resources': {}})
+    command = EnvoiStorageWekaAwsCreateStackCommand(opts, auto_exec=False)
+    template_source = command.template_source(opts, command.generate_template(opts, weka))
+    assert template_source == {'template_body': '{"Resources":{}}'}
+    assert weka.requests[0]['backend_instance_count'] == 6
+
+
+def test_oversized_templates_need_a_bucket():
+    with pytest.raises(ValueError, match='--template-bucket'):
+        EnvoiStorageWekaAwsCreateStackCommand.template_source(create_opts(), LARGE_TEMPLATE)
+
+
+def test_oversized_templates_are_staged_and_created_by_url():
+    opts = create_opts('--template-bucket', 'templates', '--stack-name', 'weka-1')
+    s3 = FakeS3()
+    stager = CloudFormationTemplateStager(s3, 'templates', prefix=opts.template_prefix)
+    command = EnvoiStorageWekaAwsCreateStackCommand(opts, auto_exec=False)
+    cfn = FakeCloudFormation()
+    for _ in range(2):
+        template_source = command.template_source(opts, command.generate_template(opts, FakeWekaApiClient(
+            LARGE_TEMPLATE)), stager=stager)
+        assert command.create_stack(cfn, opts, template_source)['StackId'].startswith('arn:aws:cloudformation')
+
+    assert [name for name, _ in s3.calls] == ['head_object', 'put_object']
+    assert cfn.stacks[0] == cfn.stacks[1]
+    assert cfn.stacks[0]['TemplateURL'].startswith('https://templates.s3.amazonaws.com/cloudformation/templates/')
+    assert 'TemplateBody' not in cfn.stacks[0]
+    assert cfn.stacks[0]['Capabilities'] == ['CAPABILITY_IAM']
+    assert cfn.stacks[0]['Parameters'] == [{'ParameterKey': 'KeyName', 'ParameterValue': 'key'},
+                                           {'ParameterKey': 'SubnetId', 'ParameterValue': 'subnet-1'},
+                                           {'ParameterKey': 'VpcId', 'ParameterValue': 'vpc-1'}]